@@ -0,0 +1,397 @@
+"""
+引用の一括インポート
+
+NDJSON または CSV の本文をストリームのまま1レコードずつ読み、
+検証済みの行を batch_size 件ごとに複数行INSERTでまとめて登録する。
+保持するのは読みかけの1レコードと1バッチ分だけなので、アップロードの大きさによらずメモリ使用量は一定。
+検証やINSERTに失敗した行は行番号付きのエラーとして記録し、ジョブ全体は止めない
+（上流に届かない・タイムアウトなど行によらないエラーではジョブを失敗にする）。
+
+ジョブの進捗・結果は実行中のワーカーのメモリに持つ。CACHE_BACKEND=redis ではキャッシュと同じ Redis にも書き、
+GET /quotes/bulk/{job_id} と Idempotency-Key の判定をどのワーカーでも同じ結果にする
+（同じキーの開始は SET NX で1つのワーカーだけが行う）。memory では単一ワーカーを前提とする。
+"""
+
+import asyncio
+import codecs
+import csv
+import hashlib
+import json
+import logging
+import time
+import uuid
+from collections import OrderedDict
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional, Tuple, Union
+
+from pydantic import ValidationError
+
+from . import config
+from .repository import DataError, QuoteRepository
+
+logger = logging.getLogger(__name__)
+
+# 1レコードの最大サイズ（これを超える行はエラーとして読み飛ばす）
+MAX_RECORD_CHARS = 1024 * 1024
+
+IMPORT_FORMATS = ("ndjson", "csv")
+
+
+class RecordError(Exception):
+    """1レコード分の読み取り・検証エラー"""
+
+
+# 長すぎる行の代わりに返す目印
+_TOO_LONG = object()
+
+
+def content_hash(title: str, text: str) -> str:
+    """quotes.content_hash と同じ (title, text) のハッシュ"""
+    return hashlib.md5(f"{title}\x1f{text}".encode("utf-8")).hexdigest()
+
+
+async def iter_lines(chunks: AsyncIterator[bytes]) -> AsyncIterator[Any]:
+    """受信したチャンクを UTF-8 としてデコードし、1行ずつ返す（改行コードは除く）"""
+    decoder = codecs.getincrementaldecoder("utf-8-sig")()
+    buffer = ""
+    too_long = False
+
+    async for chunk in chunks:
+        buffer += decoder.decode(chunk)
+        *lines, buffer = buffer.split("\n")
+        for line in lines:
+            if too_long:
+                too_long = False
+                yield _TOO_LONG
+            else:
+                yield line.rstrip("\r")
+        # 改行が来ないまま上限を超えたら、次の改行まで捨てる
+        if len(buffer) > MAX_RECORD_CHARS:
+            too_long = True
+            buffer = ""
+
+    buffer += decoder.decode(b"", final=True)
+    if too_long:
+        yield _TOO_LONG
+    elif buffer:
+        yield buffer.rstrip("\r")
+
+
+async def parse_ndjson(chunks: AsyncIterator[bytes]) -> AsyncIterator[Tuple[int, Union[dict, RecordError]]]:
+    """NDJSON（1行1オブジェクト）を (行番号, レコード or エラー) として返す"""
+    line_no = 0
+    async for line in iter_lines(chunks):
+        line_no += 1
+        if line is _TOO_LONG:
+            yield line_no, RecordError("レコードが大きすぎます")
+            continue
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError as e:
+            yield line_no, RecordError(f"JSONの形式が不正です: {e}")
+            continue
+        if not isinstance(record, dict):
+            yield line_no, RecordError("JSONオブジェクトではありません")
+            continue
+        yield line_no, record
+
+
+async def parse_csv(chunks: AsyncIterator[bytes]) -> AsyncIterator[Tuple[int, Union[dict, RecordError]]]:
+    """ヘッダ行付きの CSV を (行番号, レコード or エラー) として返す（空欄は None）"""
+    header: Optional[List[str]] = None
+    pending: List[str] = []
+    pending_chars = 0
+    quotes = 0
+    line_no = 0
+
+    async for line in iter_lines(chunks):
+        line_no += 1
+        if line is _TOO_LONG:
+            pending, pending_chars, quotes = [], 0, 0
+            yield line_no, RecordError("レコードが大きすぎます")
+            continue
+
+        pending.append(line)
+        pending_chars += len(line)
+        quotes += line.count('"')
+        # 引用符が閉じていなければフィールド内の改行なので、次の行とつなげる
+        if quotes % 2:
+            if pending_chars > MAX_RECORD_CHARS:
+                pending, pending_chars, quotes = [], 0, 0
+                yield line_no, RecordError("レコードが大きすぎます")
+            continue
+
+        start_line = line_no - len(pending) + 1
+        text = "\n".join(pending)
+        pending, pending_chars, quotes = [], 0, 0
+        if not text.strip():
+            continue
+
+        try:
+            values = next(csv.reader([text]))
+        except csv.Error as e:
+            yield start_line, RecordError(f"CSVの形式が不正です: {e}")
+            continue
+
+        if header is None:
+            header = [name.strip() for name in values]
+            continue
+        if len(values) != len(header):
+            yield start_line, RecordError(f"列数が一致しません（{len(values)}列、ヘッダは{len(header)}列）")
+            continue
+        yield start_line, {name: (value if value != "" else None) for name, value in zip(header, values)}
+
+    if pending:
+        yield line_no - len(pending) + 1, RecordError("引用符が閉じられていません")
+
+
+class ImportJob:
+    """1回の一括インポートの進捗と結果"""
+
+    def __init__(self, job_id: str, format: str, dedupe: bool, batch_size: int):
+        self.id = job_id
+        self.format = format
+        self.dedupe = dedupe
+        self.batch_size = batch_size
+        self.status = "running"
+        self.received = 0
+        self.inserted = 0
+        self.duplicates = 0
+        self.failed = 0
+        self.batches = 0
+        self.errors: List[dict] = []
+        self.error: Optional[str] = None
+        self.started_at = time.time()
+        self.finished_at: Optional[float] = None
+        # 共有ストアに最後に書いた時刻（time.monotonic）
+        self.published_at = 0.0
+
+    def add_error(self, line: int, message: str):
+        self.failed += 1
+        # 行エラーは先頭から BULK_IMPORT_MAX_ERRORS 件だけ残す（件数は failed で数える）
+        if len(self.errors) < config.BULK_IMPORT_MAX_ERRORS:
+            self.errors.append({"line": line, "error": message})
+
+    def to_dict(self) -> dict:
+        elapsed = (self.finished_at or time.time()) - self.started_at
+        return {
+            "job_id": self.id,
+            "status": self.status,
+            "format": self.format,
+            "dedupe": self.dedupe,
+            "batch_size": self.batch_size,
+            "received": self.received,
+            "inserted": self.inserted,
+            "duplicates": self.duplicates,
+            "failed": self.failed,
+            "batches": self.batches,
+            "elapsed_seconds": round(elapsed, 3),
+            "rows_per_second": round(self.received / elapsed, 1) if elapsed > 0 else 0.0,
+            "errors": self.errors,
+            "error": self.error,
+        }
+
+
+# 実行中のジョブの状態を共有ストアに残す秒数（ワーカーが落ちても同じキーでやり直せるよう、処理中は延長し続ける）
+RUNNING_LEASE = 60.0
+
+
+class RedisJobStore:
+    """ワーカー間で共有するジョブの状態（redis パッケージが必要）"""
+
+    def __init__(self, url: str, ttl: float, prefix: str = "azuma:bulk:"):
+        try:
+            import redis.asyncio as redis_asyncio
+        except ImportError as e:
+            raise RuntimeError("CACHE_BACKEND=redis には redis パッケージが必要です") from e
+
+        self._redis = redis_asyncio.from_url(url)
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def _ttl(self, state: dict) -> int:
+        return int(RUNNING_LEASE if state["status"] == "running" else self.ttl)
+
+    async def claim(self, state: dict) -> bool:
+        """まだどのワーカーも使っていない job_id なら保存して True を返す"""
+        value = json.dumps(state, ensure_ascii=False)
+        return bool(await self._redis.set(self.prefix + state["job_id"], value, ex=self._ttl(state), nx=True))
+
+    async def save(self, state: dict):
+        await self._redis.set(self.prefix + state["job_id"], json.dumps(state, ensure_ascii=False), ex=self._ttl(state))
+
+    async def load(self, job_id: str) -> Optional[dict]:
+        raw = await self._redis.get(self.prefix + job_id)
+        return json.loads(raw) if raw is not None else None
+
+
+class BulkImporter:
+    """ストリームから読んだレコードをバッチでINSERTする"""
+
+    def __init__(self, history: int, store: Optional[RedisJobStore] = None):
+        self.history = history
+        self.store = store
+        # job_id -> ImportJob（古いものから捨てる）
+        self._jobs: "OrderedDict[str, ImportJob]" = OrderedDict()
+
+    def get_job(self, job_id: str) -> Optional[ImportJob]:
+        return self._jobs.get(job_id)
+
+    async def find_job(self, job_id: str) -> Optional[dict]:
+        """ジョブの状態（このワーカーで実行中でなければ、他のワーカーのやり直しも見えるよう共有ストアを優先する）"""
+        job = self._jobs.get(job_id)
+        if job is not None and (job.status == "running" or self.store is None):
+            return job.to_dict()
+        if self.store is not None:
+            state = await self.store.load(job_id)
+            if state is not None:
+                return state
+        return job.to_dict() if job is not None else None
+
+    async def start_job(self, job_id: Optional[str], format: str, dedupe: bool, batch_size: int) -> Optional[ImportJob]:
+        """ジョブを作り、共有ストアに登録する（同じ job_id を他のワーカーが使っていれば None）"""
+        job = self.create_job(job_id, format, dedupe, batch_size)
+        if self.store is None:
+            return job
+        state = job.to_dict()
+        if not await self.store.claim(state):
+            existing = await self.store.load(job.id)
+            # 失敗・中断したジョブは同じキーでやり直せる
+            if existing is not None and existing["status"] not in ("failed", "cancelled"):
+                del self._jobs[job.id]
+                return None
+            await self.store.save(state)
+        job.published_at = time.monotonic()
+        return job
+
+    async def _publish(self, job: ImportJob):
+        """進捗を共有ストアに書く（書けなくてもインポートは続ける）"""
+        if self.store is None:
+            return
+        job.published_at = time.monotonic()
+        try:
+            await self.store.save(job.to_dict())
+        except Exception as e:
+            logger.warning("一括インポート %s の状態を保存できませんでした: %s", job.id, e)
+
+    def create_job(self, job_id: Optional[str], format: str, dedupe: bool, batch_size: int) -> ImportJob:
+        job = ImportJob(job_id or uuid.uuid4().hex, format, dedupe, batch_size)
+        self._jobs[job.id] = job
+        self._jobs.move_to_end(job.id)
+        while len(self._jobs) > self.history:
+            oldest_id, oldest = next(iter(self._jobs.items()))
+            if oldest.status == "running":
+                break
+            del self._jobs[oldest_id]
+        return job
+
+    async def run(
+        self,
+        job: ImportJob,
+        repo: QuoteRepository,
+        records: AsyncIterator[Tuple[int, Union[dict, RecordError]]],
+        to_row: Callable[[dict], dict],
+        on_inserted: Callable[[List[dict]], Awaitable[None]],
+    ) -> ImportJob:
+        """レコードを検証して batch_size 件ごとに登録する
+
+        to_row はレコードを INSERT 用の行に変換し、不正なら例外を投げる。
+        on_inserted は登録された行を受け取り、コーパスやキャッシュへ反映する。
+        """
+        batch: List[Tuple[int, dict]] = []
+        try:
+            async for line, record in records:
+                job.received += 1
+                if self.store is not None and time.monotonic() - job.published_at > RUNNING_LEASE / 3:
+                    await self._publish(job)
+                if isinstance(record, RecordError):
+                    job.add_error(line, str(record))
+                    continue
+                try:
+                    batch.append((line, to_row(record)))
+                except ValidationError as e:
+                    job.add_error(line, "; ".join(
+                        f"{'.'.join(str(part) for part in error['loc'])}: {error['msg']}" for error in e.errors()
+                    ))
+                    continue
+                except Exception as e:
+                    job.add_error(line, str(e))
+                    continue
+
+                if len(batch) >= job.batch_size:
+                    await self._flush(job, repo, batch, on_inserted)
+                    batch = []
+
+            if batch:
+                await self._flush(job, repo, batch, on_inserted)
+            job.status = "completed"
+        except asyncio.CancelledError:
+            job.status = "cancelled"
+            raise
+        except Exception as e:
+            job.status = "failed"
+            job.error = str(e)
+        finally:
+            job.finished_at = time.time()
+            await self._publish(job)
+            logger.info(
+                "一括インポート %s: %s（受信 %d件、登録 %d件、重複 %d件、失敗 %d件）",
+                job.id, job.status, job.received, job.inserted, job.duplicates, job.failed,
+            )
+        return job
+
+    async def _flush(
+        self,
+        job: ImportJob,
+        repo: QuoteRepository,
+        batch: List[Tuple[int, dict]],
+        on_inserted: Callable[[List[dict]], Awaitable[None]],
+    ):
+        job.batches += 1
+        if job.dedupe:
+            batch = await self._drop_duplicates(job, repo, batch)
+            if not batch:
+                return
+
+        try:
+            inserted = await repo.insert_quotes([row for _, row in batch])
+        except DataError:
+            # どの行が原因か分からないため、このバッチだけ1行ずつ登録し直す
+            # （タイムアウト・接続エラーは行によらないので再送せず、ジョブを失敗にする）
+            inserted = []
+            for line, row in batch:
+                try:
+                    inserted.extend(await repo.insert_quotes([row]))
+                except DataError as e:
+                    job.add_error(line, f"登録に失敗しました: {e}")
+
+        job.inserted += len(inserted)
+        if inserted:
+            await on_inserted(inserted)
+        await self._publish(job)
+
+    async def _drop_duplicates(self, job: ImportJob, repo: QuoteRepository, batch: List[Tuple[int, dict]]) -> List[Tuple[int, dict]]:
+        """バッチ内と登録済みの行で (title, text) が同じものを除く"""
+        unique: Dict[str, Tuple[int, dict]] = {}
+        for line, row in batch:
+            key = content_hash(row["title"], row["text"])
+            if key in unique:
+                job.duplicates += 1
+            else:
+                unique[key] = (line, row)
+
+        for existing in await repo.existing_content_hashes(list(unique)):
+            if unique.pop(existing, None) is not None:
+                job.duplicates += 1
+        return list(unique.values())
+
+
+def build_job_store() -> Optional[RedisJobStore]:
+    """CACHE_BACKEND=redis ならジョブの状態もワーカー間で共有する"""
+    if config.CACHE_BACKEND == "redis":
+        return RedisJobStore(config.CACHE_REDIS_URL, config.BULK_IMPORT_JOB_TTL)
+    return None
+
+
+bulk_importer = BulkImporter(config.BULK_IMPORT_JOB_HISTORY, build_job_store())
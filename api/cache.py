@@ -0,0 +1,363 @@
+"""
+読み取りキャッシュ
+
+クエリパラメータを正規化したキーで結果を保持し、書き込み時はタグ単位で無効化する。
+一覧のエントリにはフィルタ条件（theme / author / tag など）をタグとして付け、
+引用の作成・更新・削除では、その引用の新旧の値に対応するタグだけを消す。
+
+バックエンドは既定でプロセス内の LRU + TTL、CACHE_BACKEND=redis でワーカー間共有の Redis を使う。
+"""
+
+import json
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+from . import config
+from .metrics import Counter, Gauge, registry
+from .singleflight import flight
+
+# フィルタなしの一覧に付けるタグ（どの引用の書き込みでも無効化される）
+ALL_QUOTES_TAG = "quotes:all"
+
+
+def make_key(namespace: str, params: Dict[str, Any]) -> str:
+    """パラメータを正規化してキャッシュキーを作る（None は省略、順序は無視）"""
+    normalized = {name: value for name, value in params.items() if value is not None}
+    return f"{namespace}:{json.dumps(normalized, sort_keys=True, ensure_ascii=False, separators=(',', ':'))}"
+
+
+def quote_tag(quote_id: str) -> str:
+    return f"quote:{quote_id}"
+
+
+def list_tags(
+    theme: Optional[str] = None,
+    author: Optional[str] = None,
+    tags: Optional[List[str]] = None,
+    subtheme: Optional[str] = None,
+    match_all_tags: bool = True,
+) -> List[str]:
+    """一覧エントリのタグを決める
+
+    フィルタに合う引用はそのフィルタのどれにも必ず一致するため、
+    最も絞り込みの強いフィルタ1つをタグにすれば書き込み時に確実に無効化される。
+    タグのOR検索ではいずれかのタグに一致すればよいため、全タグを付ける。
+    """
+    if tags and not match_all_tags:
+        return [f"tag:{tag}" for tag in tags]
+    if theme:
+        return [f"theme:{theme}"]
+    if author:
+        return [f"author:{author}"]
+    if tags:
+        return [f"tag:{tags[0]}"]
+    if subtheme:
+        return [f"subtheme:{subtheme}"]
+    return [ALL_QUOTES_TAG]
+
+
+def row_tags(row: Optional[dict]) -> Set[str]:
+    """引用1件の書き込みで無効化すべきタグ"""
+    if not row:
+        return set()
+    tags = {ALL_QUOTES_TAG, quote_tag(row["id"])}
+    if row.get("theme"):
+        tags.add(f"theme:{row['theme']}")
+    if row.get("subtheme"):
+        tags.add(f"subtheme:{row['subtheme']}")
+    if row.get("author"):
+        tags.add(f"author:{row['author']}")
+    for tag in row.get("tags") or []:
+        tags.add(f"tag:{tag}")
+    return tags
+
+
+class _Load:
+    """実行中の取得1件（取得中に同じタグが無効化されたら結果を保存しない）"""
+
+    __slots__ = ("tags", "invalidated")
+
+    def __init__(self, tags: Tuple[str, ...]):
+        self.tags = tags
+        self.invalidated = False
+
+
+class CacheBackend:
+    """キャッシュバックエンドの基底クラス"""
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        # タグ -> そのタグを付けて保存する予定の実行中の取得
+        self._loads: Dict[str, Set[_Load]] = {}
+        # 実行中の取得があるときに無効化された回数（タグごと・全体）。取得の共有のキーに含め、
+        # 無効化の後に来た読み取りが書き込み前の取得に相乗りしないようにする
+        self._generations: Dict[str, int] = {}
+        self._epoch = 0
+
+    async def get(self, key: str) -> Optional[Any]:
+        raise NotImplementedError
+
+    async def set(self, key: str, value: Any, tags: Iterable[str] = (), ttl: Optional[float] = None):
+        raise NotImplementedError
+
+    async def invalidate_tags(self, tags: Iterable[str]):
+        raise NotImplementedError
+
+    async def clear(self):
+        raise NotImplementedError
+
+    def size(self) -> int:
+        return 0
+
+    async def _versions(self, tags: Tuple[str, ...]) -> Any:
+        """タグの版（ワーカー間で共有するバックエンドで、他のワーカーの無効化を検出するために使う）"""
+        return None
+
+    def _begin_load(self, tags: Tuple[str, ...]) -> _Load:
+        load = _Load(tags)
+        for tag in tags:
+            self._loads.setdefault(tag, set()).add(load)
+        return load
+
+    def _end_load(self, load: _Load):
+        for tag in load.tags:
+            loads = self._loads.get(tag)
+            if loads is None:
+                continue
+            loads.discard(load)
+            if not loads:
+                del self._loads[tag]
+
+    def _invalidate_loads(self, tags: Optional[Iterable[str]] = None):
+        """実行中の取得の結果を保存させない（tags が None ならすべて）"""
+        if tags is None:
+            self._epoch += 1
+            tags = list(self._loads)
+        for tag in tags:
+            loads = self._loads.get(tag)
+            if not loads:
+                continue
+            self._generations[tag] = self._generations.get(tag, 0) + 1
+            for load in loads:
+                load.invalidated = True
+
+    def _generation(self, tags: Tuple[str, ...]) -> int:
+        return self._epoch + sum(self._generations.get(tag, 0) for tag in tags)
+
+    async def get_or_load(
+        self,
+        key: str,
+        loader: Callable[[], Awaitable[Any]],
+        tags: Iterable[str] = (),
+        ttl: Optional[float] = None,
+    ) -> Any:
+        """キャッシュになければ loader で取得して保存する（None は保存しない）
+
+        同じキーの取得が実行中なら、その結果を待って共有する。
+        取得中にタグが無効化された場合は、書き込み前の値かもしれないため結果を返すだけで保存せず、
+        無効化の後に来た読み取りはその取得を待たずに新しく取得する
+        """
+        value = await self.get(key)
+        if value is not None:
+            return value
+        tags = tuple(tags)
+
+        async def load_and_store():
+            load = self._begin_load(tags)
+            try:
+                versions = await self._versions(tags)
+                loaded = await loader()
+            finally:
+                self._end_load(load)
+            if loaded is not None and not load.invalidated and await self._versions(tags) == versions:
+                await self.set(key, loaded, tags, ttl)
+            return loaded
+
+        return await flight.do(f"cache:{key}:{self._generation(tags)}", load_and_store)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "backend": type(self).__name__,
+            "size": self.size(),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+        }
+
+
+class MemoryCache(CacheBackend):
+    """プロセス内の LRU + TTL キャッシュ"""
+
+    def __init__(self, max_entries: int, default_ttl: float):
+        super().__init__()
+        self.max_entries = max_entries
+        self.default_ttl = default_ttl
+        # key -> (有効期限, 値, タグ)
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self._tag_keys: Dict[str, Set[str]] = {}
+
+    def size(self) -> int:
+        return len(self._entries)
+
+    async def get(self, key: str) -> Optional[Any]:
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        expires_at, value, _ = entry
+        if expires_at < time.monotonic():
+            self._drop(key)
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    async def set(self, key: str, value: Any, tags: Iterable[str] = (), ttl: Optional[float] = None):
+        if key in self._entries:
+            self._drop(key)
+        tags = tuple(tags)
+        self._entries[key] = (time.monotonic() + (ttl or self.default_ttl), value, tags)
+        for tag in tags:
+            self._tag_keys.setdefault(tag, set()).add(key)
+
+        while len(self._entries) > self.max_entries:
+            oldest = next(iter(self._entries))
+            self._drop(oldest)
+            self.evictions += 1
+
+    async def invalidate_tags(self, tags: Iterable[str]):
+        tags = list(tags)
+        self._invalidate_loads(tags)
+        for tag in tags:
+            for key in self._tag_keys.pop(tag, set()):
+                if key in self._entries:
+                    self._drop(key)
+                    self.invalidations += 1
+
+    async def clear(self):
+        self._invalidate_loads()
+        self._entries.clear()
+        self._tag_keys.clear()
+
+    def _drop(self, key: str):
+        _, _, tags = self._entries.pop(key)
+        for tag in tags:
+            keys = self._tag_keys.get(tag)
+            if keys is None:
+                continue
+            keys.discard(key)
+            if not keys:
+                del self._tag_keys[tag]
+
+
+class RedisCache(CacheBackend):
+    """ワーカー間で共有する Redis キャッシュ（redis パッケージが必要）"""
+
+    def __init__(self, url: str, default_ttl: float, prefix: str = "azuma:cache:"):
+        super().__init__()
+        try:
+            import redis.asyncio as redis_asyncio
+        except ImportError as e:
+            raise RuntimeError("CACHE_BACKEND=redis には redis パッケージが必要です") from e
+
+        self._redis = redis_asyncio.from_url(url)
+        self.default_ttl = default_ttl
+        self.prefix = prefix
+
+    async def get(self, key: str) -> Optional[Any]:
+        raw = await self._redis.get(self.prefix + key)
+        if raw is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return json.loads(raw)
+
+    async def set(self, key: str, value: Any, tags: Iterable[str] = (), ttl: Optional[float] = None):
+        ttl = int(ttl or self.default_ttl)
+        async with self._redis.pipeline(transaction=False) as pipe:
+            pipe.set(self.prefix + key, json.dumps(value, ensure_ascii=False), ex=ttl)
+            for tag in tags:
+                tag_key = f"{self.prefix}tag:{tag}"
+                pipe.sadd(tag_key, key)
+                pipe.expire(tag_key, ttl * 2)
+            await pipe.execute()
+
+    def _version_key(self, tag: str) -> str:
+        return f"{self.prefix}version:{tag}"
+
+    async def _versions(self, tags: Tuple[str, ...]) -> Any:
+        # 他のワーカーでの無効化も検出できるよう、タグごとの版を Redis で数える
+        if not tags:
+            return []
+        return await self._redis.mget([self._version_key(tag) for tag in tags])
+
+    async def invalidate_tags(self, tags: Iterable[str]):
+        tags = list(tags)
+        self._invalidate_loads(tags)
+        for tag in tags:
+            tag_key = f"{self.prefix}tag:{tag}"
+            async with self._redis.pipeline(transaction=False) as pipe:
+                pipe.incr(self._version_key(tag))
+                pipe.expire(self._version_key(tag), max(int(self.default_ttl), 1) * 2)
+                await pipe.execute()
+            keys = await self._redis.smembers(tag_key)
+            if keys:
+                self.invalidations += await self._redis.delete(
+                    *(self.prefix + key.decode("utf-8") for key in keys)
+                )
+            await self._redis.delete(tag_key)
+
+    async def clear(self):
+        self._invalidate_loads()
+        async for key in self._redis.scan_iter(match=self.prefix + "*"):
+            await self._redis.delete(key)
+
+
+def build_cache() -> CacheBackend:
+    """設定に応じたキャッシュバックエンドを作成"""
+    if config.CACHE_BACKEND == "redis":
+        return RedisCache(config.CACHE_REDIS_URL, config.CACHE_TTL)
+    return MemoryCache(config.CACHE_MAX_ENTRIES, config.CACHE_TTL)
+
+
+cache = build_cache()
+
+cache_lookups = registry.register(Counter("cache_lookups_total", "キャッシュの参照数", ("result",)))
+cache_evictions = registry.register(Counter("cache_evictions_total", "容量超過で追い出したエントリ数"))
+cache_invalidations = registry.register(Counter("cache_invalidations_total", "書き込みで無効化したエントリ数"))
+cache_entries = registry.register(Gauge("cache_entries", "キャッシュのエントリ数（プロセス内キャッシュのみ）"))
+cache_hit_ratio = registry.register(Gauge("cache_hit_ratio", "起動からのキャッシュのヒット率"))
+coalesced_requests = registry.register(Counter(
+    "singleflight_shared_total", "実行中の同じ問い合わせの結果を共有した回数"
+))
+
+
+def _collect_metrics():
+    stats = cache.stats()
+    cache_lookups.set_total(stats["hits"], result="hit")
+    cache_lookups.set_total(stats["misses"], result="miss")
+    cache_evictions.set_total(stats["evictions"])
+    cache_invalidations.set_total(stats["invalidations"])
+    cache_entries.set(stats["size"])
+    cache_hit_ratio.set(stats["hit_ratio"])
+    coalesced_requests.set_total(flight.shared)
+
+
+registry.add_collector(_collect_metrics)
+
+
+async def invalidate_rows(*rows: Optional[dict]):
+    """書き込まれた引用の新旧の値に対応するエントリを無効化する"""
+    tags: Set[str] = set()
+    for row in rows:
+        tags |= row_tags(row)
+    if tags:
+        await cache.invalidate_tags(tags)
@@ -0,0 +1,339 @@
+"""
+引用の変更フィード（/changes の Server-Sent Events）
+
+作成・更新・削除のたびに版（単調増加）つきのイベントをワーカー内の購読者へ配る。
+購読者ごとのキューは上限つきで、あふれた（読むのが遅い）購読者は overflow を送って切断する。
+クライアントは最後に受け取った版（Last-Event-ID ヘッダ / since）から再開でき、
+さかのぼれない版からの再開には reset を返す（一覧を取り直してから続きを受け取ってもらう）。
+
+CHANGES_SOURCE=local（既定）では書き込みハンドラが自分のワーカーの購読者に配り、版は時刻（マイクロ秒）から作る。
+複数ワーカーでは書き込みを受けたワーカーの購読者にしか届かないため、CHANGES_SOURCE=postgres にする。
+postgres ではトリガ（changes.sql）が quote_changes に記録して NOTIFY し、各ワーカーは LISTEN で通知を受けて
+テーブルから続きを読んで配る。版はコミット済みの行に quote_changes_since が記録順に付ける連番で全ワーカー共通になり
+（書き込み同士は待ち合わせず、後からコミットされた変更も読み飛ばさない）、直近分より古い版からの再開もテーブルから返す。
+"""
+
+import asyncio
+import json
+import logging
+import time
+from collections import deque
+from datetime import datetime, timezone
+from typing import AsyncIterator, Deque, List, Optional, Set
+
+from . import config
+from .fields import QUOTE_FIELDS
+from .metrics import Counter, Gauge, registry
+from .repository import get_repository
+
+logger = logging.getLogger(__name__)
+
+CHANNEL = "quote_changes"
+# 再接続までの待ち時間としてクライアントに伝えるミリ秒
+RETRY_MILLISECONDS = 3000
+# テーブルから続きを読むときの1回の件数と、再開時にさかのぼって送る上限（超えたら reset）
+CATCH_UP_PAGE_SIZE = 1000
+MAX_BACKLOG = 10000
+# 古い変更を消す間隔（秒）
+PRUNE_INTERVAL = 3600.0
+# LISTEN の接続に失敗したときにやり直すまでの秒数（倍々に延ばす）
+RECONNECT_INITIAL = 1.0
+RECONNECT_MAX = 30.0
+
+
+def _event(version: int, op: str, quote: dict, changed_at: str) -> dict:
+    return {
+        "version": version,
+        "op": op,
+        "id": quote["id"],
+        "quote": {field: quote.get(field) for field in QUOTE_FIELDS},
+        "changed_at": changed_at,
+    }
+
+
+def format_event(event_type: str, version: int, data: dict) -> str:
+    """SSE の1イベント（id に版を入れ、再接続時に Last-Event-ID として返ってくるようにする）"""
+    return f"id: {version}\nevent: {event_type}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+class Subscription:
+    """購読者1人分の上限つきキュー（None は配信の終わり）"""
+
+    def __init__(self, maxsize: int):
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize)
+        self.overflowed = False
+
+
+class ChangeFeed:
+    """直近のイベントと購読者の一覧"""
+
+    def __init__(self, buffer_size: int, queue_size: int):
+        self.buffer_size = buffer_size
+        self.queue_size = queue_size
+        self.events: Deque[dict] = deque()
+        self.version = 0
+        # これより後の版はすべて events にある（起動前・追い出した分は持っていない）
+        self.floor = time.time_ns() // 1000
+        self.published = 0
+        self.overflows = 0
+        self._subscriptions: Set[Subscription] = set()
+
+    @property
+    def subscribers(self) -> int:
+        return len(self._subscriptions)
+
+    @property
+    def position(self) -> int:
+        """ここまで配信した版（まだイベントがなくても、この版からの再開は reset にならない）"""
+        return max(self.version, self.floor)
+
+    def next_version(self) -> int:
+        """ワーカー内で配信するときの版（時刻ベースなので再起動しても小さくならない）"""
+        return max(self.version + 1, time.time_ns() // 1000)
+
+    def reset_floor(self, version: int):
+        """ここより前の版は持っていないものとする"""
+        self.version = max(self.version, version)
+        self.floor = version
+
+    def publish(self, event: dict):
+        self.version = max(self.version, event["version"])
+        self.events.append(event)
+        while len(self.events) > self.buffer_size:
+            self.floor = self.events.popleft()["version"]
+        self.published += 1
+        for subscription in list(self._subscriptions):
+            try:
+                subscription.queue.put_nowait(event)
+            except asyncio.QueueFull:
+                self._drop(subscription, overflowed=True)
+
+    def _drop(self, subscription: Subscription, overflowed: bool):
+        self._subscriptions.discard(subscription)
+        subscription.overflowed = overflowed
+        if overflowed:
+            self.overflows += 1
+        # 溜まった分は捨てて終わりの印だけ入れる（クライアントは最後に受け取った版から再開する）
+        while not subscription.queue.empty():
+            subscription.queue.get_nowait()
+        subscription.queue.put_nowait(None)
+
+    def subscribe(self) -> Subscription:
+        subscription = Subscription(self.queue_size)
+        self._subscriptions.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        self._subscriptions.discard(subscription)
+
+    def close(self):
+        """すべての購読を終わらせる（終了時用）"""
+        for subscription in list(self._subscriptions):
+            self._drop(subscription, overflowed=False)
+
+    def recent(self, version: int) -> Optional[List[dict]]:
+        """version より後のイベント（手元にない版が含まれるなら None）"""
+        if version < self.floor:
+            return None
+        return [event for event in self.events if event["version"] > version]
+
+
+change_feed = ChangeFeed(config.CHANGES_BUFFER_SIZE, config.CHANGES_QUEUE_SIZE)
+
+
+def record(op: str, row: dict):
+    """書き込みハンドラから呼ぶ（postgres ではトリガの記録を通知で受け取るため何もしない）"""
+    if config.CHANGES_SOURCE != "local":
+        return
+    changed_at = datetime.now(timezone.utc).isoformat()
+    change_feed.publish(_event(change_feed.next_version(), op, row, changed_at))
+
+
+async def _changes_since(version: int, limit: int) -> dict:
+    # 未採番の行に版を付けて書き込むため、読み取りの集約を通さず書き込みとして呼ぶ
+    # （付与は冪等で、同時に呼ばれても同じ行には同じ版が付く）
+    repo = await get_repository()
+    return await repo.rpc("quote_changes_since", {"p_version": version, "p_limit": limit})
+
+
+async def backlog(version: int) -> Optional[List[dict]]:
+    """再開に必要な version より後のイベント（さかのぼれなければ None）"""
+    events = change_feed.recent(version)
+    if events is not None or config.CHANGES_SOURCE != "postgres":
+        return events
+
+    # 手元にない分はテーブルから読む
+    events = []
+    while len(events) < MAX_BACKLOG:
+        data = await _changes_since(version, CATCH_UP_PAGE_SIZE)
+        if data["pruned_version"] > version:
+            return None
+        changes = data["changes"]
+        events.extend(_event(c["version"], c["op"], c["quote"], c["changed_at"]) for c in changes)
+        if len(changes) < CATCH_UP_PAGE_SIZE:
+            return events
+        version = changes[-1]["version"]
+    return None
+
+
+async def stream(since: Optional[int]) -> AsyncIterator[str]:
+    """SSE の本文（since が None なら接続後の変更だけを送る）"""
+    # 先に購読してから過去分を送り、その間に届いた分は版で重複を除く
+    subscription = change_feed.subscribe()
+    try:
+        yield f"retry: {RETRY_MILLISECONDS}\n\n"
+        last = change_feed.position
+        if since is not None:
+            events = await backlog(since)
+            if events is None:
+                yield format_event("reset", last, {"version": last})
+            else:
+                last = since
+                for event in events:
+                    yield format_event(event["op"], event["version"], event)
+                    last = event["version"]
+
+        while True:
+            try:
+                event = await asyncio.wait_for(subscription.queue.get(), config.CHANGES_HEARTBEAT_INTERVAL)
+            except asyncio.TimeoutError:
+                # プロキシに切られないよう、また切断に気づけるよう定期的にコメントを送る
+                yield ": ping\n\n"
+                continue
+            if event is None:
+                if subscription.overflowed:
+                    yield format_event("overflow", last, {"version": last})
+                return
+            if event["version"] <= last:
+                continue
+            yield format_event(event["op"], event["version"], event)
+            last = event["version"]
+    finally:
+        change_feed.unsubscribe(subscription)
+
+
+class PostgresChangeSource:
+    """LISTEN quote_changes で通知を受け、quote_changes から続きを読んで配る"""
+
+    def __init__(self, feed: ChangeFeed, dsn: str):
+        self.feed = feed
+        self.dsn = dsn
+        self._notified = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._pruned_at = 0.0
+        self._started = False
+
+    async def _catch_up(self):
+        while True:
+            data = await _changes_since(self.feed.version, CATCH_UP_PAGE_SIZE)
+            for change in data["changes"]:
+                self.feed.publish(_event(change["version"], change["op"], change["quote"], change["changed_at"]))
+            if len(data["changes"]) < CATCH_UP_PAGE_SIZE:
+                return
+
+    async def _prune(self):
+        if time.monotonic() - self._pruned_at < PRUNE_INTERVAL:
+            return
+        self._pruned_at = time.monotonic()
+        repo = await get_repository()
+        pruned = await repo.rpc("quote_changes_prune", {"p_keep_seconds": config.CHANGES_RETENTION})
+        if pruned:
+            logger.info("古い変更履歴を %s件削除しました", pruned)
+
+    async def _run(self):
+        import asyncpg
+
+        delay = RECONNECT_INITIAL
+        while True:
+            connection = None
+            try:
+                if not self._started:
+                    # 起動前の変更は送らない（それより前からの再開はテーブルから読む）
+                    data = await _changes_since(0, 0)
+                    self.feed.reset_floor(data["latest_version"])
+                    self._started = True
+                connection = await asyncpg.connect(self.dsn)
+                await connection.add_listener(CHANNEL, lambda *args: self._notified.set())
+                connection.add_termination_listener(lambda *args: self._notified.set())
+                delay = RECONNECT_INITIAL
+                # つながっていない間の変更を読む
+                await self._catch_up()
+                while not connection.is_closed():
+                    try:
+                        # 通知を取りこぼしても CHANGES_POLL_INTERVAL ごとに続きを読む
+                        await asyncio.wait_for(self._notified.wait(), config.CHANGES_POLL_INTERVAL)
+                    except asyncio.TimeoutError:
+                        pass
+                    self._notified.clear()
+                    await self._catch_up()
+                    await self._prune()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning("変更の通知を受け取れません（%.0f秒後に再接続）: %s", delay, e)
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, RECONNECT_MAX)
+            finally:
+                if connection is not None and not connection.is_closed():
+                    await connection.close()
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        except Exception:
+            logger.exception("変更の通知の受信を停止できませんでした")
+        self._task = None
+
+
+_source: Optional[PostgresChangeSource] = None
+
+
+def start_change_source():
+    """CHANGES_SOURCE=postgres なら LISTEN を始める"""
+    global _source
+
+    if config.CHANGES_SOURCE != "postgres" or _source is not None:
+        return
+    try:
+        import asyncpg  # noqa: F401
+    except ImportError as e:
+        raise RuntimeError("CHANGES_SOURCE=postgres には asyncpg パッケージが必要です") from e
+    if not config.DATABASE_URL:
+        raise RuntimeError("CHANGES_SOURCE=postgres には DATABASE_URL の設定が必要です")
+    _source = PostgresChangeSource(change_feed, config.DATABASE_URL)
+    _source.start()
+
+
+async def stop_change_source():
+    """購読を終わらせ、LISTEN を止める"""
+    global _source
+
+    change_feed.close()
+    if _source is not None:
+        await _source.stop()
+        _source = None
+
+
+change_subscribers = registry.register(Gauge("change_feed_subscribers", "変更フィードの購読者数"))
+change_events = registry.register(Counter("change_feed_events_total", "配信した変更イベント数"))
+change_overflows = registry.register(Counter(
+    "change_feed_overflows_total", "キューがあふれて切断した購読者数"
+))
+
+
+def _collect_metrics():
+    change_subscribers.set(change_feed.subscribers)
+    change_events.set_total(change_feed.published)
+    change_overflows.set_total(change_feed.overflows)
+
+
+registry.add_collector(_collect_metrics)
@@ -0,0 +1,123 @@
+"""
+レスポンス圧縮
+
+リクエストの Accept-Encoding（q 値を含む）から brotli / gzip を選び、レスポンスを圧縮する。
+brotli は brotli パッケージがある場合だけ使い、同じ q 値なら brotli を優先する。
+小さいレスポンス、すでに圧縮済みのもの（Content-Encoding 付き・gzip ファイル）、
+SSE（text/event-stream）は圧縮しない。ストリーミングレスポンスはチャンクごとに圧縮して送る。
+"""
+
+from typing import Dict, Optional, Tuple
+
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.middleware.gzip import GZipResponder, IdentityResponder
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+try:
+    import brotli
+except ImportError:  # brotli は任意
+    brotli = None
+
+# 圧縮しない Content-Type
+EXCLUDED_CONTENT_TYPES = ("text/event-stream", "application/gzip")
+
+# 使えるエンコーディング（q 値が同じなら先頭を優先）
+AVAILABLE_ENCODINGS = ("br", "gzip") if brotli is not None else ("gzip",)
+
+
+def parse_accept_encoding(value: str) -> Dict[str, float]:
+    """Accept-Encoding をエンコーディング名 -> q 値にする"""
+    preferences: Dict[str, float] = {}
+    for part in value.split(","):
+        name, _, params = part.partition(";")
+        name = name.strip().lower()
+        if not name:
+            continue
+        quality = 1.0
+        for param in params.split(";"):
+            key, _, raw = param.strip().partition("=")
+            if key.strip().lower() == "q":
+                try:
+                    quality = float(raw)
+                except ValueError:
+                    quality = 0.0
+        preferences[name] = quality
+    return preferences
+
+
+def choose_encoding(accept_encoding: str, available: Tuple[str, ...] = AVAILABLE_ENCODINGS) -> Optional[str]:
+    """使えるエンコーディングのうち q 値が最大のもの（同じなら available の順）"""
+    preferences = parse_accept_encoding(accept_encoding)
+    best, best_quality = None, 0.0
+    for encoding in available:
+        quality = preferences.get(encoding, preferences.get("*", 0.0))
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+    return best
+
+
+def _merge_vary(send: Send) -> Send:
+    """Vary の重複をまとめて送る（ETag を付けたハンドラと圧縮の両方が Accept-Encoding を加えるため）"""
+
+    async def wrapped(message: Message) -> None:
+        if message["type"] == "http.response.start":
+            headers = MutableHeaders(scope=message)
+            vary = headers.get("vary")
+            if vary:
+                headers["vary"] = ", ".join(dict.fromkeys(value.strip() for value in vary.split(",")))
+        await send(message)
+
+    return wrapped
+
+
+class _ExcludingMixin:
+    """圧縮しない Content-Type をそのまま送る"""
+
+    async def send_with_compression(self, message: Message) -> None:
+        await super().send_with_compression(message)
+        if message["type"] == "http.response.start":
+            content_type = Headers(raw=message["headers"]).get("content-type", "")
+            if content_type.startswith(EXCLUDED_CONTENT_TYPES):
+                self.content_type_is_excluded = True
+
+
+class _GZipResponder(_ExcludingMixin, GZipResponder):
+    pass
+
+
+class _BrotliResponder(_ExcludingMixin, IdentityResponder):
+    content_encoding = "br"
+
+    def __init__(self, app: ASGIApp, minimum_size: int, quality: int):
+        super().__init__(app, minimum_size)
+        self.compressor = brotli.Compressor(quality=quality)
+
+    def apply_compression(self, body: bytes, *, more_body: bool) -> bytes:
+        # ストリーミング中はチャンクごとに flush して、受信側がすぐに展開できるようにする
+        compressed = self.compressor.process(body)
+        return compressed + (self.compressor.flush() if more_body else self.compressor.finish())
+
+
+class CompressionMiddleware:
+    """Accept-Encoding に応じて brotli / gzip で圧縮する"""
+
+    def __init__(self, app: ASGIApp, minimum_size: int = 1000, gzip_level: int = 6, brotli_quality: int = 4):
+        self.app = app
+        self.minimum_size = minimum_size
+        self.gzip_level = gzip_level
+        self.brotli_quality = brotli_quality
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        encoding = choose_encoding(Headers(scope=scope).get("accept-encoding", ""))
+        if encoding == "br":
+            responder = _BrotliResponder(self.app, self.minimum_size, self.brotli_quality)
+        elif encoding == "gzip":
+            responder = _GZipResponder(self.app, self.minimum_size, compresslevel=self.gzip_level)
+        else:
+            await self.app(scope, receive, send)
+            return
+        await responder(scope, receive, _merge_vary(send))
@@ -0,0 +1,179 @@
+"""
+条件付き GET（ETag / Last-Modified → 304 Not Modified）
+
+インメモリコーパスの内容から作る版（DataVersion）から ETag を作り、
+クライアントの If-None-Match と一致すれば上流に問い合わせずに 304 を返す。
+版は行ごとの内容のハッシュから作るため、同じデータを読み込んだワーカーどうしや再起動の前後でも同じ値になる。
+版はワーカーごとのコーパスから作るので、他のワーカーでの書き込みはコーパスに取り込むまで反映されない。
+そのため一覧・詳細の ETag は、書き込みがすぐに全ワーカーのコーパスに届く構成
+（SNAPSHOT_DIR の変更ログで SNAPSHOT_POLL_INTERVAL ごとに取り込む、または SINGLE_WORKER=true）でだけ付ける
+（定期の全件再読み込みだけでは古い版のまま 304 を返し続けるおそれがある）。
+ETag には Accept-Encoding から選ばれる圧縮方式も含め、圧縮方式の異なる表現とは一致させない。
+コーパスを使わない（CORPUS_ENABLED=false、読み込み前）ときも版がないため、一覧・詳細には ETag を付けない。
+"""
+
+import hashlib
+import json
+import threading
+from datetime import datetime, timezone
+from email.utils import format_datetime, parsedate_to_datetime
+from typing import Any, Dict, List, Optional
+
+from fastapi import Request, Response
+
+from . import config
+from .compression import choose_encoding
+from .corpus import CorpusListener
+
+
+def _row_hash(row: dict) -> int:
+    body = json.dumps(row, sort_keys=True, ensure_ascii=False, default=str)
+    return int.from_bytes(hashlib.sha1(body.encode("utf-8")).digest()[:16], "big")
+
+
+class DataVersion(CorpusListener):
+    """コーパスの内容から作る版
+
+    行ごとの内容のハッシュの XOR を持ち、追加・更新・削除と集計列の変化では差分だけを更新する。
+    全件の再構築はワーカースレッドから呼ばれるため、行ごとのハッシュと版はロックの中でまとめて差し替える
+    """
+
+    def __init__(self):
+        self.ready = False
+        self.changed_at = datetime.now(timezone.utc)
+        self._hashes: Dict[str, int] = {}
+        self._digest = 0
+        self._lock = threading.Lock()
+
+    @property
+    def version(self) -> Optional[str]:
+        """版（コーパスを読み込む前は None）"""
+        return f"{self._digest:032x}" if self.ready else None
+
+    def _set_digest(self, digest: int):
+        if digest != self._digest or not self.ready:
+            self.changed_at = datetime.now(timezone.utc)
+        self._digest = digest
+
+    def rebuild(self, rows: List[dict]):
+        hashes = {row["id"]: _row_hash(row) for row in rows}
+        digest = 0
+        for value in hashes.values():
+            digest ^= value
+        with self._lock:
+            self._hashes = hashes
+            self._set_digest(digest)
+            self.ready = True
+
+    def upsert(self, row: dict, old: Optional[dict]):
+        value = _row_hash(row)
+        with self._lock:
+            digest = self._digest ^ self._hashes.pop(row["id"], 0) ^ value
+            self._hashes[row["id"]] = value
+            self._set_digest(digest)
+
+    def remove(self, row: dict):
+        with self._lock:
+            self._set_digest(self._digest ^ self._hashes.pop(row["id"], 0))
+
+    def update_counts(self, row: dict):
+        self.upsert(row, None)
+
+
+data_version = DataVersion()
+
+
+def _make_etag(*parts: Any) -> str:
+    digest = hashlib.sha1("\x1f".join(str(part) for part in parts).encode("utf-8")).hexdigest()
+    return f'"{digest[:24]}"'
+
+
+def _encoding(request: Request) -> Optional[str]:
+    return choose_encoding(request.headers.get("accept-encoding", ""))
+
+
+def version_etags_enabled() -> bool:
+    """他のワーカーの書き込みがすぐにこのワーカーの版に反映される構成か"""
+    return bool(config.SNAPSHOT_DIR) or config.SINGLE_WORKER
+
+
+def version_etag(request: Request) -> Optional[str]:
+    """データの版から ETag を作る（上流への問い合わせは不要。版がない・使えない構成なら None）"""
+    version = data_version.version
+    if version is None or not version_etags_enabled():
+        return None
+    return _make_etag(version, _encoding(request), request.url.path, request.url.query)
+
+
+def content_etag(request: Request, value: Any) -> str:
+    """値の内容から ETag を作る（同じ内容ならワーカーや再起動をまたいでも一致する）"""
+    body = json.dumps(value, sort_keys=True, ensure_ascii=False, default=str)
+    return _make_etag(_encoding(request), hashlib.sha1(body.encode("utf-8")).hexdigest())
+
+
+def cache_control(max_age: int) -> str:
+    """max_age が 0 なら毎回 ETag で再検証させる"""
+    if max_age <= 0:
+        return "no-cache"
+    return f"public, max-age={max_age}"
+
+
+def _etag_matches(if_none_match: str, etag: str) -> bool:
+    # If-None-Match は弱い比較（W/ を無視）で判定する
+    if if_none_match.strip() == "*":
+        return True
+    return any(candidate.strip().removeprefix("W/") == etag for candidate in if_none_match.split(","))
+
+
+def _not_modified_since(if_modified_since: Optional[str], modified: datetime) -> bool:
+    if not if_modified_since:
+        return False
+    try:
+        since = parsedate_to_datetime(if_modified_since)
+    except (TypeError, ValueError):
+        return False
+    if since.tzinfo is None:
+        since = since.replace(tzinfo=timezone.utc)
+    return modified.replace(microsecond=0) <= since
+
+
+def not_modified(
+    request: Request,
+    http_response: Response,
+    etag: str,
+    modified: datetime,
+    max_age: int,
+) -> Optional[Response]:
+    """検証用のヘッダを http_response に設定し、クライアントの持つ表現が最新なら 304 レスポンスを返す
+
+    If-None-Match があればそれだけで判定し、なければ If-Modified-Since で判定する
+    """
+    # 圧縮方式ごとに ETag が異なるため、200 にも 304 にも Vary を付ける
+    headers = {
+        "ETag": etag,
+        "Last-Modified": format_datetime(modified.replace(microsecond=0), usegmt=True),
+        "Cache-Control": cache_control(max_age),
+        "Vary": "Accept-Encoding",
+    }
+    http_response.headers.update(headers)
+
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        fresh = _etag_matches(if_none_match, etag)
+    else:
+        fresh = _not_modified_since(request.headers.get("if-modified-since"), modified)
+    if not fresh:
+        return None
+    return Response(status_code=304, headers=headers)
+
+
+def version_not_modified(request: Request, http_response: Response, max_age: int) -> Optional[Response]:
+    """データの版による条件付き GET（304 なら上流への問い合わせは不要）
+
+    版がない（コーパスを使わない・読み込み前・版を共有できない構成）ときは検証用のヘッダを付けず、Cache-Control だけを設定する
+    """
+    etag = version_etag(request)
+    if etag is None:
+        http_response.headers["Cache-Control"] = cache_control(max_age)
+        return None
+    return not_modified(request, http_response, etag, data_version.changed_at, max_age)
@@ -0,0 +1,134 @@
+"""
+Azuma Insight Quotes API 設定
+
+環境変数（.env）から設定値を読み込む
+"""
+
+import os
+from dotenv import load_dotenv
+
+# 環境変数を読み込み
+load_dotenv()
+
+
+def _env_bool(name: str, default: bool) -> bool:
+    value = os.getenv(name)
+    if value is None:
+        return default
+    return value.strip().lower() in ("1", "true", "yes", "on")
+
+
+def _env_int(name: str, default: int) -> int:
+    value = os.getenv(name)
+    return int(value) if value else default
+
+
+def _env_float(name: str, default: float) -> float:
+    value = os.getenv(name)
+    return float(value) if value else default
+
+
+# Supabase接続情報
+SUPABASE_URL = os.getenv("SUPABASE_URL")
+SUPABASE_KEY = os.getenv("SUPABASE_KEY")  # .envファイルの変数名に合わせる
+
+# Supabase(PostgREST)へのHTTP接続プール設定
+SUPABASE_HTTP2 = _env_bool("SUPABASE_HTTP2", True)
+SUPABASE_MAX_CONNECTIONS = _env_int("SUPABASE_MAX_CONNECTIONS", 100)
+SUPABASE_MAX_KEEPALIVE_CONNECTIONS = _env_int("SUPABASE_MAX_KEEPALIVE_CONNECTIONS", 20)
+SUPABASE_KEEPALIVE_EXPIRY = _env_float("SUPABASE_KEEPALIVE_EXPIRY", 30.0)
+SUPABASE_TIMEOUT = _env_float("SUPABASE_TIMEOUT", 10.0)
+
+# 同時に実行する上流クエリ数の上限（ワーカーあたり）
+SUPABASE_MAX_CONCURRENCY = _env_int("SUPABASE_MAX_CONCURRENCY", 50)
+
+# 統計カウンタの再集計間隔（秒、0で無効）
+STATS_RECONCILE_INTERVAL = _env_float("STATS_RECONCILE_INTERVAL", 3600.0)
+
+# インメモリコーパス（検索インデックスなど）の設定
+CORPUS_ENABLED = _env_bool("CORPUS_ENABLED", True)
+# 他ワーカーでの書き込みを取り込むための全件再読み込み間隔（秒、0で起動時のみ）
+CORPUS_REFRESH_INTERVAL = _env_float("CORPUS_REFRESH_INTERVAL", 600.0)
+# 複数ワーカーで共有するスナップショットの置き場所（/dev/shm 配下など。未指定ならワーカーごとに構築）、
+# 公開・取り込みの確認間隔（秒）、書き込み後に公開し直す最短間隔（秒）
+SNAPSHOT_DIR = os.getenv("SNAPSHOT_DIR")
+SNAPSHOT_POLL_INTERVAL = _env_float("SNAPSHOT_POLL_INTERVAL", 0.5)
+SNAPSHOT_PUBLISH_INTERVAL = _env_float("SNAPSHOT_PUBLISH_INTERVAL", 1.0)
+
+# 読み取りキャッシュの設定（memory: プロセス内 / redis: ワーカー間で共有）
+CACHE_BACKEND = os.getenv("CACHE_BACKEND", "memory").lower()
+CACHE_MAX_ENTRIES = _env_int("CACHE_MAX_ENTRIES", 10000)
+CACHE_TTL = _env_float("CACHE_TTL", 60.0)
+CACHE_REDIS_URL = os.getenv("CACHE_REDIS_URL", "redis://localhost:6379/0")
+
+# /stats の結果を新鮮とみなす秒数と、その後に古い値を返しながら裏で再取得する秒数、保持する条件の数
+STATS_TTL = _env_float("STATS_TTL", 5.0)
+STATS_STALE_TTL = _env_float("STATS_STALE_TTL", 300.0)
+STATS_MAX_ENTRIES = _env_int("STATS_MAX_ENTRIES", 1000)
+
+# 一括インポートの設定（1回のINSERTにまとめる件数、ジョブに残す行エラー数、保持するジョブ数）
+BULK_IMPORT_BATCH_SIZE = _env_int("BULK_IMPORT_BATCH_SIZE", 500)
+BULK_IMPORT_MAX_ERRORS = _env_int("BULK_IMPORT_MAX_ERRORS", 1000)
+BULK_IMPORT_JOB_HISTORY = _env_int("BULK_IMPORT_JOB_HISTORY", 100)
+BULK_IMPORT_JOB_TTL = _env_float("BULK_IMPORT_JOB_TTL", 86400.0)
+
+# エクスポートで上流から1回に取得する件数（PostgREST の max-rows 以下にする）
+EXPORT_PAGE_SIZE = _env_int("EXPORT_PAGE_SIZE", 1000)
+
+# 類似引用検索の設定（tfidf: 文字 n-gram の TF-IDF / embedding: ローカルの transformers モデル）
+SIMILAR_ENABLED = _env_bool("SIMILAR_ENABLED", True)
+SIMILAR_BACKEND = os.getenv("SIMILAR_BACKEND", "tfidf").lower()
+SIMILAR_DIMENSIONS = _env_int("SIMILAR_DIMENSIONS", 256)
+SIMILAR_EMBEDDING_MODEL = os.getenv("SIMILAR_EMBEDDING_MODEL", "intfloat/multilingual-e5-small")
+# python -m api.similar build で事前構築したインデックスの置き場所（未指定なら起動時に学習）
+SIMILAR_INDEX_DIR = os.getenv("SIMILAR_INDEX_DIR")
+
+# 感想の書き込みバッファの設定（まとめて書き込む件数、最大待ち秒数、バッファに保持する上限件数）
+IMPRESSIONS_BATCH_SIZE = _env_int("IMPRESSIONS_BATCH_SIZE", 500)
+IMPRESSIONS_FLUSH_INTERVAL = _env_float("IMPRESSIONS_FLUSH_INTERVAL", 1.0)
+IMPRESSIONS_MAX_PENDING = _env_int("IMPRESSIONS_MAX_PENDING", 10000)
+
+# レスポンス圧縮の設定（これより小さいレスポンスは圧縮しない、gzip の圧縮レベル、brotli の品質）
+COMPRESSION_MINIMUM_SIZE = _env_int("COMPRESSION_MINIMUM_SIZE", 1000)
+COMPRESSION_GZIP_LEVEL = _env_int("COMPRESSION_GZIP_LEVEL", 6)
+COMPRESSION_BROTLI_QUALITY = _env_int("COMPRESSION_BROTLI_QUALITY", 4)
+
+# 条件付き GET（ETag）と併せて返す Cache-Control の max-age（秒、0 なら no-cache で毎回 ETag で再検証させる）
+HTTP_MAX_AGE_QUOTE = _env_int("HTTP_MAX_AGE_QUOTE", 60)
+HTTP_MAX_AGE_LIST = _env_int("HTTP_MAX_AGE_LIST", 0)
+HTTP_MAX_AGE_STATS = _env_int("HTTP_MAX_AGE_STATS", 5)
+# ワーカーが1つだけの構成（SNAPSHOT_DIR がなくても他のワーカーの書き込みを待たずにコーパスの版を ETag に使える）
+SINGLE_WORKER = _env_bool("SINGLE_WORKER", False)
+
+# データアクセスのバックエンド（supabase: PostgREST 経由 / postgres: asyncpg で PostgreSQL に直接接続）
+DATABASE_BACKEND = os.getenv("DATABASE_BACKEND", "supabase").lower()
+DATABASE_URL = os.getenv("DATABASE_URL")
+# 直接接続の接続プール（ワーカーあたりの最小・最大接続数）、プリペアドステートメントのキャッシュ数
+# （pgbouncer のトランザクションモード経由なら 0）、1問い合わせのタイムアウト（秒）
+PG_POOL_MIN_SIZE = _env_int("PG_POOL_MIN_SIZE", 2)
+PG_POOL_MAX_SIZE = _env_int("PG_POOL_MAX_SIZE", 10)
+PG_STATEMENT_CACHE_SIZE = _env_int("PG_STATEMENT_CACHE_SIZE", 100)
+PG_COMMAND_TIMEOUT = _env_float("PG_COMMAND_TIMEOUT", 10.0)
+
+# 変更フィード（/changes の SSE）の配信元（local: 書き込みを受けたワーカー内で配信 / postgres: LISTEN/NOTIFY で全ワーカーに配信）、
+# 再開用に保持する直近のイベント数、購読者ごとのキューの上限（あふれたら切断）、接続維持のコメントを送る間隔（秒）
+CHANGES_SOURCE = os.getenv("CHANGES_SOURCE", "local").lower()
+CHANGES_BUFFER_SIZE = _env_int("CHANGES_BUFFER_SIZE", 1000)
+CHANGES_QUEUE_SIZE = _env_int("CHANGES_QUEUE_SIZE", 256)
+CHANGES_HEARTBEAT_INTERVAL = _env_float("CHANGES_HEARTBEAT_INTERVAL", 15.0)
+# postgres のとき: 通知を取りこぼしても続きを読みに行く間隔（秒）、quote_changes に残す秒数
+CHANGES_POLL_INTERVAL = _env_float("CHANGES_POLL_INTERVAL", 5.0)
+CHANGES_RETENTION = _env_float("CHANGES_RETENTION", 7 * 86400.0)
+
+# 計測: この秒数以上かかったリクエストを実行したクエリつきでログに出す（0 で無効）
+SLOW_REQUEST_SECONDS = _env_float("SLOW_REQUEST_SECONDS", 1.0)
+# リクエストのプロファイル（X-Profile ヘッダ付き、または PROFILE_SAMPLE_RATE の割合で抽出したリクエスト）
+PROFILE_ENABLED = _env_bool("PROFILE_ENABLED", False)
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+PROFILE_SAMPLE_RATE = _env_float("PROFILE_SAMPLE_RATE", 0.0)
+
+# 起動時のウォームアップ（接続・コーパスの読み込み・よく読まれるページのキャッシュ）。完了まで /health/ready は 503
+WARMUP_ENABLED = _env_bool("WARMUP_ENABLED", True)
+WARMUP_PATHS = [path.strip() for path in os.getenv("WARMUP_PATHS", "/quotes,/quotes/random,/quotes/daily,/stats").split(",") if path.strip()]
+# 終了時に裏で実行中の処理（/stats の再取得など）を待つ最大秒数
+SHUTDOWN_DRAIN_TIMEOUT = _env_float("SHUTDOWN_DRAIN_TIMEOUT", 10.0)
@@ -0,0 +1,208 @@
+"""
+引用コーパスのインメモリミラー
+
+quotes テーブルを起動時に読み込み、書き込みハンドラからの変更で差分更新する。
+他のワーカーでの書き込みを取り込むため、定期的に全件を読み直して再構築する。
+検索インデックスなどの派生構造はリスナーとして登録し、変更を受け取る。
+"""
+
+import asyncio
+import logging
+from typing import Dict, List, Optional
+
+from . import config
+from .repository import QuoteQuery, get_repository
+
+logger = logging.getLogger(__name__)
+
+# 全件読み込み時の1ページあたりの件数
+LOAD_PAGE_SIZE = 1000
+# 読み込みに失敗したときにやり直すまでの秒数
+RETRY_INTERVAL = 30.0
+
+
+class CorpusListener:
+    """コーパスの変更を受け取る派生構造の基底クラス"""
+
+    def rebuild(self, rows: List[dict]):
+        """全件から再構築する（ワーカースレッドから呼ばれるため、状態は最後に一括で差し替える）"""
+        raise NotImplementedError
+
+    def upsert(self, row: dict, old: Optional[dict]):
+        """1件の追加・更新を反映する"""
+        raise NotImplementedError
+
+    def remove(self, row: dict):
+        """1件の削除を反映する"""
+        raise NotImplementedError
+
+    def update_counts(self, row: dict):
+        """索引に使わない集計列（impression_count など）だけが変わった（既定では何もしない）"""
+
+
+class CorpusMirror:
+    """quotes テーブルのインメモリミラー"""
+
+    def __init__(self):
+        self.rows: Dict[str, dict] = {}
+        self.ready = False
+        self._listeners: List[CorpusListener] = []
+        self._pending: Optional[list] = None
+        self._reload_lock = asyncio.Lock()
+
+    def add_listener(self, listener: CorpusListener):
+        if listener in self._listeners:
+            return
+        self._listeners.append(listener)
+        if self.ready:
+            listener.rebuild(list(self.rows.values()))
+
+    async def attach(self, listener: CorpusListener):
+        """読み込み済みのコーパスにあとからリスナーを登録する（構築はワーカースレッドで行い、その間の書き込みは後から適用する）"""
+        async with self._reload_lock:
+            if listener in self._listeners:
+                return
+            if not self.ready:
+                self._listeners.append(listener)
+                return
+            snapshot = dict(self.rows)
+            self._pending = []
+            try:
+                await asyncio.to_thread(listener.rebuild, list(snapshot.values()))
+            finally:
+                pending, self._pending = self._pending, None
+            self._listeners.append(listener)
+
+            # 構築に使った行との差分として、構築中の書き込みをこのリスナーにだけ適用する
+            for op, *values in pending:
+                if op == "upsert":
+                    row = values[0]
+                    listener.upsert(row, snapshot.get(row["id"]))
+                    snapshot[row["id"]] = row
+                elif op == "increment":
+                    if values[0] in snapshot:
+                        listener.update_counts(snapshot[values[0]])
+                else:
+                    old = snapshot.pop(values[0], None)
+                    if old is not None:
+                        listener.remove(old)
+
+    async def fetch_all(self) -> List[dict]:
+        """quotes を id のキーセットでページングしながら全件取得"""
+        repo = await get_repository()
+        rows: List[dict] = []
+        after = None
+        while True:
+            page = await repo.list_quotes(QuoteQuery(order_by="id", desc=False, limit=LOAD_PAGE_SIZE, after=after))
+            rows.extend(page)
+            if len(page) < LOAD_PAGE_SIZE:
+                return rows
+            after = (None, page[-1]["id"])
+
+    async def reload(self):
+        """全件を読み直し、リスナーをワーカースレッドで再構築して差し替える"""
+        async with self._reload_lock:
+            # 読み込み・再構築中に届いた書き込みは記録しておき、差し替え後に適用し直す
+            # （読み込み済みのページより後の書き込みは読み込んだ行に含まれないため、読み込む前から記録する）
+            self._pending = []
+            try:
+                rows = await self.fetch_all()
+                await asyncio.to_thread(self._rebuild, rows)
+            finally:
+                pending, self._pending = self._pending, None
+
+            self.rows = {row["id"]: row for row in rows}
+            self.ready = True
+            for op, *values in pending:
+                if op == "upsert":
+                    self.upsert(*values)
+                elif op == "increment":
+                    self.increment(*values)
+                else:
+                    self.remove(*values)
+
+    def _rebuild(self, rows: List[dict]):
+        for listener in self._listeners:
+            listener.rebuild(rows)
+
+    def upsert(self, row: dict):
+        """作成・更新された行を反映"""
+        if self._pending is not None:
+            self._pending.append(("upsert", row))
+        old = self.rows.get(row["id"])
+        self.rows[row["id"]] = row
+        for listener in self._listeners:
+            listener.upsert(row, old)
+
+    def increment(self, quote_id: str, field: str, delta: int):
+        """索引に使わない集計列（impression_count など）を差分で更新する（リスナーには update_counts だけを通知する）"""
+        if self._pending is not None:
+            self._pending.append(("increment", quote_id, field, delta))
+        row = self.rows.get(quote_id)
+        if row is not None:
+            row[field] = (row.get(field) or 0) + delta
+            for listener in self._listeners:
+                listener.update_counts(row)
+
+    def remove(self, quote_id: str):
+        """削除された行を反映"""
+        if self._pending is not None:
+            self._pending.append(("remove", quote_id))
+        old = self.rows.pop(quote_id, None)
+        if old is None:
+            return
+        for listener in self._listeners:
+            listener.remove(old)
+
+
+corpus = CorpusMirror()
+
+_refresh_task: Optional[asyncio.Task] = None
+
+
+async def load_corpus() -> bool:
+    """コーパスを読み込む（失敗したらログに残して False）"""
+    try:
+        await corpus.reload()
+    except Exception:
+        logger.exception("コーパスの読み込みに失敗しました")
+        return False
+    logger.info("コーパスを読み込みました（%d件）", len(corpus.rows))
+    return True
+
+
+async def _refresh_loop(interval: float, load_now: bool):
+    if load_now:
+        await load_corpus()
+    if interval <= 0:
+        # 再読み込みしない設定でも、読み込めるまではやり直す
+        while not corpus.ready:
+            await asyncio.sleep(RETRY_INTERVAL)
+            await load_corpus()
+        return
+    while True:
+        await asyncio.sleep(interval if corpus.ready else min(interval, RETRY_INTERVAL))
+        await load_corpus()
+
+
+def start_refresh_task(load_now: bool = True):
+    """定期再読み込みを開始（load_now=False なら初回の読み込みは済んでいるものとして待ってから読み直す）"""
+    global _refresh_task
+
+    if not config.CORPUS_ENABLED or _refresh_task is not None:
+        return
+    _refresh_task = asyncio.create_task(_refresh_loop(config.CORPUS_REFRESH_INTERVAL, load_now))
+
+
+async def stop_refresh_task():
+    """定期再読み込みを停止"""
+    global _refresh_task
+
+    if _refresh_task is None:
+        return
+    _refresh_task.cancel()
+    try:
+        await _refresh_task
+    except asyncio.CancelledError:
+        pass
+    _refresh_task = None
@@ -0,0 +1,96 @@
+"""
+データアクセス層
+
+Supabase の非同期クライアントを1ワーカーにつき1つだけ生成し、
+keep-alive / HTTP/2 対応の httpx 接続プールを全リクエストで共有する。
+クエリは必ず execute() を経由して実行し、イベントループをブロックしない。
+"""
+
+import asyncio
+from typing import Optional
+
+import httpx
+from supabase import AsyncClient, AsyncClientOptions, acreate_client
+
+from . import config
+from .metrics import record_response_bytes, track_query
+from .singleflight import flight
+
+_client: Optional[AsyncClient] = None
+_http_client: Optional[httpx.AsyncClient] = None
+_client_lock = asyncio.Lock()
+_query_semaphore = asyncio.Semaphore(config.SUPABASE_MAX_CONCURRENCY)
+
+
+async def _count_response_bytes(response: httpx.Response):
+    # 本文はここで読み込んでおき（postgrest 側では読み込み済みの内容を使う）、圧縮されたままの受信量を数える
+    await response.aread()
+    record_response_bytes("supabase", response.num_bytes_downloaded)
+
+
+def _build_http_client() -> httpx.AsyncClient:
+    """共有HTTP接続プールを作成"""
+    return httpx.AsyncClient(
+        event_hooks={"response": [_count_response_bytes]},
+        http2=config.SUPABASE_HTTP2,
+        timeout=config.SUPABASE_TIMEOUT,
+        limits=httpx.Limits(
+            max_connections=config.SUPABASE_MAX_CONNECTIONS,
+            max_keepalive_connections=config.SUPABASE_MAX_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=config.SUPABASE_KEEPALIVE_EXPIRY,
+        ),
+    )
+
+
+async def get_supabase() -> AsyncClient:
+    """Supabase非同期クライアントを取得（初回呼び出し時に生成）"""
+    global _client, _http_client
+
+    if _client is not None:
+        return _client
+
+    async with _client_lock:
+        if _client is None:
+            _http_client = _build_http_client()
+            options = AsyncClientOptions(
+                httpx_client=_http_client,
+                postgrest_client_timeout=config.SUPABASE_TIMEOUT,
+            )
+            _client = await acreate_client(
+                config.SUPABASE_URL, config.SUPABASE_KEY, options=options
+            )
+    return _client
+
+
+def query_key(query) -> str:
+    """PostgRESTクエリを正規化したキー（メソッド・パス・パラメータ）"""
+    params = "&".join(f"{name}={value}" for name, value in sorted(query.params.multi_items()))
+    return f"{query.http_method} {query.path}?{params} {query.headers.get('Prefer', '')}"
+
+
+async def _execute(query):
+    async with _query_semaphore:
+        with track_query("supabase", f"{query.http_method} {query.path}", query_key(query)) as timer:
+            response = await query.execute()
+            timer.rows = len(response.data) if isinstance(response.data, list) else 1
+        return response
+
+
+async def execute(query):
+    """PostgRESTクエリを実行（同時実行数は SUPABASE_MAX_CONCURRENCY で制限）
+
+    読み取り（GET）は同じクエリが実行中ならその結果を共有し、上流への問い合わせを1本にまとめる
+    """
+    if query.http_method != "GET":
+        return await _execute(query)
+    return await flight.do(query_key(query), lambda: _execute(query))
+
+
+async def close_supabase():
+    """接続プールを閉じる"""
+    global _client, _http_client
+
+    if _http_client is not None:
+        await _http_client.aclose()
+    _client = None
+    _http_client = None
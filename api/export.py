@@ -0,0 +1,96 @@
+"""
+引用のストリーミングエクスポート
+
+条件に合う引用をキーセットで EXPORT_PAGE_SIZE 件ずつ取得し、NDJSON / CSV にして順に送り出す。
+次のページの取得は現在のページを送っている間に始めておき、
+保持するのは最大2ページ分だけなので、件数によらずメモリ使用量は一定。
+"""
+
+import asyncio
+import csv
+import io
+import json
+import zlib
+from dataclasses import replace
+from typing import AsyncIterator, List
+
+from .repository import QuoteQuery, QuoteRepository
+
+# 出力する列（CSV の列順。random_key などの内部用の列は含めない）
+EXPORT_COLUMNS = ["id", "title", "text", "author", "theme", "subtheme", "tags", "created_at"]
+
+EXPORT_FORMATS = {
+    "ndjson": "application/x-ndjson",
+    "csv": "text/csv; charset=utf-8",
+}
+
+
+async def iter_pages(
+    repo: QuoteRepository,
+    query: QuoteQuery,
+    page_size: int,
+) -> AsyncIterator[List[dict]]:
+    """(query.order_by, id) のキーセットでページを順に返す（次のページは先読みする）"""
+    sort_by = query.order_by
+
+    async def fetch(after):
+        return await repo.list_quotes(replace(query, limit=page_size, offset=0, after=after))
+
+    pending = asyncio.ensure_future(fetch(None))
+    try:
+        while True:
+            page = await pending
+            if len(page) < page_size:
+                if page:
+                    yield page
+                return
+            last = page[-1]
+            pending = asyncio.ensure_future(fetch((last.get(sort_by), last["id"])))
+            yield page
+    finally:
+        # クライアントが途中で切断した場合は先読みを止める
+        if not pending.done():
+            pending.cancel()
+
+
+def encode_ndjson(rows: List[dict]) -> bytes:
+    return "".join(json.dumps(row, ensure_ascii=False) + "\n" for row in rows).encode("utf-8")
+
+
+def encode_csv(rows: List[dict], header: bool = False) -> bytes:
+    """CSV に変換（tags はカンマ区切りの1列にし、POST /quotes/bulk でそのまま取り込める形にする）"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator="\n")
+    if header:
+        writer.writerow(EXPORT_COLUMNS)
+    for row in rows:
+        writer.writerow([
+            ",".join(row.get("tags") or []) if column == "tags" else row.get(column)
+            for column in EXPORT_COLUMNS
+        ])
+    return buffer.getvalue().encode("utf-8")
+
+
+async def export_stream(pages: AsyncIterator[List[dict]], format: str, compress: bool) -> AsyncIterator[bytes]:
+    """ページを指定形式のバイト列にして返す（compress なら gzip で逐次圧縮）"""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS) if compress else None
+    first = True
+
+    async for rows in pages:
+        if format == "csv":
+            chunk = encode_csv(rows, header=first)
+        else:
+            chunk = encode_ndjson(rows)
+        first = False
+
+        if compressor is not None:
+            chunk = compressor.compress(chunk)
+        if chunk:
+            yield chunk
+
+    if format == "csv" and first:
+        # 0件でもヘッダ行は出力する
+        chunk = encode_csv([], header=True)
+        yield compressor.compress(chunk) if compressor is not None else chunk
+    if compressor is not None:
+        yield compressor.flush()
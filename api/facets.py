@@ -0,0 +1,217 @@
+"""
+一覧・検索結果のファセット件数
+
+現在のフィルタ条件に一致する引用を theme / subtheme / tags / author の値ごとに数え、総件数と一緒に返す。
+コーパス読み込み済みなら本文以外の列だけを持つインメモリのスナップショットから数え、
+未読み込みならDB側の quote_facets 関数で1回の走査で集計する。
+SNAPSHOT_DIR を設定した場合は自前の構造を持たず、ワーカー間で共有するスナップショット（snapshot.py）から数える。
+値のない（NULL の）引用はそのファセットでは数えない。
+"""
+
+from collections import Counter
+from datetime import datetime, timezone
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from fastapi import HTTPException
+
+from .corpus import CorpusListener
+from .snapshot import NULL_CODE, NULL_TIME, CorpusSnapshot, SharedSnapshot, to_micros
+
+FACET_FIELDS = ["theme", "subtheme", "tags", "author"]
+
+# スナップショットに持つ本文以外の列
+_SNAPSHOT_FIELDS = ("theme", "subtheme", "author", "tags", "created_at")
+
+# フィルタ条件ごとの集計結果を保持する件数（コーパスが変わると破棄）
+MEMO_SIZE = 1000
+
+
+def parse_facets(value: Optional[str]) -> Optional[List[str]]:
+    """facets パラメータを検証してリストにする（未指定なら None）"""
+    if value is None:
+        return None
+    facets = [facet.strip() for facet in value.split(",") if facet.strip()]
+    unknown = [facet for facet in facets if facet not in FACET_FIELDS]
+    if unknown:
+        raise HTTPException(
+            status_code=400,
+            detail=f"facets に指定できるのは {', '.join(FACET_FIELDS)} です: {', '.join(unknown)}",
+        )
+    return facets
+
+
+def sort_counts(counts: Dict[str, int]) -> Dict[str, int]:
+    """件数の多い順（同数なら値の順）に並べる"""
+    return dict(sorted(counts.items(), key=lambda item: (-item[1], item[0])))
+
+
+def count_facets(rows: Iterable[dict], facets: List[str]) -> Dict[str, Dict[str, int]]:
+    """行を1回だけ走査して各ファセットの値ごとの件数を数える"""
+    counters = {facet: Counter() for facet in facets}
+    for row in rows:
+        for facet, counter in counters.items():
+            if facet == "tags":
+                counter.update(set(row.get("tags") or []))
+            elif row.get(facet) is not None:
+                counter[row[facet]] += 1
+    return {facet: sort_counts(counter) for facet, counter in counters.items()}
+
+
+def _parse_time(value: Optional[str]) -> Optional[datetime]:
+    """日付・日時の文字列を比較用の datetime にする（タイムゾーンなしは UTC とみなす）"""
+    if not value:
+        return None
+    parsed = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    return parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)
+
+
+class FacetIndex(CorpusListener):
+    """本文以外の列のスナップショットと、theme / subtheme / author / tag ごとの id 集合"""
+
+    def __init__(self):
+        self._rows: Dict[str, dict] = {}
+        self._postings: Dict[Tuple[str, str], Set[str]] = {}
+        self._memo: Dict[tuple, Tuple[int, Dict[str, Dict[str, int]]]] = {}
+        self._loaded = False
+        self._shared: Optional[SharedSnapshot] = None
+
+    def use_snapshot(self, shared: SharedSnapshot):
+        """共有スナップショットから数える（コーパスのリスナーには登録しない）"""
+        self._shared = shared
+
+    @property
+    def ready(self) -> bool:
+        if self._shared is not None:
+            return self._shared.attached
+        return self._loaded
+
+    @staticmethod
+    def _snapshot(row: dict) -> dict:
+        snapshot = {field: row.get(field) for field in _SNAPSHOT_FIELDS}
+        snapshot["created_at"] = _parse_time(snapshot["created_at"])
+        return snapshot
+
+    @staticmethod
+    def _keys(snapshot: dict) -> List[Tuple[str, str]]:
+        keys = [(field, snapshot[field]) for field in ("theme", "subtheme", "author") if snapshot[field] is not None]
+        keys.extend(("tags", tag) for tag in snapshot["tags"] or [])
+        return keys
+
+    def rebuild(self, rows: List[dict]):
+        snapshots: Dict[str, dict] = {}
+        postings: Dict[Tuple[str, str], Set[str]] = {}
+        for row in rows:
+            snapshot = snapshots[row["id"]] = self._snapshot(row)
+            for key in self._keys(snapshot):
+                postings.setdefault(key, set()).add(row["id"])
+        self._rows, self._postings, self._memo = snapshots, postings, {}
+        self._loaded = True
+
+    def upsert(self, row: dict, old: Optional[dict]):
+        if old is not None:
+            self.remove(old)
+        snapshot = self._rows[row["id"]] = self._snapshot(row)
+        for key in self._keys(snapshot):
+            self._postings.setdefault(key, set()).add(row["id"])
+        self._memo = {}
+
+    def remove(self, row: dict):
+        snapshot = self._rows.pop(row["id"], None)
+        if snapshot is not None:
+            for key in self._keys(snapshot):
+                posting = self._postings.get(key)
+                if posting is None:
+                    continue
+                posting.discard(row["id"])
+                if not posting:
+                    del self._postings[key]
+        self._memo = {}
+
+    def facets(
+        self,
+        facets: List[str],
+        theme: Optional[str] = None,
+        subtheme: Optional[str] = None,
+        author: Optional[str] = None,
+        tags: Optional[List[str]] = None,
+        date_from: Optional[str] = None,
+        date_to: Optional[str] = None,
+    ) -> Tuple[int, Dict[str, Dict[str, int]]]:
+        """/quotes と同じフィルタに一致する件数とファセット件数"""
+        memo_key = (tuple(facets), theme, subtheme, author, tuple(tags or ()), date_from, date_to)
+        if self._shared is not None:
+            return self._facets_from_snapshot(self._shared.current, memo_key)
+        if memo_key in self._memo:
+            return self._memo[memo_key]
+
+        # 等価条件は件数の少ない id 集合から積を取る
+        keys = [("theme", theme), ("subtheme", subtheme), ("author", author)]
+        keys = [key for key in keys if key[1]] + [("tags", tag) for tag in tags or []]
+        if keys:
+            sets = sorted((self._postings.get(key, set()) for key in keys), key=len)
+            ids = set(sets[0])
+            for other in sets[1:]:
+                ids &= other
+            rows = [self._rows[quote_id] for quote_id in ids]
+        else:
+            rows = list(self._rows.values())
+
+        start, end = _parse_time(date_from), _parse_time(date_to)
+        if start or end:
+            rows = [
+                row for row in rows
+                if row["created_at"] is not None
+                and (start is None or row["created_at"] >= start)
+                and (end is None or row["created_at"] <= end)
+            ]
+
+        result = (len(rows), count_facets(rows, facets))
+        if len(self._memo) >= MEMO_SIZE:
+            self._memo = {}
+        self._memo[memo_key] = result
+        return result
+
+
+    @staticmethod
+    def _facets_from_snapshot(snapshot: CorpusSnapshot, memo_key: tuple) -> Tuple[int, Dict[str, Dict[str, int]]]:
+        if memo_key in snapshot.memo:
+            return snapshot.memo[memo_key]
+        facets, theme, subtheme, author, tags, date_from, date_to = memo_key
+        filters = [("theme", theme), ("subtheme", subtheme), ("author", author)]
+        filters = [item for item in filters if item[1]] + [("tags", tag) for tag in tags]
+        start = to_micros(date_from) if date_from else None
+        end = to_micros(date_to) if date_to else None
+
+        if not filters and start is None and end is None:
+            # 条件なしはポスティングの長さがそのまま件数
+            result = (snapshot.size, {facet: sort_counts(snapshot.counts(facet)) for facet in facets})
+        else:
+            smallest, others = snapshot.candidates(filters)
+            created_at = snapshot.columns["created_at"]
+            positions = [
+                position for position in smallest
+                if all(snapshot.contains(posting, position) for posting in others)
+                and (start is None or created_at[position] != NULL_TIME and created_at[position] >= start)
+                and (end is None or created_at[position] != NULL_TIME and created_at[position] <= end)
+            ]
+            counts = {}
+            for facet in facets:
+                counter = Counter()
+                if facet == "tags":
+                    for position in positions:
+                        counter.update(snapshot.tags_at(position))
+                else:
+                    column = snapshot.columns[facet]
+                    counter.update(column[position] for position in positions)
+                    counter.pop(NULL_CODE, None)
+                values = snapshot.values[facet]
+                counts[facet] = sort_counts({values[code]: count for code, count in counter.items()})
+            result = (len(positions), counts)
+
+        if len(snapshot.memo) >= MEMO_SIZE:
+            snapshot.memo.clear()
+        snapshot.memo[memo_key] = result
+        return result
+
+
+facet_index = FacetIndex()
@@ -0,0 +1,80 @@
+"""
+一覧レスポンスの軽量化（スパースフィールドセット・本文プレビュー・高速シリアライズ）
+
+fields=title,author のように返す項目を指定すると PostgREST の select にもその列だけを渡し、
+本文などの大きな列をDBから転送しない（id は常に返す）。
+text_preview=N を指定すると本文を先頭 N 文字に切り詰める。
+N が TEXT_PREVIEW_DB_CHARS 以下なら計算列 text_preview()（quotes.sql）で切り詰めた本文だけを転送する。
+一覧の行は上流から受け取ったデータを整形するだけなので、Pydantic で検証し直さず orjson で直接シリアライズする。
+"""
+
+from typing import Iterable, List, Optional
+
+from fastapi import HTTPException, Response
+from fastapi.responses import ORJSONResponse
+
+# 一覧で返す項目（QuoteResponse と同じ）
+QUOTE_FIELDS = ["id", "title", "text", "author", "theme", "subtheme", "tags", "created_at", "impression_count"]
+
+# 行に含まれない場合の既定値（impressions.sql 適用前のDBなど）
+_DEFAULTS = {"impression_count": 0}
+
+# quotes.sql の text_preview() が返す最大文字数
+TEXT_PREVIEW_DB_CHARS = 200
+
+
+def parse_fields(value: Optional[str]) -> Optional[List[str]]:
+    """fields パラメータを検証してリストにする（未指定なら None、id は常に先頭に含める）"""
+    if value is None:
+        return None
+    fields = [field.strip() for field in value.split(",") if field.strip()]
+    unknown = [field for field in fields if field not in QUOTE_FIELDS]
+    if unknown:
+        raise HTTPException(
+            status_code=400,
+            detail=f"fields に指定できるのは {', '.join(QUOTE_FIELDS)} です: {', '.join(unknown)}",
+        )
+    return ["id"] + [field for field in dict.fromkeys(fields) if field != "id"]
+
+
+def select_columns(fields: Optional[List[str]], text_preview: Optional[int], sort_by: str) -> str:
+    """PostgREST の select に渡す列（カーソルを作るためソート項目と id は必ず含める）"""
+    if fields is None and text_preview is None:
+        return "*"
+
+    columns = list(fields or QUOTE_FIELDS)
+    for column in ("id", sort_by):
+        if column not in columns:
+            columns.append(column)
+
+    # 本文でソートする場合はカーソルに全文が必要なため、DB側では切り詰めない
+    if (
+        text_preview is not None
+        and text_preview <= TEXT_PREVIEW_DB_CHARS
+        and sort_by != "text"
+        and "text" in columns
+    ):
+        columns[columns.index("text")] = "text:text_preview"
+    return ",".join(columns)
+
+
+def shape_rows(rows: Iterable[dict], fields: Optional[List[str]], text_preview: Optional[int]) -> List[dict]:
+    """行を返す項目だけの dict にし、本文を切り詰める"""
+    columns = fields or QUOTE_FIELDS
+    shaped = []
+    for row in rows:
+        item = {column: row.get(column, _DEFAULTS.get(column)) for column in columns}
+        if text_preview is not None and item.get("text") is not None:
+            item["text"] = item["text"][:text_preview]
+        shaped.append(item)
+    return shaped
+
+
+def json_response(content, http_response: Optional[Response] = None) -> Response:
+    """response_model での検証を通さずに orjson でシリアライズする
+
+    Response を直接返すと FastAPI は依存関係で受け取った http_response のヘッダを反映しないため、
+    X-Next-Cursor などはここで引き継ぐ
+    """
+    headers = dict(http_response.headers) if http_response is not None else None
+    return ORJSONResponse(content, headers=headers)
@@ -0,0 +1,132 @@
+"""
+感想（impressions）の書き込みバッファ
+
+POST /impressions は行をメモリ上のバッファに積むだけで応答し、
+IMPRESSIONS_BATCH_SIZE 件たまるか IMPRESSIONS_FLUSH_INTERVAL 秒たつと複数行INSERTでまとめて書き込む。
+id と created_at はバッファに積む時点で決めるため、応答で返した値がそのままDBに入る。
+上流に接続できない場合はバッファに戻して次の書き込みで再送し、停止時には残りを書き込んでから終了する。
+"""
+
+import asyncio
+import logging
+from typing import Awaitable, Callable, List, Optional
+
+from . import config
+from .repository import DataError, get_repository
+
+logger = logging.getLogger(__name__)
+
+
+class ImpressionBuffer:
+    """impressions への書き込みをまとめる write-behind バッファ"""
+
+    def __init__(self, batch_size: int, flush_interval: float, max_pending: int):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.on_flushed: Optional[Callable[[List[dict]], Awaitable[None]]] = None
+        self._rows: List[dict] = []
+        self._flush_lock = asyncio.Lock()
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._closing = False
+        self.flushed = 0
+        self.dropped = 0
+        self.batches = 0
+
+    @property
+    def pending(self) -> int:
+        return len(self._rows)
+
+    def has_pending(self, field: str, value: str) -> bool:
+        """まだ書き込んでいない行に field == value のものがあるか"""
+        return any(row[field] == value for row in self._rows)
+
+    async def add(self, row: dict):
+        """行をバッファに積む（上限を超えている場合は書き込みが終わるまで待つ）"""
+        if len(self._rows) >= self.max_pending:
+            await self.flush()
+        self._rows.append(row)
+        if len(self._rows) >= self.batch_size:
+            self._wakeup.set()
+
+    async def flush(self):
+        """バッファの行をすべて書き込む"""
+        async with self._flush_lock:
+            while self._rows:
+                batch, self._rows = self._rows[:self.batch_size], self._rows[self.batch_size:]
+                try:
+                    inserted = await self._insert(batch)
+                except Exception:
+                    # 上流に届かなかったバッチは先頭に戻し、次の書き込みで再送する
+                    self._rows[:0] = batch
+                    raise
+
+                self.batches += 1
+                self.flushed += len(inserted)
+                if inserted and self.on_flushed is not None:
+                    await self.on_flushed(inserted)
+
+    async def _insert(self, batch: List[dict]) -> List[dict]:
+        repo = await get_repository()
+        try:
+            await repo.insert_impressions(batch)
+            return batch
+        except DataError:
+            # 存在しない引用・ユーザーなど行の内容によるエラーは、どの行が原因か分からないため1行ずつ登録し直す
+            # （id はバッファに積む時点で決めているため、先に登録済みの行は主キー違反で弾かれ二重には入らない）
+            inserted = []
+            for row in batch:
+                try:
+                    await repo.insert_impressions([row])
+                    inserted.append(row)
+                except DataError as e:
+                    self.dropped += 1
+                    logger.warning("感想 %s を登録できませんでした: %s", row["id"], e)
+            return inserted
+
+    async def _run(self):
+        while not self._closing:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("感想の書き込みに失敗しました（%d件を再送待ち）", len(self._rows))
+
+    def start(self):
+        """定期書き込みを開始"""
+        if self._task is not None:
+            return
+        self._closing = False
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """定期書き込みを止め、残りの行を書き込む"""
+        if self._task is not None:
+            self._closing = True
+            self._wakeup.set()
+            await self._task
+            self._task = None
+        try:
+            await self.flush()
+        except Exception:
+            logger.exception("停止時に感想 %d件を書き込めませんでした", len(self._rows))
+
+    def stats(self) -> dict:
+        return {
+            "pending": len(self._rows),
+            "flushed": self.flushed,
+            "dropped": self.dropped,
+            "batches": self.batches,
+        }
+
+
+impression_buffer = ImpressionBuffer(
+    config.IMPRESSIONS_BATCH_SIZE,
+    config.IMPRESSIONS_FLUSH_INTERVAL,
+    config.IMPRESSIONS_MAX_PENDING,
+)
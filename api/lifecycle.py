@@ -0,0 +1,179 @@
+"""
+起動・終了の管理（FastAPI の lifespan から呼ぶ）
+
+起動時は受け付けを止めずにバックグラウンドでウォームアップする。
+接続プールの作成（つながるまでやり直す）→ コーパスの読み込み（検索・タグ・ファセット・ランダムの
+インデックスの構築。類似検索のインデックスは最初の類似検索のリクエストで構築する）→ 共有スナップショットの取り込み（SNAPSHOT_DIR 設定時）→ よく読まれるページ（WARMUP_PATHS）をアプリ自身に投げてキャッシュを温める、の順に行い、
+終わるまで /health/ready は 503 を返す。接続プールはワーカーごとに lifespan の中で作る。
+終了時は /health/ready を 503 にしてから、バッファ中の感想の書き込みと裏で実行中の処理を待って接続を閉じる。
+"""
+
+import asyncio
+import logging
+import time
+from typing import Awaitable, Callable, Dict, List, Optional
+
+import httpx
+
+from . import config
+from .changes import start_change_source, stop_change_source
+from .corpus import corpus, load_corpus, start_refresh_task, stop_refresh_task
+from .impressions import impression_buffer
+from .repository import close_repository, get_repository
+from .snapshot import shared_snapshot
+from .stats import start_reconcile_task, stop_reconcile_task
+
+logger = logging.getLogger(__name__)
+
+# 接続に失敗したときにやり直すまでの秒数（倍々に延ばす）
+CONNECT_RETRY_INITIAL = 1.0
+CONNECT_RETRY_MAX = 30.0
+
+
+class Lifecycle:
+    """起動・ウォームアップ・終了の状態"""
+
+    def __init__(self):
+        # starting -> warming -> ready -> draining -> stopped
+        self.phase = "starting"
+        self.started_at = time.time()
+        self.ready_at: Optional[float] = None
+        # ウォームアップの手順ごとの結果
+        self.steps: Dict[str, dict] = {}
+        self._ready = asyncio.Event()
+        self._warmup_task: Optional[asyncio.Task] = None
+
+    @property
+    def ready(self) -> bool:
+        return self.phase == "ready"
+
+    async def wait_ready(self):
+        await self._ready.wait()
+
+    def status(self) -> dict:
+        return {
+            "status": self.phase,
+            "uptime_seconds": round(time.time() - self.started_at, 3),
+            "warmup_seconds": round(self.ready_at - self.started_at, 3) if self.ready_at else None,
+            "corpus_ready": corpus.ready,
+            "corpus_size": len(corpus.rows),
+            "snapshot": shared_snapshot.status() if config.SNAPSHOT_DIR else None,
+            "steps": self.steps,
+        }
+
+    async def _step(self, name: str, fn: Callable[[], Awaitable[Optional[str]]]):
+        started = time.perf_counter()
+        self.steps[name] = {"status": "running"}
+        try:
+            detail = await fn()
+            self.steps[name] = {"status": "ok"}
+            if detail:
+                self.steps[name]["detail"] = detail
+        except Exception as e:
+            logger.exception("ウォームアップ（%s）に失敗しました", name)
+            self.steps[name] = {"status": "error", "error": str(e)}
+        self.steps[name]["seconds"] = round(time.perf_counter() - started, 3)
+
+    async def _connect(self) -> str:
+        delay = CONNECT_RETRY_INITIAL
+        while True:
+            try:
+                repository = await get_repository()
+                return repository.name
+            except Exception as e:
+                logger.warning("データベースに接続できません（%.0f秒後に再試行）: %s", delay, e)
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, CONNECT_RETRY_MAX)
+
+    async def _load_corpus(self) -> str:
+        if config.SNAPSHOT_DIR:
+            # 読み込み中に他のワーカーで書き込まれた分も取りこぼさないよう、変更ログは先に読み始める
+            shared_snapshot.start(config.SNAPSHOT_DIR)
+        loaded = await load_corpus()
+        # 失敗しても定期再読み込みのタスクがやり直す
+        start_refresh_task(load_now=False)
+        if not loaded:
+            raise RuntimeError("コーパスを読み込めませんでした（定期再読み込みで再試行します）")
+        return f"{len(corpus.rows)}件"
+
+    async def _attach_snapshot(self) -> str:
+        # ビルダーが公開するまで待つ（ビルダーが止まっていれば定期処理の中で引き継ぐ）
+        await shared_snapshot.wait_attached()
+        return f"v{shared_snapshot.current.version}（{'ビルダー' if shared_snapshot.is_builder else '取り込みのみ'}）"
+
+    async def _warm_paths(self, app) -> str:
+        # アプリ自身に投げて、レスポンスの組み立て・キャッシュ・遅延構築される構造を初回のリクエストの前に済ませる
+        failed: List[str] = []
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://warmup", timeout=60) as client:
+            for path in config.WARMUP_PATHS:
+                try:
+                    response = await client.get(path)
+                    if response.status_code >= 500:
+                        failed.append(f"{path} ({response.status_code})")
+                except Exception as e:
+                    failed.append(f"{path} ({e})")
+        if failed:
+            raise RuntimeError("失敗したパス: " + ", ".join(failed))
+        return f"{len(config.WARMUP_PATHS)}件"
+
+    async def _warmup(self, app):
+        self.phase = "warming"
+        await self._step("repository", self._connect)
+        if config.CORPUS_ENABLED:
+            await self._step("corpus", self._load_corpus)
+            if config.SNAPSHOT_DIR:
+                await self._step("snapshot", self._attach_snapshot)
+        if config.WARMUP_PATHS:
+            await self._step("paths", lambda: self._warm_paths(app))
+        self.phase = "ready"
+        self.ready_at = time.time()
+        self._ready.set()
+        logger.info("ウォームアップが完了しました（%.2f秒）", self.ready_at - self.started_at)
+
+    async def start(self, app):
+        """バックグラウンドの処理を始め、ウォームアップを裏で実行する"""
+        self.started_at = time.time()
+        start_reconcile_task()
+        impression_buffer.start()
+        start_change_source()
+        if config.WARMUP_ENABLED:
+            self._warmup_task = asyncio.create_task(self._warmup(app))
+        else:
+            # ウォームアップしない場合はこれまでどおり初回のリクエストで接続し、コーパスは裏で読み込む
+            if config.CORPUS_ENABLED and config.SNAPSHOT_DIR:
+                shared_snapshot.start(config.SNAPSHOT_DIR)
+            start_refresh_task()
+            self.phase = "ready"
+            self.ready_at = time.time()
+            self._ready.set()
+
+    async def stop(self, drains: List[Callable[[], Awaitable[None]]] = ()):
+        """新しいリクエストを受けない状態にして、残りの処理を書き込んでから接続を閉じる"""
+        self.phase = "draining"
+        # 変更フィードの接続は開いたままなので、先に終わらせる
+        await stop_change_source()
+        if self._warmup_task is not None and not self._warmup_task.done():
+            self._warmup_task.cancel()
+            try:
+                await self._warmup_task
+            except asyncio.CancelledError:
+                pass
+
+        # 感想のバッファは書き込みきる（失敗した分はログに残る）
+        await impression_buffer.stop()
+        try:
+            await asyncio.wait_for(
+                asyncio.gather(*(drain() for drain in drains)), config.SHUTDOWN_DRAIN_TIMEOUT
+            )
+        except asyncio.TimeoutError:
+            logger.warning("終了待ちの処理が %.0f秒以内に終わりませんでした", config.SHUTDOWN_DRAIN_TIMEOUT)
+
+        await stop_refresh_task()
+        await shared_snapshot.stop()
+        await stop_reconcile_task()
+        await close_repository()
+        self.phase = "stopped"
+
+
+lifecycle = Lifecycle()
@@ -1,25 +1,55 @@
-from fastapi import FastAPI, HTTPException, Query, Depends
+from fastapi import FastAPI, HTTPException, Query, Depends, Response, Request, Header
 from fastapi.middleware.cors import CORSMiddleware
-from typing import List, Optional
-from datetime import date
-import os
-from dotenv import load_dotenv
-from supabase import create_client, Client
+from fastapi.responses import StreamingResponse, PlainTextResponse
+from typing import Dict, List, Optional, Union
+from contextlib import asynccontextmanager
+from datetime import date, datetime, timedelta, timezone
 from pydantic import BaseModel
+from collections import Counter
+from uuid import UUID, uuid4
+import asyncio
 import json
+import random
 
-# 環境変数を読み込み
-load_dotenv()
+from .repository import QuoteQuery, QuoteRepository, get_repository
+from .corpus import corpus
+from .lifecycle import lifecycle
+from .search import search_index
+from .random_pool import random_pool, daily_pivot
+from .snapshot import shared_snapshot
+from .suggest import suggest_index, parse_suggest_fields
+from .changes import record as record_change, stream as change_stream
+from .cache import ALL_QUOTES_TAG, cache, make_key, list_tags, quote_tag, invalidate_rows
+from .singleflight import StaleWhileRevalidate, flight
+from .bulk_import import IMPORT_FORMATS, bulk_importer, parse_csv, parse_ndjson
+from .export import EXPORT_COLUMNS, EXPORT_FORMATS, export_stream, iter_pages
+from .facets import facet_index, parse_facets, count_facets, sort_counts
+from .impressions import impression_buffer
+from .fields import parse_fields, select_columns, shape_rows, json_response
+from .compression import CompressionMiddleware
+from .metrics import MetricsMiddleware, error_handler, registry
+from .conditional import data_version, content_etag, not_modified, version_not_modified
+from .tag_index import tag_index, parse_tag_expression, tags_expression, expression_tags, has_negation
+from . import config
+from .pagination import SORT_FIELDS, NEXT_CURSOR_HEADER, decode_cursor, encode_cursor, keyset_key, page_after, page_rows, set_next_cursor
 
-# Supabaseクライアントの初期化
-supabase_url = os.getenv("SUPABASE_URL")
-supabase_key = os.getenv("SUPABASE_KEY")  # .envファイルの変数名に合わせる
-supabase: Client = create_client(supabase_url, supabase_key)
+def _similar_index():
+    """類似検索インデックス（numpy などを読み込むため、使うときに初めて import する）"""
+    from .similar import similar_index
+    return similar_index
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """起動時にウォームアップを始め、終了時は残りの処理を書き込んでから接続を閉じる"""
+    await lifecycle.start(app)
+    yield
+    await lifecycle.stop(drains=[stats_cache.drain])
 
 app = FastAPI(
     title="Azuma Insight Quotes API",
     description="引用コレクションのためのREST API",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan,
 )
 
 # CORS設定
@@ -29,8 +59,47 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=[NEXT_CURSOR_HEADER],
 )
 
+# Accept-Encoding に応じてレスポンスを brotli / gzip で圧縮
+app.add_middleware(
+    CompressionMiddleware,
+    minimum_size=config.COMPRESSION_MINIMUM_SIZE,
+    gzip_level=config.COMPRESSION_GZIP_LEVEL,
+    brotli_quality=config.COMPRESSION_BROTLI_QUALITY,
+)
+
+# 処理時間・上流への問い合わせの計測（圧縮を含めた時間を測るため最も外側に置く）
+app.add_middleware(
+    MetricsMiddleware,
+    slow_request_seconds=config.SLOW_REQUEST_SECONDS,
+    profile_enabled=config.PROFILE_ENABLED,
+    profile_dir=config.PROFILE_DIR,
+    profile_sample_rate=config.PROFILE_SAMPLE_RATE,
+)
+
+# 500 を返すときは元の例外をメトリクスとログに残す
+app.add_exception_handler(HTTPException, error_handler)
+
+# /stats は古い値を返しながら裏で再取得する
+stats_cache = StaleWhileRevalidate(flight, config.STATS_TTL, config.STATS_STALE_TTL, config.STATS_MAX_ENTRIES)
+
+# インメモリコーパスから派生するインデックスを登録
+corpus.add_listener(search_index)
+corpus.add_listener(data_version)
+corpus.add_listener(suggest_index)
+if config.SNAPSHOT_DIR:
+    # ファセット・ランダム引用・タグ式はワーカー間で共有するスナップショットから引く
+    corpus.add_listener(shared_snapshot)
+    facet_index.use_snapshot(shared_snapshot)
+    random_pool.use_snapshot(shared_snapshot, corpus)
+    tag_index.use_snapshot(shared_snapshot, corpus)
+else:
+    corpus.add_listener(tag_index)
+    corpus.add_listener(random_pool)
+    corpus.add_listener(facet_index)
+
 # Pydanticモデル
 class QuoteBase(BaseModel):
     title: str
@@ -67,6 +136,27 @@ class QuoteResponse(BaseModel):
     subtheme: Optional[str] = None
     tags: Optional[list] = None
     created_at: str
+    impression_count: int = 0
+
+class SimilarQuoteResponse(QuoteResponse):
+    score: float
+
+class FacetedQuotesResponse(BaseModel):
+    items: List[QuoteResponse]
+    total: int
+    facets: Dict[str, Dict[str, int]]
+
+class ImpressionCreate(BaseModel):
+    quote_id: UUID
+    user_id: UUID
+    impression: str
+
+class ImpressionResponse(BaseModel):
+    id: str
+    quote_id: str
+    user_id: str
+    impression: str
+    created_at: str
 
 class StatsResponse(BaseModel):
     total_quotes: int
@@ -85,13 +175,17 @@ async def root():
     return {
         "message": "Azuma Insight Quotes API",
         "version": "2.0.0",
+        "database_backend": config.DATABASE_BACKEND,
         "endpoints": {
             "quotes": "/quotes",
             "search": "/quotes/search",
             "tags": "/quotes/tags",
             "theme": "/quotes/theme/{theme}",
             "random": "/quotes/random",
-            "stats": "/stats"
+            "daily": "/quotes/daily",
+            "similar": "/quotes/{quote_id}/similar",
+            "stats": "/stats",
+            "health": "/health/ready"
         },
         "features": {
             "level": "2",
@@ -103,10 +197,55 @@ async def root():
         }
     }
 
-@app.get("/quotes", response_model=List[QuoteResponse])
+async def _load_facets(
+    repo: QuoteRepository,
+    facets: List[str],
+    theme: Optional[str] = None,
+    subtheme: Optional[str] = None,
+    author: Optional[str] = None,
+    tags: Optional[List[str]] = None,
+    date_from: Optional[str] = None,
+    date_to: Optional[str] = None,
+    q: Optional[str] = None,
+    search_fields: Optional[List[str]] = None,
+    search_type: str = "or",
+):
+    """フィルタ条件に一致する総件数とファセット件数を取得
+
+    キーワードなしでコーパスが読み込み済みならインメモリのスナップショットから数え、
+    それ以外はDB側の quote_facets 関数で集計する
+    """
+    if q is None and corpus.ready and facet_index.ready:
+        return facet_index.facets(facets, theme, subtheme, author, tags, date_from, date_to)
+    
+    params = {
+        "p_facets": facets,
+        "p_theme": theme,
+        "p_subtheme": subtheme,
+        "p_author": author,
+        "p_tags": tags or None,
+        "p_date_from": date_from,
+        "p_date_to": date_to,
+        "p_q": q,
+        "p_search_fields": search_fields or ["title", "text"],
+        "p_search_type": search_type,
+    }
+    
+    cache_tags = [ALL_QUOTES_TAG] if q else list_tags(theme, author, tags, subtheme)
+    data = await cache.get_or_load(make_key("quote_facets", params), lambda: repo.rpc("quote_facets", params, read=True), cache_tags)
+    return data["total"], {facet: sort_counts(data["facets"].get(facet) or {}) for facet in facets}
+
+def _cursor_position(cursor: Optional[str], sort_by: str, repo: QuoteRepository):
+    """カーソルをキーセットの位置 (ソート値, id) にする（未指定なら None で offset を使う）"""
+    return decode_cursor(cursor, sort_by, repo.collation) if cursor else None
+
+@app.get("/quotes", response_model=Union[List[QuoteResponse], FacetedQuotesResponse])
 async def get_quotes(
+    request: Request,
+    http_response: Response,
     limit: int = Query(50, ge=1, le=100, description="取得件数"),
     offset: int = Query(0, ge=0, description="オフセット"),
+    cursor: Optional[str] = Query(None, description="次ページのカーソル（指定時は offset を無視）"),
     theme: Optional[str] = Query(None, description="テーマでフィルタ"),
     subtheme: Optional[str] = Query(None, description="サブテーマでフィルタ"),
     tags: Optional[str] = Query(None, description="タグでフィルタ（カンマ区切り）"),
@@ -114,142 +253,134 @@ async def get_quotes(
     date_from: Optional[str] = Query(None, description="開始日 (YYYY-MM-DD)"),
     date_to: Optional[str] = Query(None, description="終了日 (YYYY-MM-DD)"),
     sort_by: Optional[str] = Query("created_at", description="ソート項目 (title, text, theme, created_at)"),
-    sort_order: Optional[str] = Query("desc", description="ソート順序 (asc, desc)")
+    sort_order: Optional[str] = Query("desc", description="ソート順序 (asc, desc)"),
+    facets: Optional[str] = Query(None, description="ファセット件数を返す項目（theme,subtheme,tags,author のカンマ区切り）。指定時は {items, total, facets} で返す"),
+    fields: Optional[str] = Query(None, description="返す項目（カンマ区切り、例: title,author）。id は常に返す"),
+    text_preview: Optional[int] = Query(None, ge=1, le=10000, description="本文を先頭 N 文字に切り詰めて返す"),
+    repo: QuoteRepository = Depends(get_repository)
 ):
     """引用一覧を取得（高度なフィルタリング・ソート・ページネーション付き）"""
     try:
-        query = supabase.table("quotes").select("*")
-        
-        # フィルタリング
-        if theme:
-            query = query.eq("theme", theme)
-        if subtheme:
-            query = query.eq("subtheme", subtheme)
-        if author:
-            query = query.eq("author", author)
-        if date_from:
-            query = query.gte("created_at", date_from)
-        if date_to:
-            query = query.lte("created_at", date_to)
-        
-        # タグフィルタリング（複数タグ対応）
-        if tags:
-            tag_list = [tag.strip() for tag in tags.split(",")]
-            for tag in tag_list:
-                query = query.contains("tags", [tag])
+        facet_list = parse_facets(facets)
+        field_list = parse_fields(fields)
+        
+        # 前回から変更がなければ上流に問い合わせずに 304 を返す
+        cached = version_not_modified(request, http_response, config.HTTP_MAX_AGE_LIST)
+        if cached is not None:
+            return cached
         
         # ソート
         if sort_order.lower() not in ["asc", "desc"]:
             sort_order = "desc"
         
-        if sort_by in ["title", "text", "theme", "created_at"]:
-            query = query.order(sort_by, desc=(sort_order.lower() == "desc"))
-        else:
-            query = query.order("created_at", desc=True)
-        
-        # ページネーション
-        query = query.range(offset, offset + limit - 1)
-        
-        response = query.execute()
-        
-        if response.data is None:
-            return []
-        
-        return response.data
-        
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"データベースエラー: {str(e)}")
-
-@app.get("/quotes/random", response_model=QuoteResponse)
-async def get_random_quote():
-    """ランダムな引用を取得"""
-    try:
-        # 全引用数を取得
-        count_response = supabase.table("quotes").select("id", count="exact").execute()
-        total_count = count_response.count
-        
-        if total_count == 0:
-            raise HTTPException(status_code=404, detail="引用がありません")
+        if sort_by not in SORT_FIELDS:
+            sort_by, sort_order = "created_at", "desc"
         
-        # ランダムなオフセットを生成
-        import random
-        random_offset = random.randint(0, total_count - 1)
+        # フィルタリング（タグは複数指定に対応）、select には返す列だけを渡す
+        tag_list = [tag.strip() for tag in tags.split(",")] if tags else []
+        columns = select_columns(field_list, text_preview, sort_by)
         
-        # ランダムな引用を取得
-        response = supabase.table("quotes").select("*").range(random_offset, random_offset).execute()
-        
-        if not response.data:
-            raise HTTPException(status_code=404, detail="引用が見つかりません")
-        
-        return response.data[0]
-        
-    except HTTPException:
-        raise
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"データベースエラー: {str(e)}")
-
-@app.get("/quotes/{quote_id}", response_model=QuoteResponse)
-async def get_quote(quote_id: str):
-    """特定の引用を取得"""
-    try:
-        response = supabase.table("quotes").select("*").eq("id", quote_id).execute()
+        # ページネーション（cursor 指定時はキーセット）
+        query = QuoteQuery(
+            select=columns, theme=theme, subtheme=subtheme, author=author, date_from=date_from, date_to=date_to,
+            tags=tag_list, order_by=sort_by, desc=sort_order.lower() == "desc",
+            limit=limit, offset=offset, after=_cursor_position(cursor, sort_by, repo),
+        )
         
-        if not response.data:
-            raise HTTPException(status_code=404, detail="引用が見つかりません")
+        cache_key = make_key("quotes", {
+            "limit": limit, "offset": None if cursor else offset, "cursor": cursor,
+            "theme": theme, "subtheme": subtheme, "tags": tag_list or None, "author": author,
+            "date_from": date_from, "date_to": date_to, "sort_by": sort_by, "sort_order": sort_order.lower(),
+            "select": columns,
+        })
+        rows_task = cache.get_or_load(cache_key, lambda: repo.list_quotes(query), list_tags(theme, author, tag_list, subtheme))
+        if facet_list is None:
+            rows = await rows_task
+            set_next_cursor(http_response, rows, limit, sort_by, repo.collation)
+            return json_response(shape_rows(rows, field_list, text_preview), http_response)
         
-        return response.data[0]
+        # ページとファセット件数を並行して取得
+        rows, (total, counts) = await asyncio.gather(
+            rows_task,
+            _load_facets(repo, facet_list, theme, subtheme, author, tag_list, date_from, date_to),
+        )
+        set_next_cursor(http_response, rows, limit, sort_by, repo.collation)
+        return json_response(
+            {"items": shape_rows(rows, field_list, text_preview), "total": total, "facets": counts}, http_response
+        )
         
     except HTTPException:
         raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"データベースエラー: {str(e)}")
 
-@app.post("/quotes", response_model=QuoteResponse)
-async def create_quote(quote: QuoteCreate):
-    """新しい引用を作成"""
-    try:
-        response = supabase.table("quotes").insert(quote.dict()).execute()
-        
-        if not response.data:
-            raise HTTPException(status_code=400, detail="引用の作成に失敗しました")
-        
-        return response.data[0]
-        
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"データベースエラー: {str(e)}")
+@app.get("/quotes/random", response_model=Union[QuoteResponse, List[QuoteResponse]])
+async def get_random_quote(
+    count: Optional[int] = Query(None, ge=1, le=100, description="取得件数（指定時は重複なしの配列で返す）"),
+    theme: Optional[str] = Query(None, description="テーマでフィルタ"),
+    tag: Optional[str] = Query(None, description="タグでフィルタ"),
+    author: Optional[str] = Query(None, description="作者でフィルタ"),
+    repo: QuoteRepository = Depends(get_repository)
+):
+    """ランダムな引用を取得
 
-@app.put("/quotes/{quote_id}", response_model=QuoteResponse)
-async def update_quote(quote_id: str, quote: QuoteUpdate):
-    """引用を更新"""
+    インメモリのプールが構築済みならDBに問い合わせずに選び、
+    未構築の場合は random_quotes 関数で1回の問い合わせで取得する
+    """
     try:
-        # 更新データからNoneの値を除外
-        update_data = {k: v for k, v in quote.dict().items() if v is not None}
-        
-        if not update_data:
-            raise HTTPException(status_code=400, detail="更新データがありません")
+        if corpus.ready and random_pool.ready:
+            quotes = random_pool.sample(count or 1, theme, tag, author)
+        else:
+            # 起点の乱数はこちらで決める（呼び出しごとにキーが変わり、同時のリクエストで結果を共有しない）
+            params = {"p_count": count or 1, "p_theme": theme, "p_tag": tag, "p_author": author, "p_seed": random.random()}
+            quotes = await repo.rpc("random_quotes", params, read=True) or []
         
-        response = supabase.table("quotes").update(update_data).eq("id", quote_id).execute()
+        if count is not None:
+            return quotes
         
-        if not response.data:
-            raise HTTPException(status_code=404, detail="引用が見つかりません")
+        if not quotes:
+            raise HTTPException(status_code=404, detail="引用がありません")
         
-        return response.data[0]
+        return quotes[0]
         
     except HTTPException:
         raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"データベースエラー: {str(e)}")
 
-@app.delete("/quotes/{quote_id}")
-async def delete_quote(quote_id: str):
-    """引用を削除"""
+@app.get("/quotes/daily", response_model=QuoteResponse)
+async def get_daily_quote(
+    http_response: Response,
+    theme: Optional[str] = Query(None, description="テーマでフィルタ"),
+    tag: Optional[str] = Query(None, description="タグでフィルタ"),
+    author: Optional[str] = Query(None, description="作者でフィルタ"),
+    repo: QuoteRepository = Depends(get_repository)
+):
+    """今日の一句を取得（UTCの日付とフィルタで決まり、日付が変わるまでキャッシュ可能）"""
     try:
-        response = supabase.table("quotes").delete().eq("id", quote_id).execute()
+        now = datetime.now(timezone.utc)
+        today = now.date()
         
-        if not response.data:
-            raise HTTPException(status_code=404, detail="引用が見つかりません")
+        if corpus.ready and random_pool.ready:
+            quote = random_pool.daily(today, theme, tag, author)
+        else:
+            params = {
+                "p_count": 1,
+                "p_theme": theme,
+                "p_tag": tag,
+                "p_author": author,
+                "p_seed": daily_pivot(today, theme, tag, author),
+            }
+            quotes = await repo.rpc("random_quotes", params, read=True)
+            quote = quotes[0] if quotes else None
         
-        return {"message": "引用が削除されました", "id": quote_id}
+        if quote is None:
+            raise HTTPException(status_code=404, detail="引用がありません")
+        
+        # 翌日0時（UTC）までキャッシュさせる
+        tomorrow = datetime.combine(today + timedelta(days=1), datetime.min.time(), tzinfo=timezone.utc)
+        http_response.headers["Cache-Control"] = f"public, max-age={int((tomorrow - now).total_seconds())}"
+        return quote
         
     except HTTPException:
         raise
@@ -258,143 +389,737 @@ async def delete_quote(quote_id: str):
 
 # 検索機能
 
-@app.get("/quotes/search", response_model=List[QuoteResponse])
+@app.get("/quotes/search", response_model=Union[List[QuoteResponse], FacetedQuotesResponse])
 async def search_quotes(
+    request: Request,
+    http_response: Response,
     q: str = Query(..., description="検索キーワード"),
     search_fields: Optional[str] = Query("title,text", description="検索対象フィールド（カンマ区切り）"),
     search_type: Optional[str] = Query("or", description="検索タイプ (and, or)"),
     limit: int = Query(50, ge=1, le=100, description="取得件数"),
     offset: int = Query(0, ge=0, description="オフセット"),
-    sort_by: Optional[str] = Query("created_at", description="ソート項目"),
-    sort_order: Optional[str] = Query("desc", description="ソート順序 (asc, desc)")
+    cursor: Optional[str] = Query(None, description="次ページのカーソル（指定時は offset を無視）"),
+    sort_by: Optional[str] = Query("relevance", description="ソート項目 (relevance, title, text, theme, created_at)"),
+    sort_order: Optional[str] = Query("desc", description="ソート順序 (asc, desc)"),
+    facets: Optional[str] = Query(None, description="ファセット件数を返す項目（theme,subtheme,tags,author のカンマ区切り）。指定時は {items, total, facets} で返す"),
+    fields: Optional[str] = Query(None, description="返す項目（カンマ区切り、例: title,author）。id は常に返す"),
+    text_preview: Optional[int] = Query(None, ge=1, le=10000, description="本文を先頭 N 文字に切り詰めて返す"),
+    repo: QuoteRepository = Depends(get_repository)
 ):
-    """高度なキーワード検索（複数フィールド・AND/OR検索対応）"""
+    """高度なキーワード検索（複数フィールド・AND/OR検索対応）
+
+    インメモリの検索インデックスが読み込み済みならバイグラム索引と BM25F で関連度順に返し、
+    読み込み前はDBの部分一致検索にフォールバックする
+    """
     try:
-        query = supabase.table("quotes").select("*")
+        facet_list = parse_facets(facets)
+        field_list = parse_fields(fields)
+        
+        cached = version_not_modified(request, http_response, config.HTTP_MAX_AGE_LIST)
+        if cached is not None:
+            return cached
         
         # 検索フィールドの設定
-        fields = [field.strip() for field in search_fields.split(",")]
+        requested_fields = [field.strip() for field in search_fields.split(",")]
         valid_fields = ["title", "text", "theme", "subtheme", "author"]
-        search_fields_list = [field for field in fields if field in valid_fields]
+        search_fields_list = [field for field in requested_fields if field in valid_fields]
         
         if not search_fields_list:
             search_fields_list = ["title", "text"]
         
-        # 検索条件の構築
-        if search_type.lower() == "and":
-            # AND検索：全てのフィールドにキーワードが含まれる
-            for field in search_fields_list:
-                query = query.ilike(field, f"%{q}%")
-        else:
-            # OR検索：いずれかのフィールドにキーワードが含まれる
-            or_conditions = []
-            for field in search_fields_list:
-                or_conditions.append(f"{field}.ilike.%{q}%")
-            query = query.or_(f"({','.join(or_conditions)})")
-        
-        # ソート
         if sort_order.lower() not in ["asc", "desc"]:
             sort_order = "desc"
         
-        if sort_by in ["title", "text", "theme", "created_at"]:
-            query = query.order(sort_by, desc=(sort_order.lower() == "desc"))
-        else:
-            query = query.order("created_at", desc=True)
+        if corpus.ready:
+            results = search_index.search(q, search_fields_list, search_type.lower())
+            
+            # 関連度順は (スコア降順, id)、それ以外は (項目, id) で並べる
+            if sort_by in SORT_FIELDS:
+                reverse = sort_order.lower() == "desc"
+                key = lambda item: keyset_key(item[1].get(sort_by), item[1]["id"])
+                results.sort(key=key, reverse=reverse)
+            else:
+                sort_by, reverse = "relevance", False
+                key = lambda item: (-item[0], item[1]["id"])
+            
+            # ページネーション（cursor 指定時はキーセット）
+            if cursor:
+                value, quote_id = decode_cursor(cursor, sort_by)
+                cursor_key = (-value, quote_id) if sort_by == "relevance" else keyset_key(value, quote_id)
+                page = page_after(results, key, cursor_key, reverse)[:limit]
+            else:
+                page = results[offset:offset + limit]
+            
+            if len(page) == limit:
+                score, last = page[-1]
+                value = score if sort_by == "relevance" else last.get(sort_by)
+                http_response.headers[NEXT_CURSOR_HEADER] = encode_cursor(sort_by, value, last["id"])
+            
+            items = shape_rows((row for _, row in page), field_list, text_preview)
+            if facet_list is None:
+                return json_response(items, http_response)
+            # ファセットはページではなく一致した全件から数える
+            return json_response({
+                "items": items,
+                "total": len(results),
+                "facets": count_facets((row for _, row in results), facet_list),
+            }, http_response)
         
-        # ページネーション
-        query = query.range(offset, offset + limit - 1)
+        # ソート
+        if sort_by not in SORT_FIELDS:
+            sort_by, sort_order = "created_at", "desc"
         
-        response = query.execute()
+        # 検索条件の構築（AND検索：全てのフィールドに、OR検索：いずれかのフィールドにキーワードが含まれる）
+        # ページネーション（cursor 指定時はキーセット）
+        query = QuoteQuery(
+            select=select_columns(field_list, text_preview, sort_by),
+            keyword=q, keyword_fields=search_fields_list, keyword_mode="and" if search_type.lower() == "and" else "or",
+            order_by=sort_by, desc=sort_order.lower() == "desc",
+            limit=limit, offset=offset, after=_cursor_position(cursor, sort_by, repo),
+        )
         
-        if response.data is None:
-            return []
+        if facet_list is None:
+            items = await repo.list_quotes(query)
+            set_next_cursor(http_response, items, limit, sort_by, repo.collation)
+            return json_response(shape_rows(items, field_list, text_preview), http_response)
         
-        return response.data
+        items, (total, counts) = await asyncio.gather(
+            repo.list_quotes(query),
+            _load_facets(repo, facet_list, q=q, search_fields=search_fields_list, search_type=search_type.lower()),
+        )
+        set_next_cursor(http_response, items, limit, sort_by, repo.collation)
+        return json_response(
+            {"items": shape_rows(items, field_list, text_preview), "total": total, "facets": counts}, http_response
+        )
         
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"検索エラー: {str(e)}")
 
 @app.get("/quotes/tags", response_model=List[QuoteResponse])
 async def get_quotes_by_tags(
-    tags: str = Query(..., description="タグ（カンマ区切り）"),
+    request: Request,
+    http_response: Response,
+    tags: Optional[str] = Query(None, description="タグ（カンマ区切り）"),
     match_all: bool = Query(False, description="全てのタグにマッチするか（AND検索）"),
+    expr: Optional[str] = Query(None, description="タグ式（例: 努力 AND (成功 OR 継続) AND NOT 失敗）。指定時は tags / match_all より優先"),
     limit: int = Query(50, ge=1, le=100, description="取得件数"),
     offset: int = Query(0, ge=0, description="オフセット"),
+    cursor: Optional[str] = Query(None, description="次ページのカーソル（指定時は offset を無視）"),
     sort_by: Optional[str] = Query("created_at", description="ソート項目"),
-    sort_order: Optional[str] = Query("desc", description="ソート順序 (asc, desc)")
+    sort_order: Optional[str] = Query("desc", description="ソート順序 (asc, desc)"),
+    fields: Optional[str] = Query(None, description="返す項目（カンマ区切り、例: title,author）。id は常に返す"),
+    text_preview: Optional[int] = Query(None, ge=1, le=10000, description="本文を先頭 N 文字に切り詰めて返す"),
+    repo: QuoteRepository = Depends(get_repository)
 ):
-    """タグベースの引用検索（複数タグ・AND/OR検索対応）"""
+    """タグベースの引用検索（複数タグ・AND/OR/NOT のタグ式対応）
+
+    インメモリのタグインデックスが構築済みなら集合演算で評価し、
+    未構築の場合は tags の GIN インデックスが効く cs / ov の条件でDBに問い合わせる
+    """
     try:
-        query = supabase.table("quotes").select("*")
+        field_list = parse_fields(fields)
         
-        # タグリストの作成
-        tag_list = [tag.strip() for tag in tags.split(",") if tag.strip()]
+        cached = version_not_modified(request, http_response, config.HTTP_MAX_AGE_LIST)
+        if cached is not None:
+            return cached
         
-        if not tag_list:
-            raise HTTPException(status_code=400, detail="タグが指定されていません")
-        
-        # タグ検索条件の構築
-        if match_all:
-            # AND検索：全てのタグを含む
-            for tag in tag_list:
-                query = query.contains("tags", [tag])
+        # タグ式の構築
+        if expr:
+            try:
+                node = parse_tag_expression(expr)
+            except ValueError as e:
+                raise HTTPException(status_code=400, detail=str(e))
         else:
-            # OR検索：いずれかのタグを含む
-            for tag in tag_list:
-                query = query.contains("tags", [tag])
+            tag_list = [tag.strip() for tag in (tags or "").split(",") if tag.strip()]
+            if not tag_list:
+                raise HTTPException(status_code=400, detail="タグが指定されていません")
+            # match_all なら全てのタグを含む（AND）、そうでなければいずれかを含む（OR）
+            node = tags_expression(tag_list, match_all)
         
         # ソート
         if sort_order.lower() not in ["asc", "desc"]:
             sort_order = "desc"
         
-        if sort_by in ["title", "text", "theme", "created_at"]:
-            query = query.order(sort_by, desc=(sort_order.lower() == "desc"))
-        else:
-            query = query.order("created_at", desc=True)
+        if sort_by not in SORT_FIELDS:
+            sort_by, sort_order = "created_at", "desc"
         
-        # ページネーション
-        query = query.range(offset, offset + limit - 1)
+        desc = sort_order.lower() == "desc"
         
-        response = query.execute()
+        if corpus.ready and tag_index.ready:
+            rows, next_page = page_rows(tag_index.rows(tag_index.evaluate(node)), sort_by, desc, limit, offset, cursor)
+            if next_page:
+                http_response.headers[NEXT_CURSOR_HEADER] = next_page
+            return json_response(shape_rows(rows, field_list, text_preview), http_response)
         
-        if response.data is None:
-            return []
+        # ページネーション（cursor 指定時はキーセット）
+        columns = select_columns(field_list, text_preview, sort_by)
+        query = QuoteQuery(
+            select=columns, tag_expression=node, order_by=sort_by, desc=desc,
+            limit=limit, offset=offset, after=_cursor_position(cursor, sort_by, repo),
+        )
+        
+        cache_key = make_key("quotes_by_tags", {
+            "expr": node, "limit": limit, "offset": None if cursor else offset,
+            "cursor": cursor, "sort_by": sort_by, "sort_order": sort_order.lower(), "select": columns,
+        })
+        # NOT を含む式はタグを持たない引用の書き込みでも結果が変わる
+        cache_tags = [ALL_QUOTES_TAG] if has_negation(node) else list_tags(
+            tags=sorted(expression_tags(node)), match_all_tags=False
+        )
+        rows = await cache.get_or_load(cache_key, lambda: repo.list_quotes(query), cache_tags)
         
-        return response.data
+        set_next_cursor(http_response, rows, limit, sort_by, repo.collation)
+        return json_response(shape_rows(rows, field_list, text_preview), http_response)
         
     except HTTPException:
         raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"タグ検索エラー: {str(e)}")
 
+@app.get("/quotes/tags/cooccurrence", response_model=dict)
+async def get_tag_cooccurrence(
+    tag: str = Query(..., description="基準のタグ"),
+    limit: int = Query(20, ge=1, le=100, description="返す共起タグの数"),
+    repo: QuoteRepository = Depends(get_repository)
+):
+    """タグの共起件数（tag が付いた引用に一緒に付いているタグと件数、多い順）"""
+    try:
+        if corpus.ready and tag_index.ready:
+            count, pairs = tag_index.cooccurrence(tag, limit)
+            return {
+                "tag": tag,
+                "count": count,
+                "cooccurring": [{"tag": other, "count": n} for other, n in pairs],
+            }
+        
+        params = {"p_tag": tag, "p_limit": limit}
+        cache_key = make_key("tag_cooccurrence", {"tag": tag, "limit": limit})
+        return await cache.get_or_load(cache_key, lambda: repo.rpc("tag_cooccurrence", params, read=True), list_tags(tags=[tag]))
+        
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"タグ検索エラー: {str(e)}")
+
+@app.get("/suggest", response_model=dict)
+async def get_suggestions(
+    q: str = Query("", max_length=100, description="入力中の文字列（前方一致。空なら件数の多い値）"),
+    fields: Optional[str] = Query(None, description="候補を出す項目（tags,theme,subtheme,author,title のカンマ区切り、未指定なら全項目）"),
+    limit: int = Query(10, ge=1, le=50, description="返す候補の数"),
+):
+    """入力補完の候補（全角・半角、カタカナ・ひらがなの違いを問わない前方一致で、引用の件数が多い順）"""
+    field_list = parse_suggest_fields(fields)
+    if not config.CORPUS_ENABLED:
+        raise HTTPException(status_code=503, detail="入力補完は無効です（CORPUS_ENABLED=false）")
+    if not corpus.ready:
+        raise HTTPException(status_code=503, detail="入力補完の索引を準備中です")
+    try:
+        return {"q": q, "suggestions": suggest_index.suggest(q, field_list, limit)}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"入力補完エラー: {str(e)}")
+
+@app.get("/changes")
+async def stream_changes(
+    request: Request,
+    since: Optional[int] = Query(None, ge=0, description="この版より後の変更から送る（Last-Event-ID ヘッダがあればそちらを優先）"),
+):
+    """引用の作成・更新・削除を Server-Sent Events で配信（id に版、event に create / update / delete）
+
+    さかのぼれない版を指定すると reset を送るので、一覧を取り直してから続きを受け取る。
+    読むのが遅く購読者ごとのキューがあふれた場合は overflow を送って切断する（最後に受け取った版から再接続できる）
+    """
+    last_event_id = request.headers.get("last-event-id")
+    if last_event_id:
+        try:
+            since = int(last_event_id)
+        except ValueError:
+            raise HTTPException(status_code=400, detail=f"Last-Event-ID が不正です: {last_event_id}")
+    return StreamingResponse(
+        change_stream(since),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+@app.get("/quotes/export")
+async def export_quotes(
+    format: str = Query("ndjson", description="出力形式 (ndjson, csv)"),
+    gzip: bool = Query(False, description="gzip で圧縮して返す"),
+    theme: Optional[str] = Query(None, description="テーマでフィルタ"),
+    subtheme: Optional[str] = Query(None, description="サブテーマでフィルタ"),
+    tags: Optional[str] = Query(None, description="タグでフィルタ（カンマ区切り）"),
+    author: Optional[str] = Query(None, description="作者でフィルタ"),
+    date_from: Optional[str] = Query(None, description="開始日 (YYYY-MM-DD)"),
+    date_to: Optional[str] = Query(None, description="終了日 (YYYY-MM-DD)"),
+    sort_by: Optional[str] = Query("created_at", description="ソート項目 (title, text, theme, created_at)"),
+    sort_order: Optional[str] = Query("desc", description="ソート順序 (asc, desc)"),
+    repo: QuoteRepository = Depends(get_repository)
+):
+    """条件に合う引用を全件ストリーミングで出力（/quotes と同じフィルタ、件数の上限なし）
+
+    上流からキーセットで EXPORT_PAGE_SIZE 件ずつ取得しながら送り出すため、件数によらずメモリ使用量は一定
+    """
+    format = format.lower()
+    if format not in EXPORT_FORMATS:
+        raise HTTPException(status_code=400, detail="format は ndjson または csv を指定してください")
+    
+    if sort_order.lower() not in ["asc", "desc"]:
+        sort_order = "desc"
+    
+    if sort_by not in SORT_FIELDS:
+        sort_by, sort_order = "created_at", "desc"
+    
+    tag_list = [tag.strip() for tag in tags.split(",")] if tags else []
+    
+    query = QuoteQuery(
+        select=",".join(EXPORT_COLUMNS), theme=theme, subtheme=subtheme, author=author,
+        date_from=date_from, date_to=date_to, tags=tag_list, order_by=sort_by, desc=sort_order.lower() == "desc",
+    )
+    pages = iter_pages(repo, query, config.EXPORT_PAGE_SIZE)
+    filename = f"quotes.{format}" + (".gz" if gzip else "")
+    return StreamingResponse(
+        export_stream(pages, format, gzip),
+        media_type="application/gzip" if gzip else EXPORT_FORMATS[format],
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+    )
+
+# 類似検索インデックスの登録（ワーカーの起動を重くしないよう、最初の類似検索のリクエストで始める）
+_similar_attaching: Optional[asyncio.Task] = None
+
+async def _attach_similar_index():
+    similar_index = await asyncio.to_thread(_similar_index)
+    await corpus.attach(similar_index)
+
+def _ready_similar_index():
+    global _similar_attaching
+    if not config.SIMILAR_ENABLED:
+        raise HTTPException(status_code=503, detail="類似検索は無効です（SIMILAR_ENABLED=false）")
+    if _similar_attaching is None:
+        _similar_attaching = asyncio.create_task(_attach_similar_index())
+    if not _similar_attaching.done():
+        raise HTTPException(status_code=503, detail="類似検索インデックスを準備中です")
+    error = _similar_attaching.exception()
+    if error is not None:
+        # 次のリクエストでやり直す
+        _similar_attaching = None
+        raise HTTPException(status_code=503, detail=f"類似検索インデックスを準備できません: {str(error)}")
+    similar_index = _similar_index()
+    if not similar_index.ready:
+        raise HTTPException(status_code=503, detail="類似検索インデックスを準備中です")
+    return similar_index
+
+@app.get("/quotes/similar", response_model=List[SimilarQuoteResponse])
+async def search_similar_quotes(
+    q: str = Query(..., description="この文章に似た引用を探す"),
+    limit: int = Query(10, ge=1, le=100, description="取得件数"),
+    theme: Optional[str] = Query(None, description="テーマでフィルタ"),
+    tag: Optional[str] = Query(None, description="タグでフィルタ"),
+):
+    """自由文に似た引用を類似度（コサイン類似度）の高い順に取得"""
+    similar_index = _ready_similar_index()
+    
+    try:
+        results = await similar_index.similar_to_text(q, limit, theme, tag)
+        return [{**row, "score": score} for score, row in results]
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"類似検索エラー: {str(e)}")
+
+@app.get("/quotes/{quote_id}/similar", response_model=List[SimilarQuoteResponse])
+async def get_similar_quotes(
+    quote_id: str,
+    limit: int = Query(10, ge=1, le=100, description="取得件数"),
+    theme: Optional[str] = Query(None, description="テーマでフィルタ"),
+    tag: Optional[str] = Query(None, description="タグでフィルタ"),
+):
+    """指定した引用に似た引用を類似度の高い順に取得"""
+    similar_index = _ready_similar_index()
+    
+    try:
+        results = await similar_index.similar_to(quote_id, limit, theme, tag)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"類似検索エラー: {str(e)}")
+    
+    if results is None:
+        raise HTTPException(status_code=404, detail="引用が見つかりません")
+    return [{**row, "score": score} for score, row in results]
+
+async def _load_quote(repo: QuoteRepository, quote_id: str) -> Optional[dict]:
+    """1件の引用をキャッシュ経由で取得"""
+    return await cache.get_or_load(quote_tag(quote_id), lambda: repo.get_quote(quote_id), [quote_tag(quote_id)])
+
+@app.get("/quotes/{quote_id}", response_model=QuoteResponse)
+async def get_quote(
+    quote_id: str,
+    request: Request,
+    http_response: Response,
+    repo: QuoteRepository = Depends(get_repository)
+):
+    """特定の引用を取得"""
+    try:
+        cached = version_not_modified(request, http_response, config.HTTP_MAX_AGE_QUOTE)
+        if cached is not None:
+            return cached
+        
+        quote = await _load_quote(repo, quote_id)
+        
+        if quote is None:
+            raise HTTPException(status_code=404, detail="引用が見つかりません")
+        
+        return quote
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"データベースエラー: {str(e)}")
+
+@app.post("/quotes", response_model=QuoteResponse)
+async def create_quote(quote: QuoteCreate, repo: QuoteRepository = Depends(get_repository)):
+    """新しい引用を作成"""
+    try:
+        rows = await repo.insert_quotes([_quote_values(quote.dict())])
+        
+        if not rows:
+            raise HTTPException(status_code=400, detail="引用の作成に失敗しました")
+        
+        corpus.upsert(rows[0])
+        await invalidate_rows(rows[0])
+        stats_cache.mark_stale()
+        record_change("create", rows[0])
+        return rows[0]
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"データベースエラー: {str(e)}")
+
+def _quote_values(values: dict) -> dict:
+    """リクエストの値を列の型にそろえる（tags はカンマ区切りの文字列を配列にする）"""
+    if isinstance(values.get("tags"), str):
+        tags = [tag.strip() for tag in values["tags"].split(",") if tag.strip()]
+        values = {**values, "tags": tags or None}
+    return values
+
+async def _current_row(repo: QuoteRepository, quote_id: str) -> Optional[dict]:
+    """書き込み前の行を取得（コーパスが読み込み済みならDBに問い合わせない）"""
+    if corpus.ready:
+        return corpus.rows.get(quote_id)
+    return await repo.get_quote(quote_id)
+
+@app.put("/quotes/{quote_id}", response_model=QuoteResponse)
+async def update_quote(quote_id: str, quote: QuoteUpdate, repo: QuoteRepository = Depends(get_repository)):
+    """引用を更新"""
+    try:
+        # 更新データからNoneの値を除外
+        update_data = _quote_values({k: v for k, v in quote.dict().items() if v is not None})
+        
+        if not update_data:
+            raise HTTPException(status_code=400, detail="更新データがありません")
+        
+        # 変更前の値に対応するキャッシュも無効化するため、更新前の行を控えておく
+        old_row = await _current_row(repo, quote_id)
+        
+        row = await repo.update_quote(quote_id, update_data)
+        
+        if row is None:
+            raise HTTPException(status_code=404, detail="引用が見つかりません")
+        
+        corpus.upsert(row)
+        await invalidate_rows(old_row, row)
+        stats_cache.mark_stale()
+        record_change("update", row)
+        return row
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"データベースエラー: {str(e)}")
+
+@app.delete("/quotes/{quote_id}")
+async def delete_quote(quote_id: str, repo: QuoteRepository = Depends(get_repository)):
+    """引用を削除"""
+    try:
+        row = await repo.delete_quote(quote_id)
+        
+        if row is None:
+            raise HTTPException(status_code=404, detail="引用が見つかりません")
+        
+        corpus.remove(quote_id)
+        await invalidate_rows(row)
+        stats_cache.mark_stale()
+        record_change("delete", row)
+        return {"message": "引用が削除されました", "id": quote_id}
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"データベースエラー: {str(e)}")
+
+def _bulk_row(record: dict) -> dict:
+    """一括インポートの1レコードを検証し、INSERT用の行に変換する"""
+    tags = record.get("tags")
+    if isinstance(tags, list):
+        record = {**record, "tags": ",".join(str(tag) for tag in tags)}
+    
+    row = _quote_values(QuoteCreate(**record).dict())
+    # 未指定の項目はDBの既定値（author など）を使う
+    return {k: v for k, v in row.items() if v is not None}
+
+async def _on_imported(rows: List[dict]):
+    """一括登録された行をコーパス・キャッシュに反映"""
+    for row in rows:
+        corpus.upsert(row)
+    await invalidate_rows(*rows)
+    stats_cache.mark_stale()
+    for row in rows:
+        record_change("create", row)
+
+@app.post("/quotes/bulk", response_model=dict)
+async def bulk_import_quotes(
+    request: Request,
+    format: Optional[str] = Query(None, description="本文の形式 (ndjson, csv)。省略時は Content-Type から判定"),
+    dedupe: bool = Query(True, description="title と text が同じ引用（登録済み・アップロード内）を登録しない"),
+    batch_size: int = Query(config.BULK_IMPORT_BATCH_SIZE, ge=1, le=5000, description="1回のINSERTにまとめる件数"),
+    idempotency_key: Optional[str] = Header(None, description="同じキーでの再送は登録をやり直さず前回の結果を返す"),
+    repo: QuoteRepository = Depends(get_repository)
+):
+    """NDJSON / CSV の本文をストリームで読みながら引用を一括登録
+
+    不正な行は行番号付きで errors に記録して処理を続ける。
+    実行中の進捗は GET /quotes/bulk/{job_id} で取得できる（job_id は Idempotency-Key、未指定なら自動採番）
+    """
+    if format is None:
+        content_type = request.headers.get("content-type", "")
+        format = "csv" if "csv" in content_type else "ndjson"
+    format = format.lower()
+    if format not in IMPORT_FORMATS:
+        raise HTTPException(status_code=400, detail="format は ndjson または csv を指定してください")
+    
+    if idempotency_key:
+        previous = await bulk_importer.find_job(idempotency_key)
+        if previous is not None:
+            if previous["status"] == "running":
+                raise HTTPException(status_code=409, detail="同じキーのインポートが実行中です")
+            if previous["status"] == "completed":
+                return previous
+    
+    parse = parse_csv if format == "csv" else parse_ndjson
+    job = await bulk_importer.start_job(idempotency_key, format, dedupe, batch_size)
+    if job is None:
+        # 他のワーカーが同じキーで先に始めた
+        previous = await bulk_importer.find_job(idempotency_key)
+        if previous is not None and previous["status"] == "completed":
+            return previous
+        raise HTTPException(status_code=409, detail="同じキーのインポートが実行中です")
+    await bulk_importer.run(job, repo, parse(request.stream()), _bulk_row, _on_imported)
+    
+    if job.status == "failed":
+        raise HTTPException(status_code=500, detail=f"インポートエラー: {job.error}")
+    return job.to_dict()
+
+@app.get("/quotes/bulk/{job_id}", response_model=dict)
+async def get_bulk_import_job(job_id: str):
+    """一括インポートの進捗・結果を取得"""
+    job = await bulk_importer.find_job(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="インポートジョブが見つかりません")
+    return job
+
+async def _on_impressions_flushed(rows: List[dict]):
+    """書き込まれた感想の件数をコーパスの impression_count に反映し、該当する引用のキャッシュを無効化
+
+    一覧・検索のエントリも impression_count を含むため、引用の値（テーマ・作者・タグ）に対応するエントリも消す
+    """
+    counts = Counter(row["quote_id"] for row in rows)
+    for quote_id, count in counts.items():
+        corpus.increment(quote_id, "impression_count", count)
+    await cache.invalidate_tags({quote_tag(quote_id) for quote_id in counts})
+    
+    if corpus.ready:
+        quotes = [corpus.rows[quote_id] for quote_id in counts if quote_id in corpus.rows]
+    else:
+        repo = await get_repository()
+        quotes = await repo.get_quotes(list(counts))
+    await invalidate_rows(*quotes)
+
+impression_buffer.on_flushed = _on_impressions_flushed
+
+async def _user_exists(repo: QuoteRepository, user_id: str) -> bool:
+    """ユーザーの存在をキャッシュ経由で確認（存在する場合だけキャッシュする）"""
+    async def load():
+        return True if await repo.user_exists(user_id) else None
+    return bool(await cache.get_or_load(f"user:{user_id}", load, [f"user:{user_id}"]))
+
+@app.post("/impressions", response_model=ImpressionResponse, status_code=202)
+async def create_impression(impression: ImpressionCreate, repo: QuoteRepository = Depends(get_repository)):
+    """引用への感想を登録
+
+    書き込みはバッファにまとめて非同期に行うため、応答時点ではまだDBに入っていないことがある
+    （最大 IMPRESSIONS_FLUSH_INTERVAL 秒後に書き込まれる）。
+    引用とユーザーの存在は受け付ける前に確かめる。確認後に引用やユーザーが削除されるなどして
+    書き込み時に弾かれた行は応答を返した後なので捨てられ、/impressions/stats の dropped に数える
+    """
+    if not impression.impression.strip():
+        raise HTTPException(status_code=400, detail="感想が空です")
+    
+    quote_id = str(impression.quote_id)
+    user_id = str(impression.user_id)
+    try:
+        if not (corpus.ready and quote_id in corpus.rows) and await _load_quote(repo, quote_id) is None:
+            raise HTTPException(status_code=404, detail="引用が見つかりません")
+        if not await _user_exists(repo, user_id):
+            raise HTTPException(status_code=404, detail="ユーザーが見つかりません")
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"データベースエラー: {str(e)}")
+    
+    row = {
+        "id": str(uuid4()),
+        "quote_id": quote_id,
+        "user_id": user_id,
+        "impression": impression.impression,
+        "created_at": datetime.now(timezone.utc).isoformat(),
+    }
+    try:
+        await impression_buffer.add(row)
+    except Exception as e:
+        raise HTTPException(status_code=503, detail=f"感想の書き込みが滞っています: {str(e)}")
+    return row
+
+async def _list_impressions(
+    repo: QuoteRepository, http_response: Response, field: str, value: str, limit: int, cursor: Optional[str]
+) -> List[dict]:
+    """field で絞り込んだ感想を新しい順（created_at, id のキーセット）に取得"""
+    if impression_buffer.has_pending(field, value):
+        # 自分の書き込みが一覧に見えるよう、未書き込みの行を先に書き込む（失敗しても一覧は返す）
+        try:
+            await impression_buffer.flush()
+        except Exception:
+            pass
+    
+    rows = await repo.list_impressions(field, value, limit, _cursor_position(cursor, "created_at", repo))
+    set_next_cursor(http_response, rows, limit, "created_at", repo.collation)
+    return rows
+
+@app.get("/quotes/{quote_id}/impressions", response_model=List[ImpressionResponse])
+async def get_quote_impressions(
+    quote_id: str,
+    http_response: Response,
+    limit: int = Query(20, ge=1, le=100, description="取得件数"),
+    cursor: Optional[str] = Query(None, description="次ページのカーソル"),
+    repo: QuoteRepository = Depends(get_repository)
+):
+    """引用への感想を新しい順に取得"""
+    try:
+        return await _list_impressions(repo, http_response, "quote_id", quote_id, limit, cursor)
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"データベースエラー: {str(e)}")
+
+@app.get("/users/{user_id}/impressions", response_model=List[ImpressionResponse])
+async def get_user_impressions(
+    user_id: str,
+    http_response: Response,
+    limit: int = Query(20, ge=1, le=100, description="取得件数"),
+    cursor: Optional[str] = Query(None, description="次ページのカーソル"),
+    repo: QuoteRepository = Depends(get_repository)
+):
+    """ユーザーの感想を新しい順に取得"""
+    try:
+        return await _list_impressions(repo, http_response, "user_id", user_id, limit, cursor)
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"データベースエラー: {str(e)}")
+
+@app.get("/impressions/stats", response_model=dict)
+async def get_impression_stats():
+    """感想の書き込みバッファの状況（未書き込み件数、書き込み済み件数、登録できなかった件数など）"""
+    return impression_buffer.stats()
+
 @app.get("/quotes/theme/{theme}", response_model=List[QuoteResponse])
 async def get_quotes_by_theme(
     theme: str,
+    request: Request,
+    http_response: Response,
     limit: int = Query(50, ge=1, le=100, description="取得件数"),
-    offset: int = Query(0, ge=0, description="オフセット")
+    offset: int = Query(0, ge=0, description="オフセット"),
+    cursor: Optional[str] = Query(None, description="次ページのカーソル（指定時は offset を無視）"),
+    fields: Optional[str] = Query(None, description="返す項目（カンマ区切り、例: title,author）。id は常に返す"),
+    text_preview: Optional[int] = Query(None, ge=1, le=10000, description="本文を先頭 N 文字に切り詰めて返す"),
+    repo: QuoteRepository = Depends(get_repository)
 ):
     """テーマ別の引用を取得"""
     try:
-        response = supabase.table("quotes").select("*").eq("theme", theme).order("created_at", desc=True).range(offset, offset + limit - 1).execute()
+        field_list = parse_fields(fields)
+        
+        cached = version_not_modified(request, http_response, config.HTTP_MAX_AGE_LIST)
+        if cached is not None:
+            return cached
+        
+        columns = select_columns(field_list, text_preview, "created_at")
+        query = QuoteQuery(
+            select=columns, theme=theme, limit=limit, offset=offset, after=_cursor_position(cursor, "created_at", repo)
+        )
         
-        if response.data is None:
-            return []
+        cache_key = make_key("quotes_by_theme", {
+            "theme": theme, "limit": limit, "offset": None if cursor else offset, "cursor": cursor,
+            "select": columns,
+        })
+        rows = await cache.get_or_load(cache_key, lambda: repo.list_quotes(query), list_tags(theme=theme))
         
-        return response.data
+        set_next_cursor(http_response, rows, limit, "created_at", repo.collation)
+        return json_response(shape_rows(rows, field_list, text_preview), http_response)
         
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"データベースエラー: {str(e)}")
 
 # 統計情報
 
 @app.get("/stats", response_model=StatsResponse)
-async def get_stats():
-    """拡張統計情報を取得"""
+async def get_stats(
+    request: Request,
+    http_response: Response,
+    theme: Optional[str] = Query(None, description="テーマでフィルタ"),
+    author: Optional[str] = Query(None, description="作者でフィルタ"),
+    date_from: Optional[str] = Query(None, description="開始日 (YYYY-MM-DD)"),
+    date_to: Optional[str] = Query(None, description="終了日 (YYYY-MM-DD)"),
+    repo: QuoteRepository = Depends(get_repository)
+):
+    """拡張統計情報を取得
+
+    フィルタなしの場合はトリガで維持されている統計カウンタから返し、
+    フィルタ指定時はDB側の quote_stats 関数でその場で集計する。
+    結果は STATS_TTL 秒は新鮮な値として返し、その後は古い値を返しながら裏で1回だけ再取得する。
+    ETag は返す値の内容から作るため、古い値を返している間は書き込み後も 304 になりうる
+    """
     try:
-        # 全引用を取得
-        response = supabase.table("quotes").select("*").execute()
+        async def load():
+            if theme or author or date_from or date_to:
+                params = {
+                    "p_theme": theme,
+                    "p_author": author,
+                    "p_date_from": date_from,
+                    "p_date_to": date_to,
+                }
+                return await repo.rpc("quote_stats", params, read=True)
+            return await repo.rpc("quote_stats_summary", {}, read=True)
         
-        if response.data is None:
+        stats = await stats_cache.get(
+            make_key("stats", {"theme": theme, "author": author, "date_from": date_from, "date_to": date_to}),
+            load,
+        )
+        
+        # 手元の値から ETag を作り、クライアントと同じ内容なら 304 を返す
+        cached = not_modified(
+            request, http_response, content_etag(request, stats), data_version.changed_at, config.HTTP_MAX_AGE_STATS
+        )
+        if cached is not None:
+            return cached
+        
+        if not stats:
             return StatsResponse(
                 total_quotes=0,
                 themes={},
@@ -405,68 +1130,33 @@ async def get_stats():
                 monthly_stats={}
             )
         
-        quotes = response.data
-        
-        # 基本統計
-        total_quotes = len(quotes)
-        
-        # テーマ別件数
-        themes = {}
-        subthemes = {}
-        authors = {}
-        tags = {}
-        
-        for quote in quotes:
-            # テーマ統計
-            theme = quote.get("theme", "未分類")
-            themes[theme] = themes.get(theme, 0) + 1
-            
-            # サブテーマ統計
-            subtheme = quote.get("subtheme", "未分類")
-            subthemes[subtheme] = subthemes.get(subtheme, 0) + 1
-            
-            # 作者統計
-            author = quote.get("author", "不明")
-            authors[author] = authors.get(author, 0) + 1
-            
-            # タグ統計
-            quote_tags = quote.get("tags", [])
-            if isinstance(quote_tags, list):
-                for tag in quote_tags:
-                    tags[tag] = tags.get(tag, 0) + 1
-        
-        # 日付範囲
-        dates = [quote["created_at"] for quote in quotes if quote.get("created_at")]
-        date_range = {
-            "min": min(dates) if dates else None,
-            "max": max(dates) if dates else None
-        }
-        
-        # 月別統計
-        monthly_stats = {}
-        for quote in quotes:
-            if quote.get("created_at"):
-                try:
-                    from datetime import datetime
-                    date_obj = datetime.fromisoformat(quote["created_at"].replace("Z", "+00:00"))
-                    month_key = f"{date_obj.year}-{date_obj.month:02d}"
-                    monthly_stats[month_key] = monthly_stats.get(month_key, 0) + 1
-                except:
-                    pass
-        
-        return StatsResponse(
-            total_quotes=total_quotes,
-            themes=themes,
-            subthemes=subthemes,
-            tags=tags,
-            authors=authors,
-            date_range=date_range,
-            monthly_stats=monthly_stats
-        )
+        return StatsResponse(**stats)
         
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"統計計算エラー: {str(e)}")
 
+@app.get("/health/live", response_model=dict)
+async def liveness():
+    """プロセスが応答できるか（イベントループが止まっていなければ常に 200）"""
+    return {"status": "ok"}
+
+@app.get("/health/ready", response_model=dict)
+async def readiness(http_response: Response):
+    """ウォームアップが済んでリクエストを受けられるか（準備中・終了処理中は 503）"""
+    if not lifecycle.ready:
+        http_response.status_code = 503
+    return lifecycle.status()
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    """Prometheus のテキスト形式のメトリクス（ワーカープロセスごとの値）"""
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+@app.get("/cache/stats", response_model=dict)
+async def get_cache_stats():
+    """読み取りキャッシュのヒット率・エビクション数などを取得"""
+    return {**cache.stats(), "coalesced_requests": flight.shared}
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8000) 
\ No newline at end of file
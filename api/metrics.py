@@ -0,0 +1,407 @@
+"""
+計測とメトリクス（/metrics）
+
+ルート（パスのテンプレート）ごとのレイテンシのヒストグラム、処理中のリクエスト数、
+上流への問い合わせの回数・所要時間・取得行数・バイト数を記録し、Prometheus のテキスト形式で出力する。
+値はワーカープロセスごとに持つ（Prometheus からはワーカーごとに集める）。
+
+上流への問い合わせはリクエストのコンテキストにも積み、Server-Timing ヘッダと
+遅いリクエストのログ（実行したクエリつき）に使う。singleflight で共有された問い合わせは
+最初に実行したリクエストに計上する。
+PROFILE_ENABLED=true なら X-Profile ヘッダ付きのリクエストをプロファイルして PROFILE_DIR に保存する
+（pyinstrument があればサンプリングプロファイラ、なければ cProfile）。
+"""
+
+import bisect
+import logging
+import os
+import random
+import time
+import uuid
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from fastapi.exception_handlers import http_exception_handler
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.requests import Request
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+try:
+    from pyinstrument import Profiler
+except ImportError:  # pyinstrument は任意
+    Profiler = None
+
+logger = logging.getLogger(__name__)
+
+# レイテンシのヒストグラムの境界（秒）
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# 1リクエストで記録しておくクエリ文の上限（遅いリクエストのログ用）
+MAX_STATEMENTS = 50
+# ログに出すクエリ文の最大長
+MAX_STATEMENT_LENGTH = 500
+
+# どのルートにも一致しなかったリクエストのラベル（パスをそのままラベルにしない）
+UNMATCHED_ROUTE = "<unmatched>"
+
+PROFILE_HEADER = "x-profile"
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Tuple[str, ...], values: Tuple[str, ...], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class Metric:
+    """ラベルごとの値を持つメトリクスの基底クラス"""
+
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labels: Iterable[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labels)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def _key(self, labels: Dict[str, object]) -> Tuple[str, ...]:
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def samples(self) -> Iterable[str]:
+        for key, value in sorted(self._values.items()):
+            yield f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self.samples())
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    """単調に増える累計"""
+
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def set_total(self, value: float, **labels):
+        """ほかのモジュールが数えている累計をそのまま写す"""
+        self._values[self._key(labels)] = value
+
+
+class Gauge(Metric):
+    """増減する現在値"""
+
+    kind = "gauge"
+
+    def set(self, value: float, **labels):
+        self._values[self._key(labels)] = value
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+    """値の分布（累積バケット・合計・件数）"""
+
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labels: Iterable[str] = (), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(buckets)
+        # ラベル -> (バケットごとの件数（非累積、最後は +Inf）, 合計)
+        self._series: Dict[Tuple[str, ...], Tuple[List[int], List[float]]] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        series = self._series.get(key)
+        if series is None:
+            series = self._series[key] = ([0] * (len(self.buckets) + 1), [0.0])
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1][0] += value
+
+    def samples(self) -> Iterable[str]:
+        for key, (counts, total) in sorted(self._series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = f'le="{_format_value(bound)}"'
+                yield f"{self.name}_bucket{_format_labels(self.labelnames, key, le)} {cumulative}"
+            yield f"{self.name}_sum{_format_labels(self.labelnames, key)} {_format_value(total[0])}"
+            yield f"{self.name}_count{_format_labels(self.labelnames, key)} {cumulative}"
+
+
+class Registry:
+    """メトリクスの登録と Prometheus テキスト形式での出力"""
+
+    def __init__(self):
+        self._metrics: List[Metric] = []
+        self._collectors: List[Callable[[], None]] = []
+
+    def register(self, metric: Metric) -> Metric:
+        self._metrics.append(metric)
+        return metric
+
+    def add_collector(self, collector: Callable[[], None]):
+        """出力の直前に呼ぶ関数（ほかのモジュールの統計をメトリクスに写す）"""
+        self._collectors.append(collector)
+
+    def render(self) -> str:
+        for collector in self._collectors:
+            try:
+                collector()
+            except Exception:
+                logger.exception("メトリクスの収集に失敗しました")
+        return "\n".join(metric.render() for metric in self._metrics) + "\n"
+
+
+registry = Registry()
+
+http_requests = registry.register(Counter(
+    "http_requests_total", "リクエスト数", ("method", "route", "status")
+))
+http_request_duration = registry.register(Histogram(
+    "http_request_duration_seconds", "リクエストの処理時間（秒）", ("method", "route")
+))
+http_requests_in_flight = registry.register(Gauge(
+    "http_requests_in_flight", "処理中のリクエスト数"
+))
+http_errors = registry.register(Counter(
+    "http_errors_total", "500 系で返したリクエストの元の例外", ("route", "exception")
+))
+upstream_queries = registry.register(Counter(
+    "upstream_queries_total", "上流への問い合わせ数", ("backend", "operation", "outcome")
+))
+upstream_query_duration = registry.register(Histogram(
+    "upstream_query_duration_seconds", "上流への問い合わせの所要時間（秒）", ("backend", "operation")
+))
+upstream_queries_in_flight = registry.register(Gauge(
+    "upstream_queries_in_flight", "実行中の上流への問い合わせ数", ("backend",)
+))
+upstream_rows = registry.register(Counter(
+    "upstream_rows_total", "上流から取得した行数", ("backend", "operation")
+))
+upstream_bytes = registry.register(Counter(
+    "upstream_response_bytes_total", "上流から受信したレスポンスの本文のバイト数（HTTP 経由のみ）", ("backend",)
+))
+request_upstream_queries = registry.register(Histogram(
+    "http_request_upstream_queries", "1リクエストあたりの上流への問い合わせ数", ("route",),
+    buckets=(0, 1, 2, 3, 5, 10, 20, 50),
+))
+
+
+@dataclass
+class RequestStats:
+    """1リクエストの上流への問い合わせの集計"""
+
+    queries: int = 0
+    upstream_seconds: float = 0.0
+    rows: int = 0
+    bytes: int = 0
+    # (バックエンド, クエリ文, 秒)
+    statements: List[Tuple[str, str, float]] = field(default_factory=list)
+
+
+_request_stats: ContextVar[Optional[RequestStats]] = ContextVar("request_stats", default=None)
+
+
+class QueryTimer:
+    """上流への問い合わせ1回を計測する（rows に取得行数を入れる）"""
+
+    def __init__(self, backend: str, operation: str, statement: str):
+        self.backend = backend
+        self.operation = operation
+        self.statement = statement
+        self.rows = 0
+
+    def __enter__(self) -> "QueryTimer":
+        upstream_queries_in_flight.inc(backend=self.backend)
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        seconds = time.perf_counter() - self.started
+        upstream_queries_in_flight.dec(backend=self.backend)
+        upstream_queries.inc(
+            backend=self.backend, operation=self.operation, outcome="error" if exc_type else "ok"
+        )
+        upstream_query_duration.observe(seconds, backend=self.backend, operation=self.operation)
+        if self.rows:
+            upstream_rows.inc(self.rows, backend=self.backend, operation=self.operation)
+
+        stats = _request_stats.get()
+        if stats is not None:
+            stats.queries += 1
+            stats.upstream_seconds += seconds
+            stats.rows += self.rows
+            if len(stats.statements) < MAX_STATEMENTS:
+                stats.statements.append((self.backend, self.statement, seconds))
+        return False
+
+
+def track_query(backend: str, operation: str, statement: str) -> QueryTimer:
+    return QueryTimer(backend, operation, statement)
+
+
+def record_response_bytes(backend: str, size: int):
+    """上流から受信したレスポンスの本文のバイト数を記録"""
+    upstream_bytes.inc(size, backend=backend)
+    stats = _request_stats.get()
+    if stats is not None:
+        stats.bytes += size
+
+
+def _route_label(scope: Scope) -> str:
+    route = scope.get("route")
+    return getattr(route, "path", None) or UNMATCHED_ROUTE
+
+
+async def error_handler(request: Request, exc):
+    """500 系の HTTPException の元の例外を記録してから通常どおり応答する"""
+    if exc.status_code >= 500:
+        cause = exc.__cause__ or exc.__context__
+        route = _route_label(request.scope)
+        http_errors.inc(route=route, exception=type(cause).__name__ if cause else "HTTPException")
+        # 準備中の 503 など、例外から変換したのでないものはログに出さない
+        if cause is not None:
+            logger.error("%s %s が %d を返しました: %s", request.method, route, exc.status_code, exc.detail, exc_info=cause)
+    return await http_exception_handler(request, exc)
+
+
+class _RequestProfiler:
+    """1リクエスト分のプロファイル（pyinstrument、なければ cProfile）"""
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        if Profiler is not None:
+            self._profiler = Profiler(async_mode="enabled")
+        else:
+            import cProfile
+
+            # cProfile はスレッド単位のため、同時に処理中のほかのリクエストも含まれる
+            self._profiler = cProfile.Profile()
+
+    def start(self):
+        if Profiler is not None:
+            self._profiler.start()
+        else:
+            self._profiler.enable()
+
+    def stop(self) -> str:
+        os.makedirs(self.directory, exist_ok=True)
+        name = f"{time.strftime('%Y%m%dT%H%M%S')}-{uuid.uuid4().hex[:8]}"
+        if Profiler is not None:
+            self._profiler.stop()
+            path = os.path.join(self.directory, f"{name}.html")
+            with open(path, "w", encoding="utf-8") as f:
+                f.write(self._profiler.output_html())
+        else:
+            self._profiler.disable()
+            path = os.path.join(self.directory, f"{name}.prof")
+            self._profiler.dump_stats(path)
+        return path
+
+
+class MetricsMiddleware:
+    """リクエストの処理時間と上流への問い合わせを計測する"""
+
+    def __init__(
+        self,
+        app: ASGIApp,
+        slow_request_seconds: float = 1.0,
+        profile_enabled: bool = False,
+        profile_dir: str = "profiles",
+        profile_sample_rate: float = 0.0,
+    ):
+        self.app = app
+        self.slow_request_seconds = slow_request_seconds
+        self.profile_enabled = profile_enabled
+        self.profile_dir = profile_dir
+        self.profile_sample_rate = profile_sample_rate
+
+    def _profiler(self, scope: Scope) -> Optional[_RequestProfiler]:
+        if not self.profile_enabled:
+            return None
+        if PROFILE_HEADER in Headers(scope=scope) or random.random() < self.profile_sample_rate:
+            return _RequestProfiler(self.profile_dir)
+        return None
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        stats = RequestStats()
+        token = _request_stats.set(stats)
+        profiler = self._profiler(scope)
+        status = 500
+        # SSE は接続している間ずっと続くため、処理時間として数えない
+        event_stream = False
+        started = time.perf_counter()
+
+        async def send_with_timing(message: Message):
+            nonlocal status, event_stream
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                # ブラウザの開発者ツールで上流とアプリの時間の内訳を見られるようにする
+                elapsed = (time.perf_counter() - started) * 1000
+                upstream = stats.upstream_seconds * 1000
+                headers = MutableHeaders(scope=message)
+                event_stream = headers.get("content-type", "").startswith("text/event-stream")
+                headers.append(
+                    "Server-Timing",
+                    f'upstream;dur={upstream:.1f};desc="{stats.queries} queries", app;dur={elapsed - upstream:.1f}',
+                )
+            await send(message)
+
+        http_requests_in_flight.inc()
+        if profiler is not None:
+            profiler.start()
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            seconds = time.perf_counter() - started
+            http_requests_in_flight.dec()
+            _request_stats.reset(token)
+
+            method, route = scope["method"], _route_label(scope)
+            http_requests.inc(method=method, route=route, status=status)
+            if not event_stream:
+                http_request_duration.observe(seconds, method=method, route=route)
+            request_upstream_queries.observe(stats.queries, route=route)
+
+            if profiler is not None:
+                path = profiler.stop()
+                logger.info("%s %s のプロファイルを保存しました: %s", method, scope["path"], path)
+            if 0 < self.slow_request_seconds <= seconds and not event_stream:
+                self._log_slow(scope, route, status, seconds, stats)
+
+    @staticmethod
+    def _log_slow(scope: Scope, route: str, status: int, seconds: float, stats: RequestStats):
+        query = scope.get("query_string", b"").decode("latin-1")
+        lines = [
+            f"遅いリクエスト: {scope['method']} {scope['path']}{'?' + query if query else ''}（{route}）"
+            f" {status} {seconds:.3f}秒 上流 {stats.queries}回 {stats.upstream_seconds:.3f}秒"
+            f" {stats.rows}行 {stats.bytes}バイト"
+        ]
+        for backend, statement, duration in stats.statements:
+            lines.append(f"  [{backend}] {duration * 1000:.1f}ms {statement[:MAX_STATEMENT_LENGTH]}")
+        logger.warning("\n".join(lines))
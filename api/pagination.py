@@ -0,0 +1,139 @@
+"""
+キーセット（カーソル）ページネーション
+
+カーソルは「ソート項目の値 + id」を base64url でエンコードした不透明な文字列。
+OFFSET と違い読み飛ばす行をDBが走査しないため、深いページでも速度が落ちず、
+スクロール中に引用が追加されてもページがずれない。
+
+文字列の並び順はインメモリ（Python）ではコードポイント順になる。直接接続の PostgreSQL では
+COLLATE "C" で同じ順に並べるが、PostgREST では DB の照合順序になるため、カーソルには
+作ったときの並び順（照合順序）を記録し、異なる並び順の経路では受け付けない（行の読み飛ばし・重複を防ぐ）。
+"""
+
+import base64
+import bisect
+import json
+from typing import Any, Callable, List, Optional, Tuple
+
+from fastapi import HTTPException
+
+# キーセットで使えるソート項目（id はタイブレーカー）
+SORT_FIELDS = ["title", "text", "theme", "created_at"]
+
+# NULL を取りうるソート項目
+NULLABLE_SORT_FIELDS = {"theme"}
+
+# 並び順が照合順序で変わるソート項目（created_at と関連度は経路によらず同じ順）
+COLLATED_SORT_FIELDS = {"title", "text", "theme"}
+
+# コードポイント順（インメモリ・COLLATE "C"）
+CODEPOINT_COLLATION = "C"
+
+# レスポンスヘッダで次ページのカーソルを返す
+NEXT_CURSOR_HEADER = "X-Next-Cursor"
+
+
+def encode_cursor(sort_by: str, value: Any, quote_id: str, collation: str = CODEPOINT_COLLATION) -> str:
+    payload = json.dumps([sort_by, value, quote_id, collation], ensure_ascii=False, separators=(",", ":"))
+    return base64.urlsafe_b64encode(payload.encode("utf-8")).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor: str, sort_by: str, collation: str = CODEPOINT_COLLATION) -> Tuple[Any, str]:
+    """カーソルを (ソート値, id) に戻す（ソート項目または文字列の並び順が異なるカーソルは不正とする）"""
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        cursor_sort_by, value, quote_id, cursor_collation = json.loads(base64.urlsafe_b64decode(padded).decode("utf-8"))
+    except Exception:
+        raise HTTPException(status_code=400, detail="カーソルが不正です")
+
+    if cursor_sort_by != sort_by or not isinstance(quote_id, str):
+        raise HTTPException(status_code=400, detail="カーソルが不正です")
+    if sort_by in COLLATED_SORT_FIELDS and cursor_collation != collation:
+        raise HTTPException(status_code=400, detail="カーソルを作ったときと並び順が異なります。先頭から取得し直してください")
+    return value, quote_id
+
+
+def next_cursor(rows: List[dict], limit: int, sort_by: str, collation: str = CODEPOINT_COLLATION) -> Optional[str]:
+    """ページが埋まっていれば最後の行から次ページのカーソルを作る"""
+    if len(rows) < limit or not rows:
+        return None
+    last = rows[-1]
+    return encode_cursor(sort_by, last.get(sort_by), last["id"], collation)
+
+
+def set_next_cursor(http_response, rows: List[dict], limit: int, sort_by: str, collation: str = CODEPOINT_COLLATION):
+    """次ページのカーソルをレスポンスヘッダに設定する（collation は rows を並べた経路の文字列の並び順）"""
+    cursor = next_cursor(rows, limit, sort_by, collation)
+    if cursor:
+        http_response.headers[NEXT_CURSOR_HEADER] = cursor
+
+
+def _quote(value: Any) -> str:
+    """PostgREST の or/and フィルタ内で使えるよう値をダブルクォートで囲む"""
+    escaped = str(value).replace("\\", "\\\\").replace('"', '\\"')
+    return f'"{escaped}"'
+
+
+def apply_keyset(query, sort_by: str, desc: bool, value: Any, quote_id: str):
+    """カーソル位置より後ろの行だけを返す条件を PostgREST クエリに追加する
+
+    ORDER BY sort_by, id（PostgreSQL 既定の NULLS LAST / DESC は NULLS FIRST）に対応し、
+    比較の大部分を (sort_by, id) インデックスの範囲条件で絞り込めるようにする。
+    """
+    quoted_id = _quote(quote_id)
+
+    if value is None:
+        # NULL の区間にいる場合
+        if desc:
+            return query.or_(f"and({sort_by}.is.null,id.lt.{quoted_id}),{sort_by}.not.is.null")
+        return query.is_(sort_by, "null").gt("id", quote_id)
+
+    quoted = _quote(value)
+    if desc:
+        # DESC では NULL は先頭に並ぶため、この位置より後ろに NULL は来ない
+        return query.lte(sort_by, value).or_(f"{sort_by}.lt.{quoted},id.lt.{quoted_id}")
+    if sort_by in NULLABLE_SORT_FIELDS:
+        return query.or_(f"{sort_by}.gt.{quoted},and({sort_by}.eq.{quoted},id.gt.{quoted_id}),{sort_by}.is.null")
+    return query.gte(sort_by, value).or_(f"{sort_by}.gt.{quoted},id.gt.{quoted_id}")
+
+
+def keyset_key(value: Any, quote_id: str) -> tuple:
+    """インメモリで (sort_by, id) の順に並べるキー
+
+    DB と同じく昇順では NULL を末尾に（NULLS LAST）、降順ではこの逆順なので先頭に（NULLS FIRST）並べる。
+    """
+    return (value is None, value if value is not None else "", quote_id)
+
+
+class _Descending:
+    """降順に並んだキーを bisect で探すため比較を逆にする"""
+
+    __slots__ = ("key",)
+
+    def __init__(self, key: Any):
+        self.key = key
+
+    def __lt__(self, other: "_Descending") -> bool:
+        return other.key < self.key
+
+
+def page_after(rows: List[Any], key: Callable[[Any], Any], cursor_key: Any, reverse: bool) -> List[Any]:
+    """並べ替え済みのインメモリ結果からカーソルより後ろの行を返す（二分探索でキーは O(log n) 回だけ計算する）"""
+    if reverse:
+        start = bisect.bisect_right(rows, _Descending(cursor_key), key=lambda row: _Descending(key(row)))
+    else:
+        start = bisect.bisect_right(rows, cursor_key, key=key)
+    return rows[start:]
+
+
+def page_rows(
+    rows: List[dict], sort_by: str, desc: bool, limit: int, offset: int, cursor: Optional[str]
+) -> Tuple[List[dict], Optional[str]]:
+    """インメモリの結果を (sort_by, id) で並べてページを切り出し、次ページのカーソルと返す"""
+    key = lambda row: keyset_key(row.get(sort_by), row["id"])
+    rows = sorted(rows, key=key, reverse=desc)
+    if cursor:
+        page = page_after(rows, key, keyset_key(*decode_cursor(cursor, sort_by)), desc)[:limit]
+    else:
+        page = rows[offset:offset + limit]
+    return page, next_cursor(page, limit, sort_by)
@@ -0,0 +1,315 @@
+"""
+PostgreSQL への直接接続のリポジトリ（DATABASE_BACKEND=postgres）
+
+asyncpg の接続プールで PostgREST を経由せずに問い合わせる。
+SQL はパラメータ化し、asyncpg が接続ごとにプリペアドステートメントとしてキャッシュする
+（pgbouncer のトランザクションモード経由なら PG_STATEMENT_CACHE_SIZE=0 にする）。
+返す行は REST 経由と同じ形にそろえる（id は文字列、日時は ISO 8601 の文字列）。
+"""
+
+import json
+import re
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from . import config
+from .metrics import track_query
+from .pagination import CODEPOINT_COLLATION, COLLATED_SORT_FIELDS, NULLABLE_SORT_FIELDS
+from .repository import DataError, QuoteQuery, QuoteRepository
+from .singleflight import flight
+from .tag_index import matches_empty
+
+# select に指定できる列と計算列（quotes.sql）
+QUOTE_COLUMNS = {
+    "id", "title", "text", "author", "theme", "subtheme", "tags", "created_at",
+    "random_key", "content_hash", "impression_count",
+}
+COMPUTED_COLUMNS = {"text_preview"}
+
+# 感想の列（unnest で複数行を1つのステートメントにまとめるための型）
+IMPRESSION_COLUMNS = {"id": "uuid", "quote_id": "uuid", "user_id": "uuid", "impression": "text", "created_at": "timestamptz"}
+
+_IDENTIFIER = re.compile(r"[a-z_][a-z0-9_]*")
+
+# メトリクスのラベル用に文の種類と対象（テーブル・関数）を取り出す
+_OPERATION = re.compile(r"^(SELECT|INSERT|UPDATE|DELETE)\b(?:.*?\b(?:FROM|INTO))?\s+([a-z_]+)", re.DOTALL)
+
+
+def _operation(sql: str) -> str:
+    match = _OPERATION.match(sql)
+    if match is None:
+        return sql.split(" ", 1)[0]
+    verb, target = match.groups()
+    return f"{verb} {target}"
+
+
+def _decode_timestamp(value: str) -> str:
+    # PostgREST と同じ 2024-01-01T00:00:00+00:00 の形にする
+    return datetime.fromisoformat(value).isoformat()
+
+
+def _encode_timestamp(value: Any) -> str:
+    return value.isoformat() if isinstance(value, datetime) else str(value)
+
+
+class _Params:
+    """SQL のプレースホルダ（$1, $2, ...）と値"""
+
+    def __init__(self):
+        self.values: List[Any] = []
+
+    def __call__(self, value: Any) -> str:
+        self.values.append(value)
+        return f"${len(self.values)}"
+
+
+def _column(name: str) -> str:
+    if name not in QUOTE_COLUMNS:
+        raise ValueError(f"不明な列です: {name}")
+    return f"q.{name}"
+
+
+def _select_list(select: str) -> str:
+    """PostgREST 形式の列指定（alias:column）を SELECT 句にする"""
+    if select.strip() == "*":
+        return "q.*"
+    items = []
+    for item in select.split(","):
+        alias, _, name = item.strip().rpartition(":")
+        alias = alias or name
+        if not _IDENTIFIER.fullmatch(alias):
+            raise ValueError(f"不正な列名です: {alias}")
+        expression = f"{name}(q)" if name in COMPUTED_COLUMNS else _column(name)
+        items.append(f"{expression} AS {alias}")
+    return ", ".join(items)
+
+
+def _tag_condition(node: tuple, p: _Params) -> str:
+    """タグ式の構文木を SQL にする（タグだけの AND は @>、OR は && にまとめて GIN インデックスを使う）"""
+    kind = node[0]
+    if kind == "tag":
+        return f"q.tags @> {p([node[1]])}::text[]"
+    if kind == "not":
+        return f"NOT ({_tag_condition(node[1], p)})"
+
+    children = node[1]
+    if all(child[0] == "tag" for child in children):
+        operator = "@>" if kind == "and" else "&&"
+        return f"q.tags {operator} {p([child[1] for child in children])}::text[]"
+    joiner = " AND " if kind == "and" else " OR "
+    return "(" + joiner.join(_tag_condition(child, p) for child in children) + ")"
+
+
+def _sort_column(name: str) -> str:
+    """ソート・キーセットの比較に使う式（文字列はインメモリと同じコードポイント順にする）"""
+    column = _column(name)
+    if name in COLLATED_SORT_FIELDS:
+        return f'{column} COLLATE "{CODEPOINT_COLLATION}"'
+    return column
+
+
+def _keyset_condition(sort_by: str, desc: bool, value: Any, row_id: str, p: _Params) -> str:
+    """ORDER BY sort_by, id でカーソル位置より後ろの行（pagination.apply_keyset と同じ条件）"""
+    column = _sort_column(sort_by)
+    if value is None:
+        # NULL の区間にいる場合
+        if desc:
+            return f"(({column} IS NULL AND q.id < {p(row_id)}) OR {column} IS NOT NULL)"
+        return f"({column} IS NULL AND q.id > {p(row_id)})"
+    operator = "<" if desc else ">"
+    condition = f"({column}, q.id) {operator} ({p(value)}, {p(row_id)})"
+    if not desc and sort_by in NULLABLE_SORT_FIELDS:
+        # ASC では NULL は末尾に並ぶ
+        condition = f"({condition} OR {column} IS NULL)"
+    return condition
+
+
+def build_list_query(query: QuoteQuery) -> Tuple[str, List[Any]]:
+    """QuoteQuery を SELECT 文とパラメータにする"""
+    p = _Params()
+    conditions = []
+    for name in ("theme", "subtheme", "author"):
+        value = getattr(query, name)
+        if value:
+            conditions.append(f"{_column(name)} = {p(value)}")
+    if query.date_from:
+        conditions.append(f"q.created_at >= {p(query.date_from)}")
+    if query.date_to:
+        conditions.append(f"q.created_at <= {p(query.date_to)}")
+    if query.tags:
+        conditions.append(f"q.tags @> {p(list(query.tags))}::text[]")
+
+    if query.tag_expression is not None:
+        condition = _tag_condition(query.tag_expression, p)
+        # タグのない引用は式が NULL になるため、一致すべき場合は明示的に含める
+        if matches_empty(query.tag_expression):
+            condition = f"(q.tags IS NULL OR {condition})"
+        conditions.append(condition)
+
+    if query.keyword is not None:
+        pattern = p(f"%{query.keyword}%")
+        matches = [f"{_column(field)} ILIKE {pattern}" for field in query.keyword_fields]
+        joiner = " AND " if query.keyword_mode == "and" else " OR "
+        conditions.append("(" + joiner.join(matches) + ")")
+
+    direction = "DESC" if query.desc else "ASC"
+    if query.order_by == "id":
+        order = f"q.id {direction}"
+        if query.after is not None:
+            conditions.append(f"q.id {'<' if query.desc else '>'} {p(query.after[1])}")
+    else:
+        order = f"{_sort_column(query.order_by)} {direction}, q.id {direction}"
+        if query.after is not None:
+            conditions.append(_keyset_condition(query.order_by, query.desc, *query.after, p))
+
+    sql = f"SELECT {_select_list(query.select)} FROM quotes q"
+    if conditions:
+        sql += " WHERE " + " AND ".join(conditions)
+    sql += f" ORDER BY {order}"
+    if query.limit is not None:
+        sql += f" LIMIT {p(query.limit)}"
+    if query.after is None and query.offset:
+        sql += f" OFFSET {p(query.offset)}"
+    return sql, p.values
+
+
+class PostgresRepository(QuoteRepository):
+    """asyncpg の接続プールで直接問い合わせるリポジトリ"""
+
+    name = "postgres"
+    collation = CODEPOINT_COLLATION
+
+    def __init__(self, dsn: Optional[str]):
+        self.dsn = dsn
+        self.pool = None
+        # 接続後に asyncpg.PostgresError に差し替える
+        self._errors: tuple = ()
+
+    async def connect(self):
+        try:
+            import asyncpg
+        except ImportError as e:
+            raise RuntimeError("DATABASE_BACKEND=postgres には asyncpg パッケージが必要です") from e
+        if not self.dsn:
+            raise RuntimeError("DATABASE_BACKEND=postgres には DATABASE_URL の設定が必要です")
+
+        self._errors = (asyncpg.PostgresError,)
+        self.pool = await asyncpg.create_pool(
+            self.dsn,
+            min_size=config.PG_POOL_MIN_SIZE,
+            max_size=config.PG_POOL_MAX_SIZE,
+            statement_cache_size=config.PG_STATEMENT_CACHE_SIZE,
+            command_timeout=config.PG_COMMAND_TIMEOUT,
+            server_settings={"TimeZone": "UTC", "DateStyle": "ISO"},
+            init=self._init_connection,
+        )
+
+    @staticmethod
+    async def _init_connection(connection):
+        # REST 経由と同じ値になるよう uuid・日時は文字列、json は Python のオブジェクトで受け取る
+        await connection.set_type_codec("uuid", schema="pg_catalog", encoder=str, decoder=str, format="text")
+        await connection.set_type_codec(
+            "timestamptz", schema="pg_catalog", encoder=_encode_timestamp, decoder=_decode_timestamp, format="text"
+        )
+        for name in ("json", "jsonb"):
+            await connection.set_type_codec(name, schema="pg_catalog", encoder=json.dumps, decoder=json.loads)
+
+    async def _fetch(self, sql: str, args: List[Any]) -> List[dict]:
+        with track_query("postgres", _operation(sql), f"{sql} {args!r}") as timer:
+            rows = await self.pool.fetch(sql, *args)
+            timer.rows = len(rows)
+        return [dict(row) for row in rows]
+
+    async def _read(self, sql: str, args: List[Any]) -> List[dict]:
+        """読み取りは同じ問い合わせが実行中ならその結果を共有する"""
+        return await flight.do(f"{sql} {args!r}", lambda: self._fetch(sql, args))
+
+    async def _write(self, sql: str, args: List[Any]) -> List[dict]:
+        try:
+            return await self._fetch(sql, args)
+        except self._errors as e:
+            # 22: データ例外、23: 整合性制約違反
+            if (e.sqlstate or "")[:2] in ("22", "23"):
+                raise DataError(str(e)) from e
+            raise
+
+    async def list_quotes(self, query: QuoteQuery) -> List[dict]:
+        return await self._read(*build_list_query(query))
+
+    async def get_quote(self, quote_id: str) -> Optional[dict]:
+        rows = await self._read("SELECT * FROM quotes WHERE id = $1", [quote_id])
+        return rows[0] if rows else None
+
+    async def get_quotes(self, quote_ids: List[str]) -> List[dict]:
+        if not quote_ids:
+            return []
+        return await self._read("SELECT * FROM quotes WHERE id = ANY($1::uuid[])", [list(quote_ids)])
+
+    async def insert_quotes(self, rows: List[dict]) -> List[dict]:
+        if not rows:
+            return []
+        columns = sorted({name for row in rows for name in row})
+        for name in columns:
+            _column(name)
+        p = _Params()
+        values = ", ".join(
+            "(" + ", ".join(p(row[name]) if name in row else "DEFAULT" for name in columns) + ")"
+            for row in rows
+        )
+        sql = f"INSERT INTO quotes ({', '.join(columns)}) VALUES {values} RETURNING *"
+        return await self._write(sql, p.values)
+
+    async def update_quote(self, quote_id: str, values: dict) -> Optional[dict]:
+        for name in values:
+            _column(name)
+        p = _Params()
+        assignments = ", ".join(f"{name} = {p(value)}" for name, value in values.items())
+        rows = await self._write(f"UPDATE quotes SET {assignments} WHERE id = {p(quote_id)} RETURNING *", p.values)
+        return rows[0] if rows else None
+
+    async def delete_quote(self, quote_id: str) -> Optional[dict]:
+        rows = await self._write("DELETE FROM quotes WHERE id = $1 RETURNING *", [quote_id])
+        return rows[0] if rows else None
+
+    async def existing_content_hashes(self, hashes: List[str]) -> Set[str]:
+        rows = await self._read("SELECT content_hash FROM quotes WHERE content_hash = ANY($1::text[])", [hashes])
+        return {row["content_hash"] for row in rows}
+
+    async def user_exists(self, user_id: str) -> bool:
+        return bool(await self._read("SELECT id FROM users WHERE id = $1", [user_id]))
+
+    async def insert_impressions(self, rows: List[dict]):
+        # 件数によらず同じ文になるよう列ごとの配列で渡す（プリペアドステートメントを使い回せる）
+        columns = list(IMPRESSION_COLUMNS)
+        arrays = ", ".join(f"${i}::{IMPRESSION_COLUMNS[name]}[]" for i, name in enumerate(columns, 1))
+        sql = f"INSERT INTO impressions ({', '.join(columns)}) SELECT * FROM unnest({arrays})"
+        await self._write(sql, [[row[name] for row in rows] for name in columns])
+
+    async def list_impressions(
+        self, field: str, value: str, limit: int, after: Optional[Tuple[Any, str]]
+    ) -> List[dict]:
+        if field not in ("quote_id", "user_id"):
+            raise ValueError(f"不明な列です: {field}")
+        p = _Params()
+        sql = f"SELECT * FROM impressions WHERE {field} = {p(value)}"
+        if after is not None:
+            sql += f" AND (created_at, id) < ({p(after[0])}, {p(after[1])})"
+        sql += f" ORDER BY created_at DESC, id DESC LIMIT {p(limit)}"
+        return await self._read(sql, p.values)
+
+    async def rpc(self, name: str, params: Dict[str, Any], read: bool = False) -> Any:
+        if not _IDENTIFIER.fullmatch(name) or not all(_IDENTIFIER.fullmatch(key) for key in params):
+            raise ValueError(f"不正な関数名・引数名です: {name}")
+        p = _Params()
+        arguments = ", ".join(f"{key} => {p(value)}" for key, value in params.items())
+        execute = self._read if read else self._write
+        rows = await execute(f"SELECT * FROM {name}({arguments})", p.values)
+        # スカラーを返す関数は列名が関数名の1行1列になる
+        if len(rows) == 1 and list(rows[0]) == [name]:
+            return rows[0][name]
+        return rows
+
+    async def close(self):
+        if self.pool is not None:
+            await self.pool.close()
+            self.pool = None
@@ -0,0 +1,230 @@
+"""
+ランダム引用のサンプリング
+
+コーパスの id をテーマ・タグ・作者ごとの配列として保持し、
+DBに問い合わせずに O(1) でランダムに引用を選ぶ。
+「今日の一句」は日付とフィルタから決まる位置 (0〜1) 以上で最小の random_key を持つ引用で、
+DB側の random_quotes(p_seed => ...) と同じ引用になるため、ワーカーが違っても1日の間は同じ引用を返す。
+SNAPSHOT_DIR を設定した場合は id の配列を持たず、共有スナップショットの行番号から選んでコーパスの行を返す。
+"""
+
+import bisect
+import hashlib
+import itertools
+import random
+from datetime import date
+from typing import Dict, List, Optional, Tuple
+
+from .corpus import CorpusListener, CorpusMirror
+from .snapshot import CorpusSnapshot, SharedSnapshot
+
+
+class _IndexedSet:
+    """O(1) で追加・削除・ランダム取得ができる集合"""
+
+    def __init__(self):
+        self.items: List[str] = []
+        self.positions: Dict[str, int] = {}
+
+    def __len__(self):
+        return len(self.items)
+
+    def __contains__(self, item: str):
+        return item in self.positions
+
+    def add(self, item: str):
+        if item in self.positions:
+            return
+        self.positions[item] = len(self.items)
+        self.items.append(item)
+
+    def discard(self, item: str):
+        position = self.positions.pop(item, None)
+        if position is None:
+            return
+        last = self.items.pop()
+        if position < len(self.items):
+            self.items[position] = last
+            self.positions[last] = position
+
+
+def _pool_keys(row: dict) -> List[Tuple[str, str]]:
+    keys = [("all", "")]
+    if row.get("theme"):
+        keys.append(("theme", row["theme"]))
+    if row.get("author"):
+        keys.append(("author", row["author"]))
+    for tag in row.get("tags") or []:
+        keys.append(("tag", tag))
+    return keys
+
+
+def daily_pivot(day: date, *filters: Optional[str]) -> float:
+    """日付とフィルタから「今日の一句」用の位置 (0〜1) を決める"""
+    material = "|".join([day.isoformat()] + [value or "" for value in filters])
+    seed = int.from_bytes(hashlib.sha256(material.encode("utf-8")).digest()[:8], "big")
+    return (seed >> 11) / float(1 << 53)
+
+
+class RandomPool(CorpusListener):
+    """テーマ・タグ・作者別の id 配列"""
+
+    def __init__(self):
+        self._rows: Dict[str, dict] = {}
+        self._pools: Dict[Tuple[str, str], _IndexedSet] = {}
+        self._daily: Dict[tuple, Optional[dict]] = {}
+        self._loaded = False
+        self._shared: Optional[SharedSnapshot] = None
+        self._corpus: Optional[CorpusMirror] = None
+
+    def use_snapshot(self, shared: SharedSnapshot, corpus: CorpusMirror):
+        """共有スナップショットから選ぶ（行の中身は corpus から引く。リスナーには登録しない）"""
+        self._shared, self._corpus = shared, corpus
+
+    @property
+    def ready(self) -> bool:
+        if self._shared is not None:
+            return self._shared.attached and self._corpus.ready
+        return self._loaded
+
+    def rebuild(self, rows: List[dict]):
+        new_rows: Dict[str, dict] = {}
+        pools: Dict[Tuple[str, str], _IndexedSet] = {}
+        for row in rows:
+            new_rows[row["id"]] = row
+            for key in _pool_keys(row):
+                pools.setdefault(key, _IndexedSet()).add(row["id"])
+        self._rows, self._pools, self._daily = new_rows, pools, {}
+        self._loaded = True
+
+    def upsert(self, row: dict, old: Optional[dict]):
+        if old is not None:
+            self.remove(old)
+        self._rows[row["id"]] = row
+        for key in _pool_keys(row):
+            self._pools.setdefault(key, _IndexedSet()).add(row["id"])
+        self._daily = {}
+
+    def remove(self, row: dict):
+        self._rows.pop(row["id"], None)
+        for key in _pool_keys(row):
+            pool = self._pools.get(key)
+            if pool is None:
+                continue
+            pool.discard(row["id"])
+            if not pool and key != ("all", ""):
+                del self._pools[key]
+        self._daily = {}
+
+    def _candidate_pools(self, theme: Optional[str], tag: Optional[str], author: Optional[str]) -> List[_IndexedSet]:
+        keys = [("theme", theme), ("tag", tag), ("author", author)]
+        pools = [self._pools.get(key, _IndexedSet()) for key in keys if key[1]]
+        if not pools:
+            pools = [self._pools.get(("all", ""), _IndexedSet())]
+        # 最も小さい配列から選び、残りの条件は所属チェックで確認する
+        return sorted(pools, key=len)
+
+    def sample(
+        self,
+        count: int = 1,
+        theme: Optional[str] = None,
+        tag: Optional[str] = None,
+        author: Optional[str] = None,
+    ) -> List[dict]:
+        """条件に合う引用を重複なしでランダムに count 件選ぶ"""
+        if self._shared is not None:
+            return self._sample_snapshot(self._shared.current, count, theme, tag, author)
+        smallest, *others = self._candidate_pools(theme, tag, author)
+        if not others:
+            ids = random.sample(smallest.items, min(count, len(smallest)))
+            return [self._rows[quote_id] for quote_id in ids]
+
+        # 複数条件の場合はランダムな順に見ていき、全条件を満たすものを集める
+        chosen: List[dict] = []
+        for quote_id in random.sample(smallest.items, len(smallest)):
+            if all(quote_id in pool for pool in others):
+                chosen.append(self._rows[quote_id])
+                if len(chosen) >= count:
+                    break
+        return chosen
+
+    def daily(
+        self,
+        day: date,
+        theme: Optional[str] = None,
+        tag: Optional[str] = None,
+        author: Optional[str] = None,
+    ) -> Optional[dict]:
+        """日付とフィルタで決まる「今日の一句」を返す（コーパスが変わるまで結果をキャッシュ）"""
+        if self._shared is not None:
+            return self._daily_snapshot(self._shared.current, day, theme, tag, author)
+        cache_key = (day, theme, tag, author)
+        if cache_key in self._daily:
+            return self._daily[cache_key]
+
+        pivot = daily_pivot(day, theme, tag, author)
+        smallest, *others = self._candidate_pools(theme, tag, author)
+        row = None
+        wrapped = None
+        for quote_id in smallest.items:
+            if not all(quote_id in pool for pool in others):
+                continue
+            candidate = self._rows[quote_id]
+            key = (candidate.get("random_key") or 0.0, quote_id)
+            if key[0] >= pivot:
+                if row is None or key < (row.get("random_key") or 0.0, row["id"]):
+                    row = candidate
+            elif wrapped is None or key < (wrapped.get("random_key") or 0.0, wrapped["id"]):
+                wrapped = candidate
+
+        # pivot 以上がなければ先頭へ折り返す
+        row = row or wrapped
+        self._daily[cache_key] = row
+        return row
+
+
+    @staticmethod
+    def _snapshot_filters(theme: Optional[str], tag: Optional[str], author: Optional[str]) -> List[Tuple[str, str]]:
+        return [item for item in (("theme", theme), ("tags", tag), ("author", author)) if item[1]]
+
+    def _sample_snapshot(
+        self, snapshot: CorpusSnapshot, count: int, theme: Optional[str], tag: Optional[str], author: Optional[str]
+    ) -> List[dict]:
+        smallest, others = snapshot.candidates(self._snapshot_filters(theme, tag, author))
+        order = random.sample(range(len(smallest)), min(count, len(smallest)) if not others else len(smallest))
+        chosen: List[dict] = []
+        for index in order:
+            position = smallest[index]
+            if not all(snapshot.contains(posting, position) for posting in others):
+                continue
+            # スナップショットの公開前に消えた行は飛ばす
+            row = self._corpus.rows.get(snapshot.id_at(position))
+            if row is not None:
+                chosen.append(row)
+                if len(chosen) >= count:
+                    break
+        return chosen
+
+    def _daily_snapshot(
+        self, snapshot: CorpusSnapshot, day: date, theme: Optional[str], tag: Optional[str], author: Optional[str]
+    ) -> Optional[dict]:
+        cache_key = ("daily", day, theme, tag, author)
+        if cache_key in snapshot.memo:
+            return self._corpus.rows.get(snapshot.memo[cache_key])
+
+        # 行は (random_key, id) の順なので、pivot 以上の最初の行から条件を満たすものを探し、なければ先頭へ折り返す
+        pivot = daily_pivot(day, theme, tag, author)
+        smallest, others = snapshot.candidates(self._snapshot_filters(theme, tag, author))
+        random_keys = snapshot.columns["random_key"]
+        start = bisect.bisect_left(smallest, pivot, key=lambda position: random_keys[position])
+        quote_id = None
+        for index in itertools.chain(range(start, len(smallest)), range(start)):
+            position = smallest[index]
+            if all(snapshot.contains(posting, position) for posting in others):
+                quote_id = snapshot.id_at(position)
+                break
+        snapshot.memo[cache_key] = quote_id
+        return self._corpus.rows.get(quote_id) if quote_id else None
+
+
+random_pool = RandomPool()
@@ -0,0 +1,152 @@
+"""
+リポジトリ層（データアクセスの抽象化）
+
+ハンドラやバックグラウンド処理は QuoteRepository のメソッドだけを使い、
+上流が Supabase（PostgREST）か PostgreSQL への直接接続かを意識しない。
+DATABASE_BACKEND で切り替える（supabase: REST 経由 / postgres: asyncpg の接続プールで直接接続）。
+"""
+
+import asyncio
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from . import config
+
+
+class DataError(Exception):
+    """行の内容によるエラー（制約違反・型の不一致など、同じ行を再送しても成功しない）"""
+
+
+@dataclass
+class QuoteQuery:
+    """quotes の一覧取得の条件
+
+    select は PostgREST と同じ書式の列指定（"title,text:text_preview" など、"*" で全列）。
+    after を指定するとキーセット（(order_by の値, id) より後ろ）、なければ offset で取得する。
+    """
+    select: str = "*"
+    theme: Optional[str] = None
+    subtheme: Optional[str] = None
+    author: Optional[str] = None
+    date_from: Optional[str] = None
+    date_to: Optional[str] = None
+    # すべてを含む引用に絞り込むタグ
+    tags: List[str] = field(default_factory=list)
+    # タグ式の構文木（tag_index.parse_tag_expression）
+    tag_expression: Optional[tuple] = None
+    # 部分一致検索（keyword_mode が and なら全フィールド、or ならいずれかのフィールドに含む）
+    keyword: Optional[str] = None
+    keyword_fields: List[str] = field(default_factory=list)
+    keyword_mode: str = "or"
+    order_by: str = "created_at"
+    desc: bool = True
+    limit: Optional[int] = None
+    offset: int = 0
+    after: Optional[Tuple[Any, str]] = None
+
+
+class QuoteRepository:
+    """データアクセスの基底クラス"""
+
+    name = ""
+    # 文字列のソート項目の並び順（"C" ならインメモリと同じコードポイント順）。カーソルに記録する
+    collation = "database"
+
+    async def list_quotes(self, query: QuoteQuery) -> List[dict]:
+        """条件に合う引用を (order_by, id) の順で取得"""
+        raise NotImplementedError
+
+    async def get_quote(self, quote_id: str) -> Optional[dict]:
+        raise NotImplementedError
+
+    async def get_quotes(self, quote_ids: List[str]) -> List[dict]:
+        """複数の引用をまとめて取得（存在しない id の行は含まず、順序は不定）"""
+        raise NotImplementedError
+
+    async def insert_quotes(self, rows: List[dict]) -> List[dict]:
+        """複数行を1回で登録し、登録された行を返す（行にない列はDBの既定値を使う）"""
+        raise NotImplementedError
+
+    async def update_quote(self, quote_id: str, values: dict) -> Optional[dict]:
+        """更新後の行を返す（存在しなければ None）"""
+        raise NotImplementedError
+
+    async def delete_quote(self, quote_id: str) -> Optional[dict]:
+        """削除した行を返す（存在しなければ None）"""
+        raise NotImplementedError
+
+    async def existing_content_hashes(self, hashes: List[str]) -> Set[str]:
+        """登録済みの content_hash"""
+        raise NotImplementedError
+
+    async def user_exists(self, user_id: str) -> bool:
+        """ユーザーが存在するか"""
+        raise NotImplementedError
+
+    async def insert_impressions(self, rows: List[dict]):
+        """感想を複数行INSERTで登録（行の内容によるエラーは DataError）"""
+        raise NotImplementedError
+
+    async def list_impressions(
+        self, field: str, value: str, limit: int, after: Optional[Tuple[Any, str]]
+    ) -> List[dict]:
+        """field で絞り込んだ感想を新しい順（created_at, id の降順）に取得"""
+        raise NotImplementedError
+
+    async def rpc(self, name: str, params: Dict[str, Any], read: bool = False) -> Any:
+        """DB関数を呼び出す（スカラーを返す関数は値、集合を返す関数は行のリスト）
+
+        read=True は読み取りだけの関数で、同じ呼び出しが実行中ならその結果を共有する。
+        """
+        raise NotImplementedError
+
+    async def close(self):
+        pass
+
+
+_repository: Optional[QuoteRepository] = None
+_repository_lock = asyncio.Lock()
+
+
+async def _create_repository() -> QuoteRepository:
+    if config.DATABASE_BACKEND == "postgres":
+        from .postgres_repository import PostgresRepository
+
+        repository = PostgresRepository(config.DATABASE_URL)
+        await repository.connect()
+        return repository
+
+    from .database import get_supabase
+    from .rest_repository import RestRepository
+
+    return RestRepository(await get_supabase())
+
+
+async def get_repository() -> QuoteRepository:
+    """DATABASE_BACKEND に応じたリポジトリを取得（初回呼び出し時に生成）"""
+    global _repository
+
+    if _repository is not None:
+        return _repository
+
+    async with _repository_lock:
+        if _repository is None:
+            _repository = await _create_repository()
+    return _repository
+
+
+def set_repository(repository: Optional[QuoteRepository]):
+    """リポジトリを差し替える（ベンチマークなどで上流のスタンドインをつなぐ）"""
+    global _repository
+
+    _repository = repository
+
+
+async def close_repository():
+    """リポジトリの接続を閉じる"""
+    global _repository
+
+    if _repository is not None:
+        await _repository.close()
+    _repository = None
+
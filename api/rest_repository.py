@@ -0,0 +1,155 @@
+"""
+Supabase（PostgREST）経由のリポジトリ
+
+database.py の共有接続プールと execute()（同時実行数の制限・読み取りの集約）を通して問い合わせる。
+"""
+
+import asyncio
+import json
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from postgrest.exceptions import APIError
+from postgrest.types import ReturnMethod
+from supabase import AsyncClient
+
+from .database import close_supabase, execute
+from .pagination import apply_keyset
+from .repository import DataError, QuoteQuery, QuoteRepository
+from .singleflight import flight
+from .tag_index import matches_empty, to_postgrest
+
+# 既存行の重複確認・複数行の取得で1回の in 条件に含める値の数（URL長の上限対策）
+HASH_LOOKUP_CHUNK = 100
+ID_LOOKUP_CHUNK = 100
+
+
+class RestRepository(QuoteRepository):
+    """PostgREST のクエリビルダーで問い合わせるリポジトリ"""
+
+    name = "supabase"
+
+    def __init__(self, db: AsyncClient):
+        self.db = db
+
+    def _filter(self, builder, query: QuoteQuery):
+        """QuoteQuery の絞り込み条件を PostgREST のフィルタにする"""
+        if query.theme:
+            builder = builder.eq("theme", query.theme)
+        if query.subtheme:
+            builder = builder.eq("subtheme", query.subtheme)
+        if query.author:
+            builder = builder.eq("author", query.author)
+        if query.date_from:
+            builder = builder.gte("created_at", query.date_from)
+        if query.date_to:
+            builder = builder.lte("created_at", query.date_to)
+        for tag in query.tags:
+            builder = builder.contains("tags", [tag])
+
+        if query.tag_expression is not None:
+            # タグのない引用は SQL では式が NULL になるため、一致すべき場合は明示的に含める
+            condition = to_postgrest(query.tag_expression)
+            if matches_empty(query.tag_expression):
+                condition = f"or(tags.is.null,{condition})"
+            builder = builder.or_(condition)
+
+        if query.keyword is not None:
+            pattern = f"%{query.keyword}%"
+            if query.keyword_mode == "and":
+                for field in query.keyword_fields:
+                    builder = builder.ilike(field, pattern)
+            else:
+                builder = builder.or_(",".join(f"{field}.ilike.{pattern}" for field in query.keyword_fields))
+        return builder
+
+    async def list_quotes(self, query: QuoteQuery) -> List[dict]:
+        builder = self._filter(self.db.table("quotes").select(query.select), query)
+        if query.order_by == "id":
+            builder = builder.order("id", desc=query.desc)
+            if query.after is not None:
+                builder = builder.lt("id", query.after[1]) if query.desc else builder.gt("id", query.after[1])
+        else:
+            builder = builder.order(query.order_by, desc=query.desc).order("id", desc=query.desc)
+            if query.after is not None:
+                builder = apply_keyset(builder, query.order_by, query.desc, *query.after)
+
+        if query.limit is not None:
+            if query.after is None:
+                builder = builder.range(query.offset, query.offset + query.limit - 1)
+            else:
+                builder = builder.limit(query.limit)
+        response = await execute(builder)
+        return response.data or []
+
+    async def get_quote(self, quote_id: str) -> Optional[dict]:
+        response = await execute(self.db.table("quotes").select("*").eq("id", quote_id))
+        return response.data[0] if response.data else None
+
+    async def get_quotes(self, quote_ids: List[str]) -> List[dict]:
+        lookups = [
+            execute(self.db.table("quotes").select("*").in_("id", quote_ids[i:i + ID_LOOKUP_CHUNK]))
+            for i in range(0, len(quote_ids), ID_LOOKUP_CHUNK)
+        ]
+        return [row for response in await asyncio.gather(*lookups) for row in response.data or []]
+
+    async def insert_quotes(self, rows: List[dict]) -> List[dict]:
+        try:
+            response = await execute(self.db.table("quotes").insert(rows, default_to_null=False))
+        except APIError as e:
+            raise DataError(str(e)) from e
+        return response.data or []
+
+    async def update_quote(self, quote_id: str, values: dict) -> Optional[dict]:
+        response = await execute(self.db.table("quotes").update(values).eq("id", quote_id))
+        return response.data[0] if response.data else None
+
+    async def delete_quote(self, quote_id: str) -> Optional[dict]:
+        response = await execute(self.db.table("quotes").delete().eq("id", quote_id))
+        return response.data[0] if response.data else None
+
+    async def existing_content_hashes(self, hashes: List[str]) -> Set[str]:
+        lookups = [
+            execute(
+                self.db.table("quotes").select("content_hash").in_("content_hash", hashes[i:i + HASH_LOOKUP_CHUNK])
+            )
+            for i in range(0, len(hashes), HASH_LOOKUP_CHUNK)
+        ]
+        return {
+            row["content_hash"]
+            for response in await asyncio.gather(*lookups)
+            for row in response.data or []
+        }
+
+    async def user_exists(self, user_id: str) -> bool:
+        response = await execute(self.db.table("users").select("id").eq("id", user_id))
+        return bool(response.data)
+
+    async def insert_impressions(self, rows: List[dict]):
+        try:
+            await execute(self.db.table("impressions").insert(rows, returning=ReturnMethod.minimal))
+        except APIError as e:
+            raise DataError(str(e)) from e
+
+    async def list_impressions(
+        self, field: str, value: str, limit: int, after: Optional[Tuple[Any, str]]
+    ) -> List[dict]:
+        builder = (
+            self.db.table("impressions").select("*").eq(field, value)
+            .order("created_at", desc=True).order("id", desc=True)
+        )
+        if after is not None:
+            builder = apply_keyset(builder, "created_at", True, *after)
+        response = await execute(builder.limit(limit))
+        return response.data or []
+
+    async def rpc(self, name: str, params: Dict[str, Any], read: bool = False) -> Any:
+        if not read:
+            response = await execute(self.db.rpc(name, params))
+            return response.data
+        # RPC は POST で送られ execute() では集約されないため、引数込みのキーでまとめる
+        key = f"rpc {name} {json.dumps(params, sort_keys=True, default=str)}"
+        response = await flight.do(key, lambda: execute(self.db.rpc(name, params)))
+        return response.data
+
+    async def close(self):
+        await close_supabase()
@@ -0,0 +1,224 @@
+"""
+引用の全文検索インデックス
+
+日本語は単語区切りがないため、NFKC正規化した文字列を空白で区切り、
+各区切りを文字バイグラム（1文字だけの区切りはユニグラム）に分割して転置インデックスを作る。
+スコアはフィールドごとに重みを付けた BM25F で計算する。
+"""
+
+import math
+import unicodedata
+from collections import Counter
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from .corpus import CorpusListener
+
+# フィールドごとの重み（タイトルを本文より重視する）
+FIELD_WEIGHTS = {
+    "title": 3.0,
+    "text": 1.0,
+    "theme": 1.5,
+    "subtheme": 1.5,
+    "author": 1.0,
+}
+
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+
+def normalize(value: Optional[str]) -> str:
+    """全角・半角や大文字・小文字の揺れを吸収する"""
+    if not value:
+        return ""
+    return unicodedata.normalize("NFKC", value).lower()
+
+
+def ngrams(segment: str) -> List[str]:
+    """区切り1つを文字バイグラムに分割"""
+    if len(segment) == 1:
+        return [segment]
+    return [segment[i:i + 2] for i in range(len(segment) - 1)]
+
+
+def tokenize(value: Optional[str]) -> List[str]:
+    """フィールド値をトークン列に変換"""
+    tokens: List[str] = []
+    for segment in normalize(value).split():
+        tokens.extend(ngrams(segment))
+    return tokens
+
+
+class _IndexState:
+    """インデックス本体（再構築時は丸ごと差し替える）"""
+
+    def __init__(self):
+        self.docs: Dict[str, dict] = {}
+        # field -> token -> {quote_id: 出現回数}
+        self.postings: Dict[str, Dict[str, Dict[str, int]]] = {f: {} for f in FIELD_WEIGHTS}
+        # field -> {quote_id: トークン数}
+        self.lengths: Dict[str, Dict[str, int]] = {f: {} for f in FIELD_WEIGHTS}
+        self.total_lengths: Dict[str, int] = {f: 0 for f in FIELD_WEIGHTS}
+        # 1文字のクエリ用：文字 -> その文字を含むトークン
+        self.char_tokens: Dict[str, Set[str]] = {}
+
+    def add(self, row: dict):
+        quote_id = row["id"]
+        self.docs[quote_id] = row
+        for field in FIELD_WEIGHTS:
+            tokens = tokenize(row.get(field))
+            self.lengths[field][quote_id] = len(tokens)
+            self.total_lengths[field] += len(tokens)
+            postings = self.postings[field]
+            for token, tf in Counter(tokens).items():
+                posting = postings.get(token)
+                if posting is None:
+                    posting = postings[token] = {}
+                    for char in token:
+                        self.char_tokens.setdefault(char, set()).add(token)
+                posting[quote_id] = tf
+
+    def remove(self, row: dict):
+        quote_id = row["id"]
+        if self.docs.pop(quote_id, None) is None:
+            return
+        for field in FIELD_WEIGHTS:
+            self.total_lengths[field] -= self.lengths[field].pop(quote_id, 0)
+            postings = self.postings[field]
+            for token in set(tokenize(row.get(field))):
+                posting = postings.get(token)
+                if posting is None:
+                    continue
+                posting.pop(quote_id, None)
+                if not posting:
+                    del postings[token]
+
+
+class SearchIndex(CorpusListener):
+    """BM25F スコアリング付きのバイグラム転置インデックス"""
+
+    def __init__(self):
+        self._state = _IndexState()
+
+    def __len__(self):
+        return len(self._state.docs)
+
+    def rebuild(self, rows: List[dict]):
+        state = _IndexState()
+        for row in rows:
+            state.add(row)
+        self._state = state
+
+    def upsert(self, row: dict, old: Optional[dict]):
+        if old is not None:
+            self._state.remove(old)
+        self._state.add(row)
+
+    def remove(self, row: dict):
+        self._state.remove(row)
+
+    def search(self, q: str, fields: Iterable[str], search_type: str = "or") -> List[Tuple[float, dict]]:
+        """キーワード検索して (スコア, 行) をスコアの高い順に返す
+
+        空白で区切られた各語をすべて含むフィールドを「一致」とみなし、
+        search_type が and なら全フィールドの一致、or ならいずれかの一致を条件とする。
+        """
+        state = self._state
+        terms = normalize(q).split()
+        fields = [field for field in fields if field in FIELD_WEIGHTS]
+        if not terms or not fields:
+            return []
+
+        matched: Optional[Set[str]] = None
+        # 1文字の語は索引上のトークンと一致しないため、文書頻度をここで数えておく
+        char_doc_freq: Dict[str, int] = {}
+        for field in fields:
+            field_ids: Optional[Set[str]] = None
+            for term in terms:
+                ids = self._match_term(state, field, term)
+                if len(term) == 1:
+                    char_doc_freq[term] = max(char_doc_freq.get(term, 0), len(ids))
+                field_ids = ids if field_ids is None else field_ids & ids
+                if not field_ids:
+                    break
+            field_ids = field_ids or set()
+
+            if matched is None:
+                matched = field_ids
+            elif search_type == "and":
+                matched &= field_ids
+            else:
+                matched |= field_ids
+
+        if not matched:
+            return []
+
+        results = [
+            (self._score(state, quote_id, terms, fields, char_doc_freq), state.docs[quote_id])
+            for quote_id in matched
+        ]
+        results.sort(key=lambda item: (-item[0], item[1]["id"]))
+        return results
+
+    @staticmethod
+    def _match_term(state: _IndexState, field: str, term: str) -> Set[str]:
+        postings = state.postings[field]
+
+        if len(term) == 1:
+            ids: Set[str] = set()
+            for token in state.char_tokens.get(term, ()):
+                ids.update(postings.get(token, ()))
+            return ids
+
+        # 出現件数の少ないトークンから積集合を取る
+        token_postings = sorted((postings.get(token, {}) for token in set(ngrams(term))), key=len)
+        if not token_postings[0]:
+            return set()
+        ids = set(token_postings[0])
+        for posting in token_postings[1:]:
+            ids.intersection_update(posting)
+            if not ids:
+                return ids
+
+        # 3文字以上の語はバイグラムが連続しているとは限らないので部分一致で確認する
+        if len(term) > 2:
+            ids = {quote_id for quote_id in ids if term in normalize(state.docs[quote_id].get(field))}
+        return ids
+
+    @staticmethod
+    def _score(
+        state: _IndexState,
+        quote_id: str,
+        terms: List[str],
+        fields: List[str],
+        char_doc_freq: Dict[str, int],
+    ) -> float:
+        total_docs = len(state.docs)
+        tokens = set()
+        for term in terms:
+            tokens.update(ngrams(term))
+
+        score = 0.0
+        for token in tokens:
+            weighted_tf = 0.0
+            doc_freq = char_doc_freq.get(token, 0)
+            for field in fields:
+                if len(token) == 1:
+                    tf = normalize(state.docs[quote_id].get(field)).count(token)
+                else:
+                    posting = state.postings[field].get(token)
+                    if not posting:
+                        continue
+                    doc_freq = max(doc_freq, len(posting))
+                    tf = posting.get(quote_id)
+                if not tf:
+                    continue
+                avg_length = state.total_lengths[field] / total_docs or 1.0
+                length_norm = 1 - BM25_B + BM25_B * state.lengths[field][quote_id] / avg_length
+                weighted_tf += FIELD_WEIGHTS[field] * tf / length_norm
+            if weighted_tf:
+                idf = math.log(1 + (total_docs - doc_freq + 0.5) / (doc_freq + 0.5))
+                score += idf * weighted_tf * (BM25_K1 + 1) / (BM25_K1 + weighted_tf)
+        return score
+
+
+search_index = SearchIndex()
@@ -0,0 +1,502 @@
+"""
+類似引用の検索（ベクトルインデックス）
+
+title + text を固定長の float32 ベクトルに変換し、コサイン類似度の上位 k 件を返す。
+既定のエンコーダは文字 n-gram の TF-IDF を SVD で圧縮したもの（単語区切りのない日本語でもそのまま使える）。
+SIMILAR_BACKEND=embedding ならローカルの transformers モデルの平均プーリング埋め込みを使う。
+
+SIMILAR_INDEX_DIR に事前構築したインデックス（python -m api.similar build）があれば
+ベクトル行列を読み取り専用で memmap し、同じホストのワーカー間でページキャッシュを共有する。
+インデックス構築後の書き込みは差分（追加・更新ベクトルと削除済み id）として持ち、全体の再計算はしない。
+インデックスは最初の類似検索のリクエストでコーパスに登録する（numpy などをワーカーの起動時に読み込まない）。
+学習（SIMILAR_INDEX_DIR がなければ登録時）は1回だけで、コーパスの定期再読み込みでは
+今の状態と内容が変わった行だけをベクトル化する（python -m api.similar build で置き換えたインデックスは次の再読み込みで読み直す）。
+書き込まれた行と検索文のベクトル化はイベントループを止めないようスレッドで行い、
+書き込みは溜まった分をまとめて1回でベクトル化する（一括インポートでも行ごとにモデルを通さない）。
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import threading
+from typing import Dict, List, Optional, Set, Tuple
+
+import numpy as np
+
+from . import config
+from .bulk_import import content_hash
+from .corpus import CorpusListener
+from .search import normalize
+
+logger = logging.getLogger(__name__)
+
+BACKENDS = ("tfidf", "embedding")
+
+# インデックスディレクトリ内のファイル
+META_FILE = "meta.json"
+VECTORS_FILE = "vectors.f32"
+IDS_FILE = "ids.json"
+ENCODER_FILE = "encoder.joblib"
+
+
+def document(row: dict) -> str:
+    """ベクトル化する文書（タイトルと本文）"""
+    return f"{row.get('title') or ''}\n{row.get('text') or ''}"
+
+
+def row_hash(row: dict) -> str:
+    return row.get("content_hash") or content_hash(row.get("title") or "", row.get("text") or "")
+
+
+def _normalize_rows(vectors: np.ndarray) -> np.ndarray:
+    """各行を単位ベクトルにする（内積がコサイン類似度になる）"""
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+class TfidfEncoder:
+    """文字 n-gram の TF-IDF を SVD で dimensions 次元に圧縮する"""
+
+    backend = "tfidf"
+
+    def __init__(self, dimensions: int):
+        self.dimensions = dimensions
+        self._vectorizer = None
+        self._svd = None
+
+    def fit(self, texts: List[str]) -> np.ndarray:
+        from sklearn.decomposition import TruncatedSVD
+        from sklearn.feature_extraction.text import TfidfVectorizer
+
+        self._vectorizer = TfidfVectorizer(
+            analyzer="char_wb",
+            ngram_range=(2, 3),
+            preprocessor=normalize,
+            sublinear_tf=True,
+            dtype=np.float32,
+        )
+        matrix = self._vectorizer.fit_transform(texts)
+        # 文書数・語彙数より多い次元には圧縮できない
+        components = min(self.dimensions, matrix.shape[0] - 1, matrix.shape[1] - 1)
+        self._svd = TruncatedSVD(n_components=components, random_state=0) if components >= 2 else None
+        if self._svd is None:
+            return _normalize_rows(matrix.toarray())
+        return _normalize_rows(self._svd.fit_transform(matrix))
+
+    def encode(self, texts: List[str]) -> np.ndarray:
+        matrix = self._vectorizer.transform(texts)
+        if self._svd is None:
+            return _normalize_rows(matrix.toarray())
+        return _normalize_rows(self._svd.transform(matrix))
+
+    def save(self, directory: str):
+        import joblib
+
+        joblib.dump({"vectorizer": self._vectorizer, "svd": self._svd}, os.path.join(directory, ENCODER_FILE))
+
+    @classmethod
+    def load(cls, directory: str, meta: dict) -> "TfidfEncoder":
+        import joblib
+
+        encoder = cls(meta["dimensions"])
+        state = joblib.load(os.path.join(directory, ENCODER_FILE))
+        encoder._vectorizer, encoder._svd = state["vectorizer"], state["svd"]
+        return encoder
+
+
+class EmbeddingEncoder:
+    """ローカルの transformers モデルの平均プーリング埋め込み（transformers と torch が必要）"""
+
+    backend = "embedding"
+
+    def __init__(self, model_name: str, batch_size: int = 32):
+        self.model_name = model_name
+        self.batch_size = batch_size
+        self._tokenizer = None
+        self._model = None
+        # 書き込みと検索文のベクトル化が別々のスレッドから同時に呼ぶため、モデルの読み込みは1回にする
+        self._load_lock = threading.Lock()
+
+    def _load_model(self):
+        with self._load_lock:
+            if self._model is not None:
+                return
+            try:
+                from transformers import AutoModel, AutoTokenizer
+            except ImportError as e:
+                raise RuntimeError("SIMILAR_BACKEND=embedding には transformers と torch が必要です") from e
+
+            self._tokenizer = AutoTokenizer.from_pretrained(self.model_name)
+            model = AutoModel.from_pretrained(self.model_name)
+            model.eval()
+            self._model = model
+
+    def fit(self, texts: List[str]) -> np.ndarray:
+        return self.encode(texts)
+
+    def encode(self, texts: List[str]) -> np.ndarray:
+        import torch
+
+        self._load_model()
+        batches = []
+        with torch.no_grad():
+            for i in range(0, len(texts), self.batch_size):
+                inputs = self._tokenizer(
+                    texts[i:i + self.batch_size], padding=True, truncation=True, return_tensors="pt"
+                )
+                hidden = self._model(**inputs).last_hidden_state
+                mask = inputs["attention_mask"].unsqueeze(-1).to(hidden.dtype)
+                pooled = (hidden * mask).sum(dim=1) / mask.sum(dim=1).clamp(min=1e-9)
+                batches.append(pooled.cpu().numpy())
+        return _normalize_rows(np.concatenate(batches) if batches else np.zeros((0, 0)))
+
+    def save(self, directory: str):
+        pass
+
+    @classmethod
+    def load(cls, directory: str, meta: dict) -> "EmbeddingEncoder":
+        return cls(meta["model"])
+
+
+def build_encoder():
+    """設定に応じたエンコーダを作成"""
+    if config.SIMILAR_BACKEND == "embedding":
+        return EmbeddingEncoder(config.SIMILAR_EMBEDDING_MODEL)
+    return TfidfEncoder(config.SIMILAR_DIMENSIONS)
+
+
+def save_index(directory: str, encoder, rows: List[dict], vectors: np.ndarray):
+    """インデックスをディレクトリに書き出す（meta.json を最後に置き換え、読み込み側が途中の状態を見ないようにする）"""
+    os.makedirs(directory, exist_ok=True)
+
+    def replace(name: str, write):
+        path = os.path.join(directory, name)
+        tmp = f"{path}.tmp{os.getpid()}"
+        write(tmp)
+        os.replace(tmp, path)
+
+    encoder.save(directory)
+    replace(VECTORS_FILE, lambda path: np.ascontiguousarray(vectors, dtype=np.float32).tofile(path))
+    replace(IDS_FILE, lambda path: _write_json(path, [[row["id"], row_hash(row)] for row in rows]))
+    meta = {
+        "backend": encoder.backend,
+        "dimensions": int(vectors.shape[1]),
+        "count": int(vectors.shape[0]),
+        "model": getattr(encoder, "model_name", None),
+    }
+    replace(META_FILE, lambda path: _write_json(path, meta))
+
+
+def _write_json(path: str, value):
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(value, f, ensure_ascii=False)
+
+
+def load_index(directory: str):
+    """事前構築したインデックスを読み込む（ベクトル行列は memmap）。なければ None"""
+    meta_path = os.path.join(directory, META_FILE)
+    if not os.path.exists(meta_path):
+        return None
+
+    with open(meta_path, encoding="utf-8") as f:
+        meta = json.load(f)
+    if meta["backend"] != config.SIMILAR_BACKEND:
+        logger.warning("類似検索インデックスのバックエンドが設定と異なるため使いません: %s", meta["backend"])
+        return None
+
+    encoder_class = EmbeddingEncoder if meta["backend"] == "embedding" else TfidfEncoder
+    encoder = encoder_class.load(directory, meta)
+    with open(os.path.join(directory, IDS_FILE), encoding="utf-8") as f:
+        ids = [tuple(item) for item in json.load(f)]
+    if meta["count"]:
+        vectors = np.memmap(
+            os.path.join(directory, VECTORS_FILE), dtype=np.float32, mode="r",
+            shape=(meta["count"], meta["dimensions"]),
+        )
+    else:
+        vectors = np.zeros((0, meta["dimensions"]), dtype=np.float32)
+    return encoder, ids, vectors
+
+
+class _VectorState:
+    """ベース行列と、その後の書き込みの差分"""
+
+    def __init__(self, encoder, ids: List[str], vectors: np.ndarray, rows: Dict[str, dict], hashes: Dict[str, str]):
+        self.encoder = encoder
+        self.ids = ids
+        self.positions = {quote_id: i for i, quote_id in enumerate(ids)}
+        self.vectors = vectors
+        self.rows = rows
+        # 使っているベクトルをどの内容（row_hash）から作ったか
+        self.hashes = hashes
+        # ベース行列で使わない行（削除・更新済み）
+        self.masked: Set[str] = set()
+        # ベース行列の後に追加・更新された行のベクトル
+        self.extra: Dict[str, np.ndarray] = {}
+        self._extra_matrix: Optional[Tuple[List[str], np.ndarray]] = None
+
+    def copy(self, rows: Dict[str, dict]) -> "_VectorState":
+        """ベース行列を共有し、差分だけを複製した状態（作っている間も元の状態は書き込みを受け付ける）"""
+        state = _VectorState(self.encoder, self.ids, self.vectors, rows, dict(self.hashes))
+        state.masked = set(self.masked)
+        state.extra = dict(self.extra)
+        return state
+
+    def set_vector(self, quote_id: str, vector: np.ndarray, digest: str):
+        if quote_id in self.positions:
+            self.masked.add(quote_id)
+        self.extra[quote_id] = vector
+        self.hashes[quote_id] = digest
+        self._extra_matrix = None
+
+    def drop(self, quote_id: str):
+        if quote_id in self.positions:
+            self.masked.add(quote_id)
+        self.hashes.pop(quote_id, None)
+        if self.extra.pop(quote_id, None) is not None:
+            self._extra_matrix = None
+
+    def apply_changes(self, rows: List[dict]) -> int:
+        """rows と内容が違う行だけをベクトル化し直し、rows にない行を落とす（ベクトル化した件数）"""
+        for quote_id in [quote_id for quote_id in self.hashes if quote_id not in self.rows]:
+            self.drop(quote_id)
+        changed = [row for row in rows if self.hashes.get(row["id"]) != row_hash(row)]
+        if changed:
+            for row, vector in zip(changed, self.encoder.encode([document(row) for row in changed])):
+                self.set_vector(row["id"], vector, row_hash(row))
+        return len(changed)
+
+    def vector(self, quote_id: str) -> Optional[np.ndarray]:
+        if quote_id in self.extra:
+            return self.extra[quote_id]
+        position = self.positions.get(quote_id)
+        if position is None or quote_id in self.masked:
+            return None
+        return np.asarray(self.vectors[position])
+
+    def extra_matrix(self) -> Tuple[List[str], np.ndarray]:
+        if self._extra_matrix is None:
+            ids = list(self.extra)
+            dimensions = self.vectors.shape[1]
+            matrix = np.stack([self.extra[i] for i in ids]) if ids else np.zeros((0, dimensions), np.float32)
+            self._extra_matrix = (ids, matrix)
+        return self._extra_matrix
+
+
+class SimilarIndex(CorpusListener):
+    """類似引用検索用のベクトルインデックス"""
+
+    def __init__(self, index_dir: Optional[str] = None):
+        self.index_dir = index_dir
+        self._state: Optional[_VectorState] = None
+        # 読み込んだ事前構築インデックスの meta.json の更新時刻（置き換えられたら読み直す）
+        self._index_mtime: Optional[float] = None
+        # ベクトル化を待っている書き込み（id -> 行）と、それをまとめてベクトル化するタスク
+        self._pending: Dict[str, dict] = {}
+        self._encoding: Optional[asyncio.Task] = None
+
+    @property
+    def ready(self) -> bool:
+        return self._state is not None
+
+    def _current_index_mtime(self) -> Optional[float]:
+        if not self.index_dir:
+            return None
+        try:
+            return os.path.getmtime(os.path.join(self.index_dir, META_FILE))
+        except OSError:
+            return None
+
+    def rebuild(self, rows: List[dict]):
+        rows_by_id = {row["id"]: row for row in rows}
+        index_mtime = self._current_index_mtime()
+        if self._state is not None and index_mtime == self._index_mtime:
+            # 再読み込みでは学習し直さず、今の状態との差分だけを反映した新しい状態に差し替える
+            state = self._state.copy(rows_by_id)
+            changed = state.apply_changes(rows)
+            self._state = state
+            if changed:
+                logger.info("類似検索インデックスに差分 %d件を反映しました", changed)
+            return
+
+        loaded = load_index(self.index_dir) if self.index_dir else None
+        self._index_mtime = index_mtime
+        if loaded is None:
+            # 事前構築したインデックスがなければ全件からその場で学習する
+            encoder = build_encoder()
+            vectors = encoder.fit([document(row) for row in rows]) if rows else None
+            if vectors is None:
+                self._state = None
+                return
+            hashes = {row["id"]: row_hash(row) for row in rows}
+            self._state = _VectorState(encoder, [row["id"] for row in rows], vectors, rows_by_id, hashes)
+            return
+
+        encoder, indexed, vectors = loaded
+        state = _VectorState(encoder, [quote_id for quote_id, _ in indexed], vectors, rows_by_id, dict(indexed))
+        # インデックス構築後に追加・変更・削除された行だけを差分として反映する
+        changed = state.apply_changes(rows)
+        self._state = state
+        logger.info("類似検索インデックスを読み込みました（%d件、差分 %d件）", len(indexed), changed)
+
+    def upsert(self, row: dict, old: Optional[dict]):
+        state = self._state
+        if state is None:
+            return
+        state.rows[row["id"]] = row
+        if state.hashes.get(row["id"]) == row_hash(row) and state.vector(row["id"]) is not None:
+            return
+        self._pending[row["id"]] = row
+        if self._encoding is not None and not self._encoding.done():
+            # 実行中のタスクが今のバッチのあとに続けてベクトル化する
+            return
+        try:
+            self._encoding = asyncio.get_running_loop().create_task(self._encode_pending())
+        except RuntimeError:
+            # イベントループの外（コマンドラインなど）ではその場でベクトル化する
+            batch, self._pending = list(self._pending.values()), {}
+            self._apply(state, batch, state.encoder.encode([document(pending) for pending in batch]))
+
+    def remove(self, row: dict):
+        state = self._state
+        if state is None:
+            return
+        self._pending.pop(row["id"], None)
+        state.rows.pop(row["id"], None)
+        state.drop(row["id"])
+
+    async def _encode_pending(self):
+        """溜まった書き込みをまとめてスレッドでベクトル化する（ベクトル化中に届いた分は次のバッチにする）"""
+        while self._pending:
+            state = self._state
+            batch, self._pending = list(self._pending.values()), {}
+            try:
+                vectors = await asyncio.to_thread(state.encoder.encode, [document(row) for row in batch])
+            except Exception:
+                logger.exception("類似検索インデックスに %d件を反映できませんでした", len(batch))
+                continue
+            # ベクトル化の間に再構築された場合は、新しい状態に反映済み
+            if self._state is state:
+                self._apply(state, batch, vectors)
+
+    def _apply(self, state: _VectorState, rows: List[dict], vectors: np.ndarray):
+        for row, vector in zip(rows, vectors):
+            # ベクトル化の間に削除されたもの・再び書き込まれたもの（次のバッチで反映）は飛ばす
+            if row["id"] in state.rows and row["id"] not in self._pending:
+                state.set_vector(row["id"], vector, row_hash(row))
+
+    async def wait_pending(self):
+        """ベクトル化を待っている書き込みを反映し終えるまで待つ"""
+        while self._encoding is not None and not self._encoding.done():
+            await asyncio.shield(self._encoding)
+
+    async def similar_to(
+        self,
+        quote_id: str,
+        limit: int = 10,
+        theme: Optional[str] = None,
+        tag: Optional[str] = None,
+    ) -> Optional[List[Tuple[float, dict]]]:
+        """指定した引用に似た引用を返す（引用がインデックスになければ None）"""
+        state = self._state
+        if state is not None and state.vector(quote_id) is None and quote_id in state.rows:
+            # 作成直後でまだベクトル化されていなければ反映を待つ
+            await self.wait_pending()
+            state = self._state
+        vector = state.vector(quote_id) if state else None
+        if vector is None:
+            return None
+        return self._top_k(state, vector, limit, theme, tag, exclude=quote_id)
+
+    async def similar_to_text(
+        self,
+        q: str,
+        limit: int = 10,
+        theme: Optional[str] = None,
+        tag: Optional[str] = None,
+    ) -> List[Tuple[float, dict]]:
+        """自由文に似た引用を返す"""
+        state = self._state
+        vector = (await asyncio.to_thread(state.encoder.encode, [q]))[0]
+        return self._top_k(state, vector, limit, theme, tag)
+
+    @staticmethod
+    def _top_k(
+        state: _VectorState,
+        vector: np.ndarray,
+        limit: int,
+        theme: Optional[str],
+        tag: Optional[str],
+        exclude: Optional[str] = None,
+    ) -> List[Tuple[float, dict]]:
+        extra_ids, extra_matrix = state.extra_matrix()
+        ids = state.ids + extra_ids
+        scores = np.concatenate([state.vectors @ vector, extra_matrix @ vector])
+
+        def accept(quote_id: str) -> bool:
+            row = state.rows.get(quote_id)
+            if row is None or quote_id == exclude:
+                return False
+            if theme and row.get("theme") != theme:
+                return False
+            if tag and tag not in (row.get("tags") or []):
+                return False
+            return True
+
+        # 除外される行がなければ上位 k 件の選択だけで済むので、まず多めに候補を取り、足りなければ全件を並べる
+        base_count = len(state.ids)
+        results: List[Tuple[float, dict]] = []
+        for candidates in (min(len(ids), (limit + 1) * 4), len(ids)):
+            if candidates == 0:
+                break
+            top = np.argpartition(-scores, candidates - 1)[:candidates] if candidates < len(ids) else np.arange(len(ids))
+            results = []
+            for i in top[np.argsort(-scores[top], kind="stable")]:
+                quote_id = ids[i]
+                if i < base_count and quote_id in state.masked:
+                    continue
+                if accept(quote_id):
+                    results.append((float(scores[i]), state.rows[quote_id]))
+                    if len(results) >= limit:
+                        return results
+            if candidates == len(ids):
+                break
+        return results
+
+
+similar_index = SimilarIndex(config.SIMILAR_INDEX_DIR)
+
+
+async def _build(directory: str):
+    from .corpus import corpus
+    from .repository import close_repository
+
+    try:
+        rows = await corpus.fetch_all()
+    finally:
+        await close_repository()
+
+    encoder = build_encoder()
+    vectors = encoder.fit([document(row) for row in rows])
+    save_index(directory, encoder, rows, vectors)
+    print(f"{len(rows)}件、{vectors.shape[1]}次元のインデックスを {directory} に書き出しました")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="類似引用検索インデックスの事前構築")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    build = subparsers.add_parser("build", help="quotes 全件からインデックスを構築して書き出す")
+    build.add_argument("--out", default=config.SIMILAR_INDEX_DIR, help="出力先ディレクトリ（既定: SIMILAR_INDEX_DIR）")
+    args = parser.parse_args()
+
+    if not args.out:
+        parser.error("--out または SIMILAR_INDEX_DIR を指定してください")
+    asyncio.run(_build(args.out))
+
+
+if __name__ == "__main__":
+    main()
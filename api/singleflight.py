@@ -0,0 +1,122 @@
+"""
+同一クエリのリクエスト合流（singleflight）と stale-while-revalidate
+
+同じキーの処理が実行中なら新たに上流へ問い合わせず、実行中の結果を共有する。
+キャッシュ切れ直後にアクセスが集中しても、上流へのクエリは1本にまとまる。
+"""
+
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Optional, Set, Tuple
+
+
+class SingleFlight:
+    """キーごとに実行中の処理を1つにまとめる"""
+
+    def __init__(self):
+        self._calls: Dict[str, asyncio.Task] = {}
+        self.shared = 0
+
+    def in_flight(self, key: str) -> bool:
+        return key in self._calls
+
+    async def do(self, key: str, fn: Callable[[], Awaitable[Any]]) -> Any:
+        """key の処理が実行中ならその結果を待ち、なければ fn を実行する"""
+        task = self._calls.get(key)
+        if task is not None:
+            self.shared += 1
+        else:
+            task = asyncio.ensure_future(fn())
+            self._calls[key] = task
+            task.add_done_callback(lambda done: self._finish(key, done))
+
+        # 最初の呼び出し元が切断されても、待っている他のリクエストの処理は止めない
+        return await asyncio.shield(task)
+
+    def _finish(self, key: str, task: asyncio.Task):
+        if self._calls.get(key) is task:
+            del self._calls[key]
+        # 待つ側が全員キャンセルされた場合でも例外を回収済みにしておく
+        if not task.cancelled():
+            task.exception()
+
+
+class StaleWhileRevalidate:
+    """期限切れ後もしばらくは古い値を返し、裏で1回だけ再取得する
+
+    キーはクエリパラメータから作られ種類に上限がないため、古い値も返せなくなったものと
+    max_entries を超えた分（最近使われていない順）は捨てる。
+    """
+
+    def __init__(self, flight: SingleFlight, ttl: float, stale_ttl: float, max_entries: int = 1000):
+        self._flight = flight
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.max_entries = max_entries
+        # key -> (取得時刻, 値)（最近使われた順）
+        self._entries: "OrderedDict[str, Tuple[float, Any]]" = OrderedDict()
+        self._background: Set[asyncio.Task] = set()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    async def get(self, key: str, loader: Callable[[], Awaitable[Any]]) -> Any:
+        entry = self._entries.get(key)
+        if entry is not None:
+            age = time.monotonic() - entry[0]
+            if age < self.ttl:
+                self._entries.move_to_end(key)
+                return entry[1]
+            if age < self.ttl + self.stale_ttl:
+                self._entries.move_to_end(key)
+                self._revalidate(key, loader)
+                return entry[1]
+            del self._entries[key]
+
+        return await self._flight.do(key, lambda: self._load(key, loader))
+
+    def mark_stale(self, key: Optional[str] = None):
+        """値を古い扱いにする（次の読み取りは古い値を返しつつ再取得を始める）"""
+        keys = [key] if key is not None else list(self._entries)
+        for stale_key in keys:
+            entry = self._entries.get(stale_key)
+            if entry is not None:
+                self._entries[stale_key] = (entry[0] - self.ttl, entry[1])
+
+    def _revalidate(self, key: str, loader: Callable[[], Awaitable[Any]]):
+        if self._flight.in_flight(key):
+            return
+        task = asyncio.ensure_future(self._flight.do(key, lambda: self._load(key, loader)))
+        self._background.add(task)
+        task.add_done_callback(self._revalidated)
+
+    def _revalidated(self, task: asyncio.Task):
+        self._background.discard(task)
+        # 再取得の失敗は古い値を返し続けるだけにする（次の読み取りで再試行）
+        if not task.cancelled():
+            task.exception()
+
+    async def drain(self):
+        """裏で実行中の再取得が終わるのを待つ（終了時用）"""
+        if self._background:
+            await asyncio.gather(*self._background, return_exceptions=True)
+
+    async def _load(self, key: str, loader: Callable[[], Awaitable[Any]]) -> Any:
+        value = await loader()
+        self._entries[key] = (time.monotonic(), value)
+        self._entries.move_to_end(key)
+        self._evict()
+        return value
+
+    def _evict(self):
+        """古い値も返せなくなったエントリと、上限を超えた分を使われていない順に捨てる"""
+        now = time.monotonic()
+        while self._entries:
+            key, (loaded_at, _) = next(iter(self._entries.items()))
+            if len(self._entries) <= self.max_entries and now - loaded_at < self.ttl + self.stale_ttl:
+                break
+            del self._entries[key]
+
+
+flight = SingleFlight()
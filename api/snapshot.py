@@ -0,0 +1,476 @@
+"""
+ワーカー間で共有する本文以外の列のスナップショット
+
+複数ワーカーで動かすと、ファセットやランダム引用用の構造がワーカーの数だけ複製され、
+書き込みを受けたワーカーとそれ以外とで内容もずれる。
+SNAPSHOT_DIR を設定すると、1つのワーカー（ビルダー、ロックファイルの flock で選ぶ）だけが
+id・theme / subtheme / author の番号・タグ番号の並び・created_at（int64 のマイクロ秒）・random_key を
+列ごとの配列にしてファイルへ書き出し、一時ファイルからの os.replace で公開する。
+各ワーカーはそのファイルを mmap してコピーせずに読み、新しい版が公開されたら参照を差し替える。
+スナップショットから引くのはファセット件数・ランダム引用・タグ式とタグの共起で、これらの構造はワーカーごとには持たない。
+本文を使う全文検索・入力補完・類似検索の索引と、ETag の版（行ごとのハッシュ）、返す行の中身（corpus.rows）は
+共有せず、今もワーカーごとに持つ（ワーカーあたりのメモリはこれらの分だけ残る）。
+
+書き込みを受けたワーカーは引用の id を変更ログ（changes.log）に追記し、
+他のワーカーはそれを読んでDBから行をまとめて取り直して自分のコーパスに取り込む（定期の全件再読み込みを待たない）。
+変更ログへの追記は続けて届いた変更をまとめ、ワーカースレッドで1回の write にする。
+ビルダーは取り込んだ変更から新しい版を公開する。ビルダーのワーカーが止まるとロックが外れ、別のワーカーが引き継ぐ。
+
+ファイルの形式（リトルエンディアン）:
+    マジック (8バイト) | ヘッダ長 (uint64) | ヘッダ (JSON) | 8バイト境界に揃えた列の並び
+ヘッダには版・件数・値の辞書（番号 -> 文字列）・各列の位置を持つ。
+行は (random_key, id) の順に並べ、値ごとの行番号の並び（ポスティング）も昇順で持つ。
+"""
+
+import asyncio
+import bisect
+import json
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+import uuid
+from array import array
+from datetime import datetime, timezone
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+from . import config
+from .corpus import CorpusListener, corpus
+from .repository import get_repository
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"AZQSNAP1"
+_PREFIX = struct.Struct("<8sQ")
+
+SNAPSHOT_FILE = "quotes.snapshot"
+CHANGELOG_FILE = "changes.log"
+LOCK_FILE = "builder.lock"
+
+# 値のない（NULL の）列
+NULL_CODE = -1
+NULL_TIME = -(1 << 63)
+
+# 番号に置き換える列（tags は1行に複数）
+DIMENSIONS = ("theme", "subtheme", "author", "tags")
+
+# 変更ログがこの大きさを超えたらビルダーが消す（次の追記で新しいファイルになる）
+CHANGELOG_MAX_BYTES = 1 << 20
+
+# 変更ログで知った引用をDBから取り直すときの1回の件数
+FETCH_CHUNK_SIZE = 500
+
+
+def to_micros(value: Optional[str]) -> int:
+    """日付・日時の文字列を UTC のマイクロ秒にする（タイムゾーンなしは UTC とみなす）"""
+    if not value:
+        return NULL_TIME
+    parsed = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    delta = parsed - datetime(1970, 1, 1, tzinfo=timezone.utc)
+    return (delta.days * 86400 + delta.seconds) * 1_000_000 + delta.microseconds
+
+
+def _align(offset: int) -> int:
+    return (offset + 7) & ~7
+
+
+def write_snapshot(path: str, rows: Iterable[dict], version: int) -> int:
+    """行から列ごとの配列を作り、一時ファイルに書いてから path に置き換える（件数を返す）"""
+    rows = sorted(rows, key=lambda row: (row.get("random_key") or 0.0, row["id"]))
+    dictionaries: Dict[str, Dict[str, int]] = {dimension: {} for dimension in DIMENSIONS}
+    postings: Dict[str, List[List[int]]] = {dimension: [] for dimension in DIMENSIONS}
+
+    def code(dimension: str, value: str, position: int) -> int:
+        codes = dictionaries[dimension]
+        number = codes.get(value)
+        if number is None:
+            number = codes[value] = len(codes)
+            postings[dimension].append([])
+        postings[dimension][number].append(position)
+        return number
+
+    ids = bytearray()
+    random_keys = array("d")
+    created_at = array("q")
+    columns = {dimension: array("i") for dimension in ("theme", "subtheme", "author")}
+    tag_offsets = array("q", [0])
+    tag_codes = array("i")
+    for position, row in enumerate(rows):
+        ids += uuid.UUID(row["id"]).bytes
+        random_keys.append(row.get("random_key") or 0.0)
+        created_at.append(to_micros(row.get("created_at")))
+        for dimension, column in columns.items():
+            value = row.get(dimension)
+            column.append(NULL_CODE if value is None else code(dimension, value, position))
+        for tag in dict.fromkeys(row.get("tags") or []):
+            tag_codes.append(code("tags", tag, position))
+        tag_offsets.append(len(tag_codes))
+
+    sections: List[Tuple[str, str, bytes, int]] = [
+        ("ids", "B", bytes(ids), len(ids)),
+        ("random_key", "d", random_keys.tobytes(), len(random_keys)),
+        ("created_at", "q", created_at.tobytes(), len(created_at)),
+        ("tag_offsets", "q", tag_offsets.tobytes(), len(tag_offsets)),
+        ("tag_codes", "i", tag_codes.tobytes(), len(tag_codes)),
+    ]
+    sections.extend((dimension, "i", column.tobytes(), len(column)) for dimension, column in columns.items())
+    for dimension in DIMENSIONS:
+        offsets = array("q", [0])
+        flat = array("i")
+        for positions in postings[dimension]:
+            flat.extend(positions)
+            offsets.append(len(flat))
+        sections.append((f"{dimension}_posting_offsets", "q", offsets.tobytes(), len(offsets)))
+        sections.append((f"{dimension}_postings", "i", flat.tobytes(), len(flat)))
+
+    layout: Dict[str, list] = {}
+    offset = 0
+    for name, typecode, data, count in sections:
+        layout[name] = [offset, count, typecode]
+        offset = _align(offset + len(data))
+    header = json.dumps({
+        "version": version,
+        "rows": len(rows),
+        "published_at": time.time(),
+        "dictionaries": {dimension: list(codes) for dimension, codes in dictionaries.items()},
+        "sections": layout,
+    }, ensure_ascii=False).encode("utf-8")
+
+    temporary = f"{path}.{os.getpid()}.tmp"
+    with open(temporary, "wb") as f:
+        f.write(_PREFIX.pack(MAGIC, len(header)))
+        f.write(header)
+        f.write(b"\0" * (_align(f.tell()) - f.tell()))
+        for name, _, data, _ in sections:
+            f.write(data)
+            f.write(b"\0" * (_align(len(data)) - len(data)))
+    os.replace(temporary, path)
+    return len(rows)
+
+
+class CorpusSnapshot:
+    """mmap したスナップショット1版（列は memoryview でコピーせずに読む）"""
+
+    def __init__(self, path: str):
+        with open(path, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        view = memoryview(self._mmap)
+        magic, header_length = _PREFIX.unpack_from(view)
+        if magic != MAGIC:
+            raise ValueError(f"スナップショットの形式が違います: {path}")
+        header = json.loads(bytes(view[_PREFIX.size:_PREFIX.size + header_length]))
+        base = _align(_PREFIX.size + header_length)
+
+        self.version: int = header["version"]
+        self.published_at: float = header["published_at"]
+        self.size: int = header["rows"]
+        self.values: Dict[str, List[str]] = header["dictionaries"]
+        self._codes = {dimension: {value: code for code, value in enumerate(values)} for dimension, values in self.values.items()}
+        self.columns: Dict[str, memoryview] = {}
+        for name, (offset, count, typecode) in header["sections"].items():
+            itemsize = array(typecode).itemsize
+            self.columns[name] = view[base + offset:base + offset + count * itemsize].cast(typecode)
+        # この版に対する集計結果（版が変わると参照ごと捨てる）
+        self.memo: Dict[tuple, object] = {}
+
+    def id_at(self, position: int) -> str:
+        return str(uuid.UUID(bytes=bytes(self.columns["ids"][position * 16:position * 16 + 16])))
+
+    def code(self, dimension: str, value: str) -> int:
+        return self._codes[dimension].get(value, NULL_CODE)
+
+    def posting(self, dimension: str, value: str) -> Sequence[int]:
+        """値を持つ行番号の昇順の並び（該当なしなら空）"""
+        code = self.code(dimension, value)
+        if code == NULL_CODE:
+            return ()
+        offsets = self.columns[f"{dimension}_posting_offsets"]
+        return self.columns[f"{dimension}_postings"][offsets[code]:offsets[code + 1]]
+
+    def counts(self, dimension: str) -> Dict[str, int]:
+        """全行での値ごとの件数（ポスティングの長さ）"""
+        offsets = self.columns[f"{dimension}_posting_offsets"]
+        return {value: offsets[code + 1] - offsets[code] for code, value in enumerate(self.values[dimension])}
+
+    def tags_at(self, position: int) -> Sequence[int]:
+        offsets = self.columns["tag_offsets"]
+        return self.columns["tag_codes"][offsets[position]:offsets[position + 1]]
+
+    def candidates(self, filters: List[Tuple[str, str]]) -> Tuple[Sequence[int], List[Sequence[int]]]:
+        """等価条件の行番号: (最も短いポスティング, 残りのポスティング)。条件なしなら全行"""
+        if not filters:
+            return range(self.size), []
+        smallest, *others = sorted((self.posting(dimension, value) for dimension, value in filters), key=len)
+        return smallest, others
+
+    @staticmethod
+    def contains(posting: Sequence[int], position: int) -> bool:
+        index = bisect.bisect_left(posting, position)
+        return index < len(posting) and posting[index] == position
+
+
+class _ChangelogTail:
+    """変更ログを開いたまま読み進める（消されたら残りを読み切ってから新しいファイルを開く）"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.size = 0
+        self._file = None
+        self._buffer = b""
+
+    def _open(self, at_end: bool):
+        try:
+            self._file = open(self.path, "rb")
+        except FileNotFoundError:
+            return
+        if at_end:
+            self._file.seek(0, os.SEEK_END)
+        self._buffer = b""
+
+    def start(self):
+        # 開始前の変更は読み込むコーパスに含まれる
+        self._open(at_end=True)
+
+    def read(self) -> List[str]:
+        if self._file is None:
+            self._open(at_end=False)
+            if self._file is None:
+                return []
+        try:
+            replaced = os.stat(self.path).st_ino != os.fstat(self._file.fileno()).st_ino
+        except FileNotFoundError:
+            replaced = True
+        data = self._buffer + self._file.read()
+        # 書きかけの行は次の周回で読む
+        end = data.rfind(b"\n") + 1
+        self._buffer = data[end:]
+        self.size = self._file.tell()
+        if replaced:
+            self._file.close()
+            self._file = None
+        return data[:end].decode("utf-8").splitlines()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class SharedSnapshot(CorpusListener):
+    """スナップショットの公開（ビルダーのワーカー）と、変更ログ・スナップショットの取り込み（全ワーカー）"""
+
+    def __init__(self):
+        self.directory: Optional[str] = None
+        self.current: Optional[CorpusSnapshot] = None
+        self.is_builder = False
+        self._pid = str(os.getpid())
+        self._lock_file = None
+        self._tail: Optional[_ChangelogTail] = None
+        self._publish_lock = threading.Lock()
+        self._version = 0
+        self._dirty = False
+        self._published = 0.0
+        # 変更ログから取り込み中（自分の変更としてログに書き戻さない）
+        self._applying = False
+        # 変更ログにまだ書いていない行と、それを書き込むタスク
+        self._unwritten: List[str] = []
+        self._writing: Optional[asyncio.Task] = None
+        self._file_id: Optional[Tuple[int, int]] = None
+        self._attached = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def attached(self) -> bool:
+        return self.current is not None
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.directory, name)
+
+    # -- CorpusListener: ビルダーは公開し直す。自分のワーカーでの書き込みは変更ログに残す --
+
+    def rebuild(self, rows: List[dict]):
+        if self.is_builder:
+            self._publish(rows)
+
+    def upsert(self, row: dict, old: Optional[dict]):
+        self._changed(row["id"])
+
+    def remove(self, row: dict):
+        self._changed(row["id"])
+
+    def _changed(self, quote_id: str):
+        if self.directory is None:
+            return
+        if self.is_builder:
+            self._dirty = True
+        if self._applying:
+            return
+        # 一括登録などで続けて届く変更はまとめて1回で追記する
+        self._unwritten.append(f"{self._pid} {quote_id}\n")
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self._write_changelog(self._take_unwritten())
+            return
+        if self._writing is None or self._writing.done():
+            self._writing = loop.create_task(self._write_unwritten())
+
+    def _take_unwritten(self) -> str:
+        lines, self._unwritten = self._unwritten, []
+        return "".join(lines)
+
+    def _write_changelog(self, data: str):
+        # O_APPEND の1回の write で書くので、他のワーカーの追記と混ざらない
+        fd = os.open(self._path(CHANGELOG_FILE), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, data.encode("utf-8"))
+        finally:
+            os.close(fd)
+
+    async def _write_unwritten(self):
+        """たまった行をワーカースレッドで追記する（書き込み中に届いた行は続けて次の1回で書く）"""
+        while self._unwritten:
+            data = self._take_unwritten()
+            try:
+                await asyncio.to_thread(self._write_changelog, data)
+            except OSError:
+                logger.exception("変更ログに書き込めませんでした")
+
+    # -- ビルダー --
+
+    def _try_become_builder(self) -> bool:
+        import fcntl
+
+        if self._lock_file is None:
+            self._lock_file = open(self._path(LOCK_FILE), "a+")
+        try:
+            fcntl.flock(self._lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return False
+        self.is_builder = True
+        self._dirty = True
+        logger.info("スナップショットのビルダーになりました（pid %s）", self._pid)
+        return True
+
+    def _publish(self, rows: List[dict]):
+        with self._publish_lock:
+            self._version = max(self._version, self.current.version if self.current else 0) + 1
+            started = time.perf_counter()
+            count = write_snapshot(self._path(SNAPSHOT_FILE), rows, self._version)
+            self._published = time.monotonic()
+            logger.debug("スナップショット v%d を公開しました（%d件、%.3f秒）", self._version, count, time.perf_counter() - started)
+
+    # -- 全ワーカー --
+
+    async def _apply_changes(self):
+        entries = [line.split() for line in self._tail.read()]
+        quote_ids = list(dict.fromkeys(quote_id for pid, quote_id in entries if pid != self._pid))
+        if self.is_builder and self._tail.size >= CHANGELOG_MAX_BYTES:
+            try:
+                os.unlink(self._tail.path)
+            except FileNotFoundError:
+                pass
+        if not quote_ids:
+            return
+
+        repo = await get_repository()
+        chunks = await asyncio.gather(*(
+            repo.get_quotes(quote_ids[i:i + FETCH_CHUNK_SIZE]) for i in range(0, len(quote_ids), FETCH_CHUNK_SIZE)
+        ))
+        rows = {row["id"]: row for chunk in chunks for row in chunk}
+        # 取り込みは待ちを挟まずに行い、同時に来た書き込みは通常どおりログに残るようにする
+        self._applying = True
+        try:
+            for quote_id in quote_ids:
+                row = rows.get(quote_id)
+                if row is not None:
+                    corpus.upsert(row)
+                else:
+                    corpus.remove(quote_id)
+        finally:
+            self._applying = False
+
+    def _attach_if_changed(self):
+        path = self._path(SNAPSHOT_FILE)
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return
+        file_id = (stat.st_ino, stat.st_mtime_ns)
+        if file_id == self._file_id:
+            return
+        snapshot = CorpusSnapshot(path)
+        # 参照の差し替えだけなので、処理中のリクエストは古い版を最後まで使える
+        self.current, self._file_id = snapshot, file_id
+        self._attached.set()
+
+    async def _poll(self):
+        while True:
+            try:
+                if not self.is_builder:
+                    self._try_become_builder()
+                if corpus.ready:
+                    await self._apply_changes()
+                    if (
+                        self.is_builder
+                        and self._dirty
+                        and time.monotonic() - self._published >= config.SNAPSHOT_PUBLISH_INTERVAL
+                    ):
+                        self._dirty = False
+                        await asyncio.to_thread(self._publish, list(corpus.rows.values()))
+                self._attach_if_changed()
+            except Exception:
+                logger.exception("スナップショットの更新に失敗しました")
+            await asyncio.sleep(config.SNAPSHOT_POLL_INTERVAL)
+
+    def start(self, directory: str):
+        """ビルダーの選出・公開・取り込みの定期処理を始める（コーパスの読み込みより前に呼ぶ）"""
+        if self._task is not None:
+            return
+        self.directory = directory
+        self._pid = str(os.getpid())
+        os.makedirs(directory, exist_ok=True)
+        self._tail = _ChangelogTail(self._path(CHANGELOG_FILE))
+        self._tail.start()
+        self._task = asyncio.create_task(self._poll())
+
+    async def wait_attached(self):
+        await self._attached.wait()
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        # 書き込み中・未書き込みの変更を他のワーカーに残す
+        if self._writing is not None:
+            await self._writing
+            self._writing = None
+        if self._unwritten:
+            await self._write_unwritten()
+        if self._tail is not None:
+            self._tail.close()
+        if self._lock_file is not None:
+            # ロックを外して他のワーカーに引き継ぐ（スナップショットは次のビルダーが公開するまで使える）
+            self._lock_file.close()
+            self._lock_file = None
+        self.is_builder = False
+
+    def status(self) -> dict:
+        current = self.current
+        return {
+            "builder": self.is_builder,
+            "version": current.version if current else None,
+            "rows": current.size if current else None,
+            "age_seconds": round(time.time() - current.published_at, 3) if current else None,
+        }
+
+
+shared_snapshot = SharedSnapshot()
@@ -0,0 +1,57 @@
+"""
+統計カウンタの定期再集計
+
+カウンタは quotes へのトリガで差分更新される（sql/azuma-insight/stats.sql）。
+ここではずれを修復するため quote_stats_reconcile() を定期的に呼び出す。
+DB側のアドバイザリロックにより、複数ワーカーが同時に呼んでも実行は1つだけになる。
+"""
+
+import asyncio
+import logging
+from typing import Optional
+
+from . import config
+from .repository import get_repository
+
+logger = logging.getLogger(__name__)
+
+_reconcile_task: Optional[asyncio.Task] = None
+
+
+async def reconcile_stats() -> bool:
+    """カウンタを再集計する（他のワーカーが実行中なら False）"""
+    repo = await get_repository()
+    return bool(await repo.rpc("quote_stats_reconcile", {}))
+
+
+async def _reconcile_loop(interval: float):
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            if await reconcile_stats():
+                logger.info("統計カウンタを再集計しました")
+        except Exception:
+            logger.exception("統計カウンタの再集計に失敗しました")
+
+
+def start_reconcile_task():
+    """定期再集計タスクを開始"""
+    global _reconcile_task
+
+    if config.STATS_RECONCILE_INTERVAL <= 0 or _reconcile_task is not None:
+        return
+    _reconcile_task = asyncio.create_task(_reconcile_loop(config.STATS_RECONCILE_INTERVAL))
+
+
+async def stop_reconcile_task():
+    """定期再集計タスクを停止"""
+    global _reconcile_task
+
+    if _reconcile_task is None:
+        return
+    _reconcile_task.cancel()
+    try:
+        await _reconcile_task
+    except asyncio.CancelledError:
+        pass
+    _reconcile_task = None
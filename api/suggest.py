@@ -0,0 +1,161 @@
+"""
+入力補完（前方一致の候補）
+
+タグ・テーマ・サブテーマ・作者・タイトルの値ごとに引用の件数を数え、
+正規化したキーで並べた配列を二分探索して前方一致する範囲を求め、件数の多い順に返す。
+キーは NFKC 正規化・小文字化に加えてカタカナをひらがなに寄せるため、
+全角・半角やカタカナ・ひらがなの違いを問わずに一致する（漢字の読みでは引けない）。
+作成・更新・削除はリスナーとして差分で反映する。
+"""
+
+import bisect
+import heapq
+from collections import Counter
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from fastapi import HTTPException
+
+from .corpus import CorpusListener
+from .search import normalize
+
+SUGGEST_FIELDS = ["tags", "theme", "subtheme", "author", "title"]
+
+# 前方一致の範囲の上端に使う文字
+_MAX_CHAR = "\U0010ffff"
+# カタカナ（ァ〜ヶ）をひらがなに寄せる
+_KATAKANA_TO_HIRAGANA = {code: code - 0x60 for code in range(0x30A1, 0x30F7)}
+
+# 前方一致ごとの結果を保持する件数（値が変わったフィールドだけ破棄）
+MEMO_SIZE = 1000
+
+
+def suggest_key(value: Optional[str]) -> str:
+    """表記の揺れを吸収した比較用のキー（連続する空白は1つにする）"""
+    return " ".join(normalize(value).translate(_KATAKANA_TO_HIRAGANA).split())
+
+
+def parse_suggest_fields(value: Optional[str]) -> List[str]:
+    """fields パラメータを検証してリストにする（未指定なら全フィールド）"""
+    if value is None:
+        return list(SUGGEST_FIELDS)
+    fields = list(dict.fromkeys(field.strip() for field in value.split(",") if field.strip()))
+    unknown = [field for field in fields if field not in SUGGEST_FIELDS]
+    if unknown or not fields:
+        raise HTTPException(
+            status_code=400,
+            detail=f"fields に指定できるのは {', '.join(SUGGEST_FIELDS)} です: {', '.join(unknown)}",
+        )
+    return fields
+
+
+def _values(row: dict, field: str) -> List[str]:
+    if field == "tags":
+        return list(dict.fromkeys(tag for tag in row.get("tags") or [] if tag))
+    value = row.get(field)
+    return [value] if value else []
+
+
+class _FieldIndex:
+    """1フィールドの値ごとの件数と、(キー, 値) の昇順の配列・(-件数, キー, 値) の昇順の配列"""
+
+    def __init__(self, counts: Optional[Counter] = None):
+        self.counts: Counter = counts or Counter()
+        self.keys: List[Tuple[str, str]] = sorted((suggest_key(value), value) for value in self.counts)
+        self.ranked: List[Tuple[int, str, str]] = sorted((-self.counts[value], key, value) for key, value in self.keys)
+        self._memo: Dict[Tuple[str, int], List[Tuple[str, int]]] = {}
+
+    def _rerank(self, key: str, value: str, before: int, after: int):
+        if before:
+            position = bisect.bisect_left(self.ranked, (-before, key, value))
+            del self.ranked[position]
+        if after:
+            bisect.insort(self.ranked, (-after, key, value))
+
+    def add(self, value: str):
+        key = suggest_key(value)
+        self.counts[value] += 1
+        if self.counts[value] == 1:
+            bisect.insort(self.keys, (key, value))
+        self._rerank(key, value, self.counts[value] - 1, self.counts[value])
+        self._memo = {}
+
+    def discard(self, value: str):
+        if value not in self.counts:
+            return
+        key = suggest_key(value)
+        self.counts[value] -= 1
+        self._rerank(key, value, self.counts[value] + 1, self.counts[value])
+        if self.counts[value] <= 0:
+            del self.counts[value]
+            del self.keys[bisect.bisect_left(self.keys, (key, value))]
+        self._memo = {}
+
+    def lookup(self, prefix: str, limit: int) -> List[Tuple[str, int]]:
+        """prefix で始まる値を件数の多い順（同数ならキーの順）に limit 件"""
+        memo_key = (prefix, limit)
+        if memo_key in self._memo:
+            return self._memo[memo_key]
+        low = bisect.bisect_left(self.keys, (prefix,))
+        high = bisect.bisect_left(self.keys, (prefix + _MAX_CHAR,))
+        matches = high - low
+        if matches * matches <= limit * len(self.ranked):
+            # 一致する範囲が狭ければ範囲の中から件数の多いものを選ぶ
+            top = heapq.nsmallest(limit, ((-self.counts[value], key, value) for key, value in self.keys[low:high]))
+        else:
+            # 広ければ件数の多い順に見ていき、一致するものが limit 件そろったところでやめる
+            top = []
+            for entry in self.ranked:
+                if entry[1].startswith(prefix):
+                    top.append(entry)
+                    if len(top) >= limit:
+                        break
+        result = [(value, -negative) for negative, _, value in top]
+        if len(self._memo) >= MEMO_SIZE:
+            self._memo = {}
+        self._memo[memo_key] = result
+        return result
+
+
+class SuggestIndex(CorpusListener):
+    """フィールドごとの前方一致の索引"""
+
+    def __init__(self):
+        self._fields: Dict[str, _FieldIndex] = {field: _FieldIndex() for field in SUGGEST_FIELDS}
+
+    def rebuild(self, rows: List[dict]):
+        counts = {field: Counter() for field in SUGGEST_FIELDS}
+        for row in rows:
+            for field, counter in counts.items():
+                counter.update(_values(row, field))
+        self._fields = {field: _FieldIndex(counter) for field, counter in counts.items()}
+
+    def upsert(self, row: dict, old: Optional[dict]):
+        for field, index in self._fields.items():
+            before = _values(old, field) if old is not None else []
+            after = _values(row, field)
+            if before == after:
+                continue
+            for value in before:
+                index.discard(value)
+            for value in after:
+                index.add(value)
+
+    def remove(self, row: dict):
+        for field, index in self._fields.items():
+            for value in _values(row, field):
+                index.discard(value)
+
+    def suggest(self, prefix: str, fields: Iterable[str], limit: int = 10) -> List[dict]:
+        """prefix で始まる値をフィールドをまたいで件数の多い順に limit 件（空なら件数の多い値）"""
+        key = suggest_key(prefix)
+        candidates = []
+        for order, field in enumerate(fields):
+            for value, count in self._fields[field].lookup(key, limit):
+                candidates.append((-count, order, suggest_key(value), field, value))
+        return [
+            {"field": field, "value": value, "count": -negative}
+            for negative, _, _, field, value in heapq.nsmallest(limit, candidates)
+        ]
+
+
+suggest_index = SuggestIndex()
@@ -0,0 +1,325 @@
+"""
+タグの転置インデックスとタグ式
+
+タグごとに引用 id の集合を持ち、AND / OR / NOT を組み合わせたタグ式を集合演算で評価する。
+AND は件数の少ない集合から積を取るため、計算量はテーブル全体ではなく候補の件数に比例する。
+コーパス未読み込み時は同じ式を PostgREST の論理式（tags の GIN インデックスが効く cs / ov）に変換して問い合わせる。
+SNAPSHOT_DIR を設定した場合は id の集合を持たず、共有スナップショットのタグのポスティング（行番号）で式を評価し、
+一致した行はコーパスの今の行のタグで確かめてから返す（スナップショットの公開前に作られた・タグが付いた引用は次の公開まで出ない）。
+
+タグ式の例: 努力 AND (成功 OR 継続) AND NOT 失敗
+  - AND / OR / NOT は大文字・小文字を問わない（& | - ! も使える）
+  - 空白で並べただけの場合は AND、カンマ区切りは OR
+  - 空白や記号を含むタグは "..." で囲む
+"""
+
+from collections import Counter
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+from .corpus import CorpusListener, CorpusMirror
+from .snapshot import CorpusSnapshot, SharedSnapshot
+
+_KEYWORDS = {"and": "&", "or": "|", "not": "!"}
+_SYMBOLS = {"&": "&", "|": "|", ",": "|", "!": "!", "-": "!", "(": "(", ")": ")"}
+# 語の途中に現れても区切りとみなす記号（- と ! は語の先頭でだけ NOT とみなす）
+_WORD_BREAKS = set('&|,()"')
+
+
+def _tokenize(expr: str) -> List[Tuple[str, str]]:
+    """タグ式を (種類, 値) の列に分割する"""
+    tokens: List[Tuple[str, str]] = []
+    i = 0
+    while i < len(expr):
+        char = expr[i]
+        if char.isspace():
+            i += 1
+        elif char == '"':
+            end = expr.find('"', i + 1)
+            if end < 0:
+                raise ValueError("タグ式の引用符が閉じられていません")
+            tokens.append(("tag", expr[i + 1:end]))
+            i = end + 1
+        elif char in _SYMBOLS:
+            tokens.append(("op", _SYMBOLS[char]))
+            i += 1
+        else:
+            start = i
+            while i < len(expr) and not expr[i].isspace() and expr[i] not in _WORD_BREAKS:
+                i += 1
+            word = expr[start:i]
+            keyword = _KEYWORDS.get(word.lower())
+            tokens.append(("op", keyword) if keyword else ("tag", word))
+    return tokens
+
+
+class _Parser:
+    """or_expr := and_expr (| and_expr)* / and_expr := not_expr (&? not_expr)* / not_expr := ! not_expr | atom"""
+
+    def __init__(self, tokens: List[Tuple[str, str]]):
+        self.tokens = tokens
+        self.position = 0
+
+    def peek(self) -> Optional[Tuple[str, str]]:
+        return self.tokens[self.position] if self.position < len(self.tokens) else None
+
+    def take(self) -> Tuple[str, str]:
+        token = self.peek()
+        if token is None:
+            raise ValueError("タグ式が途中で終わっています")
+        self.position += 1
+        return token
+
+    def parse(self) -> tuple:
+        node = self.or_expr()
+        if self.peek() is not None:
+            raise ValueError(f"タグ式の解析に失敗しました: {self.peek()[1]}")
+        return node
+
+    def or_expr(self) -> tuple:
+        children = [self.and_expr()]
+        while self.peek() == ("op", "|"):
+            self.take()
+            children.append(self.and_expr())
+        return children[0] if len(children) == 1 else ("or", children)
+
+    def and_expr(self) -> tuple:
+        children = [self.not_expr()]
+        while True:
+            token = self.peek()
+            if token == ("op", "&"):
+                self.take()
+            elif token is None or token in (("op", "|"), ("op", ")")):
+                break
+            children.append(self.not_expr())
+        return children[0] if len(children) == 1 else ("and", children)
+
+    def not_expr(self) -> tuple:
+        if self.peek() == ("op", "!"):
+            self.take()
+            return ("not", self.not_expr())
+        return self.atom()
+
+    def atom(self) -> tuple:
+        kind, value = self.take()
+        if kind == "tag":
+            if not value.strip():
+                raise ValueError("空のタグは指定できません")
+            return ("tag", value.strip())
+        if value == "(":
+            node = self.or_expr()
+            if self.peek() != ("op", ")"):
+                raise ValueError("タグ式の括弧が閉じられていません")
+            self.take()
+            return node
+        raise ValueError(f"タグ式の解析に失敗しました: {value}")
+
+
+def parse_tag_expression(expr: str) -> tuple:
+    """タグ式を構文木 ("tag", 名前) / ("and", [...]) / ("or", [...]) / ("not", 子) に変換する"""
+    tokens = _tokenize(expr)
+    if not tokens:
+        raise ValueError("タグ式が空です")
+    return _Parser(tokens).parse()
+
+
+def tags_expression(tags: List[str], match_all: bool) -> tuple:
+    """タグのリストを全一致（AND）またはいずれか一致（OR）の構文木にする"""
+    nodes = [("tag", tag) for tag in tags]
+    return nodes[0] if len(nodes) == 1 else ("and" if match_all else "or", nodes)
+
+
+def expression_tags(node: tuple) -> Set[str]:
+    """式に現れるタグ"""
+    if node[0] == "tag":
+        return {node[1]}
+    if node[0] == "not":
+        return expression_tags(node[1])
+    tags: Set[str] = set()
+    for child in node[1]:
+        tags |= expression_tags(child)
+    return tags
+
+
+def has_negation(node: tuple) -> bool:
+    if node[0] == "tag":
+        return False
+    if node[0] == "not":
+        return True
+    return any(has_negation(child) for child in node[1])
+
+
+def matches_empty(node: tuple) -> bool:
+    """タグのない引用が式に一致するか"""
+    if node[0] == "tag":
+        return False
+    if node[0] == "not":
+        return not matches_empty(node[1])
+    results = (matches_empty(child) for child in node[1])
+    return all(results) if node[0] == "and" else any(results)
+
+
+def matches_tags(node: tuple, tags: Set[str]) -> bool:
+    """タグの集合が式に一致するか"""
+    kind = node[0]
+    if kind == "tag":
+        return node[1] in tags
+    if kind == "not":
+        return not matches_tags(node[1], tags)
+    results = (matches_tags(child, tags) for child in node[1])
+    return all(results) if kind == "and" else any(results)
+
+
+def _evaluate(node: tuple, posting: Callable[[str], Set], universe: Callable[[], Set]) -> Set:
+    """タグ式に一致する要素の集合（posting はタグを持つ要素、universe は全要素。返り値は読み取り専用として扱う）"""
+    kind = node[0]
+    if kind == "tag":
+        return posting(node[1])
+    if kind == "not":
+        # 否定だけの式は全件からの差になる
+        return universe() - _evaluate(node[1], posting, universe)
+    if kind == "or":
+        items: Set = set()
+        for child in node[1]:
+            items |= _evaluate(child, posting, universe)
+        return items
+
+    positives = [child for child in node[1] if child[0] != "not"]
+    negatives = [child[1] for child in node[1] if child[0] == "not"]
+    if not positives:
+        return _evaluate(("not", ("or", negatives)), posting, universe)
+
+    # 件数の少ない集合から順に積を取る
+    sets = sorted((_evaluate(child, posting, universe) for child in positives), key=len)
+    items = set(sets[0])
+    for other in sets[1:]:
+        if not items:
+            return items
+        items &= other
+    for child in negatives:
+        if not items:
+            break
+        items -= _evaluate(child, posting, universe)
+    return items
+
+
+def array_literal(tags) -> str:
+    """PostgreSQL の配列リテラル（各要素をダブルクォートで囲む）"""
+    escaped = (tag.replace("\\", "\\\\").replace('"', '\\"') for tag in tags)
+    return "{" + ",".join(f'"{tag}"' for tag in escaped) + "}"
+
+
+def to_postgrest(node: tuple, negate: bool = False) -> str:
+    """構文木を PostgREST の論理式に変換する（タグだけの AND は cs、OR は ov にまとめて GIN インデックスを使う）
+
+    tags が NULL の行は SQL では式全体が NULL になり一致しないため、
+    呼び出し側で matches_empty() が真なら tags.is.null を OR で加える
+    """
+    prefix = "not." if negate else ""
+    kind = node[0]
+    if kind == "tag":
+        return f"tags.{prefix}cs.{array_literal([node[1]])}"
+    if kind == "not":
+        return to_postgrest(node[1], not negate)
+
+    children = node[1]
+    if all(child[0] == "tag" for child in children):
+        operator = "cs" if kind == "and" else "ov"
+        return f"tags.{prefix}{operator}.{array_literal(child[1] for child in children)}"
+    return f"{prefix}{kind}({','.join(to_postgrest(child) for child in children)})"
+
+
+class TagIndex(CorpusListener):
+    """タグ -> 引用 id の集合"""
+
+    def __init__(self):
+        self._rows: Dict[str, dict] = {}
+        self._postings: Dict[str, Set[str]] = {}
+        self._loaded = False
+        self._shared: Optional[SharedSnapshot] = None
+        self._corpus: Optional[CorpusMirror] = None
+
+    def use_snapshot(self, shared: SharedSnapshot, corpus: CorpusMirror):
+        """共有スナップショットで評価する（行の中身は corpus から引く。リスナーには登録しない）"""
+        self._shared, self._corpus = shared, corpus
+
+    @property
+    def ready(self) -> bool:
+        if self._shared is not None:
+            return self._shared.attached
+        return self._loaded
+
+    def rebuild(self, rows: List[dict]):
+        new_rows: Dict[str, dict] = {}
+        postings: Dict[str, Set[str]] = {}
+        for row in rows:
+            new_rows[row["id"]] = row
+            for tag in row.get("tags") or []:
+                postings.setdefault(tag, set()).add(row["id"])
+        self._rows, self._postings = new_rows, postings
+        self._loaded = True
+
+    def upsert(self, row: dict, old: Optional[dict]):
+        if old is not None:
+            self.remove(old)
+        self._rows[row["id"]] = row
+        for tag in row.get("tags") or []:
+            self._postings.setdefault(tag, set()).add(row["id"])
+
+    def remove(self, row: dict):
+        self._rows.pop(row["id"], None)
+        for tag in row.get("tags") or []:
+            posting = self._postings.get(tag)
+            if posting is None:
+                continue
+            posting.discard(row["id"])
+            if not posting:
+                del self._postings[tag]
+
+    def evaluate(self, node: tuple) -> Set[str]:
+        """タグ式に一致する引用 id（返り値は読み取り専用として扱う）"""
+        if self._shared is not None:
+            return self._evaluate_snapshot(self._shared.current, node)
+        return _evaluate(node, lambda tag: self._postings.get(tag, set()), self._rows.keys)
+
+    def rows(self, ids) -> List[dict]:
+        rows = self._corpus.rows if self._shared is not None else self._rows
+        return [rows[quote_id] for quote_id in ids if quote_id in rows]
+
+    def cooccurrence(self, tag: str, limit: int) -> Tuple[int, List[Tuple[str, int]]]:
+        """tag を持つ引用の件数と、それらに一緒に付いているタグの件数（多い順）"""
+        if self._shared is not None:
+            return self._cooccurrence_snapshot(self._shared.current, tag, limit)
+        ids = self._postings.get(tag, set())
+        counts: Counter = Counter()
+        for quote_id in ids:
+            counts.update(other for other in set(self._rows[quote_id].get("tags") or []) if other != tag)
+        return len(ids), sorted(counts.items(), key=lambda item: (-item[1], item[0]))[:limit]
+
+    def _evaluate_snapshot(self, snapshot: CorpusSnapshot, node: tuple) -> Set[str]:
+        positions = _evaluate(node, lambda tag: set(snapshot.posting("tags", tag)), lambda: set(range(snapshot.size)))
+        ids: Set[str] = set()
+        for position in positions:
+            quote_id = snapshot.id_at(position)
+            # スナップショットの公開後に消えた・タグが変わった行は除く
+            row = self._corpus.rows.get(quote_id)
+            if row is not None and matches_tags(node, set(row.get("tags") or [])):
+                ids.add(quote_id)
+        return ids
+
+    @staticmethod
+    def _cooccurrence_snapshot(snapshot: CorpusSnapshot, tag: str, limit: int) -> Tuple[int, List[Tuple[str, int]]]:
+        memo_key = ("cooccurrence", tag)
+        if memo_key not in snapshot.memo:
+            code = snapshot.code("tags", tag)
+            positions = snapshot.posting("tags", tag)
+            counts: Counter = Counter()
+            for position in positions:
+                counts.update(other for other in set(snapshot.tags_at(position)) if other != code)
+            names = snapshot.values["tags"]
+            pairs = sorted(((names[other], n) for other, n in counts.items()), key=lambda item: (-item[1], item[0]))
+            snapshot.memo[memo_key] = (len(positions), pairs)
+        count, pairs = snapshot.memo[memo_key]
+        return count, pairs[:limit]
+
+
+tag_index = TagIndex()
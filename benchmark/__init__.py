@@ -0,0 +1,11 @@
+"""
+Azuma Insight Quotes API ベンチマーク
+
+API をプロセス内で起動し、合成した引用コーパスを持つローカルのスタンドイン（MemoryRepository）を
+上流の代わりにつないで、エンドポイントごとのスループットとレイテンシを測る。
+Supabase やネットワークに依存しないため、CI やオフラインでもコミット間の性能を比較できる。
+
+使い方:
+    python -m benchmark run --size 100000 --concurrency 1,8,32
+    python -m benchmark compare benchmark/results/before.json benchmark/results/after.json
+"""
@@ -0,0 +1,293 @@
+"""
+ベンチマークのコマンドライン
+
+    python -m benchmark run [--size N] [--concurrency 1,8,32] [--requests N] [--endpoints ...] [--out PATH]
+    python -m benchmark compare OLD.json NEW.json [--threshold 10]
+"""
+
+import argparse
+import asyncio
+import json
+import math
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Dict, List, Optional
+from urllib.parse import urlencode
+
+from .data import generate_quotes, vocabulary
+
+RESULTS_DIR = Path(__file__).parent / "results"
+
+ENDPOINTS = ["quotes", "search", "tags", "random", "stats"]
+
+# エンドポイントごとに用意するパスの種類数（seed から決まる）
+PATH_VARIANTS = 200
+
+
+def _git(*args: str) -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", *args], cwd=Path(__file__).parent, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _path(route: str, params: dict) -> str:
+    params = {key: value for key, value in params.items() if value is not None}
+    return f"{route}?{urlencode(params)}" if params else route
+
+
+def build_paths(endpoint: str, seed: int, words: Dict[str, List[str]]) -> List[str]:
+    """負荷をかけるパスを seed から決まる順に生成する（よく使われる語ほど多く選ぶ）"""
+    rng = random.Random(f"{seed}:{endpoint}")
+    themes, keywords = words["themes"], words["keywords"]
+    # 頻出タグほど選ばれやすくする（実際の検索と同じく上位に偏る）
+    tags = words["tags"][:50]
+
+    def tag() -> str:
+        return tags[min(int(rng.expovariate(0.15)), len(tags) - 1)]
+
+    paths = []
+    for _ in range(PATH_VARIANTS):
+        if endpoint == "quotes":
+            paths.append(_path("/quotes", {
+                "theme": rng.choice(themes) if rng.random() < 0.4 else None,
+                "sort_by": rng.choice(["created_at", "created_at", "title", "theme"]),
+                "sort_order": rng.choice(["desc", "asc"]),
+                "limit": 20,
+                "offset": rng.choice([0, 0, 0, 20, 100, 1000]),
+            }))
+        elif endpoint == "search":
+            paths.append(_path("/quotes/search", {
+                "q": rng.choice(keywords),
+                "search_type": rng.choice(["or", "or", "and"]),
+                "limit": 20,
+            }))
+        elif endpoint == "tags":
+            kind = rng.random()
+            if kind < 0.5:
+                params = {"tags": tag()}
+            elif kind < 0.8:
+                params = {"tags": f"{tag()},{tag()}", "match_all": rng.choice(["true", "false"])}
+            else:
+                params = {"expr": f"{tag()} AND ({tag()} OR {tag()}) AND NOT {tag()}"}
+            paths.append(_path("/quotes/tags", {**params, "limit": 20}))
+        elif endpoint == "random":
+            paths.append(_path("/quotes/random", {
+                "theme": rng.choice(themes) if rng.random() < 0.3 else None,
+                "count": rng.choice([None, None, 5]),
+            }))
+        elif endpoint == "stats":
+            paths.append(_path("/stats", {"theme": rng.choice(themes) if rng.random() < 0.2 else None}))
+        else:
+            raise ValueError(f"不明なエンドポイントです: {endpoint}")
+    return paths
+
+
+def percentile(sorted_values: List[float], fraction: float) -> float:
+    """最近傍順位法のパーセンタイル"""
+    if not sorted_values:
+        return 0.0
+    rank = max(0, min(len(sorted_values) - 1, math.ceil(fraction * len(sorted_values)) - 1))
+    return sorted_values[rank]
+
+
+async def run_level(client, paths: List[str], concurrency: int, requests: int) -> dict:
+    """同時実行数 concurrency で paths を順に requests 回叩く"""
+    latencies: List[float] = []
+    errors = 0
+    issued = 0
+
+    async def worker():
+        nonlocal errors, issued
+        while issued < requests:
+            path = paths[issued % len(paths)]
+            issued += 1
+            started = time.perf_counter()
+            try:
+                response = await client.get(path)
+                if response.status_code >= 400:
+                    errors += 1
+            except Exception:
+                errors += 1
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    ms = [value * 1000 for value in latencies]
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "seconds": round(elapsed, 4),
+        "throughput": round(len(latencies) / elapsed, 2),
+        "latency_ms": {
+            "mean": round(sum(ms) / len(ms), 3),
+            "p50": round(percentile(ms, 0.50), 3),
+            "p95": round(percentile(ms, 0.95), 3),
+            "p99": round(percentile(ms, 0.99), 3),
+            "max": round(ms[-1], 3),
+        },
+    }
+
+
+def _configure(args):
+    """api を読み込む前に設定を環境変数で与える（config はインポート時に読まれる）"""
+    os.environ.update({
+        "CORPUS_ENABLED": "false" if args.no_corpus else "true",
+        "CORPUS_REFRESH_INTERVAL": "0",
+        "STATS_RECONCILE_INTERVAL": "0",
+        "SIMILAR_ENABLED": "false",
+        "CACHE_BACKEND": "memory",
+    })
+    if args.no_cache:
+        # 0 は既定の TTL に置き換わるため、実質的に毎回読み直す短さにする
+        os.environ["CACHE_TTL"] = "0.000001"
+        os.environ["STATS_TTL"] = "0.000001"
+        os.environ["STATS_STALE_TTL"] = "0.000001"
+
+
+async def run(args) -> dict:
+    _configure(args)
+
+    import httpx
+
+    from api.lifecycle import lifecycle
+    from api.main import app
+    from api.repository import set_repository
+
+    from .standin import MemoryRepository
+
+    started = time.perf_counter()
+    repository = MemoryRepository(generate_quotes(args.size, args.seed), args.upstream_latency / 1000)
+    generate_seconds = time.perf_counter() - started
+    set_repository(repository)
+
+    words = vocabulary()
+    levels = [int(value) for value in args.concurrency.split(",")]
+    endpoints = [name.strip() for name in args.endpoints.split(",")]
+    results = []
+
+    limits = httpx.Limits(max_connections=None, max_keepalive_connections=None)
+    transport = httpx.ASGITransport(app=app)
+    async with app.router.lifespan_context(app):
+        started = time.perf_counter()
+        await lifecycle.wait_ready()
+        warmup_seconds = time.perf_counter() - started
+        print(f"コーパス {args.size}件（生成 {generate_seconds:.2f}秒、ウォームアップ {warmup_seconds:.2f}秒）", file=sys.stderr)
+
+        async with httpx.AsyncClient(transport=transport, base_url="http://benchmark", limits=limits, timeout=60) as client:
+            for endpoint in endpoints:
+                paths = build_paths(endpoint, args.seed, words)
+                # 各パスを1回ずつ叩いて、初回だけの処理（インデックスの遅延構築など）を測定から外す
+                if args.warmup:
+                    await run_level(client, paths, max(levels), len(paths))
+                for concurrency in levels:
+                    calls = sum(repository.calls.values())
+                    result = await run_level(client, paths, concurrency, args.requests)
+                    result.update(
+                        endpoint=endpoint,
+                        concurrency=concurrency,
+                        upstream_calls=sum(repository.calls.values()) - calls,
+                    )
+                    results.append(result)
+                    latency = result["latency_ms"]
+                    print(
+                        f"{endpoint:>8} c={concurrency:<4} {result['throughput']:9.1f} req/s  "
+                        f"p50 {latency['p50']:7.2f}ms  p95 {latency['p95']:7.2f}ms  p99 {latency['p99']:7.2f}ms  "
+                        f"エラー {result['errors']}  上流 {result['upstream_calls']}",
+                        file=sys.stderr,
+                    )
+
+    return {
+        "meta": {
+            "commit": _git("rev-parse", "--short", "HEAD"),
+            "dirty": bool(_git("status", "--porcelain", "--untracked-files=no")),
+            "timestamp": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "size": args.size,
+            "seed": args.seed,
+            "requests": args.requests,
+            "corpus": not args.no_corpus,
+            "cache": not args.no_cache,
+            "upstream_latency_ms": args.upstream_latency,
+            "generate_seconds": round(generate_seconds, 3),
+            "warmup_seconds": round(warmup_seconds, 3),
+        },
+        "results": results,
+    }
+
+
+def compare(old: dict, new: dict, threshold: float) -> bool:
+    """スループットの低下・p95 の悪化が threshold % を超えた組み合わせがあれば False"""
+    previous = {(row["endpoint"], row["concurrency"]): row for row in old["results"]}
+    ok = True
+    print(f"{old['meta'].get('commit')} → {new['meta'].get('commit')}（しきい値 {threshold:g}%）")
+    for row in new["results"]:
+        base = previous.get((row["endpoint"], row["concurrency"]))
+        if base is None:
+            continue
+        throughput = (row["throughput"] - base["throughput"]) / base["throughput"] * 100
+        p95 = (row["latency_ms"]["p95"] - base["latency_ms"]["p95"]) / max(base["latency_ms"]["p95"], 1e-9) * 100
+        regressed = throughput < -threshold or p95 > threshold
+        ok = ok and not regressed
+        print(
+            f"{'✗' if regressed else ' '} {row['endpoint']:>8} c={row['concurrency']:<4} "
+            f"{base['throughput']:9.1f} → {row['throughput']:9.1f} req/s ({throughput:+6.1f}%)  "
+            f"p95 {base['latency_ms']['p95']:7.2f} → {row['latency_ms']['p95']:7.2f}ms ({p95:+6.1f}%)"
+        )
+    return ok
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(prog="python -m benchmark", description="Azuma Insight Quotes API ベンチマーク")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = commands.add_parser("run", help="ベンチマークを実行して結果を JSON に保存する")
+    run_parser.add_argument("--size", type=int, default=10000, help="合成コーパスの件数（例: 10000, 100000, 1000000）")
+    run_parser.add_argument("--seed", type=int, default=0, help="コーパスとリクエストの乱数シード")
+    run_parser.add_argument("--concurrency", default="1,8,32", help="同時実行数（カンマ区切り）")
+    run_parser.add_argument("--requests", type=int, default=500, help="同時実行数1段階あたりのリクエスト数")
+    run_parser.add_argument("--endpoints", default=",".join(ENDPOINTS), help=f"対象（{','.join(ENDPOINTS)}）")
+    run_parser.add_argument("--upstream-latency", type=float, default=0.0, help="上流の呼び出し1回ごとの遅延（ミリ秒）")
+    run_parser.add_argument("--no-corpus", action="store_true", help="インメモリコーパスを使わず毎回上流に問い合わせる")
+    run_parser.add_argument("--no-cache", action="store_true", help="クエリ結果のキャッシュを実質無効にする")
+    run_parser.add_argument("--no-warmup", dest="warmup", action="store_false", help="測定前のウォームアップを省く")
+    run_parser.add_argument("--out", type=Path, help="結果の保存先（既定: benchmark/results/<日時>-<コミット>-<件数>.json）")
+
+    compare_parser = commands.add_parser("compare", help="2つの結果を比較し、悪化があれば終了コード1を返す")
+    compare_parser.add_argument("old", type=Path)
+    compare_parser.add_argument("new", type=Path)
+    compare_parser.add_argument("--threshold", type=float, default=10.0, help="悪化とみなす変化率（%%）")
+
+    args = parser.parse_args(argv)
+
+    if args.command == "compare":
+        old = json.loads(args.old.read_text(encoding="utf-8"))
+        new = json.loads(args.new.read_text(encoding="utf-8"))
+        return 0 if compare(old, new, args.threshold) else 1
+
+    report = asyncio.run(run(args))
+    out = args.out
+    if out is None:
+        stamp = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%S")
+        out = RESULTS_DIR / f"{stamp}-{report['meta']['commit'] or 'unknown'}-{args.size}.json"
+    out.parent.mkdir(parents=True, exist_ok=True)
+    out.write_text(json.dumps(report, ensure_ascii=False, indent=2) + "\n", encoding="utf-8")
+    print(f"結果を保存しました: {out}", file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
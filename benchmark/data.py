@@ -0,0 +1,145 @@
+"""
+合成コーパスの生成
+
+日本語の語彙を組み合わせて引用を作る。同じ seed なら同じコーパスになる。
+タグ・作者・テーマは実データと同じく一部に偏る（Zipf 分布）ようにし、
+タグや作者の付いていない引用も一定割合で混ぜる。
+"""
+
+import hashlib
+import random
+import uuid
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Iterator, List, Optional
+
+THEMES = {
+    "人生": ["生き方", "選択", "時間", "死生観"],
+    "仕事": ["働き方", "リーダーシップ", "チーム", "成果"],
+    "人間関係": ["友情", "家族", "信頼", "対話"],
+    "お金": ["投資", "節約", "価値", "豊かさ"],
+    "学び": ["読書", "習慣", "失敗", "好奇心"],
+    "挑戦": ["決断", "勇気", "継続", "変化"],
+    "健康": ["心", "体", "休息", "食事"],
+    "幸福": ["感謝", "喜び", "満足", "希望"],
+}
+
+NOUNS = [
+    "人生", "仕事", "努力", "成功", "失敗", "時間", "未来", "過去", "今日", "明日", "心", "夢", "希望",
+    "勇気", "自信", "感謝", "幸福", "言葉", "行動", "習慣", "挑戦", "変化", "成長", "学び", "知恵",
+    "経験", "信頼", "友情", "家族", "仲間", "愛", "自由", "責任", "決断", "情熱", "忍耐", "継続",
+    "目標", "目的", "価値", "意味", "答え", "問い", "道", "一歩", "壁", "扉", "光", "影", "風", "山",
+    "海", "空", "種", "花", "実", "根", "お金", "健康", "笑顔", "涙", "才能", "運", "偶然", "必然",
+]
+
+VERBS = [
+    "育てる", "つくる", "変える", "支える", "照らす", "導く", "超える", "選ぶ", "信じる", "続ける",
+    "始める", "手放す", "見つける", "積み重ねる", "磨く", "待つ", "受け入れる", "分かち合う",
+]
+
+ADJECTIVES = [
+    "小さな", "大きな", "静かな", "確かな", "新しい", "古い", "まっすぐな", "やさしい", "強い",
+    "弱い", "遠い", "近い", "深い", "本当の", "見えない", "ささやかな",
+]
+
+TEMPLATES = [
+    "{a}{n1}が{n2}を{v}。",
+    "{n1}とは、{a}{n2}を{v}ことである。",
+    "{n1}を{v}者だけが、{n2}にたどり着く。",
+    "{a}{n1}の積み重ねが{n2}になる。",
+    "{n1}は{n2}の中にある。",
+    "今日の{n1}が、明日の{n2}を{v}。",
+    "{n1}に近道はない。{a}{n2}を{v}だけだ。",
+    "{n1}を恐れるな。{n2}はその先にある。",
+]
+
+FAMILY_NAMES = ["佐藤", "鈴木", "高橋", "田中", "伊藤", "渡辺", "山本", "中村", "小林", "加藤",
+                "吉田", "山田", "佐々木", "山口", "松本", "井上", "木村", "林", "清水", "山崎"]
+GIVEN_NAMES = ["太郎", "花子", "一郎", "美咲", "健太", "陽菜", "翔", "結衣", "大輔", "さくら",
+               "誠", "愛", "直樹", "彩", "拓也", "真由美", "悠", "葵", "浩", "恵"]
+
+# quotes.author の既定値
+DEFAULT_AUTHOR = "成幸者への道"
+
+# 1件あたりのタグ数の分布（0〜5個）
+TAG_COUNT_WEIGHTS = [10, 30, 30, 18, 8, 4]
+
+
+def content_hash(title: str, text: str) -> str:
+    """quotes.content_hash と同じ (title, text) のハッシュ"""
+    return hashlib.md5(f"{title}\x1f{text}".encode("utf-8")).hexdigest()
+
+
+def zipf_weights(count: int, exponent: float = 1.1) -> List[float]:
+    return [1.0 / (rank ** exponent) for rank in range(1, count + 1)]
+
+
+def _sentence(rng: random.Random) -> str:
+    return rng.choice(TEMPLATES).format(
+        a=rng.choice(ADJECTIVES), n1=rng.choice(NOUNS), n2=rng.choice(NOUNS), v=rng.choice(VERBS),
+    )
+
+
+def tag_vocabulary(size: int) -> List[str]:
+    """タグの語彙（出現頻度の高い順）"""
+    tags = list(dict.fromkeys(NOUNS + [subtheme for subthemes in THEMES.values() for subtheme in subthemes]))
+    i = 0
+    while len(tags) < size:
+        tags.append(f"{ADJECTIVES[i // len(NOUNS) % len(ADJECTIVES)]}{NOUNS[i % len(NOUNS)]}")
+        i += 1
+    return tags[:size]
+
+
+def generate_quotes(
+    count: int,
+    seed: int = 0,
+    tag_count: int = 300,
+    author_count: int = 400,
+    now: Optional[datetime] = None,
+) -> Iterator[dict]:
+    """quotes テーブルと同じ列を持つ合成データを count 件生成する"""
+    rng = random.Random(seed)
+    now = now or datetime(2025, 1, 1, tzinfo=timezone.utc)
+    span = timedelta(days=3 * 365).total_seconds()
+
+    tags = tag_vocabulary(tag_count)
+    tag_weights = zipf_weights(len(tags))
+    authors = [f"{family}{given}" for family in FAMILY_NAMES for given in GIVEN_NAMES][:author_count]
+    author_weights = zipf_weights(len(authors))
+    themes = list(THEMES)
+    theme_weights = zipf_weights(len(themes), 0.6)
+
+    for _ in range(count):
+        theme = rng.choices(themes, theme_weights)[0] if rng.random() > 0.05 else None
+        subtheme = rng.choice(THEMES[theme]) if theme and rng.random() > 0.2 else None
+        size = rng.choices(range(len(TAG_COUNT_WEIGHTS)), TAG_COUNT_WEIGHTS)[0]
+        quote_tags = list(dict.fromkeys(rng.choices(tags, tag_weights, k=size))) or None
+        author = rng.choices(authors, author_weights)[0] if rng.random() > 0.3 else DEFAULT_AUTHOR
+
+        # 本文は1〜数文（まれに長文）
+        sentences = 1 + min(int(rng.expovariate(0.6)), 30)
+        text = "".join(_sentence(rng) for _ in range(sentences))
+        title = f"{rng.choice(ADJECTIVES)}{rng.choice(NOUNS)}"
+        created_at = now - timedelta(seconds=rng.random() * span)
+
+        yield {
+            "id": str(uuid.UUID(int=rng.getrandbits(128), version=4)),
+            "title": title,
+            "text": text,
+            "author": author,
+            "theme": theme,
+            "subtheme": subtheme,
+            "tags": quote_tags,
+            "created_at": created_at.isoformat(timespec="microseconds"),
+            "random_key": rng.random(),
+            "content_hash": content_hash(title, text),
+            "impression_count": 0,
+        }
+
+
+def vocabulary(tag_count: int = 300) -> Dict[str, List[str]]:
+    """負荷をかけるリクエストのパラメータに使う語彙（タグは頻出順）"""
+    return {
+        "themes": list(THEMES),
+        "tags": tag_vocabulary(tag_count),
+        "keywords": NOUNS + VERBS,
+    }
@@ -0,0 +1,337 @@
+"""
+上流のスタンドイン（メモリ上の QuoteRepository）
+
+PostgREST / PostgreSQL と同じ結果（並び順・NULL の扱い・RPC の戻り値の形）を返す。
+ソート済みの並びはソート項目ごとに初回に作って書き込みまで使い回し、
+キーセットの位置は二分探索で求める（インデックスの範囲走査に相当）。
+upstream_latency を指定すると呼び出しごとに待ち、ネットワークの往復を模擬する。
+"""
+
+import asyncio
+import bisect
+import uuid
+from collections import Counter
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+from api.repository import DataError, QuoteQuery, QuoteRepository
+from api.tag_index import matches_empty
+
+from .data import DEFAULT_AUTHOR, content_hash
+
+# quotes.sql の text_preview() が返す文字数
+TEXT_PREVIEW_CHARS = 200
+
+
+def _sort_key(row: dict, field: str) -> tuple:
+    # ASC は NULLS LAST（DESC はこの並びを逆にたどると NULLS FIRST になる）
+    value = row.get(field)
+    return (value is None, value if value is not None else "", row["id"])
+
+
+def _evaluate_tags(node: tuple, tags: Set[str]) -> bool:
+    kind = node[0]
+    if kind == "tag":
+        return node[1] in tags
+    if kind == "not":
+        return not _evaluate_tags(node[1], tags)
+    results = (_evaluate_tags(child, tags) for child in node[1])
+    return all(results) if kind == "and" else any(results)
+
+
+def _month(created_at: str) -> str:
+    return created_at[:7]
+
+
+class MemoryRepository(QuoteRepository):
+    """合成コーパスを保持するメモリ上のリポジトリ"""
+
+    name = "memory"
+    # Python の文字列比較（コードポイント順）で並べる
+    collation = "C"
+
+    def __init__(self, rows: Iterable[dict], upstream_latency: float = 0.0, users: Iterable[str] = ()):
+        self.rows: Dict[str, dict] = {row["id"]: row for row in rows}
+        self.users: Set[str] = set(users)
+        self.impressions: List[dict] = []
+        self.upstream_latency = upstream_latency
+        # 呼び出し回数（メソッド名・RPC 名ごと）
+        self.calls: Counter = Counter()
+        self._sorted: Dict[str, Tuple[List[tuple], List[dict]]] = {}
+        self._summary: Optional[dict] = None
+
+    async def _roundtrip(self, name: str):
+        self.calls[name] += 1
+        if self.upstream_latency > 0:
+            await asyncio.sleep(self.upstream_latency)
+
+    def _changed(self):
+        self._sorted.clear()
+        self._summary = None
+
+    # 並び順とキーセット
+
+    def _ordered(self, field: str) -> Tuple[List[tuple], List[dict]]:
+        if field not in self._sorted:
+            rows = sorted(self.rows.values(), key=lambda row: _sort_key(row, field))
+            self._sorted[field] = ([_sort_key(row, field) for row in rows], rows)
+        return self._sorted[field]
+
+    def _scan(self, query: QuoteQuery) -> Iterator[dict]:
+        """(order_by, id) の順にカーソル位置より後ろの行をたどる"""
+        keys, rows = self._ordered(query.order_by)
+        position = None
+        if query.after is not None:
+            value, row_id = query.after
+            position = (value is None, value if value is not None else "", row_id)
+            if query.order_by == "id":
+                position = (False, row_id, row_id)
+
+        if query.desc:
+            start = len(rows) - 1 if position is None else bisect.bisect_left(keys, position) - 1
+            return (rows[i] for i in range(start, -1, -1))
+        start = 0 if position is None else bisect.bisect_right(keys, position)
+        return (rows[i] for i in range(start, len(rows)))
+
+    # 絞り込み
+
+    def _matcher(self, query: QuoteQuery) -> Callable[[dict], bool]:
+        keyword = query.keyword.lower() if query.keyword is not None else None
+
+        def match(row: dict) -> bool:
+            if query.theme and row.get("theme") != query.theme:
+                return False
+            if query.subtheme and row.get("subtheme") != query.subtheme:
+                return False
+            if query.author and row.get("author") != query.author:
+                return False
+            if query.date_from and row["created_at"] < query.date_from:
+                return False
+            if query.date_to and row["created_at"] > query.date_to:
+                return False
+            tags = row.get("tags")
+            if query.tags and (tags is None or not set(query.tags) <= set(tags)):
+                return False
+            if query.tag_expression is not None:
+                if tags is None:
+                    if not matches_empty(query.tag_expression):
+                        return False
+                elif not _evaluate_tags(query.tag_expression, set(tags)):
+                    return False
+            if keyword is not None:
+                hits = [keyword in (row.get(field) or "").lower() for field in query.keyword_fields]
+                if not (all(hits) if query.keyword_mode == "and" else any(hits)):
+                    return False
+            return True
+
+        return match
+
+    @staticmethod
+    def _project(row: dict, select: str) -> dict:
+        if select.strip() == "*":
+            return dict(row)
+        item = {}
+        for column in select.split(","):
+            alias, _, name = column.strip().rpartition(":")
+            if name == "text_preview":
+                item[alias or name] = row["text"][:TEXT_PREVIEW_CHARS]
+            else:
+                item[alias or name] = row.get(name)
+        return item
+
+    # QuoteRepository
+
+    async def list_quotes(self, query: QuoteQuery) -> List[dict]:
+        await self._roundtrip("list_quotes")
+        match = self._matcher(query)
+        skip = query.offset if query.after is None else 0
+        page = []
+        for row in self._scan(query):
+            if not match(row):
+                continue
+            if skip:
+                skip -= 1
+                continue
+            page.append(self._project(row, query.select))
+            if query.limit is not None and len(page) >= query.limit:
+                break
+        return page
+
+    async def get_quote(self, quote_id: str) -> Optional[dict]:
+        await self._roundtrip("get_quote")
+        row = self.rows.get(quote_id)
+        return dict(row) if row is not None else None
+
+    async def get_quotes(self, quote_ids: List[str]) -> List[dict]:
+        await self._roundtrip("get_quotes")
+        return [dict(self.rows[quote_id]) for quote_id in dict.fromkeys(quote_ids) if quote_id in self.rows]
+
+    async def insert_quotes(self, rows: List[dict]) -> List[dict]:
+        await self._roundtrip("insert_quotes")
+        inserted = []
+        for values in rows:
+            if not values.get("title") or not values.get("text"):
+                raise DataError("title / text は必須です")
+            row = {
+                "id": str(uuid.uuid4()),
+                "author": DEFAULT_AUTHOR,
+                "theme": None,
+                "subtheme": None,
+                "tags": None,
+                "created_at": datetime.now(timezone.utc).isoformat(timespec="microseconds"),
+                "impression_count": 0,
+                **values,
+            }
+            row["random_key"] = row.get("random_key", uuid.uuid4().int / (1 << 128))
+            row["content_hash"] = content_hash(row["title"], row["text"])
+            inserted.append(row)
+        for row in inserted:
+            self.rows[row["id"]] = row
+        self._changed()
+        return [dict(row) for row in inserted]
+
+    async def update_quote(self, quote_id: str, values: dict) -> Optional[dict]:
+        await self._roundtrip("update_quote")
+        row = self.rows.get(quote_id)
+        if row is None:
+            return None
+        row.update(values)
+        row["content_hash"] = content_hash(row["title"], row["text"])
+        self._changed()
+        return dict(row)
+
+    async def delete_quote(self, quote_id: str) -> Optional[dict]:
+        await self._roundtrip("delete_quote")
+        row = self.rows.pop(quote_id, None)
+        self._changed()
+        return row
+
+    async def existing_content_hashes(self, hashes: List[str]) -> Set[str]:
+        await self._roundtrip("existing_content_hashes")
+        wanted = set(hashes)
+        return {row["content_hash"] for row in self.rows.values() if row["content_hash"] in wanted}
+
+    async def user_exists(self, user_id: str) -> bool:
+        await self._roundtrip("user_exists")
+        return user_id in self.users
+
+    async def insert_impressions(self, rows: List[dict]):
+        await self._roundtrip("insert_impressions")
+        missing = [row["quote_id"] for row in rows if row["quote_id"] not in self.rows]
+        if missing:
+            raise DataError(f"引用が存在しません: {missing[0]}")
+        unknown = [row["user_id"] for row in rows if row["user_id"] not in self.users]
+        if unknown:
+            raise DataError(f"ユーザーが存在しません: {unknown[0]}")
+        for row in rows:
+            self.impressions.append(dict(row))
+            self.rows[row["quote_id"]]["impression_count"] += 1
+
+    async def list_impressions(
+        self, field: str, value: str, limit: int, after: Optional[Tuple[Any, str]]
+    ) -> List[dict]:
+        await self._roundtrip("list_impressions")
+        rows = sorted(
+            (row for row in self.impressions if row[field] == value),
+            key=lambda row: (row["created_at"], row["id"]),
+            reverse=True,
+        )
+        if after is not None:
+            rows = [row for row in rows if (row["created_at"], row["id"]) < tuple(after)]
+        return rows[:limit]
+
+    async def rpc(self, name: str, params: Dict[str, Any], read: bool = False) -> Any:
+        await self._roundtrip(f"rpc:{name}")
+        handler = getattr(self, f"_rpc_{name}", None)
+        if handler is None:
+            raise DataError(f"関数 {name} はありません")
+        return handler(**params)
+
+    # RPC（sql/azuma-insight の関数と同じ戻り値）
+
+    def _rpc_random_quotes(self, p_count=1, p_theme=None, p_tag=None, p_author=None, p_seed=None) -> List[dict]:
+        keys, rows = self._ordered("random_key")
+        pivot = p_seed if p_seed is not None else uuid.uuid4().int / (1 << 128)
+        start = bisect.bisect_left(keys, (False, pivot, ""))
+        picked = []
+        for i in range(len(rows)):
+            row = rows[(start + i) % len(rows)]
+            if p_theme and row.get("theme") != p_theme:
+                continue
+            if p_author and row.get("author") != p_author:
+                continue
+            if p_tag and p_tag not in (row.get("tags") or ()):
+                continue
+            picked.append(dict(row))
+            if len(picked) >= p_count:
+                break
+        return picked
+
+    @staticmethod
+    def _aggregate(rows: Iterable[dict]) -> dict:
+        themes, subthemes, authors, tags, months = Counter(), Counter(), Counter(), Counter(), Counter()
+        total, first, last = 0, None, None
+        for row in rows:
+            total += 1
+            themes[row.get("theme") or "未分類"] += 1
+            subthemes[row.get("subtheme") or "未分類"] += 1
+            authors[row.get("author") or "不明"] += 1
+            tags.update(row.get("tags") or ())
+            months[_month(row["created_at"])] += 1
+            first = row["created_at"] if first is None else min(first, row["created_at"])
+            last = row["created_at"] if last is None else max(last, row["created_at"])
+        return {
+            "total_quotes": total,
+            "themes": dict(themes),
+            "subthemes": dict(subthemes),
+            "authors": dict(authors),
+            "tags": dict(tags),
+            "date_range": {"min": first, "max": last},
+            "monthly_stats": dict(months),
+        }
+
+    def _rpc_quote_stats_summary(self) -> dict:
+        # DB ではトリガで維持されるカウンタを読むだけなので、書き込みまで集計結果を使い回す
+        if self._summary is None:
+            self._summary = self._aggregate(self.rows.values())
+        return self._summary
+
+    def _rpc_quote_stats(self, p_theme=None, p_author=None, p_date_from=None, p_date_to=None) -> dict:
+        match = self._matcher(QuoteQuery(theme=p_theme, author=p_author, date_from=p_date_from, date_to=p_date_to))
+        return self._aggregate(row for row in self.rows.values() if match(row))
+
+    def _rpc_quote_stats_reconcile(self) -> bool:
+        self._summary = None
+        return True
+
+    def _rpc_quote_facets(
+        self, p_facets, p_theme=None, p_subtheme=None, p_author=None, p_tags=None, p_date_from=None,
+        p_date_to=None, p_q=None, p_search_fields=("title", "text"), p_search_type="or",
+    ) -> dict:
+        match = self._matcher(QuoteQuery(
+            theme=p_theme, subtheme=p_subtheme, author=p_author, tags=p_tags or [],
+            date_from=p_date_from, date_to=p_date_to,
+            keyword=p_q, keyword_fields=list(p_search_fields), keyword_mode=p_search_type,
+        ))
+        counts = {facet: Counter() for facet in p_facets}
+        total = 0
+        for row in self.rows.values():
+            if not match(row):
+                continue
+            total += 1
+            for facet, counter in counts.items():
+                if facet == "tags":
+                    counter.update(set(row.get("tags") or ()))
+                elif row.get(facet) is not None:
+                    counter[row[facet]] += 1
+        return {"total": total, "facets": {facet: dict(counter) for facet, counter in counts.items()}}
+
+    def _rpc_tag_cooccurrence(self, p_tag, p_limit=20) -> dict:
+        tagged = [row["tags"] for row in self.rows.values() if p_tag in (row.get("tags") or ())]
+        counter = Counter(tag for tags in tagged for tag in set(tags) if tag != p_tag)
+        pairs = sorted(counter.items(), key=lambda pair: (-pair[1], pair[0]))[:p_limit]
+        return {
+            "tag": p_tag,
+            "count": len(tagged),
+            "cooccurring": [{"tag": tag, "count": count} for tag, count in pairs],
+        }
@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+"""
+Azuma Insight Quotes API 負荷テストスクリプト
+
+同時実行数を段階的に上げながら各エンドポイントを叩き、
+スループット（req/s）が同時実行数に応じて伸びるかを確認する。
+
+使い方:
+    python load_test.py [同時実行数...]   例) python load_test.py 1 4 16 64
+"""
+
+import asyncio
+import sys
+import time
+
+import httpx
+
+# API ベースURL
+BASE_URL = "http://localhost:8000"
+
+# 1段階あたりのリクエスト数
+REQUESTS_PER_LEVEL = 200
+
+ENDPOINTS = [
+    "/quotes?limit=20",
+    "/quotes/search?q=人生&limit=20",
+    "/quotes/random",
+    "/stats",
+]
+
+
+async def run_level(client: httpx.AsyncClient, path: str, concurrency: int):
+    """指定した同時実行数で path を REQUESTS_PER_LEVEL 回叩く"""
+    remaining = REQUESTS_PER_LEVEL
+    errors = 0
+
+    async def worker():
+        nonlocal remaining, errors
+        while remaining > 0:
+            remaining -= 1
+            try:
+                response = await client.get(path)
+                if response.status_code >= 400:
+                    errors += 1
+            except httpx.HTTPError:
+                errors += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    return REQUESTS_PER_LEVEL / elapsed, errors
+
+
+async def main(levels):
+    print("🏋️ Azuma Insight Quotes API 負荷テスト開始")
+    print("=" * 50)
+
+    limits = httpx.Limits(max_connections=max(levels), max_keepalive_connections=max(levels))
+    async with httpx.AsyncClient(base_url=BASE_URL, limits=limits, timeout=30) as client:
+        for path in ENDPOINTS:
+            print(f"📍 {path}")
+            for concurrency in levels:
+                throughput, errors = await run_level(client, path, concurrency)
+                print(f"  同時実行数 {concurrency:>4}: {throughput:8.1f} req/s  エラー {errors}")
+            print()
+
+    print("🎉 負荷テスト完了!")
+
+
+if __name__ == "__main__":
+    levels = [int(arg) for arg in sys.argv[1:]] or [1, 4, 16, 64]
+    asyncio.run(main(levels))
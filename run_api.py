@@ -4,7 +4,6 @@ Azuma Insight Quotes API 起動スクリプト
 """
 
 import uvicorn
-from api.main import app
 
 if __name__ == "__main__":
     print("🚀 Azuma Insight Quotes API を起動中...")
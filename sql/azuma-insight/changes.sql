@@ -0,0 +1,140 @@
+-- 引用の変更履歴（/changes の SSE で配信し、クライアントが最後に受け取った版から再開できるようにする）
+-- API を CHANGES_SOURCE=postgres で動かすと、各ワーカーが LISTEN quote_changes で通知を受けて続きを読む
+-- seq は書き込みのトランザクションがそれぞれシーケンスから取る記録順（取るときに他の書き込みを待たない）。
+-- version は配信の版で、コミット済みの行に quote_changes_since が seq の順に付ける。
+-- seq はコミット順とずれる（小さい seq のトランザクションが後からコミットしうる）ため、そのまま版にすると
+-- 先に大きい版を読んだ購読側が後からコミットされた行を読み飛ばす。コミット後に付ける版ならその心配がない
+CREATE TABLE IF NOT EXISTS quote_changes (
+    seq bigserial PRIMARY KEY,
+    version bigint UNIQUE,
+    op text NOT NULL CHECK (op IN ('create', 'update', 'delete')),
+    quote_id uuid NOT NULL,
+    quote jsonb,
+    changed_at timestamp with time zone NOT NULL DEFAULT now()
+);
+
+CREATE INDEX IF NOT EXISTS quote_changes_changed_at_idx ON quote_changes (changed_at);
+CREATE INDEX IF NOT EXISTS quote_changes_unversioned_idx ON quote_changes (seq) WHERE version IS NULL;
+
+-- 付けた最大の版と、削除済み（quote_changes_prune で消した）最大の版。後者より前からの再開はできない
+CREATE TABLE IF NOT EXISTS quote_changes_state (
+    id boolean PRIMARY KEY DEFAULT true CHECK (id),
+    last_version bigint NOT NULL DEFAULT 0,
+    pruned_version bigint NOT NULL DEFAULT 0
+);
+INSERT INTO quote_changes_state (id) VALUES (true) ON CONFLICT DO NOTHING;
+
+CREATE OR REPLACE FUNCTION quote_changes_trigger()
+RETURNS trigger
+LANGUAGE plpgsql
+AS $$
+BEGIN
+    -- 感想数 impression_count だけが変わる更新は配信しない
+    IF TG_OP = 'UPDATE' THEN
+        IF NOT EXISTS (
+            SELECT 1 FROM old_rows o JOIN new_rows n ON n.id = o.id
+            WHERE to_jsonb(o) - 'impression_count' IS DISTINCT FROM to_jsonb(n) - 'impression_count'
+        ) THEN
+            RETURN NULL;
+        END IF;
+    END IF;
+
+    IF TG_OP = 'INSERT' THEN
+        INSERT INTO quote_changes (op, quote_id, quote)
+        SELECT 'create', n.id, to_jsonb(n) FROM new_rows n ORDER BY n.id;
+    ELSIF TG_OP = 'UPDATE' THEN
+        INSERT INTO quote_changes (op, quote_id, quote)
+        SELECT 'update', n.id, to_jsonb(n)
+        FROM old_rows o JOIN new_rows n ON n.id = o.id
+        WHERE to_jsonb(o) - 'impression_count' IS DISTINCT FROM to_jsonb(n) - 'impression_count'
+        ORDER BY n.id;
+    ELSE
+        INSERT INTO quote_changes (op, quote_id, quote)
+        SELECT 'delete', o.id, to_jsonb(o) FROM old_rows o ORDER BY o.id;
+    END IF;
+
+    -- 同じトランザクション内の同じ通知は1つにまとまる（購読側は版で続きを読むので中身は空でよい）
+    PERFORM pg_notify('quote_changes', '');
+    RETURN NULL;
+END;
+$$;
+
+-- 遷移テーブルは1つのトリガに1種類の操作しか指定できないため、操作ごとに作成する
+DROP TRIGGER IF EXISTS quote_changes_insert ON quotes;
+DROP TRIGGER IF EXISTS quote_changes_update ON quotes;
+DROP TRIGGER IF EXISTS quote_changes_delete ON quotes;
+CREATE TRIGGER quote_changes_insert
+    AFTER INSERT ON quotes
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION quote_changes_trigger();
+CREATE TRIGGER quote_changes_update
+    AFTER UPDATE ON quotes
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION quote_changes_trigger();
+CREATE TRIGGER quote_changes_delete
+    AFTER DELETE ON quotes
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION quote_changes_trigger();
+
+-- p_version より後の変更を版の順に最大 p_limit 件（削除済みの版と最新の版も返し、再開できるかを判定できるようにする）
+-- 先に、版のないコミット済みの行へ seq の順に版を付ける（版を付ける側だけが状態の行のロックで直列になり、書き込みは待たせない）
+CREATE OR REPLACE FUNCTION quote_changes_since(p_version bigint, p_limit integer DEFAULT 1000)
+RETURNS jsonb
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    v_last bigint;
+BEGIN
+    IF EXISTS (SELECT 1 FROM quote_changes WHERE version IS NULL) THEN
+        SELECT last_version INTO v_last FROM quote_changes_state FOR UPDATE;
+        -- ロックを待った間に別の呼び出しが付けた版は、この文の時点で見えている
+        WITH numbered AS (
+            SELECT seq, v_last + row_number() OVER (ORDER BY seq) AS version
+            FROM quote_changes
+            WHERE version IS NULL
+        )
+        UPDATE quote_changes c SET version = n.version
+        FROM numbered n
+        WHERE c.seq = n.seq;
+        IF FOUND THEN
+            UPDATE quote_changes_state
+            SET last_version = (SELECT max(version) FROM quote_changes);
+        END IF;
+    END IF;
+
+    RETURN jsonb_build_object(
+        'pruned_version', (SELECT pruned_version FROM quote_changes_state),
+        'latest_version', (SELECT last_version FROM quote_changes_state),
+        'changes', COALESCE((
+            SELECT jsonb_agg(to_jsonb(c) - 'seq' ORDER BY c.version)
+            FROM (
+                SELECT * FROM quote_changes WHERE version > p_version ORDER BY version LIMIT p_limit
+            ) c
+        ), '[]'::jsonb)
+    );
+END;
+$$;
+
+-- p_keep_seconds より古い変更を消す（消した件数を返す）
+-- 版の途中に穴を作らないよう、古い変更のうち最大の版までをまとめて消す
+CREATE OR REPLACE FUNCTION quote_changes_prune(p_keep_seconds double precision)
+RETURNS integer
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    v_max bigint;
+    v_count integer;
+BEGIN
+    SELECT max(version) INTO v_max
+    FROM quote_changes
+    WHERE changed_at < now() - make_interval(secs => p_keep_seconds);
+    IF v_max IS NULL THEN
+        RETURN 0;
+    END IF;
+
+    DELETE FROM quote_changes WHERE version <= v_max;
+    GET DIAGNOSTICS v_count = ROW_COUNT;
+    UPDATE quote_changes_state SET pruned_version = greatest(pruned_version, v_max);
+    RETURN v_count;
+END;
+$$;
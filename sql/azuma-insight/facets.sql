@@ -0,0 +1,64 @@
+-- 一覧・検索結果のファセット件数（/quotes, /quotes/search の facets 指定時、インメモリのコーパス未読み込みの場合に RPC で呼び出す）
+-- フィルタ結果を1回だけ走査し、GROUPING SETS で theme / subtheme / author と総件数をまとめて集計する
+-- p_q を指定すると p_search_fields の部分一致（大文字・小文字を区別しない）で絞り込む
+CREATE OR REPLACE FUNCTION quote_facets(
+    p_facets text[] DEFAULT ARRAY['theme', 'subtheme', 'tags', 'author'],
+    p_theme text DEFAULT NULL,
+    p_subtheme text DEFAULT NULL,
+    p_author text DEFAULT NULL,
+    p_tags text[] DEFAULT NULL,
+    p_date_from timestamp with time zone DEFAULT NULL,
+    p_date_to timestamp with time zone DEFAULT NULL,
+    p_q text DEFAULT NULL,
+    p_search_fields text[] DEFAULT ARRAY['title', 'text'],
+    p_search_type text DEFAULT 'or'
+) RETURNS jsonb
+LANGUAGE sql STABLE
+AS $$
+    WITH matched AS MATERIALIZED (
+        SELECT q.theme, q.subtheme, q.author, q.tags
+        FROM quotes q
+        CROSS JOIN LATERAL (
+            SELECT array_agg(strpos(lower(f.value), lower(p_q)) > 0) AS hits
+            FROM (VALUES ('title', q.title), ('text', q.text), ('theme', q.theme),
+                         ('subtheme', q.subtheme), ('author', q.author)) AS f(name, value)
+            WHERE f.name = ANY(p_search_fields)
+        ) s
+        WHERE (p_theme IS NULL OR q.theme = p_theme)
+          AND (p_subtheme IS NULL OR q.subtheme = p_subtheme)
+          AND (p_author IS NULL OR q.author = p_author)
+          AND (p_tags IS NULL OR q.tags @> p_tags)
+          AND (p_date_from IS NULL OR q.created_at >= p_date_from)
+          AND (p_date_to IS NULL OR q.created_at <= p_date_to)
+          AND (p_q IS NULL OR CASE
+                WHEN p_search_type = 'and' THEN COALESCE(true = ALL(s.hits), false)
+                ELSE COALESCE(true = ANY(s.hits), false)
+              END)
+    ),
+    grouped AS (
+        SELECT GROUPING(theme, subtheme, author) AS grouping_set, theme, subtheme, author, count(*) AS n
+        FROM matched
+        GROUP BY GROUPING SETS ((theme), (subtheme), (author), ())
+    )
+    SELECT jsonb_build_object(
+        'total', COALESCE((SELECT n FROM grouped WHERE grouping_set = 7), 0),
+        'facets', jsonb_strip_nulls(jsonb_build_object(
+            'theme', CASE WHEN 'theme' = ANY(p_facets) THEN COALESCE(
+                (SELECT jsonb_object_agg(theme, n) FROM grouped WHERE grouping_set = 3 AND theme IS NOT NULL),
+                '{}'::jsonb) END,
+            'subtheme', CASE WHEN 'subtheme' = ANY(p_facets) THEN COALESCE(
+                (SELECT jsonb_object_agg(subtheme, n) FROM grouped WHERE grouping_set = 5 AND subtheme IS NOT NULL),
+                '{}'::jsonb) END,
+            'author', CASE WHEN 'author' = ANY(p_facets) THEN COALESCE(
+                (SELECT jsonb_object_agg(author, n) FROM grouped WHERE grouping_set = 6 AND author IS NOT NULL),
+                '{}'::jsonb) END,
+            'tags', CASE WHEN 'tags' = ANY(p_facets) THEN COALESCE(
+                (SELECT jsonb_object_agg(tag, n) FROM (
+                    SELECT u.tag, count(*) AS n
+                    FROM matched m, LATERAL (SELECT DISTINCT unnest(m.tags) AS tag) u
+                    GROUP BY u.tag
+                ) t),
+                '{}'::jsonb) END
+        ))
+    );
+$$;
@@ -4,4 +4,52 @@ CREATE TABLE IF NOT EXISTS impressions (
     user_id uuid NOT NULL REFERENCES users(id) ON DELETE CASCADE,
     impression text NOT NULL,
     created_at timestamp with time zone DEFAULT timezone('utc', now())
-);
\ No newline at end of file
+);
+
+-- 引用別・ユーザー別の一覧（created_at, id のキーセット）用インデックス
+CREATE INDEX IF NOT EXISTS impressions_quote_id_created_at_idx ON impressions (quote_id, created_at DESC, id DESC);
+CREATE INDEX IF NOT EXISTS impressions_user_id_created_at_idx ON impressions (user_id, created_at DESC, id DESC);
+
+-- 引用ごとの感想数（impressions へのINSERT/DELETE時にトリガで差分更新し、リクエストごとに COUNT(*) しない）
+ALTER TABLE quotes ADD COLUMN IF NOT EXISTS impression_count bigint NOT NULL DEFAULT 0;
+
+CREATE OR REPLACE FUNCTION impressions_count_trigger()
+RETURNS trigger
+LANGUAGE plpgsql
+AS $$
+BEGIN
+    -- 文単位で実行し、API がまとめて書き込んだ複数行INSERTでも引用ごとに1回だけ更新する
+    -- （先に引用 id 順で行ロックを取り、ワーカー間の同時書き込みでのデッドロックを避ける）
+    IF TG_OP = 'INSERT' THEN
+        PERFORM 1 FROM quotes WHERE id IN (SELECT quote_id FROM new_rows) ORDER BY id FOR NO KEY UPDATE;
+        UPDATE quotes q
+        SET impression_count = q.impression_count + d.n
+        FROM (SELECT quote_id, count(*) AS n FROM new_rows GROUP BY quote_id) d
+        WHERE q.id = d.quote_id;
+    ELSE
+        PERFORM 1 FROM quotes WHERE id IN (SELECT quote_id FROM old_rows) ORDER BY id FOR NO KEY UPDATE;
+        UPDATE quotes q
+        SET impression_count = greatest(q.impression_count - d.n, 0)
+        FROM (SELECT quote_id, count(*) AS n FROM old_rows GROUP BY quote_id) d
+        WHERE q.id = d.quote_id;
+    END IF;
+    RETURN NULL;
+END;
+$$;
+
+DROP TRIGGER IF EXISTS impressions_count_insert ON impressions;
+DROP TRIGGER IF EXISTS impressions_count_delete ON impressions;
+CREATE TRIGGER impressions_count_insert
+    AFTER INSERT ON impressions
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION impressions_count_trigger();
+CREATE TRIGGER impressions_count_delete
+    AFTER DELETE ON impressions
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION impressions_count_trigger();
+
+-- 既存の感想から件数を初期化する
+UPDATE quotes q
+SET impression_count = c.n
+FROM (SELECT quote_id, count(*) AS n FROM impressions GROUP BY quote_id) c
+WHERE q.id = c.quote_id AND q.impression_count <> c.n;
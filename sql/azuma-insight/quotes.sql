@@ -6,5 +6,37 @@ CREATE TABLE quotes (
     theme text,
     subtheme text,
     tags text[],
-    created_at timestamp with time zone DEFAULT timezone('utc', now())
-);
\ No newline at end of file
+    created_at timestamp with time zone NOT NULL DEFAULT timezone('utc', now())
+);
+
+-- 既存テーブル向け：キーセットページネーションのため created_at を NOT NULL にする
+ALTER TABLE quotes ALTER COLUMN created_at SET NOT NULL;
+
+-- 統計・フィルタ用インデックス
+CREATE INDEX IF NOT EXISTS quotes_author_idx ON quotes (author);
+
+-- キーセットページネーション用の複合インデックス（ソート項目 + id）
+-- 降順は同じインデックスの逆向きスキャンで処理される
+-- text は長文がB-treeの1エントリの上限を超えうるため作成しない
+CREATE INDEX IF NOT EXISTS quotes_created_at_id_idx ON quotes (created_at, id);
+CREATE INDEX IF NOT EXISTS quotes_title_id_idx ON quotes (title, id);
+CREATE INDEX IF NOT EXISTS quotes_theme_id_idx ON quotes (theme, id);
+-- DATABASE_BACKEND=postgres は文字列を COLLATE "C"（インメモリと同じコードポイント順）で並べるため、その順のインデックス
+CREATE INDEX IF NOT EXISTS quotes_title_c_id_idx ON quotes ((title COLLATE "C"), id);
+CREATE INDEX IF NOT EXISTS quotes_theme_c_id_idx ON quotes ((theme COLLATE "C"), id);
+
+-- 一括インポートの重複判定用（title と text の組のハッシュ）
+-- 長文の text を直接インデックスに入れないよう md5 を生成列として持つ
+-- 既存の重複データや POST /quotes を妨げないよう一意制約にはしない
+ALTER TABLE quotes ADD COLUMN IF NOT EXISTS content_hash text
+    GENERATED ALWAYS AS (md5(title || chr(31) || text)) STORED;
+CREATE INDEX IF NOT EXISTS quotes_content_hash_idx ON quotes (content_hash);
+
+-- 一覧の本文プレビュー用の計算列（PostgREST で select=text:text_preview とすると先頭200文字だけを転送する）
+-- 文字数は api/fields.py の TEXT_PREVIEW_DB_CHARS と合わせる
+CREATE OR REPLACE FUNCTION text_preview(quotes)
+RETURNS text
+LANGUAGE sql IMMUTABLE
+AS $$
+    SELECT left($1.text, 200);
+$$;
@@ -0,0 +1,44 @@
+-- ランダム引用の取得（/quotes/random のインメモリプール未構築時に RPC で呼び出す）
+-- 各行に一様乱数のキーを持たせ、ランダムな位置からインデックスを辿って1回の問い合わせで取得する
+ALTER TABLE quotes ADD COLUMN IF NOT EXISTS random_key double precision NOT NULL DEFAULT random();
+CREATE INDEX IF NOT EXISTS quotes_random_key_idx ON quotes (random_key);
+
+-- p_seed を指定すると同じ位置から取得する（「今日の一句」用）
+CREATE OR REPLACE FUNCTION random_quotes(
+    p_count integer DEFAULT 1,
+    p_theme text DEFAULT NULL,
+    p_tag text DEFAULT NULL,
+    p_author text DEFAULT NULL,
+    p_seed double precision DEFAULT NULL
+) RETURNS SETOF quotes
+LANGUAGE plpgsql VOLATILE
+AS $$
+DECLARE
+    v_pivot double precision := COALESCE(p_seed, random());
+BEGIN
+    RETURN QUERY
+    (
+        SELECT q.*
+        FROM quotes q
+        WHERE q.random_key >= v_pivot
+          AND (p_theme IS NULL OR q.theme = p_theme)
+          AND (p_author IS NULL OR q.author = p_author)
+          AND (p_tag IS NULL OR q.tags @> ARRAY[p_tag])
+        ORDER BY q.random_key
+        LIMIT p_count
+    )
+    UNION ALL
+    -- 末尾に達したら先頭から折り返す
+    (
+        SELECT q.*
+        FROM quotes q
+        WHERE q.random_key < v_pivot
+          AND (p_theme IS NULL OR q.theme = p_theme)
+          AND (p_author IS NULL OR q.author = p_author)
+          AND (p_tag IS NULL OR q.tags @> ARRAY[p_tag])
+        ORDER BY q.random_key
+        LIMIT p_count
+    )
+    LIMIT p_count;
+END;
+$$;
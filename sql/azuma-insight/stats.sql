@@ -0,0 +1,223 @@
+-- 統計情報の集計関数（/stats から RPC で呼び出す）
+-- 集計はすべてDB側で行い、件数だけを返す
+CREATE OR REPLACE FUNCTION quote_stats(
+    p_theme text DEFAULT NULL,
+    p_author text DEFAULT NULL,
+    p_date_from timestamp with time zone DEFAULT NULL,
+    p_date_to timestamp with time zone DEFAULT NULL
+) RETURNS jsonb
+LANGUAGE sql STABLE
+AS $$
+    WITH filtered AS (
+        SELECT theme, subtheme, author, tags, created_at
+        FROM quotes
+        WHERE (p_theme IS NULL OR theme = p_theme)
+          AND (p_author IS NULL OR author = p_author)
+          AND (p_date_from IS NULL OR created_at >= p_date_from)
+          AND (p_date_to IS NULL OR created_at <= p_date_to)
+    )
+    SELECT jsonb_build_object(
+        'total_quotes', (SELECT count(*) FROM filtered),
+        'themes', COALESCE((
+            SELECT jsonb_object_agg(key, n)
+            FROM (SELECT COALESCE(theme, '未分類') AS key, count(*) AS n FROM filtered GROUP BY 1) s
+        ), '{}'::jsonb),
+        'subthemes', COALESCE((
+            SELECT jsonb_object_agg(key, n)
+            FROM (SELECT COALESCE(subtheme, '未分類') AS key, count(*) AS n FROM filtered GROUP BY 1) s
+        ), '{}'::jsonb),
+        'authors', COALESCE((
+            SELECT jsonb_object_agg(key, n)
+            FROM (SELECT COALESCE(author, '不明') AS key, count(*) AS n FROM filtered GROUP BY 1) s
+        ), '{}'::jsonb),
+        'tags', COALESCE((
+            SELECT jsonb_object_agg(tag, n)
+            FROM (SELECT tag, count(*) AS n FROM filtered, unnest(tags) AS tag GROUP BY tag) s
+        ), '{}'::jsonb),
+        'date_range', (
+            SELECT jsonb_build_object('min', min(created_at), 'max', max(created_at)) FROM filtered
+        ),
+        'monthly_stats', COALESCE((
+            SELECT jsonb_object_agg(month, n)
+            FROM (
+                SELECT to_char(created_at AT TIME ZONE 'UTC', 'YYYY-MM') AS month, count(*) AS n
+                FROM filtered
+                WHERE created_at IS NOT NULL
+                GROUP BY 1
+            ) s
+        ), '{}'::jsonb)
+    );
+$$;
+
+
+-- 統計カウンタ（quotes へのINSERT/UPDATE/DELETE時にトリガで差分更新）
+-- dimension: total / theme / subtheme / author / tag / month
+CREATE TABLE IF NOT EXISTS quote_stats_counters (
+    dimension text NOT NULL,
+    key text NOT NULL,
+    count bigint NOT NULL DEFAULT 0,
+    PRIMARY KEY (dimension, key)
+);
+
+-- 1行分のカウンタキーを列挙する
+CREATE OR REPLACE FUNCTION quote_stats_keys(
+    p_theme text,
+    p_subtheme text,
+    p_author text,
+    p_tags text[],
+    p_created_at timestamp with time zone
+) RETURNS TABLE (dimension text, key text)
+LANGUAGE sql STABLE
+AS $$
+    SELECT 'total', ''
+    UNION ALL SELECT 'theme', COALESCE(p_theme, '未分類')
+    UNION ALL SELECT 'subtheme', COALESCE(p_subtheme, '未分類')
+    UNION ALL SELECT 'author', COALESCE(p_author, '不明')
+    UNION ALL SELECT 'tag', tag FROM unnest(p_tags) AS tag
+    UNION ALL SELECT 'month', to_char(p_created_at AT TIME ZONE 'UTC', 'YYYY-MM')
+        WHERE p_created_at IS NOT NULL;
+$$;
+
+CREATE OR REPLACE FUNCTION quote_stats_counters_trigger()
+RETURNS trigger
+LANGUAGE plpgsql
+AS $$
+BEGIN
+    -- 集計対象の列が変わらない更新（感想数 impression_count の差分更新など）では何もしない
+    -- （old_rows は UPDATE / DELETE でしか存在しないため、条件を1つの式にまとめず IF を分ける）
+    IF TG_OP = 'UPDATE' THEN
+        IF NOT EXISTS (
+            SELECT 1 FROM old_rows o JOIN new_rows n ON n.id = o.id
+            WHERE (o.theme, o.subtheme, o.author, o.tags, o.created_at)
+                IS DISTINCT FROM (n.theme, n.subtheme, n.author, n.tags, n.created_at)
+        ) THEN
+            RETURN NULL;
+        END IF;
+    END IF;
+
+    -- 文単位で実行し、遷移テーブルの旧値を -1、新値を +1 として合算して差分が出たキーだけを更新する
+    -- （一括インポートの複数行INSERTでもカウンタの更新は1文で済む）
+    -- （キー順に更新してワーカー間の同時書き込みでのデッドロックを避ける）
+    IF TG_OP = 'INSERT' THEN
+        INSERT INTO quote_stats_counters (dimension, key, count)
+        SELECT k.dimension, k.key, count(*)
+        FROM new_rows n,
+        LATERAL quote_stats_keys(n.theme, n.subtheme, n.author, n.tags, n.created_at) AS k
+        GROUP BY k.dimension, k.key
+        ORDER BY k.dimension, k.key
+        ON CONFLICT (dimension, key)
+        DO UPDATE SET count = quote_stats_counters.count + EXCLUDED.count;
+        RETURN NULL;
+    END IF;
+
+    IF TG_OP = 'DELETE' THEN
+        INSERT INTO quote_stats_counters (dimension, key, count)
+        SELECT k.dimension, k.key, -count(*)
+        FROM old_rows o,
+        LATERAL quote_stats_keys(o.theme, o.subtheme, o.author, o.tags, o.created_at) AS k
+        GROUP BY k.dimension, k.key
+        ORDER BY k.dimension, k.key
+        ON CONFLICT (dimension, key)
+        DO UPDATE SET count = quote_stats_counters.count + EXCLUDED.count;
+    ELSE
+        INSERT INTO quote_stats_counters (dimension, key, count)
+        SELECT k.dimension, k.key, sum(k.delta)
+        FROM (
+            SELECT o_k.dimension, o_k.key, -1 AS delta
+            FROM old_rows o,
+            LATERAL quote_stats_keys(o.theme, o.subtheme, o.author, o.tags, o.created_at) AS o_k
+            UNION ALL
+            SELECT n_k.dimension, n_k.key, 1 AS delta
+            FROM new_rows n,
+            LATERAL quote_stats_keys(n.theme, n.subtheme, n.author, n.tags, n.created_at) AS n_k
+        ) k
+        GROUP BY k.dimension, k.key
+        HAVING sum(k.delta) <> 0
+        ORDER BY k.dimension, k.key
+        ON CONFLICT (dimension, key)
+        DO UPDATE SET count = quote_stats_counters.count + EXCLUDED.count;
+    END IF;
+
+    -- 0件になったキー（削除されたタグなど）を取り除く
+    DELETE FROM quote_stats_counters c
+    USING (
+        SELECT DISTINCT k.dimension, k.key
+        FROM old_rows o,
+        LATERAL quote_stats_keys(o.theme, o.subtheme, o.author, o.tags, o.created_at) AS k
+    ) AS o
+    WHERE c.dimension = o.dimension AND c.key = o.key
+      AND c.count <= 0 AND c.dimension <> 'total';
+
+    RETURN NULL;
+END;
+$$;
+
+-- 遷移テーブルは1つのトリガに1種類の操作しか指定できないため、操作ごとに作成する
+DROP TRIGGER IF EXISTS quotes_stats_counters ON quotes;
+DROP TRIGGER IF EXISTS quotes_stats_counters_insert ON quotes;
+DROP TRIGGER IF EXISTS quotes_stats_counters_update ON quotes;
+DROP TRIGGER IF EXISTS quotes_stats_counters_delete ON quotes;
+CREATE TRIGGER quotes_stats_counters_insert
+    AFTER INSERT ON quotes
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION quote_stats_counters_trigger();
+CREATE TRIGGER quotes_stats_counters_update
+    AFTER UPDATE ON quotes
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION quote_stats_counters_trigger();
+CREATE TRIGGER quotes_stats_counters_delete
+    AFTER DELETE ON quotes
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION quote_stats_counters_trigger();
+
+-- カウンタを quotes から再集計してずれを修復する
+-- 複数ワーカーから同時に呼ばれても実行されるのは1つだけ（他は false を返す）
+CREATE OR REPLACE FUNCTION quote_stats_reconcile()
+RETURNS boolean
+LANGUAGE plpgsql
+AS $$
+BEGIN
+    IF NOT pg_try_advisory_xact_lock(hashtext('quote_stats_reconcile')) THEN
+        RETURN false;
+    END IF;
+
+    -- 再集計中の書き込みを待たせてカウンタとの整合を保つ（読み取りは止めない）
+    LOCK TABLE quotes IN SHARE MODE;
+
+    DELETE FROM quote_stats_counters;
+    INSERT INTO quote_stats_counters (dimension, key, count)
+    SELECT k.dimension, k.key, count(*)
+    FROM quotes q,
+    LATERAL quote_stats_keys(q.theme, q.subtheme, q.author, q.tags, q.created_at) AS k
+    GROUP BY k.dimension, k.key;
+
+    INSERT INTO quote_stats_counters (dimension, key, count)
+    VALUES ('total', '', 0)
+    ON CONFLICT (dimension, key) DO NOTHING;
+
+    RETURN true;
+END;
+$$;
+
+-- カウンタから統計情報を返す（/stats のフィルタなし呼び出し用）
+CREATE OR REPLACE FUNCTION quote_stats_summary()
+RETURNS jsonb
+LANGUAGE sql STABLE
+AS $$
+    SELECT jsonb_build_object(
+        'total_quotes', COALESCE((SELECT count FROM quote_stats_counters WHERE dimension = 'total'), 0),
+        'themes', COALESCE((SELECT jsonb_object_agg(key, count) FROM quote_stats_counters WHERE dimension = 'theme'), '{}'::jsonb),
+        'subthemes', COALESCE((SELECT jsonb_object_agg(key, count) FROM quote_stats_counters WHERE dimension = 'subtheme'), '{}'::jsonb),
+        'authors', COALESCE((SELECT jsonb_object_agg(key, count) FROM quote_stats_counters WHERE dimension = 'author'), '{}'::jsonb),
+        'tags', COALESCE((SELECT jsonb_object_agg(key, count) FROM quote_stats_counters WHERE dimension = 'tag'), '{}'::jsonb),
+        -- min/max は created_at のインデックスで求める
+        'date_range', jsonb_build_object(
+            'min', (SELECT min(created_at) FROM quotes),
+            'max', (SELECT max(created_at) FROM quotes)
+        ),
+        'monthly_stats', COALESCE((SELECT jsonb_object_agg(key, count) FROM quote_stats_counters WHERE dimension = 'month'), '{}'::jsonb)
+    );
+$$;
+
+-- 既存データからカウンタを初期化
+SELECT quote_stats_reconcile();
@@ -0,0 +1,31 @@
+-- タグ検索用の GIN インデックス（@> / && をテーブル全体の走査なしで評価する）
+CREATE INDEX IF NOT EXISTS quotes_tags_gin_idx ON quotes USING gin (tags);
+
+-- p_tag が付いた引用の件数と、それらに一緒に付いているタグの件数（多い順に p_limit 件）
+-- /quotes/tags/cooccurrence のインメモリインデックス未構築時に RPC で呼び出す
+CREATE OR REPLACE FUNCTION tag_cooccurrence(
+    p_tag text,
+    p_limit integer DEFAULT 20
+) RETURNS jsonb
+LANGUAGE sql STABLE
+AS $$
+    WITH tagged AS (
+        SELECT tags FROM quotes WHERE tags @> ARRAY[p_tag]
+    )
+    SELECT jsonb_build_object(
+        'tag', p_tag,
+        'count', (SELECT count(*) FROM tagged),
+        'cooccurring', COALESCE((
+            SELECT jsonb_agg(jsonb_build_object('tag', tag, 'count', n) ORDER BY n DESC, tag)
+            FROM (
+                SELECT u.tag, count(*) AS n
+                FROM tagged t,
+                LATERAL (SELECT DISTINCT unnest(t.tags) AS tag) u
+                WHERE u.tag <> p_tag
+                GROUP BY u.tag
+                ORDER BY n DESC, u.tag
+                LIMIT p_limit
+            ) s
+        ), '[]'::jsonb)
+    );
+$$;
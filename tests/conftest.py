@@ -0,0 +1,81 @@
+"""
+テスト共通のフィクスチャ
+
+api は config をインポート時に読むため、先に環境変数で設定を与える。
+上流はベンチマークと同じメモリ上のスタンドイン（benchmark/standin.py）を使い、Supabase には接続しない。
+非同期の処理はセッションで共有する1つのイベントループの上で run() を通して実行する
+（モジュールレベルのロックやキューが最初に使ったループに結びつくため）。
+"""
+
+import asyncio
+import os
+import uuid
+from contextlib import AsyncExitStack
+
+import pytest
+
+os.environ.update({
+    "SUPABASE_URL": "http://upstream.invalid",
+    "SUPABASE_KEY": "test",
+    "DATABASE_BACKEND": "supabase",
+    "CORPUS_ENABLED": "true",
+    "CORPUS_REFRESH_INTERVAL": "0",
+    "STATS_RECONCILE_INTERVAL": "0",
+    "SIMILAR_ENABLED": "false",
+    "CACHE_BACKEND": "memory",
+    "CHANGES_SOURCE": "local",
+    "WARMUP_PATHS": "",
+    "SINGLE_WORKER": "true",
+})
+os.environ.pop("SNAPSHOT_DIR", None)
+
+# アプリに読み込ませる合成コーパスの件数
+CORPUS_SIZE = 300
+
+
+@pytest.fixture(scope="session")
+def run():
+    """コルーチンをセッション共通のイベントループで実行する関数"""
+    loop = asyncio.new_event_loop()
+    yield loop.run_until_complete
+    loop.close()
+
+
+@pytest.fixture(scope="session")
+def upstream():
+    """アプリがつなぐメモリ上のリポジトリ"""
+    from benchmark.data import generate_quotes
+    from benchmark.standin import MemoryRepository
+
+    return MemoryRepository(generate_quotes(CORPUS_SIZE, seed=1))
+
+
+@pytest.fixture
+def user_id(upstream):
+    """上流に登録したユーザーのID"""
+    user_id = str(uuid.uuid4())
+    upstream.users.add(user_id)
+    return user_id
+
+
+@pytest.fixture(scope="session")
+def client(run, upstream):
+    """起動処理（コーパスの読み込みまで）を済ませたアプリへの httpx クライアント"""
+    import httpx
+
+    from api.lifecycle import lifecycle
+    from api.main import app
+    from api.repository import set_repository
+
+    set_repository(upstream)
+    stack = AsyncExitStack()
+
+    async def start():
+        await stack.enter_async_context(app.router.lifespan_context(app))
+        await lifecycle.wait_ready()
+        transport = httpx.ASGITransport(app=app)
+        return await stack.enter_async_context(httpx.AsyncClient(transport=transport, base_url="http://test"))
+
+    yield run(start())
+    run(stack.aclose())
+    set_repository(None)
@@ -0,0 +1,60 @@
+"""ベンチマーク（合成データ・リクエストの再現性・集計と比較）"""
+
+import pytest
+
+from benchmark.__main__ import ENDPOINTS, build_paths, compare, percentile, run_level
+from benchmark.data import content_hash, generate_quotes, vocabulary
+
+
+def test_generated_corpus_is_reproducible():
+    first = list(generate_quotes(50, seed=3))
+
+    assert first == list(generate_quotes(50, seed=3))
+    assert first != list(generate_quotes(50, seed=4))
+    assert len({row["id"] for row in first}) == 50
+    assert all(row["content_hash"] == content_hash(row["title"], row["text"]) for row in first)
+
+
+def test_paths_depend_only_on_seed_and_endpoint():
+    words = vocabulary()
+
+    assert build_paths("tags", 0, words) == build_paths("tags", 0, words)
+    assert build_paths("tags", 0, words) != build_paths("tags", 1, words)
+    with pytest.raises(ValueError):
+        build_paths("unknown", 0, words)
+
+
+def test_percentile_uses_nearest_rank():
+    values = [float(value) for value in range(1, 101)]
+
+    assert percentile(values, 0.50) == 50.0
+    assert percentile(values, 0.95) == 95.0
+    assert percentile(values, 1.0) == 100.0
+    assert percentile([], 0.5) == 0.0
+
+
+def _report(throughput, p95, commit):
+    return {
+        "meta": {"commit": commit},
+        "results": [{"endpoint": "quotes", "concurrency": 8, "throughput": throughput, "latency_ms": {"p95": p95}}],
+    }
+
+
+def test_compare_flags_regressions_beyond_the_threshold(capsys):
+    base = _report(1000.0, 10.0, "old")
+
+    assert compare(base, _report(950.0, 10.5, "new"), threshold=10)
+    assert not compare(base, _report(850.0, 10.0, "new"), threshold=10)
+    assert not compare(base, _report(1000.0, 12.0, "new"), threshold=10)
+    assert "✗" in capsys.readouterr().out
+
+
+@pytest.mark.parametrize("endpoint", ENDPOINTS)
+def test_every_generated_path_succeeds(run, client, endpoint):
+    paths = build_paths(endpoint, 0, vocabulary())
+
+    result = run(run_level(client, paths, concurrency=8, requests=len(paths)))
+
+    assert result["requests"] == len(paths)
+    assert result["errors"] == 0
+    assert result["latency_ms"]["p50"] <= result["latency_ms"]["p95"] <= result["latency_ms"]["max"]
@@ -0,0 +1,169 @@
+"""一括インポート（NDJSON / CSV の読み取り・バッチ登録・行エラーとジョブの失敗）"""
+
+import json
+
+from api.bulk_import import BulkImporter, parse_csv, parse_ndjson
+from api.repository import DataError
+from benchmark.standin import MemoryRepository
+
+
+async def _chunks(data: bytes, size: int = 7):
+    for i in range(0, len(data), size):
+        yield data[i:i + size]
+
+
+async def _collect(records):
+    return [record async for record in records]
+
+
+def _row(record: dict) -> dict:
+    if not record.get("title"):
+        raise ValueError("title がありません")
+    return {"title": record["title"], "text": record.get("text") or "本文"}
+
+
+async def _ignore(rows):
+    pass
+
+
+def test_parse_ndjson_reports_bad_lines(run):
+    data = '{"title": "a"}\n\nnot json\n[1]\n{"title": "ｂ"}'.encode("utf-8")
+    records = run(_collect(parse_ndjson(_chunks(data))))
+
+    assert [line for line, _ in records] == [1, 3, 4, 5]
+    assert records[0][1] == {"title": "a"}
+    assert "JSON" in str(records[1][1])
+    assert "オブジェクト" in str(records[2][1])
+    assert records[3][1] == {"title": "ｂ"}
+
+
+def test_parse_csv_handles_quoted_newlines_and_blanks(run):
+    data = 'title,text,author\r\n"改行\nあり","本文, ""引用""",\r\n題,本文2,著者\r\n'.encode("utf-8-sig")
+    records = run(_collect(parse_csv(_chunks(data, 5))))
+
+    assert [record for _, record in records] == [
+        {"title": "改行\nあり", "text": '本文, "引用"', "author": None},
+        {"title": "題", "text": "本文2", "author": "著者"},
+    ]
+
+
+class _FlakyRepository(MemoryRepository):
+    """タイトルが「不正」の行を含むINSERTを DataError にし、fail_transport なら接続エラーにする"""
+
+    def __init__(self, fail_transport: bool = False):
+        super().__init__([])
+        self.fail_transport = fail_transport
+        self.inserts = 0
+
+    async def insert_quotes(self, rows):
+        self.inserts += 1
+        if self.fail_transport:
+            raise ConnectionError("upstream unavailable")
+        if any(row["title"] == "不正" for row in rows):
+            raise DataError("invalid row")
+        return await super().insert_quotes(rows)
+
+
+def _records(titles):
+    async def records():
+        for line, title in enumerate(titles, 1):
+            yield line, {"title": title}
+    return records()
+
+
+def test_data_error_retries_batch_row_by_row(run):
+    repository, importer = _FlakyRepository(), BulkImporter(history=10)
+    job = importer.create_job(None, "ndjson", dedupe=True, batch_size=3)
+
+    run(importer.run(job, repository, _records(["a", "不正", "c", "a", ""]), _row, _ignore))
+
+    assert job.status == "completed"
+    assert job.inserted == 2
+    assert job.duplicates == 1
+    assert [error["line"] for error in job.errors] == [2, 5]
+    # 1バッチ目（失敗）+ 1行ずつ3回 + 2バッチ目（重複のみで INSERT なし）
+    assert repository.inserts == 4
+
+
+def test_transport_error_fails_the_job_without_row_retries(run):
+    repository, importer = _FlakyRepository(fail_transport=True), BulkImporter(history=10)
+    job = importer.create_job(None, "ndjson", dedupe=False, batch_size=2)
+
+    run(importer.run(job, repository, _records(["a", "b", "c", "d"]), _row, _ignore))
+
+    assert job.status == "failed"
+    assert "upstream unavailable" in job.error
+    assert repository.inserts == 1
+    assert job.errors == []
+
+
+class _SharedStore:
+    """ワーカー間で共有する Redis の代わり（SET NX と同じく先に登録したワーカーだけが使える）"""
+
+    def __init__(self):
+        self.states = {}
+
+    async def claim(self, state):
+        if state["job_id"] in self.states:
+            return False
+        self.states[state["job_id"]] = state
+        return True
+
+    async def save(self, state):
+        self.states[state["job_id"]] = state
+
+    async def load(self, job_id):
+        return self.states.get(job_id)
+
+
+def test_jobs_and_keys_are_shared_between_workers(run):
+    store = _SharedStore()
+    first, second = BulkImporter(history=10, store=store), BulkImporter(history=10, store=store)
+    repository = _FlakyRepository()
+
+    job = run(first.start_job("key", "ndjson", dedupe=False, batch_size=2))
+    # 実行中は他のワーカーから同じキーで始められない
+    assert run(second.find_job("key"))["status"] == "running"
+    assert run(second.start_job("key", "ndjson", dedupe=False, batch_size=2)) is None
+    assert second.get_job("key") is None
+
+    run(first.run(job, repository, _records(["a", "b", "c"]), _row, _ignore))
+
+    assert run(second.find_job("key"))["inserted"] == 3
+    assert run(second.find_job("key"))["status"] == "completed"
+
+
+def test_failed_job_can_be_retried_on_another_worker(run):
+    store = _SharedStore()
+    first, second = BulkImporter(history=10, store=store), BulkImporter(history=10, store=store)
+
+    job = run(first.start_job("key", "ndjson", dedupe=False, batch_size=2))
+    run(first.run(job, _FlakyRepository(fail_transport=True), _records(["a", "b"]), _row, _ignore))
+    retry = run(second.start_job("key", "ndjson", dedupe=False, batch_size=2))
+    run(second.run(retry, _FlakyRepository(), _records(["a", "b"]), _row, _ignore))
+
+    assert first.get_job("key").status == "failed"
+    assert run(first.find_job("key"))["status"] == "completed"
+
+
+def test_bulk_endpoint_imports_and_reports_job(run, client):
+    lines = [
+        {"title": "一括1", "text": "本文1", "tags": ["一括", "試験"]},
+        {"title": "一括2", "text": "本文2", "tags": "一括"},
+        {"text": "タイトルなし"},
+    ]
+    body = "\n".join(json.dumps(line, ensure_ascii=False) for line in lines).encode("utf-8")
+    response = run(client.post("/quotes/bulk", content=body, headers={"Content-Type": "application/x-ndjson", "Idempotency-Key": "bulk-test"}))
+
+    job = response.json()
+    assert response.status_code == 200
+    assert (job["inserted"], job["failed"]) == (2, 1)
+    assert job["errors"][0]["line"] == 3
+    assert run(client.get("/quotes/bulk/bulk-test")).json()["inserted"] == 2
+    # 同じキーでの再送は登録し直さない
+    assert run(client.post("/quotes/bulk", content=body, headers={"Idempotency-Key": "bulk-test"})).json()["inserted"] == 2
+
+    found = run(client.get("/quotes/tags", params={"tags": "一括"})).json()
+    assert sorted(item["title"] for item in found) == ["一括1", "一括2"]
+    for item in found:
+        run(client.delete(f"/quotes/{item['id']}"))
@@ -0,0 +1,159 @@
+"""読み取りキャッシュ（キー・タグでの無効化・取得中の無効化）と書き込みによる無効化"""
+
+import asyncio
+import time
+
+from api.cache import ALL_QUOTES_TAG, MemoryCache, list_tags, make_key, row_tags
+
+
+def test_make_key_ignores_order_and_none():
+    assert make_key("quotes", {"a": 1, "b": None, "c": "x"}) == make_key("quotes", {"c": "x", "a": 1})
+    assert make_key("quotes", {"a": 1}) != make_key("quotes", {"a": 2})
+
+
+def test_list_tags_uses_narrowest_filter():
+    assert list_tags() == [ALL_QUOTES_TAG]
+    assert list_tags(theme="人生", author="誰か") == ["theme:人生"]
+    assert list_tags(tags=["a", "b"], match_all_tags=False) == ["tag:a", "tag:b"]
+
+
+def test_row_tags_cover_every_filter_the_row_matches():
+    row = {"id": "1", "theme": "人生", "subtheme": None, "author": "誰か", "tags": ["a", "b"]}
+    assert row_tags(row) == {ALL_QUOTES_TAG, "quote:1", "theme:人生", "author:誰か", "tag:a", "tag:b"}
+    assert row_tags(None) == set()
+
+
+def test_invalidate_tags_drops_only_tagged_entries(run):
+    cache = MemoryCache(max_entries=10, default_ttl=60)
+
+    async def scenario():
+        await cache.set("a", 1, ["theme:人生"])
+        await cache.set("b", 2, ["theme:仕事"])
+        await cache.invalidate_tags(["theme:人生"])
+        return await cache.get("a"), await cache.get("b")
+
+    assert run(scenario()) == (None, 2)
+    assert cache.invalidations == 1
+
+
+def test_lru_eviction_and_ttl(run):
+    cache = MemoryCache(max_entries=2, default_ttl=60)
+
+    async def scenario():
+        await cache.set("a", 1)
+        await cache.set("b", 2)
+        await cache.get("a")
+        await cache.set("c", 3)
+        await cache.set("short", 4, ttl=0.001)
+        time.sleep(0.01)
+        return [await cache.get(key) for key in ("a", "b", "c", "short")]
+
+    assert run(scenario()) == [None, None, 3, None]
+    assert cache.evictions == 2
+
+
+def _gated_loader(value):
+    started, release = asyncio.Event(), asyncio.Event()
+    calls = []
+
+    async def loader():
+        calls.append(1)
+        started.set()
+        await release.wait()
+        return value
+
+    return loader, started, release, calls
+
+
+def test_load_in_flight_during_invalidation_is_not_stored(run):
+    cache = MemoryCache(max_entries=10, default_ttl=60)
+    loader, started, release, _ = _gated_loader(["古い一覧"])
+
+    async def scenario():
+        load = asyncio.ensure_future(cache.get_or_load("list", loader, ["theme:人生"]))
+        await started.wait()
+        await cache.invalidate_tags(["theme:人生"])
+        release.set()
+        value = await load
+        return value, await cache.get("list")
+
+    assert run(scenario()) == (["古い一覧"], None)
+
+
+def test_reads_after_invalidation_do_not_join_the_old_load(run):
+    cache = MemoryCache(max_entries=10, default_ttl=60)
+    loader, started, release, calls = _gated_loader(["古い一覧"])
+
+    async def fresh():
+        return ["新しい一覧"]
+
+    async def scenario():
+        old = asyncio.ensure_future(cache.get_or_load("list", loader, ["theme:人生"]))
+        await started.wait()
+        await cache.invalidate_tags(["theme:人生"])
+        # 書き込み後の読み取りは実行中の取得に相乗りせず、取り直す
+        new = await cache.get_or_load("list", fresh, ["theme:人生"])
+        release.set()
+        return await old, new, await cache.get("list")
+
+    assert run(scenario()) == (["古い一覧"], ["新しい一覧"], ["新しい一覧"])
+    assert len(calls) == 1
+
+
+def test_unrelated_invalidation_does_not_prevent_store(run):
+    cache = MemoryCache(max_entries=10, default_ttl=60)
+    loader, started, release, _ = _gated_loader(["一覧"])
+
+    async def scenario():
+        load = asyncio.ensure_future(cache.get_or_load("list", loader, ["theme:人生"]))
+        await started.wait()
+        await cache.invalidate_tags(["theme:仕事"])
+        release.set()
+        await load
+        return await cache.get("list")
+
+    assert run(scenario()) == ["一覧"]
+
+
+def test_concurrent_loads_share_one_call(run):
+    cache = MemoryCache(max_entries=10, default_ttl=60)
+    loader, started, release, calls = _gated_loader("値")
+
+    async def scenario():
+        loads = [asyncio.ensure_future(cache.get_or_load("key", loader)) for _ in range(5)]
+        await started.wait()
+        release.set()
+        return await asyncio.gather(*loads)
+
+    assert run(scenario()) == ["値"] * 5
+    assert len(calls) == 1
+
+
+def _listed(run, client, params, quote_id):
+    response = run(client.get("/quotes", params={**params, "limit": 100}))
+    return next((item for item in response.json() if item["id"] == quote_id), None)
+
+
+def test_update_invalidates_cached_lists(run, client):
+    created = run(client.post("/quotes", json={"title": "キャッシュ前", "text": "本文", "author": "試験", "theme": "試験用"})).json()
+    assert _listed(run, client, {"theme": "試験用"}, created["id"])["title"] == "キャッシュ前"
+
+    run(client.put(f"/quotes/{created['id']}", json={"title": "キャッシュ後"}))
+
+    assert _listed(run, client, {"theme": "試験用"}, created["id"])["title"] == "キャッシュ後"
+    run(client.delete(f"/quotes/{created['id']}"))
+    assert _listed(run, client, {"theme": "試験用"}, created["id"]) is None
+
+
+def test_impression_flush_invalidates_cached_lists(run, client, user_id):
+    from api.impressions import impression_buffer
+
+    created = run(client.post("/quotes", json={"title": "感想数", "text": "本文", "author": "試験", "theme": "感想数"})).json()
+    assert _listed(run, client, {"theme": "感想数"}, created["id"])["impression_count"] == 0
+
+    body = {"quote_id": created["id"], "user_id": user_id, "impression": "よい"}
+    assert run(client.post("/impressions", json=body)).status_code == 202
+    run(impression_buffer.flush())
+
+    assert _listed(run, client, {"theme": "感想数"}, created["id"])["impression_count"] == 1
+    run(client.delete(f"/quotes/{created['id']}"))
@@ -0,0 +1,135 @@
+"""変更フィード（/changes の SSE：再開・reset・overflow）"""
+
+import asyncio
+import json
+
+import pytest
+
+from api import changes
+from api.changes import ChangeFeed
+
+
+@pytest.fixture
+def feed(monkeypatch):
+    feed = ChangeFeed(buffer_size=3, queue_size=2)
+    monkeypatch.setattr(changes, "change_feed", feed)
+    return feed
+
+
+def _parse(message: str) -> dict:
+    fields = dict(line.split(": ", 1) for line in message.strip().splitlines())
+    return {"id": int(fields["id"]), "event": fields["event"], "data": json.loads(fields["data"])}
+
+
+def _publish(feed: ChangeFeed, op: str = "update") -> dict:
+    event = changes._event(feed.next_version(), op, {"id": f"q{feed.published}", "title": "題"}, "2024-01-01T00:00:00+00:00")
+    feed.publish(event)
+    return event
+
+
+async def _take(stream, count: int) -> list:
+    """retry を読み飛ばして count 件のイベントを読む"""
+    events = []
+    async for message in stream:
+        if message.startswith(("retry:", ":")):
+            continue
+        events.append(_parse(message))
+        if len(events) == count:
+            return events
+    return events
+
+
+def test_unknown_version_resets_to_the_current_version(run, feed):
+    async def scenario():
+        stream = changes.stream(since=0)
+        (reset,) = await _take(stream, 1)
+        await stream.aclose()
+        # reset の版から再開すれば、それ以降の変更を受け取れる
+        resumed = changes.stream(since=reset["id"])
+        first = asyncio.ensure_future(_take(resumed, 1))
+        await asyncio.sleep(0)
+        event = _publish(feed)
+        (received,) = await first
+        await resumed.aclose()
+        return reset, event, received
+
+    reset, event, received = run(scenario())
+
+    assert reset["event"] == "reset"
+    assert reset["id"] == reset["data"]["version"] == feed.floor > 0
+    assert received["id"] == event["version"]
+
+
+def test_resume_replays_backlog_then_live_events_without_duplicates(run, feed):
+    published = [_publish(feed) for _ in range(3)]
+
+    async def scenario():
+        stream = changes.stream(since=published[0]["version"])
+        reading = asyncio.ensure_future(_take(stream, 3))
+        await asyncio.sleep(0)
+        live = _publish(feed, "delete")
+        events = await reading
+        await stream.aclose()
+        return events, live
+
+    events, live = run(scenario())
+
+    assert [event["id"] for event in events] == [published[1]["version"], published[2]["version"], live["version"]]
+    assert events[-1]["event"] == "delete"
+
+
+def test_evicted_versions_cannot_be_resumed(feed):
+    published = [_publish(feed) for _ in range(5)]
+
+    assert feed.recent(published[0]["version"]) is None
+    assert [event["version"] for event in feed.recent(published[2]["version"])] == [published[3]["version"], published[4]["version"]]
+    assert feed.position == published[-1]["version"]
+
+
+def test_slow_subscriber_gets_overflow(run, feed):
+    async def scenario():
+        stream = changes.stream(since=None)
+        await stream.__anext__()
+        for _ in range(3):
+            _publish(feed)
+        (overflow,) = await _take(stream, 1)
+        return overflow
+
+    overflow = run(scenario())
+
+    assert overflow["event"] == "overflow"
+    assert feed.overflows == 1
+    assert feed.subscribers == 0
+
+
+def test_writes_are_recorded_in_local_mode(run, client):
+    from api.changes import change_feed
+
+    created = run(client.post("/quotes", json={"title": "変更", "text": "本文"})).json()
+    run(client.delete(f"/quotes/{created['id']}"))
+
+    recorded = [(event["op"], event["id"]) for event in list(change_feed.events)[-2:]]
+    assert recorded == [("create", created["id"]), ("delete", created["id"])]
+    assert change_feed.events[-1]["version"] > change_feed.events[-2]["version"]
+
+
+def test_invalid_last_event_id_is_rejected(run, client):
+    response = run(client.get("/changes", headers={"Last-Event-ID": "abc"}))
+    assert response.status_code == 400
+
+
+def test_version_assignment_is_called_as_a_write(run, monkeypatch):
+    calls = []
+
+    class _Repository:
+        async def rpc(self, name, params, read=False):
+            calls.append((name, read))
+            return {"latest_version": 0, "changes": []}
+
+    async def get_repository():
+        return _Repository()
+
+    monkeypatch.setattr(changes, "get_repository", get_repository)
+    run(changes._changes_since(0, 10))
+
+    assert calls == [("quote_changes_since", False)]
@@ -0,0 +1,109 @@
+"""条件付き GET（データの版から作る ETag と 304）"""
+
+import random
+
+from api.conditional import DataVersion
+from benchmark.data import generate_quotes
+
+
+def test_version_depends_only_on_the_data():
+    rows = list(generate_quotes(50, seed=6))
+    worker, other = DataVersion(), DataVersion()
+    assert worker.version is None
+
+    worker.rebuild(rows)
+    other.rebuild(random.Random(1).sample(rows, len(rows)))
+    # 別のワーカー・再起動後でも、同じデータなら同じ版になる
+    assert worker.version == other.version
+
+    before = worker.version
+    changed = {**rows[0], "title": "変更後"}
+    worker.upsert(changed, rows[0])
+    assert worker.version != before
+    other.rebuild([changed] + rows[1:])
+    assert worker.version == other.version
+
+    worker.upsert(rows[0], changed)
+    assert worker.version == before
+    worker.remove(rows[1])
+    other.rebuild([rows[0]] + rows[2:])
+    assert worker.version == other.version
+
+
+def test_reloading_unchanged_data_keeps_the_version():
+    rows = list(generate_quotes(20, seed=7))
+    version = DataVersion()
+    version.rebuild(rows)
+    etag, changed_at = version.version, version.changed_at
+
+    version.rebuild([dict(row) for row in rows])
+
+    assert (version.version, version.changed_at) == (etag, changed_at)
+
+
+def test_matching_etag_returns_304_without_upstream_call(run, client, upstream):
+    first = run(client.get("/quotes", params={"limit": 5}))
+    etag = first.headers["ETag"]
+    assert first.headers["Vary"] == "Accept-Encoding"
+
+    calls = sum(upstream.calls.values())
+    second = run(client.get("/quotes", params={"limit": 5}, headers={"If-None-Match": etag}))
+
+    assert second.status_code == 304
+    assert second.headers["ETag"] == etag
+    assert second.headers["Vary"] == "Accept-Encoding"
+    assert sum(upstream.calls.values()) == calls
+    assert run(client.get("/quotes", params={"limit": 6})).headers["ETag"] != etag
+
+
+def test_etag_differs_per_encoding(run, client):
+    plain = run(client.get("/quotes", params={"limit": 5}, headers={"Accept-Encoding": "identity"}))
+    gzipped = run(client.get("/quotes", params={"limit": 5}, headers={"Accept-Encoding": "gzip"}))
+
+    assert plain.headers["ETag"] != gzipped.headers["ETag"]
+    assert run(client.get("/quotes", params={"limit": 5}, headers={
+        "Accept-Encoding": "gzip", "If-None-Match": plain.headers["ETag"],
+    })).status_code == 200
+
+
+def test_writes_and_impressions_change_the_etag(run, client, upstream, user_id):
+    from api.impressions import impression_buffer
+
+    quote_id = next(iter(upstream.rows))
+    etag = run(client.get(f"/quotes/{quote_id}")).headers["ETag"]
+
+    created = run(client.post("/quotes", json={"title": "版", "text": "本文"})).json()
+    after_create = run(client.get(f"/quotes/{quote_id}", headers={"If-None-Match": etag}))
+    assert after_create.status_code == 200
+
+    run(client.post("/impressions", json={"quote_id": quote_id, "user_id": user_id, "impression": "よい"}))
+    run(impression_buffer.flush())
+    after_impression = run(client.get(f"/quotes/{quote_id}", headers={"If-None-Match": after_create.headers["ETag"]}))
+    assert after_impression.status_code == 200
+
+    # 作成した引用を消すと、感想数の変化だけが残る
+    run(client.delete(f"/quotes/{created['id']}"))
+    assert run(client.get(f"/quotes/{quote_id}")).headers["ETag"] not in (etag, after_create.headers["ETag"])
+
+
+def test_no_etag_without_the_corpus(run, client, monkeypatch):
+    from api.conditional import data_version
+
+    monkeypatch.setattr(data_version, "ready", False)
+    response = run(client.get("/quotes", params={"limit": 5}))
+
+    assert response.status_code == 200
+    assert "ETag" not in response.headers
+    assert response.headers["Cache-Control"] == "no-cache"
+
+
+def test_no_version_etag_when_other_workers_writes_arrive_late(run, client, monkeypatch):
+    from api import config
+
+    monkeypatch.setattr(config, "SINGLE_WORKER", False)
+    monkeypatch.setattr(config, "SNAPSHOT_DIR", None)
+    assert "ETag" not in run(client.get("/quotes", params={"limit": 5})).headers
+
+    # 変更ログで他のワーカーの書き込みを取り込む構成なら版を使う
+    monkeypatch.setattr(config, "SNAPSHOT_DIR", "/dev/shm/azuma-insight")
+    assert "ETag" in run(client.get("/quotes", params={"limit": 5})).headers
@@ -0,0 +1,157 @@
+"""コーパスミラーの再読み込みと書き込みの競合"""
+
+import asyncio
+import threading
+
+from api.corpus import CorpusListener, CorpusMirror
+
+
+def _row(quote_id: str, title: str) -> dict:
+    return {"id": quote_id, "title": title, "text": "本文", "tags": None}
+
+
+class _Ids(CorpusListener):
+    def __init__(self):
+        self.ids = set()
+
+    def rebuild(self, rows):
+        self.ids = {row["id"] for row in rows}
+
+    def upsert(self, row, old):
+        self.ids.add(row["id"])
+
+    def remove(self, row):
+        self.ids.discard(row["id"])
+
+
+class _GatedMirror(CorpusMirror):
+    """全件取得の途中で止められるミラー（取得結果は止める前の上流の内容）"""
+
+    def __init__(self, rows):
+        super().__init__()
+        self.upstream_rows = rows
+        self.fetching = asyncio.Event()
+        self.release = asyncio.Event()
+
+    async def fetch_all(self):
+        rows = list(self.upstream_rows)
+        self.fetching.set()
+        await self.release.wait()
+        return rows
+
+
+def test_writes_during_fetch_are_replayed_after_reload(run):
+    kept, deleted, updated = _row("1", "残る"), _row("2", "消える"), _row("3", "古い")
+    mirror = _GatedMirror([kept, deleted, updated])
+    listener = _Ids()
+    mirror.add_listener(listener)
+
+    async def scenario():
+        reload = asyncio.ensure_future(mirror.reload())
+        await mirror.fetching.wait()
+        # 取得済みの内容より新しい書き込み
+        mirror.upsert(_row("4", "新規"))
+        mirror.upsert(_row("3", "新しい"))
+        mirror.remove("2")
+        mirror.release.set()
+        await reload
+
+    run(scenario())
+
+    assert set(mirror.rows) == {"1", "3", "4"}
+    assert mirror.rows["3"]["title"] == "新しい"
+    assert listener.ids == {"1", "3", "4"}
+
+
+def test_increments_during_fetch_are_replayed_after_reload(run):
+    mirror = _GatedMirror([{**_row("1", "a"), "impression_count": 3}])
+
+    async def scenario():
+        reload = asyncio.ensure_future(mirror.reload())
+        await mirror.fetching.wait()
+        mirror.increment("1", "impression_count", 2)
+        mirror.release.set()
+        await reload
+
+    run(scenario())
+
+    assert mirror.rows["1"]["impression_count"] == 5
+
+
+def test_failed_fetch_stops_recording_writes(run):
+    class _Failing(CorpusMirror):
+        async def fetch_all(self):
+            raise RuntimeError("upstream down")
+
+    mirror = _Failing()
+
+    async def scenario():
+        try:
+            await mirror.reload()
+        except RuntimeError:
+            pass
+
+    run(scenario())
+    mirror.upsert(_row("1", "a"))
+
+    assert mirror._pending is None
+    assert not mirror.ready
+
+
+def test_attach_builds_off_the_loop_and_replays_writes_made_meanwhile(run):
+    mirror = _GatedMirror([_row("1", "a"), _row("2", "b")])
+    mirror.release.set()
+    run(mirror.reload())
+    building, release = threading.Event(), threading.Event()
+
+    class _Slow(_Ids):
+        def rebuild(self, rows):
+            super().rebuild(rows)
+            building.set()
+            release.wait(5)
+
+    listener = _Slow()
+
+    async def scenario():
+        attach = asyncio.ensure_future(mirror.attach(listener))
+        await asyncio.to_thread(building.wait, 5)
+        # 構築中（別スレッド）の書き込み
+        mirror.upsert(_row("3", "c"))
+        mirror.remove("1")
+        release.set()
+        await attach
+
+    run(scenario())
+
+    assert listener.ids == {"2", "3"}
+    assert listener in mirror._listeners and mirror._pending is None
+
+
+def test_similar_index_is_attached_on_the_first_similar_request(run, client, upstream, monkeypatch):
+    from api import config, main
+
+    class _Index(_Ids):
+        ready = False
+
+        def rebuild(self, rows):
+            super().rebuild(rows)
+            self.ready = True
+
+        async def similar_to(self, quote_id, limit, theme, tag):
+            return []
+
+    index = _Index()
+    monkeypatch.setattr(config, "SIMILAR_ENABLED", True)
+    monkeypatch.setattr(main, "_similar_index", lambda: index)
+    monkeypatch.setattr(main, "_similar_attaching", None)
+    quote_id = next(iter(upstream.rows))
+
+    try:
+        assert index not in main.corpus._listeners
+        assert run(client.get(f"/quotes/{quote_id}/similar")).status_code == 503
+        run(main._similar_attaching)
+        assert run(client.get(f"/quotes/{quote_id}/similar")).status_code == 200
+        assert index.ids == set(main.corpus.rows)
+    finally:
+        if index in main.corpus._listeners:
+            main.corpus._listeners.remove(index)
@@ -0,0 +1,107 @@
+"""ストリーミングエクスポート（キーセットでのページ送り・NDJSON / CSV / gzip）"""
+
+import asyncio
+import csv
+import gzip
+import io
+import json
+
+from api.export import EXPORT_COLUMNS, export_stream, iter_pages
+from api.repository import QuoteQuery
+from benchmark.data import generate_quotes
+from benchmark.standin import MemoryRepository
+
+
+async def _collect(iterator):
+    return [item async for item in iterator]
+
+
+def test_pages_cover_every_row_in_order(run):
+    rows = list(generate_quotes(50, seed=12))
+    repository = MemoryRepository(rows)
+
+    pages = run(_collect(iter_pages(repository, QuoteQuery(order_by="theme", desc=False), 7)))
+
+    assert [len(page) for page in pages] == [7] * 7 + [1]
+    exported = [row["id"] for page in pages for row in page]
+    everything = run(repository.list_quotes(QuoteQuery(order_by="theme", desc=False, limit=100)))
+    assert exported == [row["id"] for row in everything]
+    # 最後のページが page_size ちょうどなら、空のページを読んで終わる
+    assert len(run(_collect(iter_pages(MemoryRepository(rows[:14]), QuoteQuery(), 7)))) == 2
+
+
+class _SlowRepository(MemoryRepository):
+    """2ページ目以降の取得を遅らせ、取り消されたかを記録する"""
+
+    def __init__(self, rows):
+        super().__init__(rows)
+        self.cancelled = 0
+
+    async def list_quotes(self, query):
+        if query.after is not None:
+            try:
+                await asyncio.sleep(10)
+            except asyncio.CancelledError:
+                self.cancelled += 1
+                raise
+        return await super().list_quotes(query)
+
+
+def test_closing_early_cancels_the_prefetch(run):
+    repository = _SlowRepository(generate_quotes(50, seed=12))
+
+    async def scenario():
+        pages = iter_pages(repository, QuoteQuery(), 10)
+        first = await pages.__anext__()
+        # 先読みが始まってからクライアントが切断した場合
+        await asyncio.sleep(0)
+        await pages.aclose()
+        await asyncio.sleep(0)
+        return first
+
+    assert len(run(scenario())) == 10
+    assert repository.cancelled == 1
+
+
+def test_csv_writes_header_once_and_joins_tags(run):
+    async def pages():
+        yield [{"id": "1", "title": "題", "text": "本文, \"引用\"", "tags": ["a", "b"]}]
+        yield [{"id": "2", "title": "題2", "text": "改行\nあり", "tags": None}]
+
+    data = b"".join(run(_collect(export_stream(pages(), "csv", compress=False))))
+    records = list(csv.reader(io.StringIO(data.decode("utf-8"))))
+
+    assert records[0] == EXPORT_COLUMNS
+    assert [record[EXPORT_COLUMNS.index("tags")] for record in records[1:]] == ["a,b", ""]
+    assert records[2][EXPORT_COLUMNS.index("text")] == "改行\nあり"
+
+
+def test_empty_csv_still_has_a_header(run):
+    async def pages():
+        return
+        yield
+
+    data = b"".join(run(_collect(export_stream(pages(), "csv", compress=True))))
+    assert gzip.decompress(data).decode("utf-8").strip() == ",".join(EXPORT_COLUMNS)
+
+
+def test_export_endpoint_streams_the_whole_corpus(run, client, upstream):
+    response = run(client.get("/quotes/export"))
+    lines = [json.loads(line) for line in response.text.splitlines()]
+
+    assert response.headers["content-type"] == "application/x-ndjson"
+    assert "quotes.ndjson" in response.headers["content-disposition"]
+    assert {line["id"] for line in lines} == set(upstream.rows)
+    assert all(set(line) == set(EXPORT_COLUMNS) for line in lines)
+
+
+def test_export_endpoint_filters_and_compresses(run, client, upstream):
+    theme = next(row["theme"] for row in upstream.rows.values() if row["theme"])
+    plain = run(client.get("/quotes/export", params={"format": "csv", "theme": theme}))
+    compressed = run(client.get("/quotes/export", params={"format": "csv", "theme": theme, "gzip": "true"}))
+
+    records = list(csv.DictReader(io.StringIO(plain.text)))
+    assert {record["id"] for record in records} == {row["id"] for row in upstream.rows.values() if row["theme"] == theme}
+    assert compressed.headers["content-type"] == "application/gzip"
+    assert gzip.decompress(compressed.content) == plain.content
+    assert run(client.get("/quotes/export", params={"format": "xml"})).status_code == 400
@@ -0,0 +1,112 @@
+"""ファセット件数（インメモリの索引・共有スナップショット・DB側の集計の一致）"""
+
+import pytest
+from fastapi import HTTPException
+
+from api.facets import FacetIndex, count_facets, parse_facets, sort_counts
+from api.snapshot import CorpusSnapshot, write_snapshot
+from benchmark.data import generate_quotes
+from benchmark.standin import MemoryRepository
+
+FACETS = ["theme", "subtheme", "tags", "author"]
+
+CONDITIONS = [
+    {},
+    {"theme": "挑戦"},
+    {"theme": "挑戦", "subtheme": "継続"},
+    {"author": "佐藤美咲"},
+    {"tags": ["夢"]},
+    {"tags": ["夢", "希望"]},
+    {"theme": "存在しない"},
+    {"date_from": "2023-01-01", "date_to": "2023-12-31T23:59:59+00:00"},
+    {"theme": "挑戦", "date_from": "2023-06-01"},
+]
+
+
+@pytest.fixture(scope="module")
+def rows():
+    return list(generate_quotes(300, seed=1))
+
+
+def _expected(rows, condition):
+    data = MemoryRepository(rows)._rpc_quote_facets(FACETS, *(
+        condition.get(name) for name in ("theme", "subtheme", "author", "tags", "date_from", "date_to")
+    ))
+    return data["total"], {facet: sort_counts(counts) for facet, counts in data["facets"].items()}
+
+
+def test_parse_facets():
+    assert parse_facets(None) is None
+    assert parse_facets(" theme, tags ,") == ["theme", "tags"]
+    with pytest.raises(HTTPException) as raised:
+        parse_facets("theme,title")
+    assert raised.value.status_code == 400
+    assert "title" in raised.value.detail
+
+
+def test_count_facets_counts_each_tag_once_and_skips_null():
+    rows = [
+        {"theme": "人生", "author": None, "tags": ["夢", "夢", "希望"]},
+        {"theme": "人生", "author": "作者", "tags": None},
+        {"theme": "仕事", "author": "作者", "tags": ["夢"]},
+    ]
+
+    counts = count_facets(rows, ["theme", "author", "tags"])
+
+    assert counts == {"theme": {"人生": 2, "仕事": 1}, "author": {"作者": 2}, "tags": {"夢": 2, "希望": 1}}
+    assert list(counts["tags"]) == ["夢", "希望"]
+
+
+@pytest.mark.parametrize("condition", CONDITIONS)
+def test_index_matches_database_aggregation(rows, condition):
+    index = FacetIndex()
+    index.rebuild(rows)
+
+    assert index.facets(FACETS, **condition) == _expected(rows, condition)
+
+
+@pytest.mark.parametrize("condition", CONDITIONS)
+def test_shared_snapshot_matches_database_aggregation(rows, condition, tmp_path):
+    path = str(tmp_path / "snapshot")
+    write_snapshot(path, rows, 1)
+    key = (tuple(FACETS),) + tuple(
+        condition.get(name) for name in ("theme", "subtheme", "author")
+    ) + (tuple(condition.get("tags") or ()), condition.get("date_from"), condition.get("date_to"))
+
+    assert FacetIndex._facets_from_snapshot(CorpusSnapshot(path), key) == _expected(rows, condition)
+
+
+def test_index_follows_upserts_and_removals(rows):
+    index = FacetIndex()
+    index.rebuild(rows)
+    total, before = index.facets(["theme"], theme="挑戦")
+
+    row = next(row for row in rows if row["theme"] == "挑戦")
+    index.upsert({**row, "theme": "新しいテーマ"}, row)
+    assert index.facets(["theme"], theme="挑戦")[0] == total - 1
+    assert index.facets(["theme"])[1]["theme"]["新しいテーマ"] == 1
+
+    index.remove({**row, "theme": "新しいテーマ"})
+    assert "新しいテーマ" not in index.facets(["theme"])[1]["theme"]
+    assert index.facets(["theme"])[0] == len(rows) - 1
+
+
+def test_quotes_endpoint_returns_items_total_and_facets(run, client, upstream, monkeypatch):
+    params = {"facets": "theme,tags", "theme": "挑戦", "limit": 5}
+    from_corpus = run(client.get("/quotes", params=params)).json()
+
+    assert set(from_corpus) == {"items", "total", "facets"}
+    assert len(from_corpus["items"]) == 5
+    assert from_corpus["total"] == sum(1 for row in upstream.rows.values() if row["theme"] == "挑戦")
+    assert set(from_corpus["facets"]) == {"theme", "tags"}
+
+    # コーパスを使わない場合も quote_facets で同じ結果になる
+    from api import main
+    monkeypatch.setattr(main.corpus, "ready", False)
+    calls = upstream.calls["rpc:quote_facets"]
+    from_database = run(client.get("/quotes", params=params)).json()
+    assert from_database["total"] == from_corpus["total"]
+    assert from_database["facets"] == from_corpus["facets"]
+    assert upstream.calls["rpc:quote_facets"] > calls
+
+    assert run(client.get("/quotes", params={"facets": "text"})).status_code == 400
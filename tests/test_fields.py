@@ -0,0 +1,60 @@
+"""一覧レスポンスの軽量化（スパースフィールドセット・本文プレビュー）"""
+
+import pytest
+from fastapi import HTTPException
+
+from api.fields import QUOTE_FIELDS, TEXT_PREVIEW_DB_CHARS, parse_fields, select_columns, shape_rows
+
+
+def test_parse_fields_always_starts_with_id():
+    assert parse_fields(None) is None
+    assert parse_fields("author, title,author") == ["id", "author", "title"]
+    assert parse_fields("title,id") == ["id", "title"]
+    with pytest.raises(HTTPException) as raised:
+        parse_fields("title,random_key")
+    assert raised.value.status_code == 400
+    assert "random_key" in raised.value.detail
+
+
+@pytest.mark.parametrize("fields, text_preview, sort_by, expected", [
+    (None, None, "created_at", "*"),
+    (["id", "title"], None, "created_at", "id,title,created_at"),
+    (["id", "title"], None, "title", "id,title"),
+    (["id", "text"], 50, "created_at", "id,text:text_preview,created_at"),
+    (["id", "text"], 50, "text", "id,text"),
+    (["id", "text"], TEXT_PREVIEW_DB_CHARS + 1, "created_at", "id,text,created_at"),
+    (["id", "title"], 50, "created_at", "id,title,created_at"),
+    (None, 50, "created_at", "id,title,text:text_preview,author,theme,subtheme,tags,created_at,impression_count"),
+])
+def test_select_columns(fields, text_preview, sort_by, expected):
+    assert select_columns(fields, text_preview, sort_by) == expected
+
+
+def test_shape_rows_drops_extra_columns_and_truncates():
+    rows = [{"id": "1", "title": "題", "text": "あいうえお", "created_at": "2024-01-01", "random_key": 0.5}]
+
+    assert shape_rows(rows, ["id", "text"], 3) == [{"id": "1", "text": "あいう"}]
+    full = shape_rows(rows, None, None)[0]
+    assert list(full) == QUOTE_FIELDS
+    assert full["impression_count"] == 0 and full["author"] is None
+
+
+def test_list_endpoint_sends_only_requested_columns(run, client, upstream, monkeypatch):
+    selects = []
+    list_quotes = upstream.list_quotes
+
+    async def recording(query):
+        selects.append(query.select)
+        return await list_quotes(query)
+
+    monkeypatch.setattr(upstream, "list_quotes", recording)
+
+    response = run(client.get("/quotes", params={"fields": "title,text", "text_preview": 5, "limit": 3, "sort_by": "title"}))
+    items = response.json()
+
+    assert selects == ["id,title,text:text_preview"]
+    assert [list(item) for item in items] == [["id", "title", "text"]] * 3
+    assert all(len(item["text"]) <= 5 for item in items)
+    assert all(item["text"] == upstream.rows[item["id"]]["text"][:5] for item in items)
+    assert "x-next-cursor" in response.headers
+    assert run(client.get("/quotes", params={"fields": "title,body"})).status_code == 400
@@ -0,0 +1,85 @@
+"""感想の登録（受け付け時の検証・書き込みバッファ）と一覧"""
+
+import uuid
+
+from api.impressions import ImpressionBuffer
+from api.pagination import NEXT_CURSOR_HEADER
+from benchmark.data import generate_quotes
+from benchmark.standin import MemoryRepository
+
+
+def _quote_id(upstream):
+    return next(iter(upstream.rows))
+
+
+def test_impression_is_accepted_and_listed(run, client, upstream, user_id):
+    quote_id = _quote_id(upstream)
+    posted = [
+        run(client.post("/impressions", json={"quote_id": quote_id, "user_id": user_id, "impression": f"感想{i}"}))
+        for i in range(3)
+    ]
+    assert [response.status_code for response in posted] == [202] * 3
+
+    # 未書き込みの行があれば一覧の前に書き込むため、自分の感想がすぐ見える
+    first = run(client.get(f"/users/{user_id}/impressions", params={"limit": 2}))
+    cursor = first.headers[NEXT_CURSOR_HEADER]
+    rest = run(client.get(f"/users/{user_id}/impressions", params={"limit": 2, "cursor": cursor}))
+
+    listed = [item["id"] for item in first.json() + rest.json()]
+    assert listed == [response.json()["id"] for response in reversed(posted)]
+    assert NEXT_CURSOR_HEADER not in rest.headers
+    assert {item["id"] for item in run(client.get(f"/quotes/{quote_id}/impressions", params={"limit": 100})).json()} >= set(listed)
+
+
+def test_unknown_user_or_quote_is_rejected_before_buffering(run, client, upstream, user_id):
+    from api.impressions import impression_buffer
+
+    pending = impression_buffer.pending
+    unknown_user = {"quote_id": _quote_id(upstream), "user_id": str(uuid.uuid4()), "impression": "よい"}
+    unknown_quote = {"quote_id": str(uuid.uuid4()), "user_id": user_id, "impression": "よい"}
+    empty = {"quote_id": _quote_id(upstream), "user_id": user_id, "impression": "  "}
+
+    assert run(client.post("/impressions", json=unknown_user)).json()["detail"] == "ユーザーが見つかりません"
+    assert run(client.post("/impressions", json=unknown_quote)).status_code == 404
+    assert run(client.post("/impressions", json=empty)).status_code == 400
+    assert impression_buffer.pending == pending
+
+
+def test_user_lookup_is_cached_only_when_found(run, client, upstream, user_id):
+    body = {"quote_id": _quote_id(upstream), "user_id": str(uuid.uuid4()), "impression": "よい"}
+    assert run(client.post("/impressions", json=body)).status_code == 404
+    # 見つからなかった結果は覚えないため、後から登録されたユーザーはすぐ受け付ける
+    upstream.users.add(body["user_id"])
+    calls = upstream.calls["user_exists"]
+    assert run(client.post("/impressions", json=body)).status_code == 202
+    assert run(client.post("/impressions", json=body)).status_code == 202
+    assert upstream.calls["user_exists"] == calls + 1
+
+
+def test_rows_rejected_at_write_time_are_dropped_and_counted(run, monkeypatch):
+    rows = list(generate_quotes(3, seed=2))
+    repository = MemoryRepository(rows, users=["u1"])
+    buffer = ImpressionBuffer(batch_size=10, flush_interval=60, max_pending=100)
+    flushed = []
+
+    async def get_repository():
+        return repository
+
+    async def on_flushed(inserted):
+        flushed.extend(row["id"] for row in inserted)
+
+    monkeypatch.setattr("api.impressions.get_repository", get_repository)
+    buffer.on_flushed = on_flushed
+
+    async def scenario():
+        # 2行目は受け付けた後にユーザーが削除された場合を再現する
+        for i, user in enumerate(["u1", "削除済み", "u1"]):
+            row = {"id": f"i{i}", "quote_id": rows[0]["id"], "user_id": user, "impression": "よい", "created_at": f"2024-01-0{i + 1}"}
+            await buffer.add(row)
+        await buffer.flush()
+
+    run(scenario())
+
+    assert flushed == ["i0", "i2"]
+    assert buffer.stats() == {"pending": 0, "flushed": 2, "dropped": 1, "batches": 1}
+    assert repository.rows[rows[0]["id"]]["impression_count"] == 2
@@ -0,0 +1,88 @@
+"""起動・終了の管理（ウォームアップの手順・接続のやり直し・ヘルスチェック）"""
+
+import pytest
+from fastapi import FastAPI, HTTPException
+
+from api import config, lifecycle as lifecycle_module
+from api.lifecycle import Lifecycle
+
+
+def test_probes_after_warmup(run, client):
+    from api.lifecycle import lifecycle
+
+    assert run(client.get("/health/live")).json() == {"status": "ok"}
+    ready = run(client.get("/health/ready"))
+    body = ready.json()
+
+    assert ready.status_code == 200
+    assert body["status"] == "ready" and body["corpus_ready"] is True
+    assert body["steps"]["repository"]["status"] == "ok"
+    assert body["steps"]["corpus"]["status"] == "ok"
+    assert body["steps"]["corpus"]["detail"] == f"{body['corpus_size']}件"
+    assert lifecycle.ready
+
+
+def test_not_ready_while_draining(run, client, monkeypatch):
+    from api.lifecycle import lifecycle
+
+    monkeypatch.setattr(lifecycle, "phase", "draining")
+
+    response = run(client.get("/health/ready"))
+    assert response.status_code == 503
+    assert response.json()["status"] == "draining"
+    assert run(client.get("/health/live")).status_code == 200
+
+
+def test_failed_step_is_recorded_and_warmup_continues(run):
+    lifecycle = Lifecycle()
+
+    async def failing():
+        raise RuntimeError("失敗")
+
+    run(lifecycle._step("broken", failing))
+
+    assert lifecycle.steps["broken"]["status"] == "error"
+    assert lifecycle.steps["broken"]["error"] == "失敗"
+    assert "seconds" in lifecycle.steps["broken"]
+
+
+def test_connect_retries_with_backoff(run, monkeypatch):
+    attempts, delays = [], []
+
+    class _Repository:
+        name = "memory"
+
+    async def get_repository():
+        attempts.append(1)
+        if len(attempts) < 4:
+            raise ConnectionError("接続できません")
+        return _Repository()
+
+    async def sleep(delay):
+        delays.append(delay)
+
+    monkeypatch.setattr(lifecycle_module, "get_repository", get_repository)
+    monkeypatch.setattr(lifecycle_module.asyncio, "sleep", sleep)
+    monkeypatch.setattr(lifecycle_module, "CONNECT_RETRY_MAX", 3.0)
+
+    assert run(Lifecycle()._connect()) == "memory"
+    assert delays == [1.0, 2.0, 3.0]
+
+
+def test_warm_paths_reports_failing_paths(run, monkeypatch):
+    app = FastAPI()
+
+    @app.get("/ok")
+    async def ok():
+        return {}
+
+    @app.get("/broken")
+    async def broken():
+        raise HTTPException(status_code=500, detail="壊れています")
+
+    monkeypatch.setattr(config, "WARMUP_PATHS", ["/ok", "/missing"])
+    assert run(Lifecycle()._warm_paths(app)) == "2件"
+
+    monkeypatch.setattr(config, "WARMUP_PATHS", ["/ok", "/broken"])
+    with pytest.raises(RuntimeError, match="/broken \\(500\\)"):
+        run(Lifecycle()._warm_paths(app))
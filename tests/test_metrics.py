@@ -0,0 +1,83 @@
+"""計測とメトリクス（Prometheus のテキスト形式・ルートのラベル・上流への問い合わせの集計）"""
+
+import re
+import uuid
+
+from api.metrics import Counter, Histogram, RequestStats, _request_stats, track_query
+
+
+def _sample(text: str, name: str, **labels) -> float:
+    """出力から1つのサンプルの値を取り出す（ない場合は 0）"""
+    for line in text.splitlines():
+        if line.startswith(name + "{") and all(f'{key}="{value}"' in line for key, value in labels.items()):
+            return float(line.rsplit(" ", 1)[1])
+    return 0.0
+
+
+def test_histogram_buckets_are_cumulative():
+    histogram = Histogram("latency", "説明", ("route",), buckets=(0.1, 1.0))
+    for value in (0.05, 0.1, 0.5, 3.0):
+        histogram.observe(value, route="/a")
+
+    assert histogram.render().splitlines() == [
+        "# HELP latency 説明",
+        "# TYPE latency histogram",
+        'latency_bucket{route="/a",le="0.1"} 2',
+        'latency_bucket{route="/a",le="1"} 3',
+        'latency_bucket{route="/a",le="+Inf"} 4',
+        'latency_sum{route="/a"} 3.65',
+        'latency_count{route="/a"} 4',
+    ]
+
+
+def test_label_values_are_escaped():
+    counter = Counter("errors_total", "説明", ("exception",))
+    counter.inc(exception='a"b\\c\nd')
+
+    assert counter.render().splitlines()[-1] == 'errors_total{exception="a\\"b\\\\c\\nd"} 1'
+
+
+def test_queries_are_added_to_the_current_request():
+    stats = RequestStats()
+    token = _request_stats.set(stats)
+    try:
+        with track_query("postgres", "SELECT quotes", "SELECT 1") as timer:
+            timer.rows = 3
+        with track_query("postgres", "SELECT quotes", "SELECT 2"):
+            pass
+    finally:
+        _request_stats.reset(token)
+
+    assert (stats.queries, stats.rows) == (2, 3)
+    assert [statement for _, statement, _ in stats.statements] == ["SELECT 1", "SELECT 2"]
+
+
+def test_routes_are_labelled_by_template(run, client, upstream):
+    quote_id = next(iter(upstream.rows))
+    before = run(client.get("/metrics")).text
+
+    response = run(client.get(f"/quotes/{quote_id}"))
+    run(client.get("/no/such/path"))
+    after = run(client.get("/metrics")).text
+
+    assert re.match(r'upstream;dur=[\d.]+;desc="\d+ queries", app;dur=', response.headers["server-timing"])
+    labels = {"method": "GET", "route": "/quotes/{quote_id}", "status": "200"}
+    assert _sample(after, "http_requests_total", **labels) == _sample(before, "http_requests_total", **labels) + 1
+    assert _sample(after, "http_requests_total", route="<unmatched>", status="404") >= 1
+    assert quote_id not in after
+
+
+def test_server_errors_record_the_original_exception(run, client, upstream, monkeypatch):
+    from api import main
+
+    async def failing(quote_id):
+        raise RuntimeError("接続が切れました")
+
+    monkeypatch.setattr(main.corpus, "ready", False)
+    monkeypatch.setattr(upstream, "get_quote", failing)
+
+    response = run(client.get(f"/quotes/{uuid.uuid4()}"))
+    text = run(client.get("/metrics")).text
+
+    assert response.status_code == 500
+    assert _sample(text, "http_errors_total", route="/quotes/{quote_id}", exception="RuntimeError") >= 1
@@ -0,0 +1,161 @@
+"""キーセットページネーション（カーソル）とインメモリ・DBの経路の並び順の一致"""
+
+import pytest
+from fastapi import HTTPException
+
+from api.pagination import NEXT_CURSOR_HEADER, decode_cursor, encode_cursor, keyset_key, page_after, page_rows
+from api.repository import QuoteQuery
+from benchmark.data import generate_quotes
+from benchmark.standin import MemoryRepository
+
+PAGE_SIZE = 7
+
+
+def test_cursor_round_trip():
+    cursor = encode_cursor("theme", None, "abc")
+    assert decode_cursor(cursor, "theme") == (None, "abc")
+    assert decode_cursor(encode_cursor("title", "努力", "x"), "title") == ("努力", "x")
+
+
+@pytest.mark.parametrize("cursor, sort_by", [
+    ("not-base64!", "title"),
+    (encode_cursor("title", "a", "x"), "theme"),
+    (encode_cursor("title", "a", 1), "title"),
+])
+def test_invalid_cursor_is_rejected(cursor, sort_by):
+    with pytest.raises(HTTPException) as error:
+        decode_cursor(cursor, sort_by)
+    assert error.value.status_code == 400
+
+
+def test_cursor_from_another_collation_is_rejected_for_text_fields():
+    cursor = encode_cursor("title", "努力", "x", "database")
+
+    with pytest.raises(HTTPException) as error:
+        decode_cursor(cursor, "title")
+    assert error.value.status_code == 400
+    assert decode_cursor(cursor, "title", "database") == ("努力", "x")
+    # created_at の並びは照合順序によらない
+    assert decode_cursor(encode_cursor("created_at", "2024-01-01", "x", "database"), "created_at") == ("2024-01-01", "x")
+
+
+@pytest.mark.parametrize("reverse", [False, True])
+def test_page_after_matches_a_linear_scan(reverse):
+    rows = sorted(generate_quotes(80, seed=6), key=lambda row: keyset_key(row["theme"], row["id"]), reverse=reverse)
+    key = lambda row: keyset_key(row["theme"], row["id"])
+
+    for cursor_key in [key(row) for row in rows] + [keyset_key("", ""), keyset_key(None, "~")]:
+        expected = [row for row in rows if (key(row) < cursor_key if reverse else key(row) > cursor_key)]
+        assert page_after(rows, key, cursor_key, reverse) == expected
+
+
+def _memory_pages(rows, sort_by, desc):
+    """インメモリの経路（page_rows）で全ページをたどる"""
+    ids, cursor = [], None
+    while True:
+        page, cursor = page_rows(rows, sort_by, desc, PAGE_SIZE, 0, cursor)
+        ids.extend(row["id"] for row in page)
+        if cursor is None:
+            return ids
+
+
+def _db_pages(run, repository, sort_by, desc):
+    """DBの経路（スタンドインは ORDER BY sort_by, id と同じ並び・NULL の扱い）で全ページをたどる"""
+    ids, after = [], None
+    while True:
+        query = QuoteQuery(order_by=sort_by, desc=desc, limit=PAGE_SIZE, after=after)
+        page = run(repository.list_quotes(query))
+        ids.extend(row["id"] for row in page)
+        if len(page) < PAGE_SIZE:
+            return ids
+        after = (page[-1][sort_by], page[-1]["id"])
+
+
+@pytest.mark.parametrize("sort_by", ["theme", "title", "created_at"])
+@pytest.mark.parametrize("desc", [False, True])
+def test_memory_and_db_paging_agree(run, sort_by, desc):
+    rows = list(generate_quotes(120, seed=3))
+    assert any(row["theme"] is None for row in rows)
+    repository = MemoryRepository(rows)
+
+    memory_ids = _memory_pages(rows, sort_by, desc)
+
+    assert memory_ids == _db_pages(run, repository, sort_by, desc)
+    assert sorted(memory_ids) == sorted(row["id"] for row in rows)
+
+
+def test_theme_nulls_last_ascending_first_descending():
+    rows = list(generate_quotes(60, seed=4))
+    ascending, _ = page_rows(rows, "theme", False, len(rows), 0, None)
+    descending, _ = page_rows(rows, "theme", True, len(rows), 0, None)
+
+    nulls = sum(row["theme"] is None for row in rows)
+    assert all(row["theme"] is None for row in ascending[-nulls:])
+    assert all(row["theme"] is None for row in descending[:nulls])
+
+
+def test_cursor_from_memory_path_continues_on_db_path(run):
+    rows = list(generate_quotes(120, seed=5))
+    repository = MemoryRepository(rows)
+    everything = _db_pages(run, repository, "theme", False)
+
+    # NULL の区間の手前・途中をまたぐ位置まで進める
+    cursor, seen = None, []
+    for _ in range(len(rows) // PAGE_SIZE - 1):
+        page, cursor = page_rows(rows, "theme", False, PAGE_SIZE, 0, cursor)
+        seen.extend(row["id"] for row in page)
+    rest = run(repository.list_quotes(
+        QuoteQuery(order_by="theme", desc=False, limit=len(rows), after=decode_cursor(cursor, "theme"))
+    ))
+
+    assert seen + [row["id"] for row in rest] == everything
+
+
+def _tag_pages(run, client, params):
+    ids, cursor = [], None
+    while True:
+        response = run(client.get("/quotes/tags", params={**params, **({"cursor": cursor} if cursor else {})}))
+        assert response.status_code == 200
+        ids.extend(item["id"] for item in response.json())
+        cursor = response.headers.get(NEXT_CURSOR_HEADER)
+        if cursor is None:
+            return ids
+
+
+@pytest.mark.parametrize("sort_order", ["asc", "desc"])
+def test_tag_search_paging_matches_with_and_without_corpus(run, client, monkeypatch, sort_order):
+    from api.main import corpus
+
+    # NOT を含む式はタグのない引用も含めて全件に一致する
+    params = {"expr": "NOT 存在しないタグ", "sort_by": "theme", "sort_order": sort_order, "limit": 40}
+    from_corpus = _tag_pages(run, client, params)
+    monkeypatch.setattr(corpus, "ready", False)
+    from_db = _tag_pages(run, client, params)
+
+    assert from_corpus == from_db
+    assert len(from_corpus) == len(corpus.rows)
+
+
+def test_keyword_search_sorted_by_theme_puts_nulls_last(run, client):
+    from api.main import corpus
+
+    word = next(row["title"][-2:] for row in corpus.rows.values() if row["theme"] is None)
+    response = run(client.get("/quotes/search", params={"q": word, "sort_by": "theme", "sort_order": "asc", "limit": 100}))
+    themes = [item["theme"] for item in response.json()]
+
+    assert None in themes
+    assert themes == sorted(themes, key=lambda theme: (theme is None, theme or ""))
+
+
+def test_cursor_is_rejected_by_a_path_with_another_collation(run, client, upstream, monkeypatch):
+    from api.main import corpus
+
+    params = {"expr": "NOT 存在しないタグ", "sort_by": "title", "limit": 10}
+    cursor = run(client.get("/quotes/tags", params=params)).headers[NEXT_CURSOR_HEADER]
+    # DB の照合順序で並べる上流（PostgREST）に切り替わった場合
+    monkeypatch.setattr(corpus, "ready", False)
+    monkeypatch.setattr(upstream, "collation", "database")
+
+    response = run(client.get("/quotes/tags", params={**params, "cursor": cursor}))
+
+    assert response.status_code == 400
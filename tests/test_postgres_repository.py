@@ -0,0 +1,112 @@
+"""PostgreSQL 直結のリポジトリ（組み立てる SQL・エラーの変換・読み取りの共有）"""
+
+import asyncio
+
+import pytest
+
+from api.postgres_repository import PostgresRepository, _operation, _select_list, build_list_query
+from api.repository import DataError, QuoteQuery
+
+
+class _Error(Exception):
+    def __init__(self, sqlstate):
+        super().__init__(sqlstate)
+        self.sqlstate = sqlstate
+
+
+class _Pool:
+    """実行した文を記録し、決めておいた行を返す接続プールの代わり"""
+
+    def __init__(self, rows=(), error=None):
+        self.rows, self.error = list(rows), error
+        self.executed = []
+
+    async def fetch(self, sql, *args):
+        self.executed.append((sql, list(args)))
+        await asyncio.sleep(0)
+        if self.error is not None:
+            raise self.error
+        return self.rows
+
+
+def _repository(pool):
+    repository = PostgresRepository("postgresql://test")
+    repository.pool, repository._errors = pool, (_Error,)
+    return repository
+
+
+def test_filters_and_keyset_become_one_parameterized_statement():
+    sql, args = build_list_query(QuoteQuery(
+        select="id,title", theme="人生", tags=["夢"], date_from="2024-01-01",
+        order_by="theme", desc=False, limit=20, after=("人生", "abc"),
+    ))
+
+    assert sql == (
+        "SELECT q.id AS id, q.title AS title FROM quotes q"
+        " WHERE q.theme = $1 AND q.created_at >= $2 AND q.tags @> $3::text[]"
+        ' AND ((q.theme COLLATE "C", q.id) > ($4, $5) OR q.theme COLLATE "C" IS NULL)'
+        ' ORDER BY q.theme COLLATE "C" ASC, q.id ASC LIMIT $6'
+    )
+    assert args == ["人生", "2024-01-01", ["夢"], "人生", "abc", 20]
+
+
+def test_offset_keyword_and_id_order():
+    sql, args = build_list_query(QuoteQuery(
+        keyword="努力", keyword_fields=["title", "text"], keyword_mode="and", order_by="id", limit=5, offset=10,
+    ))
+
+    assert sql == (
+        "SELECT q.* FROM quotes q WHERE (q.title ILIKE $1 AND q.text ILIKE $1)"
+        " ORDER BY q.id DESC LIMIT $2 OFFSET $3"
+    )
+    assert args == ["%努力%", 5, 10]
+    # キーセット指定時は offset を使わない
+    sql, _ = build_list_query(QuoteQuery(order_by="id", limit=5, offset=10, after=(None, "abc")))
+    assert "q.id < $1" in sql and "OFFSET" not in sql
+
+
+def test_select_list_maps_computed_columns_and_rejects_unknown_names():
+    assert _select_list("id,text:text_preview") == "q.id AS id, text_preview(q) AS text"
+    for select in ("id,password", "id;drop:title"):
+        with pytest.raises(ValueError):
+            _select_list(select)
+
+
+def test_operation_labels():
+    assert _operation("SELECT q.* FROM quotes q WHERE q.id = $1") == "SELECT quotes"
+    assert _operation("INSERT INTO impressions (id) SELECT * FROM unnest($1::uuid[])") == "INSERT impressions"
+    assert _operation("WITH x AS (SELECT 1) SELECT 1") == "WITH"
+
+
+def test_rpc_unwraps_scalar_functions_and_passes_named_arguments(run):
+    pool = _Pool([{"quote_stats_reconcile": True}])
+
+    assert run(_repository(pool).rpc("quote_stats_reconcile", {})) is True
+    pool.rows = [{"id": "1"}, {"id": "2"}]
+    assert run(_repository(pool).rpc("random_quotes", {"p_count": 2, "p_theme": None})) == pool.rows
+    assert pool.executed[-1] == ("SELECT * FROM random_quotes(p_count => $1, p_theme => $2)", [2, None])
+    with pytest.raises(ValueError):
+        run(_repository(pool).rpc("random_quotes; drop", {}))
+
+
+def test_data_and_constraint_errors_become_data_errors(run):
+    with pytest.raises(DataError):
+        run(_repository(_Pool(error=_Error("23505"))).insert_quotes([{"title": "題", "text": "本文"}]))
+    with pytest.raises(DataError):
+        run(_repository(_Pool(error=_Error("22P02"))).delete_quote("not-a-uuid"))
+    # 接続断などはそのまま上げる
+    with pytest.raises(_Error):
+        run(_repository(_Pool(error=_Error("08006"))).delete_quote("abc"))
+
+
+def test_identical_concurrent_reads_share_one_query(run):
+    pool = _Pool([{"id": "abc"}])
+    repository = _repository(pool)
+
+    async def scenario():
+        return await asyncio.gather(*(repository.get_quote("abc") for _ in range(5)), repository.get_quote("def"))
+
+    results = run(scenario())
+
+    assert results[:5] == [{"id": "abc"}] * 5
+    assert [args for _, args in pool.executed] == [["abc"], ["def"]]
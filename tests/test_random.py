@@ -0,0 +1,94 @@
+"""ランダム引用と「今日の一句」（インメモリのプールと random_quotes の一致）"""
+
+from datetime import date
+
+import pytest
+
+from api.random_pool import RandomPool, daily_pivot
+from benchmark.data import generate_quotes
+from benchmark.standin import MemoryRepository
+
+DAYS = [date(2024, 1, 1), date(2024, 2, 29), date(2025, 12, 31)]
+
+
+@pytest.fixture(scope="module")
+def rows():
+    return list(generate_quotes(300, seed=1))
+
+
+@pytest.fixture
+def pool(rows):
+    pool = RandomPool()
+    pool.rebuild(rows)
+    return pool
+
+
+def test_pivot_depends_on_day_and_filters():
+    pivot = daily_pivot(DAYS[0], None, None, None)
+
+    assert 0 <= pivot < 1
+    assert daily_pivot(DAYS[0], None, None, None) == pivot
+    assert daily_pivot(DAYS[1], None, None, None) != pivot
+    assert daily_pivot(DAYS[0], "人生", None, None) != pivot
+
+
+def test_sample_is_distinct_and_filtered(pool, rows):
+    theme = rows[0]["theme"]
+    tag = next(tag for row in rows if row["theme"] == theme for tag in row["tags"] or [])
+
+    chosen = pool.sample(10, theme=theme, tag=tag)
+
+    expected = {row["id"] for row in rows if row["theme"] == theme and tag in (row["tags"] or [])}
+    assert len(chosen) == min(10, len(expected))
+    assert len({row["id"] for row in chosen}) == len(chosen)
+    assert {row["id"] for row in chosen} <= expected
+    assert len(pool.sample(1000)) == len(rows)
+    assert pool.sample(3, theme="存在しない") == []
+
+
+@pytest.mark.parametrize("day", DAYS)
+@pytest.mark.parametrize("filters", [(None, None, None), ("挑戦", None, None), (None, "夢", None), ("挑戦", "一歩", None)])
+def test_daily_matches_random_quotes_with_the_same_seed(pool, rows, day, filters):
+    theme, tag, author = filters
+    expected = MemoryRepository(rows)._rpc_random_quotes(
+        1, theme, tag, author, p_seed=daily_pivot(day, theme, tag, author)
+    )
+
+    chosen = pool.daily(day, theme, tag, author)
+
+    assert (chosen["id"] if chosen else None) == (expected[0]["id"] if expected else None)
+
+
+def test_daily_changes_after_the_chosen_quote_is_removed(pool):
+    chosen = pool.daily(DAYS[0])
+    pool.remove(chosen)
+
+    assert pool.daily(DAYS[0])["id"] != chosen["id"]
+    pool.upsert(chosen, None)
+    assert pool.daily(DAYS[0])["id"] == chosen["id"]
+
+
+def test_random_endpoint_uses_the_pool(run, client, upstream):
+    theme = next(row["theme"] for row in upstream.rows.values() if row["theme"])
+    calls = upstream.calls["rpc:random_quotes"]
+
+    single = run(client.get("/quotes/random", params={"theme": theme})).json()
+    several = run(client.get("/quotes/random", params={"theme": theme, "count": 5})).json()
+
+    assert single["theme"] == theme
+    assert all(quote["theme"] == theme for quote in several)
+    assert len({quote["id"] for quote in several}) == len(several)
+    assert upstream.calls["rpc:random_quotes"] == calls
+    assert run(client.get("/quotes/random", params={"theme": "存在しない"})).status_code == 404
+    assert run(client.get("/quotes/random", params={"count": 0})).status_code == 422
+
+
+def test_daily_endpoint_is_the_same_with_and_without_the_corpus(run, client, upstream, monkeypatch):
+    first = run(client.get("/quotes/daily"))
+    assert "max-age=" in first.headers["cache-control"]
+
+    from api import main
+    monkeypatch.setattr(main.corpus, "ready", False)
+    calls = upstream.calls["rpc:random_quotes"]
+    assert run(client.get("/quotes/daily")).json()["id"] == first.json()["id"]
+    assert upstream.calls["rpc:random_quotes"] == calls + 1
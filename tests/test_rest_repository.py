@@ -0,0 +1,98 @@
+"""Supabase（PostgREST）経由のリポジトリ（非同期の並行実行・同時実行数の制限・読み取りの集約）"""
+
+import asyncio
+from urllib.parse import parse_qsl, urlsplit
+
+import httpx
+import pytest
+from supabase import AsyncClientOptions, acreate_client
+
+from api import database
+from api.repository import DataError, QuoteQuery
+from api.rest_repository import RestRepository
+
+
+class _Upstream:
+    """受けたリクエストと同時に処理中の数を記録する PostgREST の代わり"""
+
+    def __init__(self, status=200, body=None):
+        self.status, self.body = status, body if body is not None else [{"id": "1"}]
+        self.requests = []
+        self.in_flight = self.max_in_flight = 0
+
+    async def __call__(self, request: httpx.Request) -> httpx.Response:
+        self.requests.append(request)
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            await asyncio.sleep(0.01)
+        finally:
+            self.in_flight -= 1
+        return httpx.Response(self.status, json=self.body)
+
+
+@pytest.fixture
+def rest(run):
+    clients = []
+
+    def make(upstream: _Upstream) -> RestRepository:
+        http = httpx.AsyncClient(transport=httpx.MockTransport(upstream))
+        clients.append(http)
+        options = AsyncClientOptions(httpx_client=http)
+        return RestRepository(run(acreate_client("http://upstream.test", "test", options=options)))
+
+    yield make
+    for http in clients:
+        run(http.aclose())
+
+
+def test_list_query_becomes_postgrest_parameters(run, rest):
+    upstream = _Upstream()
+
+    run(rest(upstream).list_quotes(QuoteQuery(
+        select="id,title", theme="人生", tags=["夢"], keyword="努力", keyword_fields=["title", "text"],
+        order_by="title", desc=False, limit=5, offset=10,
+    )))
+
+    (request,) = upstream.requests
+    assert urlsplit(str(request.url)).path == "/rest/v1/quotes"
+    assert parse_qsl(request.url.query.decode()) == [
+        ("select", "id,title"), ("theme", "eq.人生"), ("tags", "cs.{夢}"),
+        ("or", "(title.ilike.%努力%,text.ilike.%努力%)"), ("order", "title.asc,id.asc"),
+        ("offset", "10"), ("limit", "5"),
+    ]
+
+
+def test_reads_run_concurrently_up_to_the_limit(run, rest, monkeypatch):
+    upstream = _Upstream()
+    repository = rest(upstream)
+    monkeypatch.setattr(database, "_query_semaphore", asyncio.Semaphore(3))
+
+    async def scenario():
+        return await asyncio.gather(*(repository.get_quote(f"id-{i}") for i in range(8)))
+
+    assert run(scenario()) == [{"id": "1"}] * 8
+    assert len(upstream.requests) == 8
+    # イベントループを止めずに並行して待ち、同時に投げるのは SUPABASE_MAX_CONCURRENCY 本まで
+    assert upstream.max_in_flight == 3
+
+
+def test_identical_reads_share_one_request_but_writes_do_not(run, rest):
+    upstream = _Upstream()
+    repository = rest(upstream)
+
+    async def scenario():
+        await asyncio.gather(*(repository.get_quote("same") for _ in range(5)))
+        await asyncio.gather(*(repository.rpc("quote_stats_summary", {}, read=True) for _ in range(5)))
+        await asyncio.gather(*(repository.update_quote("same", {"title": "題"}) for _ in range(2)))
+
+    run(scenario())
+
+    assert [request.method for request in upstream.requests] == ["GET", "POST", "PATCH", "PATCH"]
+
+
+def test_rejected_inserts_become_data_errors(run, rest):
+    upstream = _Upstream(409, {"code": "23505", "message": "duplicate key value", "details": None, "hint": None})
+
+    with pytest.raises(DataError, match="duplicate key value"):
+        run(rest(upstream).insert_quotes([{"title": "題", "text": "本文"}]))
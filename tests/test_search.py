@@ -0,0 +1,92 @@
+"""全文検索インデックス（バイグラムの一致と BM25F の順位）"""
+
+import pytest
+
+from api.search import SearchIndex, normalize, tokenize
+
+FIELDS = ["title", "text", "theme", "subtheme", "author"]
+
+
+def _row(quote_id, title="", text="", theme=None, author=None):
+    return {"id": quote_id, "title": title, "text": text, "theme": theme, "subtheme": None, "author": author, "tags": None}
+
+
+@pytest.fixture
+def index():
+    index = SearchIndex()
+    index.rebuild([
+        _row("title", title="継続は力なり", text="毎日少しずつ"),
+        _row("text", title="ことば", text="継続することが大切だ"),
+        _row("twice", title="ことば", text="継続、継続、また継続"),
+        _row("long", title="ことば", text="継続" + "。とても長い本文が続く" * 20),
+        _row("author", title="名言", text="本文", author="継続 太郎"),
+        _row("other", title="努力", text="ＡＢＣ　全角の英字"),
+    ])
+    return index
+
+
+def _ids(results):
+    return [row["id"] for _, row in results]
+
+
+def test_tokenize_normalizes_width_and_case():
+    assert normalize("ＡＢＣ") == "abc"
+    assert tokenize("継続は 力") == ["継続", "続は", "力"]
+
+
+def test_title_match_outranks_body_match():
+    index = SearchIndex()
+    index.rebuild([
+        _row("in-title", title="継続の話", text="ほかの本文"),
+        _row("in-text", title="ほかの題", text="継続の話"),
+        _row("none", title="ほかの題", text="ほかの本文"),
+    ])
+
+    # 同じ長さ・出現回数なら、重みの大きいタイトルでの一致が上に来る
+    assert _ids(index.search("継続", FIELDS)) == ["in-title", "in-text"]
+
+
+def test_every_matching_field_is_searched(index):
+    assert set(_ids(index.search("継続", FIELDS))) == {"title", "text", "twice", "long", "author"}
+
+
+def test_term_frequency_and_length_normalization(index):
+    ranked = _ids(index.search("継続", ["text"]))
+
+    assert ranked.index("twice") < ranked.index("text") < ranked.index("long")
+
+
+def test_and_requires_every_term_and_field_mode(index):
+    assert _ids(index.search("継続 力", FIELDS)) == ["title"]
+    assert _ids(index.search("継続", ["title", "author"], search_type="and")) == []
+    assert set(_ids(index.search("継続", ["title", "author"], search_type="or"))) == {"title", "author"}
+
+
+def test_substring_must_be_contiguous(index):
+    # バイグラム「継続」「続大」はどちらも索引にあるが、「継続大」という並びはない
+    index.upsert(_row("split", title="継続 続大"), None)
+    assert _ids(index.search("継続大", ["title"])) == []
+
+
+def test_single_character_and_fullwidth_queries(index):
+    assert "title" in _ids(index.search("力", FIELDS))
+    assert _ids(index.search("abc", FIELDS)) == ["other"]
+
+
+def test_upsert_and_remove_update_results(index):
+    index.upsert(_row("title", title="努力は報われる"), _row("title", title="継続は力なり", text="毎日少しずつ"))
+    assert "title" not in _ids(index.search("継続", ["title"]))
+    index.remove(_row("author", title="名言", text="本文", author="継続 太郎"))
+    assert _ids(index.search("継続", ["author"])) == []
+    assert len(index) == 5
+
+
+def test_search_endpoint_ranks_with_the_corpus(run, client):
+    created = run(client.post("/quotes", json={"title": "検索順位の試験", "text": "本文", "author": "試験"})).json()
+    other = run(client.post("/quotes", json={"title": "別の題", "text": "検索順位の試験について書いた本文", "author": "試験"})).json()
+
+    results = run(client.get("/quotes/search", params={"q": "検索順位"})).json()
+
+    assert [item["id"] for item in results[:2]] == [created["id"], other["id"]]
+    for quote in (created, other):
+        run(client.delete(f"/quotes/{quote['id']}"))
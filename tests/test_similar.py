@@ -0,0 +1,145 @@
+"""類似引用のベクトルインデックス（書き込みのまとめてのベクトル化と検索）"""
+
+import asyncio
+import os
+import threading
+
+import pytest
+
+pytest.importorskip("sklearn")
+
+from api.similar import SimilarIndex  # noqa: E402
+from benchmark.data import generate_quotes  # noqa: E402
+
+
+class _CountingEncoder:
+    """ベクトル化の呼び出し回数・件数と、呼ばれたスレッドを記録する"""
+
+    def __init__(self, encoder):
+        self._encoder = encoder
+        self.backend = encoder.backend
+        self.calls = []
+        self.fits = 0
+
+    def fit(self, texts):
+        self.fits += 1
+        return self._encoder.fit(texts)
+
+    def encode(self, texts):
+        self.calls.append((len(texts), threading.current_thread() is threading.main_thread()))
+        return self._encoder.encode(texts)
+
+
+@pytest.fixture
+def index(monkeypatch):
+    from api import similar
+
+    encoders = []
+
+    def build_encoder():
+        encoder = _CountingEncoder(similar.TfidfEncoder(32))
+        encoders.append(encoder)
+        return encoder
+
+    monkeypatch.setattr(similar, "build_encoder", build_encoder)
+    index = SimilarIndex()
+    index.rows = list(generate_quotes(200, seed=11))
+    index.rebuild(index.rows)
+    index.encoder = encoders[0]
+    return index
+
+
+def _new_row(i: int) -> dict:
+    return {"id": f"new-{i}", "title": f"新しい引用{i}", "text": "努力は必ず報われる。継続は力なり。", "tags": None, "theme": None}
+
+
+def test_writes_are_encoded_in_one_batch_off_the_loop(run, index):
+    async def scenario():
+        for i in range(50):
+            index.upsert(_new_row(i), None)
+        await index.wait_pending()
+
+    run(scenario())
+
+    assert index.encoder.calls == [(50, False)]
+    assert all(index._state.vector(f"new-{i}") is not None for i in range(50))
+
+
+def test_writes_during_encoding_go_to_the_next_batch(run, index):
+    async def scenario():
+        index.upsert(_new_row(0), None)
+        await asyncio.sleep(0)
+        index.upsert(_new_row(1), None)
+        index.upsert(_new_row(2), None)
+        index.remove(_new_row(2))
+        await index.wait_pending()
+
+    run(scenario())
+
+    assert [count for count, _ in index.encoder.calls] == [1, 1]
+    assert index._state.vector("new-1") is not None
+    assert index._state.vector("new-2") is None
+
+
+def test_similar_to_waits_for_a_just_created_quote(run, index):
+    async def scenario():
+        index.upsert(_new_row(0), None)
+        index.upsert(_new_row(1), None)
+        return await index.similar_to("new-0", limit=3)
+
+    results = run(scenario())
+
+    assert results is not None
+    assert results[0][1]["id"] == "new-1"
+    assert results[0][0] > 0.9
+
+
+def test_text_query_is_encoded_off_the_loop(run, index):
+    results = run(index.similar_to_text("努力は必ず報われる", limit=5))
+
+    assert len(results) == 5
+    assert index.encoder.calls[-1] == (1, False)
+    scores = [score for score, _ in results]
+    assert scores == sorted(scores, reverse=True)
+
+
+def test_filters_and_unknown_quote(run, index):
+    theme = next(row["theme"] for row in index._state.rows.values() if row["theme"])
+    results = run(index.similar_to_text("人生", limit=5, theme=theme))
+
+    assert results and all(row["theme"] == theme for _, row in results)
+    assert run(index.similar_to("missing")) is None
+
+
+def test_reload_encodes_only_changed_rows_without_refitting(index):
+    rows = index.rows
+    index.rebuild(rows)
+    assert (index.encoder.fits, index.encoder.calls) == (1, [])
+
+    edited = [{**rows[0], "text": "まったく別の本文", "content_hash": None}, *rows[1:150], _new_row(0)]
+    index.rebuild(edited)
+
+    assert index.encoder.fits == 1
+    assert [count for count, _ in index.encoder.calls] == [2]
+    assert index._state.vector(rows[199]["id"]) is None
+    assert index._state.vector("new-0") is not None
+    # 次の再読み込みでは、前回反映した分はベクトル化し直さない
+    index.rebuild(edited)
+    assert [count for count, _ in index.encoder.calls] == [2]
+
+
+def test_reload_picks_up_a_replaced_prebuilt_index(tmp_path):
+    from api import similar
+
+    rows = list(generate_quotes(60, seed=12))
+    encoder = similar.TfidfEncoder(16)
+    similar.save_index(str(tmp_path), encoder, rows[:50], encoder.fit([similar.document(row) for row in rows[:50]]))
+    os.utime(tmp_path / similar.META_FILE, (0, 0))
+    index = SimilarIndex(str(tmp_path))
+    index.rebuild(rows)
+    assert len(index._state.ids) == 50 and len(index._state.extra) == 10
+
+    similar.save_index(str(tmp_path), encoder, rows, encoder.encode([similar.document(row) for row in rows]))
+    index.rebuild(rows)
+
+    assert len(index._state.ids) == 60 and index._state.extra == {}
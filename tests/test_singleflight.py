@@ -0,0 +1,114 @@
+"""同一クエリの合流（singleflight）と stale-while-revalidate"""
+
+import asyncio
+
+import pytest
+
+from api.singleflight import SingleFlight, StaleWhileRevalidate
+
+
+class _Loader:
+    """呼ばれた回数を数え、release されるまで待つ取得処理"""
+
+    def __init__(self):
+        self.calls = 0
+        self.release = asyncio.Event()
+        self.release.set()
+
+    async def __call__(self):
+        self.calls += 1
+        await self.release.wait()
+        return self.calls
+
+
+def test_concurrent_calls_share_one_execution(run):
+    flight, loader = SingleFlight(), _Loader()
+    loader.release.clear()
+
+    async def scenario():
+        calls = [asyncio.ensure_future(flight.do("key", loader)) for _ in range(4)]
+        await asyncio.sleep(0)
+        loader.release.set()
+        return await asyncio.gather(*calls)
+
+    assert run(scenario()) == [1, 1, 1, 1]
+    assert flight.shared == 3
+    assert not flight.in_flight("key")
+
+
+def test_failure_is_shared_and_not_remembered(run):
+    flight = SingleFlight()
+    attempts = []
+
+    async def failing():
+        attempts.append(1)
+        raise RuntimeError("upstream")
+
+    async def scenario():
+        results = await asyncio.gather(flight.do("key", failing), flight.do("key", failing), return_exceptions=True)
+        assert all(isinstance(result, RuntimeError) for result in results)
+        with pytest.raises(RuntimeError):
+            await flight.do("key", failing)
+
+    run(scenario())
+    assert len(attempts) == 2
+
+
+def test_stale_value_is_served_while_revalidating(run, monkeypatch):
+    swr, loader = StaleWhileRevalidate(SingleFlight(), ttl=10, stale_ttl=100), _Loader()
+    now = [1000.0]
+    monkeypatch.setattr("api.singleflight.time.monotonic", lambda: now[0])
+
+    async def scenario():
+        first = await swr.get("stats", loader)
+        now[0] += 50
+        stale = await swr.get("stats", loader)
+        await swr.drain()
+        fresh = await swr.get("stats", loader)
+        return first, stale, fresh
+
+    assert run(scenario()) == (1, 1, 2)
+    assert loader.calls == 2
+
+
+def test_mark_stale_triggers_background_reload(run):
+    swr, loader = StaleWhileRevalidate(SingleFlight(), ttl=60, stale_ttl=60), _Loader()
+
+    async def scenario():
+        await swr.get("stats", loader)
+        swr.mark_stale()
+        stale = await swr.get("stats", loader)
+        await swr.drain()
+        return stale, await swr.get("stats", loader)
+
+    assert run(scenario()) == (1, 2)
+
+
+def test_entries_are_bounded(run):
+    swr, loader = StaleWhileRevalidate(SingleFlight(), ttl=60, stale_ttl=60, max_entries=3), _Loader()
+
+    async def scenario():
+        for i in range(10):
+            await swr.get(f"theme={i}", loader)
+        # 最近使ったものは残る
+        await swr.get("theme=7", loader)
+        await swr.get("theme=10", loader)
+
+    run(scenario())
+    assert len(swr) == 3
+    assert set(swr._entries) == {"theme=9", "theme=7", "theme=10"}
+
+
+def test_expired_entries_are_dropped(run, monkeypatch):
+    swr, loader = StaleWhileRevalidate(SingleFlight(), ttl=1, stale_ttl=1), _Loader()
+    now = [1000.0]
+    monkeypatch.setattr("api.singleflight.time.monotonic", lambda: now[0])
+
+    async def scenario():
+        await swr.get("a", loader)
+        await swr.get("b", loader)
+        now[0] += 5
+        await swr.get("c", loader)
+
+    run(scenario())
+    assert list(swr._entries) == ["c"]
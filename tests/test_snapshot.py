@@ -0,0 +1,76 @@
+"""ワーカー間で共有するスナップショットの変更ログ（まとめての追記と取り込み）"""
+
+import threading
+
+import pytest
+
+from api import snapshot
+from api.corpus import CorpusMirror
+from api.snapshot import CHANGELOG_FILE, SharedSnapshot, _ChangelogTail
+from benchmark.data import generate_quotes
+from benchmark.standin import MemoryRepository
+
+
+@pytest.fixture
+def shared(tmp_path):
+    shared = SharedSnapshot()
+    shared.directory = str(tmp_path)
+    shared._pid = "100"
+    shared._tail = _ChangelogTail(shared._path(CHANGELOG_FILE))
+    return shared
+
+
+def test_changes_are_appended_in_one_write_off_the_loop(run, shared, monkeypatch):
+    writes = []
+    write = shared._write_changelog
+
+    def counting_write(data):
+        writes.append((data.count("\n"), threading.current_thread() is threading.main_thread()))
+        write(data)
+
+    monkeypatch.setattr(shared, "_write_changelog", counting_write)
+    rows = list(generate_quotes(100, seed=8))
+
+    async def scenario():
+        for row in rows:
+            shared.upsert(row, None)
+        shared.remove(rows[0])
+        await shared.stop()
+
+    run(scenario())
+
+    assert writes == [(101, False)]
+    with open(shared._path(CHANGELOG_FILE), encoding="utf-8") as f:
+        lines = f.read().splitlines()
+    assert lines == [f"100 {row['id']}" for row in rows] + [f"100 {rows[0]['id']}"]
+
+
+def test_other_workers_changes_are_fetched_in_chunks(run, shared, monkeypatch):
+    rows = list(generate_quotes(30, seed=9))
+    repository = MemoryRepository(rows[:25])
+    mirror = CorpusMirror()
+    mirror.rows = {row["id"]: dict(row, title="古い") for row in rows}
+    mirror.ready = True
+    mirror.add_listener(shared)
+
+    async def get_repository():
+        return repository
+
+    monkeypatch.setattr(snapshot, "corpus", mirror)
+    monkeypatch.setattr(snapshot, "get_repository", get_repository)
+    monkeypatch.setattr(snapshot, "FETCH_CHUNK_SIZE", 10)
+    shared._tail.start()
+    # 自分（pid 100）の変更は取り込まない。同じ引用の重複は1回だけ取り直す
+    with open(shared._path(CHANGELOG_FILE), "a", encoding="utf-8") as f:
+        f.write("".join(f"200 {row['id']}\n" for row in rows + rows[:5]))
+        f.write(f"100 {rows[0]['id']}\n")
+
+    run(shared._apply_changes())
+
+    assert repository.calls["get_quotes"] == 3
+    assert repository.calls["get_quote"] == 0
+    assert all(mirror.rows[row["id"]]["title"] == row["title"] for row in rows[:25])
+    # DBにない（削除された）引用はコーパスからも消す
+    assert all(row["id"] not in mirror.rows for row in rows[25:])
+    # 取り込んだ変更は自分の変更として書き戻さない
+    assert shared._unwritten == []
@@ -0,0 +1,74 @@
+"""/stats（DB側での集計・カウンタの読み出し・書き込み後の再取得）"""
+
+from collections import Counter
+
+from api.stats import reconcile_stats
+
+
+def _reads(upstream) -> Counter:
+    return Counter({name: count for name, count in upstream.calls.items() if not name.startswith("rpc:")})
+
+
+def test_filtered_stats_are_aggregated_by_quote_stats(run, client, upstream):
+    theme = next(row["theme"] for row in upstream.rows.values() if row["theme"])
+    calls = upstream.calls["rpc:quote_stats"]
+
+    stats = run(client.get("/stats", params={"theme": theme, "date_from": "2023-01-01"})).json()
+
+    expected = [row for row in upstream.rows.values() if row["theme"] == theme and row["created_at"] >= "2023-01-01"]
+    assert stats["total_quotes"] == len(expected)
+    assert stats["themes"] == {theme: len(expected)}
+    assert upstream.calls["rpc:quote_stats"] == calls + 1
+
+
+def test_identical_filtered_requests_share_one_aggregation(run, client, upstream):
+    params = {"author": next(row["author"] for row in upstream.rows.values() if row["author"])}
+    first = run(client.get("/stats", params=params)).json()
+    calls = upstream.calls["rpc:quote_stats"]
+
+    # STATS_TTL の間は同じ条件の集計を使い回す
+    assert run(client.get("/stats", params=params)).json() == first
+    assert upstream.calls["rpc:quote_stats"] == calls
+
+
+def test_summary_reads_the_counters_without_listing_quotes(run, client, upstream):
+    from api.main import stats_cache
+
+    stats_cache.mark_stale()
+    run(client.get("/stats"))
+    run(stats_cache.drain())
+    before = _reads(upstream)
+
+    stats = run(client.get("/stats")).json()
+
+    assert stats["total_quotes"] == len(upstream.rows)
+    assert stats["themes"] == dict(Counter(row["theme"] or "未分類" for row in upstream.rows.values()))
+    assert sum(stats["monthly_stats"].values()) == len(upstream.rows)
+    # 引用そのものは読まない
+    assert _reads(upstream) == before
+
+
+def test_write_marks_the_summary_stale(run, client, upstream):
+    from api.main import stats_cache
+
+    total = run(client.get("/stats")).json()["total_quotes"]
+    created = run(client.post("/quotes", json={"title": "統計", "text": "本文", "theme": "統計の試験"})).json()
+
+    # 書き込み直後は古い値を返しつつ裏で取り直す
+    assert run(client.get("/stats")).json()["total_quotes"] in (total, total + 1)
+    run(stats_cache.drain())
+    stats = run(client.get("/stats")).json()
+    assert stats["total_quotes"] == total + 1
+    assert stats["themes"]["統計の試験"] == 1
+
+    run(client.delete(f"/quotes/{created['id']}"))
+    run(client.get("/stats"))
+    run(stats_cache.drain())
+    assert "統計の試験" not in run(client.get("/stats")).json()["themes"]
+
+
+def test_reconcile_calls_the_database_function(run, client, upstream):
+    calls = upstream.calls["rpc:quote_stats_reconcile"]
+
+    assert run(reconcile_stats()) is True
+    assert upstream.calls["rpc:quote_stats_reconcile"] == calls + 1
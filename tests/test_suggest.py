@@ -0,0 +1,90 @@
+"""入力補完（正規化したキーでの前方一致と件数順）"""
+
+from collections import Counter
+
+import pytest
+from fastapi import HTTPException
+
+from api.suggest import SUGGEST_FIELDS, SuggestIndex, _FieldIndex, parse_suggest_fields, suggest_key
+from benchmark.data import generate_quotes
+
+
+def _row(quote_id, tags=None, theme=None, author=None, title=""):
+    return {"id": quote_id, "title": title, "text": "", "theme": theme, "subtheme": None, "author": author, "tags": tags}
+
+
+def _naive(counts: Counter, prefix: str, limit: int):
+    matches = sorted(
+        (-count, suggest_key(value), value) for value, count in counts.items() if suggest_key(value).startswith(prefix)
+    )
+    return [(value, -negative) for negative, _, value in matches[:limit]]
+
+
+def test_suggest_key_ignores_width_case_and_kana():
+    assert suggest_key("ＡＢＣ") == suggest_key("abc") == "abc"
+    assert suggest_key("カタカナ") == suggest_key("ｶﾀｶﾅ") == suggest_key("かたかな")
+    assert suggest_key("  ワーク 　ライフ ") == "わーく らいふ"
+    assert suggest_key(None) == ""
+
+
+def test_parse_suggest_fields():
+    assert parse_suggest_fields(None) == SUGGEST_FIELDS
+    assert parse_suggest_fields("author, tags,author") == ["author", "tags"]
+    for value in ("text", ","):
+        with pytest.raises(HTTPException) as raised:
+            parse_suggest_fields(value)
+        assert raised.value.status_code == 400
+
+
+@pytest.mark.parametrize("prefix", ["", "せ", "せい", "ど", "ゆめ", "存在しない"])
+@pytest.mark.parametrize("limit", [1, 3, 50])
+def test_lookup_matches_a_full_scan(prefix, limit):
+    # 一致する範囲が狭い場合と広い場合で別の方法を使うので、どちらも全件の走査と比べる
+    counts = Counter()
+    for row in generate_quotes(300, seed=1):
+        counts.update(row["tags"] or [])
+    counts.update({"セイコウ": 2, "せいかつ": 5, "ドリョク": 1})
+    index = _FieldIndex(Counter(counts))
+
+    assert index.lookup(prefix, limit) == _naive(counts, prefix, limit)
+
+
+def test_counts_follow_upserts_and_removals():
+    index = SuggestIndex()
+    index.rebuild([_row("1", tags=["夢", "夢中"]), _row("2", tags=["夢"]), _row("3", tags=["夢中"], author="夢野")])
+
+    assert index.suggest("夢", ["tags", "author"]) == [
+        {"field": "tags", "value": "夢", "count": 2},
+        {"field": "tags", "value": "夢中", "count": 2},
+        {"field": "author", "value": "夢野", "count": 1},
+    ]
+
+    index.upsert(_row("2", tags=["夢中"]), _row("2", tags=["夢"]))
+    assert index.suggest("夢", ["tags"], limit=1) == [{"field": "tags", "value": "夢中", "count": 3}]
+    index.remove(_row("3", tags=["夢中"], author="夢野"))
+    assert index.suggest("夢", ["author"]) == []
+    assert index.suggest("夢", ["tags"]) == [
+        {"field": "tags", "value": "夢中", "count": 2},
+        {"field": "tags", "value": "夢", "count": 1},
+    ]
+
+
+def test_katakana_prefix_finds_hiragana_values():
+    index = SuggestIndex()
+    index.rebuild([_row("1", theme="しごと"), _row("2", title="ＡＩの時代")])
+
+    assert index.suggest("シゴ", SUGGEST_FIELDS) == [{"field": "theme", "value": "しごと", "count": 1}]
+    assert index.suggest("ai", ["title"]) == [{"field": "title", "value": "ＡＩの時代", "count": 1}]
+
+
+def test_suggest_endpoint(run, client, upstream, monkeypatch):
+    tag, count = Counter(tag for row in upstream.rows.values() for tag in row["tags"] or []).most_common(1)[0]
+
+    response = run(client.get("/suggest", params={"q": tag, "fields": "tags", "limit": 5})).json()
+    assert response["q"] == tag
+    assert response["suggestions"][0] == {"field": "tags", "value": tag, "count": count}
+    assert run(client.get("/suggest", params={"fields": "text"})).status_code == 400
+
+    from api import main
+    monkeypatch.setattr(main.corpus, "ready", False)
+    assert run(client.get("/suggest", params={"q": tag})).status_code == 503
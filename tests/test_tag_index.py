@@ -0,0 +1,159 @@
+"""タグ式の解析とタグの転置インデックス（DB側の条件との一致）"""
+
+from types import SimpleNamespace
+
+import pytest
+
+from api.corpus import CorpusMirror
+from api.postgres_repository import _Params, _tag_condition
+from api.tag_index import (
+    TagIndex, matches_empty, parse_tag_expression, tags_expression, to_postgrest,
+)
+from api.snapshot import CorpusSnapshot, write_snapshot
+from benchmark.data import generate_quotes
+from benchmark.standin import _evaluate_tags
+
+A, B, C = ("tag", "努力"), ("tag", "成功"), ("tag", "失敗")
+
+
+@pytest.mark.parametrize("expr, expected", [
+    ("努力", A),
+    ("努力 成功", ("and", [A, B])),
+    ("努力 and 成功 OR 失敗", ("or", [("and", [A, B]), C])),
+    ("努力 & (成功 | 失敗)", ("and", [A, ("or", [B, C])])),
+    ("努力,成功", ("or", [A, B])),
+    ("NOT 努力 -成功 !失敗", ("and", [("not", A), ("not", B), ("not", C)])),
+    ('"ワーク ライフ" e-mail', ("and", [("tag", "ワーク ライフ"), ("tag", "e-mail")])),
+    ("not not 努力", ("not", ("not", A))),
+])
+def test_parse_tag_expression(expr, expected):
+    assert parse_tag_expression(expr) == expected
+
+
+@pytest.mark.parametrize("expr, message", [
+    ("", "空です"),
+    ("   ", "空です"),
+    ("(努力 OR 成功", "閉じられていません"),
+    ('"努力', "引用符"),
+    ("努力 AND", "途中で終わっています"),
+    ("努力 )", "解析に失敗しました"),
+    ("OR 努力", "解析に失敗しました"),
+    ('""', "空のタグ"),
+])
+def test_invalid_expressions_are_rejected(expr, message):
+    with pytest.raises(ValueError, match=message):
+        parse_tag_expression(expr)
+
+
+def test_invalid_expression_is_a_400(run, client):
+    response = run(client.get("/quotes/tags", params={"expr": "(努力"}))
+    assert response.status_code == 400
+    assert "閉じられていません" in response.json()["detail"]
+
+
+def test_matches_empty_and_postgrest_filters():
+    assert not matches_empty(A)
+    assert matches_empty(("not", A))
+    assert not matches_empty(("and", [("not", A), B]))
+    assert matches_empty(("or", [("not", A), B]))
+
+    assert to_postgrest(("and", [A, B])) == 'tags.cs.{"努力","成功"}'
+    assert to_postgrest(("or", [A, ("not", B)])) == 'or(tags.cs.{"努力"},tags.not.cs.{"成功"})'
+    assert to_postgrest(("not", ("or", [A, B]))) == 'tags.not.ov.{"努力","成功"}'
+
+
+def test_sql_condition_uses_array_operators():
+    p = _Params()
+    condition = _tag_condition(("and", [("or", [A, B]), ("not", C)]), p)
+    assert condition == "(q.tags && $1::text[] AND NOT (q.tags @> $2::text[]))"
+    assert p.values == [["努力", "成功"], ["失敗"]]
+
+
+@pytest.mark.parametrize("expr", [
+    "人生", "人生 仕事", "人生,仕事", "努力 AND (成功 OR 継続) AND NOT 失敗",
+    "NOT 人生", "-人生 -仕事", "NOT (人生 OR 夢)", "存在しない", "存在しない, 今日",
+])
+def test_index_matches_row_by_row_evaluation(expr):
+    rows = list(generate_quotes(300, seed=1))
+    index = TagIndex()
+    index.rebuild(rows)
+    node = parse_tag_expression(expr)
+
+    expected = {
+        row["id"] for row in rows
+        if (_evaluate_tags(node, set(row["tags"])) if row["tags"] else matches_empty(node))
+    }
+
+    assert index.evaluate(node) == expected
+
+
+def _snapshot_index(rows, tmp_path):
+    """共有スナップショットで評価するインデックス（行の中身は rows を読み込んだコーパスから引く）"""
+    path = str(tmp_path / "snapshot")
+    write_snapshot(path, rows, 1)
+    mirror = CorpusMirror()
+    mirror.rows = {row["id"]: row for row in rows}
+    mirror.ready = True
+    index = TagIndex()
+    index.use_snapshot(SimpleNamespace(current=CorpusSnapshot(path), attached=True), mirror)
+    return index, mirror
+
+
+@pytest.mark.parametrize("expr", [
+    "人生", "人生,仕事", "努力 AND (成功 OR 継続) AND NOT 失敗", "NOT 人生", "-人生 -仕事", "存在しない",
+])
+def test_snapshot_index_matches_the_in_memory_index(expr, tmp_path):
+    rows = list(generate_quotes(300, seed=1))
+    memory = TagIndex()
+    memory.rebuild(rows)
+    shared, _ = _snapshot_index(rows, tmp_path)
+    node = parse_tag_expression(expr)
+
+    assert shared.evaluate(node) == memory.evaluate(node)
+    assert sorted(row["id"] for row in shared.rows(shared.evaluate(node))) == sorted(memory.evaluate(node))
+    assert shared.cooccurrence("人生", 10) == memory.cooccurrence("人生", 10)
+
+
+def test_snapshot_index_checks_the_current_rows(tmp_path):
+    rows = list(generate_quotes(50, seed=2))
+    index, mirror = _snapshot_index(rows, tmp_path)
+    tagged = [row for row in rows if row["tags"]]
+    removed, retagged = tagged[0], tagged[1]
+    tag = retagged["tags"][0]
+
+    # スナップショットの公開前に消えた行・タグが変わった行は返さない
+    del mirror.rows[removed["id"]]
+    mirror.rows[retagged["id"]] = {**retagged, "tags": ["新しいタグ"]}
+
+    assert removed["id"] not in index.evaluate(("tag", removed["tags"][0]))
+    assert retagged["id"] not in index.evaluate(("tag", tag))
+
+
+def test_index_follows_upserts_and_removals():
+    rows = list(generate_quotes(20, seed=2))
+    index = TagIndex()
+    index.rebuild(rows)
+    row = rows[0]
+
+    index.upsert({**row, "tags": ["新しいタグ"]}, row)
+    assert index.evaluate(("tag", "新しいタグ")) == {row["id"]}
+    assert all(row["id"] not in index.evaluate(("tag", tag)) for tag in row["tags"] or [])
+
+    index.remove({**row, "tags": ["新しいタグ"]})
+    assert index.evaluate(("tag", "新しいタグ")) == set()
+    assert row["id"] not in index.evaluate(("not", ("tag", "新しいタグ")))
+
+
+def test_or_matching_returns_quotes_with_any_tag(run, client, upstream):
+    def ids(params):
+        return {item["id"] for item in run(client.get("/quotes/tags", params={**params, "limit": 100})).json()}
+
+    either = ids({"tags": "夢,希望"})
+    both = ids({"tags": "夢,希望", "match_all": "true"})
+
+    assert either == {
+        row["id"] for row in upstream.rows.values() if {"夢", "希望"} & set(row["tags"] or [])
+    }
+    assert both <= either
+    assert ids({"expr": "夢 OR 希望"}) == either
+    assert tags_expression(["夢", "希望"], False) == ("or", [("tag", "夢"), ("tag", "希望")])